@@ -170,6 +170,7 @@ class analysis_base(parameter_manager):
         self.__data_list = []
         self.parameters = []  # Inherited from parent class parameter_data
         self.data_names = []
+        self.deferred_data_names = []  # Outputs that can be written when the analysis is saved, see add_deferred_parameter
         self.run_info = run_info_dict()
         self.omsi_analysis_storage = []
         self._analysis_instances[weakref.ref(self)] = None  # Register the object with analysis_base._analysis_instance
@@ -411,14 +412,21 @@ class analysis_base(parameter_manager):
 
         :param analysis_output: The output of the execute_analysis(...) function to be recorded
         """
+        # Deferred outputs are not recorded but written when the analysis is saved. Also remove
+        # any outputs recorded by a previous execution that was not deferred.
+        deferred_data_names = self.get_deferred_data_names()
+        self.__data_list = [ana_data for ana_data in self.__data_list if ana_data['name'] not in deferred_data_names]
         # Record the analysis output so that we can save it to file
         if analysis_output is not None:
             if len(self.data_names) == 1:   # We need this case, because analysis_output is not a tuple we can slice
-                log_helper.debug(__name__, "Recording output " + str(self.data_names[0]),
-                                 root=self.mpi_root, comm=self.mpi_comm)
-                self[self.data_names[0]] = analysis_output
+                if self.data_names[0] not in deferred_data_names:
+                    log_helper.debug(__name__, "Recording output " + str(self.data_names[0]),
+                                     root=self.mpi_root, comm=self.mpi_comm)
+                    self[self.data_names[0]] = analysis_output
             else:
                 for data_index, data_name in enumerate(self.data_names):
+                    if data_name in deferred_data_names:
+                        continue
                     log_helper.debug(__name__, "Recording output " + str(data_name),
                                      root=self.mpi_root, comm=self.mpi_comm)
                     self[data_name] = analysis_output[data_index]
@@ -1394,16 +1402,61 @@ class analysis_base(parameter_manager):
         This function is used to write the actual analysis data to file. If not implemented, then the
         omsi_file_analysis API's default behavior is used instead.
 
+        The default implementation writes the deferred outputs using write_deferred_analysis_data
+        (if the analysis is deferred, see add_deferred_parameter) followed by all recorded outputs.
+
         :param analysis_group: The h5py.Group object where the analysis is stored. May be None on cores that
             do not perform any writing but which need to participate in communication, e.g., to collect data
             for writing.
 
         """
-        # The default implementation does roughly the following
-        # from omsi.dataformat.omsi_file.analysis import omsi_file_analysis
-        # for ana_data in self..get_all_analysis_data():
+        # Without deferred outputs the omsi_file_analysis API does roughly the following
+        # for ana_data in self.get_all_analysis_data():
         #        omsi_file_analysis.__write_omsi_analysis_data__(analysis_group, ana_data)
-        raise NotImplementedError
+        if analysis_group is None or len(self.get_deferred_data_names()) == 0:
+            raise NotImplementedError
+        from omsi.dataformat.omsi_file.analysis import omsi_file_analysis
+        self.write_deferred_analysis_data(analysis_group)
+        for ana_data in self.get_all_analysis_data():
+            omsi_file_analysis.__write_omsi_analysis_data__(analysis_group, ana_data)
+
+    def add_deferred_parameter(self, default=False):
+        """
+        Add the 'deferred' parameter for analyses whose outputs listed in self.deferred_data_names can be
+        computed block-by-block directly into the analysis group when the analysis is saved, rather than in
+        memory when the analysis is executed. If the analysis is deferred, then these outputs are not recorded
+        by record_execute_analysis_outputs and write_deferred_analysis_data is used to write them.
+
+        :param default: Boolean indicating whether the outputs are deferred by default
+        """
+        self.add_parameter(name='deferred',
+                           help='Do not compute the ' + ', '.join(self.deferred_data_names) + ' output(s) ' +
+                                'when the analysis is executed. Instead the output(s) are computed ' +
+                                'block-by-block and written directly to the analysis group when the ' +
+                                'analysis is saved to file.',
+                           dtype=self.get_default_dtypes()['bool'],
+                           required=False,
+                           default=default,
+                           group=self.get_default_parameter_groups()['settings'])
+
+    def get_deferred_data_names(self):
+        """
+        Get the names of the outputs that are written only when the analysis is saved, see add_deferred_parameter.
+
+        :returns: List of strings with the names of the deferred outputs. Empty if the analysis is not deferred.
+        """
+        if len(self.deferred_data_names) > 0 and self['deferred']:
+            return self.deferred_data_names
+        return []
+
+    def write_deferred_analysis_data(self, analysis_group):
+        """
+        Implement this function to compute and write the deferred outputs block-by-block directly
+        to the given analysis group, see add_deferred_parameter.
+
+        :param analysis_group: The h5py.Group object where the analysis is stored.
+        """
+        raise NotImplementedError("Implement write_deferred_analysis_data in order to defer outputs.")
 
     def add_custom_data_to_omsi_file(self, analysis_group):
         """
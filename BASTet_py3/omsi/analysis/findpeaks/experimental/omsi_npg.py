@@ -1,10 +1,12 @@
 from time import time, ctime
 import sys
+import heapq
 from sys import exit
 
 import numpy as np
 
 from omsi.analysis.base import analysis_base
+from omsi.analysis.findpeaks.omsi_findpeaks_local import peak_arrayindex_to_indptr
 from omsi.dataformat.omsi_file.main_file import omsi_file
 
 
@@ -37,6 +39,7 @@ class omsi_npg(analysis_base):
         """Initalize the basic data members"""
         super(omsi_npg, self).__init__()
         self.analysis_identifier = name_key
+        self.peaksIndptr = None
         self.data_names = ['npg_labels_medianmz', 'npg_labels_list', 'npg_peaks_labels', 'npghc_tc_labels',
                            'npghc_labels_list', 'npghc_peaks_labels']
         # self.parameters = ['peaksBins', 'npg_peaks_Intensities', 'npg_peaks_ArrayIndex', 'peaksMZdata', 'peaksMZ',
@@ -232,6 +235,7 @@ class omsi_npg(analysis_base):
             self['npg_split_max'] = 1000
 
         #Copy parameters to local variables for convenience
+        self.peaksIndptr = None
         peaksBins = self['peaksBins']
         peaksIntensities = self['npg_peaks_Intensities']
         peaksArrayIndex = self['npg_peaks_ArrayIndex']
@@ -708,83 +712,85 @@ class omsi_npg(analysis_base):
 
         return spec
 
-    # custom hierarchical clustering
+    # custom hierarchical clustering of the label m/z values
+    # repeatedly merges the two nearest neighboring values (replacing them by their median)
+    # until the smallest distance between neighbors reaches TreeCut. Since the values are
+    # sorted, every cluster is a contiguous run of the unique values and only the gaps
+    # between neighboring clusters can change. We therefore keep the gaps in a heap with
+    # lazy invalidation and the clusters in a doubly linked list, which makes each merge
+    # O(log n) instead of the O(n) array deletes and relabeling of a naive implementation.
+    # ties are resolved towards the leftmost gap, as with argmin.
     def myHC(self, labelsMMz, TreeCut):
         thelist, inverse_idxs = np.unique(labelsMMz, return_inverse=True)
-        lbls = np.arange(1, len(thelist) + 1)
-
-        ltmz = np.copy(thelist)
-        ltid = np.copy(lbls)
+        numValues = len(thelist)
+
+        # current value of each cluster, stored at the index of its leftmost element
+        values = np.copy(thelist)
+        # neighboring clusters (numValues and -1 are used as end markers)
+        nextIdx = list(range(1, numValues + 1))
+        prevIdx = list(range(-1, numValues - 1))
+        alive = [True] * numValues
+        # version of the current gap to the right of each cluster, used to invalidate heap entries
+        gapVersion = [0] * numValues
+        # mergedLeft[i] is True if value i was merged with the cluster to its left
+        mergedLeft = np.zeros(numValues, dtype=bool)
 
         dif = np.diff(thelist)
+        gapHeap = list(zip(dif.tolist(), range(numValues - 1), [0] * (numValues - 1)))
+        heapq.heapify(gapHeap)
 
-        print("NPG Amount : ", len(thelist))
+        print("NPG Amount : ", numValues)
 
         percentcheck = None
         totalcounter = 0
-        totallen = len(thelist)
         timekeep1 = time()
-        while (len(thelist) > 1):
+        while gapHeap:
+            gap, left, version = heapq.heappop(gapHeap)
+            # skip gaps that have been changed or removed by previous merges
+            if not alive[left] or version != gapVersion[left]:
+                continue
 
             # -- counter + --
-            percent = int(100. * float(totalcounter) / float(totallen))
+            percent = int(100. * float(totalcounter) / float(numValues))
             timer = int(time() - timekeep1)
             if (percent != percentcheck):
-                print("[", percent, "% - dif.min:", round(dif.min(), 4), "len:", len(thelist), "\t-", timer, "s ]\r", end=' ')
+                print("[", percent, "% - dif.min:", round(gap, 4), "len:", numValues - totalcounter, "\t-", timer, "s ]\r", end=' ')
                 sys.stdout.flush()
                 percentcheck = percent
             totalcounter += 1
             # -- counter - --
 
             # stop if treecut is reached
-            if (dif.min() >= TreeCut):
+            if (gap >= TreeCut):
                 break
 
-            mpos = dif.argmin()
-            thelistL = thelist[mpos]
-            thelistR = thelist[mpos + 1]
-
             # replace the 2 nearest with median of them
-            mymedian = np.median([thelistL, thelistR])
-            thelist[mpos] = mymedian
-            thelist = np.delete(thelist, mpos + 1)
+            right = nextIdx[left]
+            values[left] = (values[left] + values[right]) / 2
+            alive[right] = False
+            mergedLeft[right] = True
+            nextIdx[left] = nextIdx[right]
+            if nextIdx[left] < numValues:
+                prevIdx[nextIdx[left]] = left
 
-            # update dif
-            dif = np.delete(dif, mpos)
             # update dif left
-            if (mpos != 0):
-                dif[mpos - 1] = thelist[mpos] - thelist[mpos - 1]
+            leftNeighbor = prevIdx[left]
+            if (leftNeighbor >= 0):
+                gapVersion[leftNeighbor] += 1
+                heapq.heappush(gapHeap, (float(values[left] - values[leftNeighbor]), leftNeighbor,
+                                         gapVersion[leftNeighbor]))
             # update dif right
-            if (mpos != len(dif)):
-                dif[mpos] = thelist[mpos + 1] - thelist[mpos]
-
-            lblsL = lbls[mpos]
-            lblsR = lbls[mpos + 1]
-
-            mmin = min(lbls[mpos], lbls[mpos + 1])
-            mmax = max(lbls[mpos], lbls[mpos + 1])
-
-            # re-label left position as lower label
-            lbls[mpos] = mmin
-            # mark previous higher labels as lower labels
-            idxs = np.where(lbls == mmax)[0]
-            lbls[idxs] = mmin
-            # remove the higher label
-            lbls = np.delete(lbls, mpos + 1)
-
-            idxs = np.where(ltid == mmax)[0]
-            ltid[idxs] = mmin
+            gapVersion[left] += 1
+            if (nextIdx[left] < numValues):
+                heapq.heappush(gapHeap, (float(values[nextIdx[left]] - values[left]), left, gapVersion[left]))
 
         # ---- end of while
 
         # --- labeling ---
-        peaksLabels = ltid[inverse_idxs]
-        UniqueLabels = np.unique(peaksLabels)
-
-        ClusterRange = np.arange(1, len(UniqueLabels) + 1)
-        LabelsRange = np.arange(0, peaksLabels.max() + 1)
-        LabelsRange[UniqueLabels] = ClusterRange
-        result = LabelsRange[peaksLabels]
+        # clusters are contiguous runs of the sorted values so they are numbered
+        # 1..N from left to right by counting the values that start a new cluster
+        ltid = np.cumsum(~mergedLeft)
+        result = ltid[inverse_idxs]
 
         return result
 
@@ -854,107 +860,57 @@ class omsi_npg(analysis_base):
         nearestPeakIndex = (np.abs(myPeaksArray - myPeak)).argmin()
         return nearestPeakIndex
 
-    # binary search
-    # returns the peaks of a coordinate (x,y) from peaksArrayIndex
-    def getCoordPeaksB(self, xCoord, yCoord):
+    # returns the CSR row pointer of the peaks, i.e., the peaks of the i-th pixel of
+    # peaksArrayIndex are stored in [indptr[i], indptr[i+1]). The pointer is computed
+    # once from peaksArrayIndex so that we do not need to read peaksArrayIndex for
+    # every pixel and only slice the peaks we actually need
+    def getPeaksIndptr(self):
+        if self.peaksIndptr is None:
+            self.peaksIndptr = peak_arrayindex_to_indptr(self['npg_peaks_ArrayIndex'][:],
+                                                         self['peaksMZ'].shape[0])
+        return self.peaksIndptr
+
+    # returns the start and end index of the peaks of a coordinate (x,y)
+    # or None in case of an invalid coordinate
+    def getCoordRangeB(self, xCoord, yCoord):
         peaksArrayIndex = self['npg_peaks_ArrayIndex']
-        peaksMZ = self['peaksMZ']
 
         pAILast = peaksArrayIndex.shape[0] - 1
         pAImaxX = peaksArrayIndex[pAILast][0]
         pAImaxY = peaksArrayIndex[pAILast][1]
 
-        pStart = 0
-        pEnd = 1
-
         # check its a valid coordinate
         if (xCoord < 0 or xCoord > pAImaxX or yCoord < 0 or yCoord > pAImaxY):
             print("Error: Invalid Coordinate")
-            return 0
-
-        else:
-            # if its the last coord
-            if (xCoord == pAImaxX and yCoord == pAImaxY):
-                pStart = peaksArrayIndex[pAILast][2]
-                pEnd = peaksMZ.shape[0]
+            return None
 
-            # if its not last coord
-            else:
-                pAIXLeftIdx = np.searchsorted(peaksArrayIndex[:, 0], xCoord)
-                pAIindex = pAIXLeftIdx + yCoord
-                pStart = peaksArrayIndex[pAIindex][2]
-                pEnd = peaksArrayIndex[pAIindex + 1][2]
+        indptr = self.getPeaksIndptr()
+        pAIindex = xCoord * (pAImaxY + 1) + yCoord
+        return indptr[pAIindex], indptr[pAIindex + 1]
 
-            return peaksMZ[pStart:pEnd]
+    # returns the peaks of a coordinate (x,y) from peaksArrayIndex
+    def getCoordPeaksB(self, xCoord, yCoord):
+        pRange = self.getCoordRangeB(xCoord, yCoord)
+        if pRange is None:
+            return 0
+        return self['peaksMZ'][pRange[0]:pRange[1]]
 
-    # binary search
     # returns the peak index of a coordinate (x,y) from peaksArrayIndex
     def getCoordIdxB(self, xCoord, yCoord):
-        peaksArrayIndex = self['npg_peaks_ArrayIndex']
-        peaksMZ = self['peaksMZ']
-
-        pAILast = peaksArrayIndex.shape[0] - 1
-        pAImaxX = peaksArrayIndex[pAILast][0]
-        pAImaxY = peaksArrayIndex[pAILast][1]
-
-        pStart = 0
-        pEnd = 1
-
-        # check its a valid coordinate
-        if (xCoord < 0 or xCoord > pAImaxX or yCoord < 0 or yCoord > pAImaxY):
-            print("Error: Invalid Coordinate")
+        pRange = self.getCoordRangeB(xCoord, yCoord)
+        if pRange is None:
             return 0
+        return pRange[0]
 
-        else:
-            # if its the last coord
-            if (xCoord == pAImaxX and yCoord == pAImaxY):
-                pStart = peaksArrayIndex[pAILast][2]
-                pEnd = peaksMZ.shape[0]
-
-            # if its not last coord
-            else:
-                pAIXLeftIdx = np.searchsorted(peaksArrayIndex[:, 0], xCoord)
-                pAIindex = pAIXLeftIdx + yCoord
-                pStart = peaksArrayIndex[pAIindex][2]
-
-            return pStart
-
-    # binary search
     # 1. rPeaks = returns the peaks of a coordinate (x,y) from peaksArrayIndex
     # 2. rLabels = returns the labels of the rPeaks
     def getCoordInfoB(self, xCoord, yCoord, peaksLabels):
-        peaksArrayIndex = self['npg_peaks_ArrayIndex']
-        peaksMZ = self['peaksMZ']
-
-        pAILast = peaksArrayIndex.shape[0] - 1
-        pAImaxX = peaksArrayIndex[pAILast][0]
-        pAImaxY = peaksArrayIndex[pAILast][1]
-
-        pStart = 0
-        pEnd = 1
-
-        # check its a valid coordinate
-        if (xCoord < 0 or xCoord > pAImaxX or yCoord < 0 or yCoord > pAImaxY):
-            print("Error: Invalid Coordinate")
+        pRange = self.getCoordRangeB(xCoord, yCoord)
+        if pRange is None:
             return 0
-
-        else:
-            # if its the last coord
-            if (xCoord == pAImaxX and yCoord == pAImaxY):
-                pStart = peaksArrayIndex[pAILast][2]
-                pEnd = peaksMZ.shape[0]
-
-            # if its not last coord
-            else:
-                pAIXLeftIdx = np.searchsorted(peaksArrayIndex[:, 0], xCoord)
-                pAIindex = pAIXLeftIdx + yCoord
-                pStart = peaksArrayIndex[pAIindex][2]
-                pEnd = peaksArrayIndex[pAIindex + 1][2]
-
-            rPeaks = peaksMZ[pStart:pEnd]
-            rLabels = peaksLabels[pStart:pEnd]
-
-            return rPeaks, rLabels
+        rPeaks = self['peaksMZ'][pRange[0]:pRange[1]]
+        rLabels = peaksLabels[pRange[0]:pRange[1]]
+        return rPeaks, rLabels
 
     # pixelMap assigns a flag to each pixel where:
     # 0 = initialized value
@@ -964,49 +920,14 @@ class omsi_npg(analysis_base):
     # this allows us to skip pixels with no peaks both
     # when checking a pixel itself and its neighbors
     def getPixelMap(self, Nx, Ny):
-        peaksArrayIndex = self['npg_peaks_ArrayIndex']
-        peaksMZ = self['peaksMZ']
-
-        pixelMap = np.zeros((Nx, Ny))
-
-        pAILast = peaksArrayIndex.shape[0] - 1
-        pAImaxX = peaksArrayIndex[pAILast][0]
-        pAImaxY = peaksArrayIndex[pAILast][1]
-
-        pStart = 0
-        pEnd = 0
-        pAIindex = 0
-
-        for x in range(Nx):
-            for y in range(Ny):
-                # pStart is the index location of
-                # current pixel's peaks values
-                pStart = peaksArrayIndex[pAIindex][2]
-
-                # pEnd is the index location of next pixel's values
-                # if current pixel its the last element of peaksArrayIndex
-                # we set pEnd peaksMZ size to prevent out of bounds
-                if (x == pAImaxX and y == pAImaxY):
-                    pEnd = peaksMZ.shape[0]
-                else:
-                    pEnd = peaksArrayIndex[pAIindex + 1][2]
-
-                # Compare pStart and pEnd to obtain the
-                # ammount of peaks in current pixel and
-                # set the appropiate value to pixelMap
-                if (pEnd > pStart):
-                    # some peaks in current pixel
-                    pixelMap[x, y] = 1
-                elif (pEnd == pStart):
-                    # no peaks in current pixel
-                    pixelMap[x, y] = 2
-                else:
-                    # error
-                    pixelMap[x, y] = 3
-
-                pAIindex += 1
-
-        return pixelMap
+        # the number of peaks of each pixel is the difference of
+        # consecutive start indices of the peaks
+        pixelPeaks = np.diff(self.getPeaksIndptr()[:(Nx * Ny + 1)])
+        pixelMap = np.zeros(Nx * Ny)
+        pixelMap[pixelPeaks > 0] = 1
+        pixelMap[pixelPeaks == 0] = 2
+        pixelMap[pixelPeaks < 0] = 3
+        return pixelMap.reshape((Nx, Ny))
 
     # union find
     # http://code.activestate.com/recipes/577225-union-find/
@@ -4,6 +4,7 @@ import sys
 import numpy as np
 
 from omsi.analysis.base import analysis_base
+from omsi.analysis.findpeaks.omsi_findpeaks_local import peak_arrayindex_to_indptr
 from omsi.dataformat.omsi_file.main_file import omsi_file
 
 
@@ -17,7 +18,7 @@ class omsi_peakcube(analysis_base):
         #                   'HCLabelsList']
         dtypes = self.get_default_dtypes()
         groups = self.get_default_parameter_groups()
-        self.add_parameter(name='peakBins',
+        self.add_parameter(name='peaksBins',
                            help='',
                            dtype=dtypes['ndarray'],
                            group=groups['input'],
@@ -47,6 +48,16 @@ class omsi_peakcube(analysis_base):
                            dtype=dtypes['ndarray'],
                            group=groups['input'],
                            required=True)
+        self.add_parameter(name='peak_cube_dtype',
+                           help='The data type used to store the peak cube',
+                           dtype=str,
+                           default='float64',
+                           choices=['float64', 'float32'],
+                           group=groups['settings'],
+                           required=False)
+        self.deferred_data_names = ['npg_peak_cube_mz']
+        self.add_deferred_parameter()
+        self.__deferred_peak_cube = None
 
     # ------------------------ viewer functions start ----------------------
 
@@ -167,8 +178,16 @@ class omsi_peakcube(analysis_base):
         peaksMZdata = self['peaksMZdata']
         HCpeaksLabels = self['HCpeaksLabels']
         HCLabelsList = self['HCLabelsList']
+        peakCubeDtype = self['peak_cube_dtype']
 
-        myPeakCube = self.getPeakCube(peaksIntensities, peaksArrayIndex, HCpeaksLabels, HCLabelsList)
+        if self['deferred']:
+            # keep the inputs so that write_deferred_analysis_data can assemble the cube directly in the file
+            self.__deferred_peak_cube = (peaksIntensities, peaksArrayIndex, HCpeaksLabels, HCLabelsList, peakCubeDtype)
+            myPeakCube = None
+        else:
+            self.__deferred_peak_cube = None
+            myPeakCube = self.getPeakCube(peaksIntensities, peaksArrayIndex, HCpeaksLabels, HCLabelsList,
+                                          dtype=peakCubeDtype)
         print("\ndone!")
         print("Calculating global m\z...")
         myGlobalMz = self.getGlobalMz(peaksBins, peaksMZdata, HCpeaksLabels, HCLabelsList)
@@ -186,7 +205,8 @@ class omsi_peakcube(analysis_base):
         self.clear_parameter_data()
 
         # Collect peak cube into hdf5
-        self['npg_peak_cube_mz'] = np.asarray(myPeakCube)
+        if myPeakCube is not None:
+            self['npg_peak_cube_mz'] = myPeakCube
         self['npg_peak_mz'] = np.asarray(myGlobalMz)
 
         #		#Save the analysis dependencies to the __dependency_list so that the data can be saved automatically by the omsi HDF5 file API
@@ -216,66 +236,105 @@ class omsi_peakcube(analysis_base):
         """We are recording our outputs manually as part of the execute function"""
         pass
 
+    def get_deferred_data_names(self):
+        """The parameters are cleared by execute_analysis, hence, use the inputs kept for the deferred peak cube"""
+        if self.__deferred_peak_cube is not None:
+            return self.deferred_data_names
+        return []
+
+    def write_deferred_analysis_data(self, analysis_group):
+        """
+        Assemble the peak cube block-by-block directly into the npg_peak_cube_mz dataset of the analysis group.
+
+        :param analysis_group: The h5py.Group object where the analysis is stored.
+        """
+        peaksIntensities, peaksArrayIndex, HCpeaksLabels, HCLabelsList, peakCubeDtype = self.__deferred_peak_cube
+        pAILast = peaksArrayIndex.shape[0] - 1
+        peakCubeShape = (peaksArrayIndex[pAILast][0] + 1, peaksArrayIndex[pAILast][1] + 1, len(HCLabelsList))
+        peakCube = analysis_group.create_dataset(name='npg_peak_cube_mz',
+                                                 shape=peakCubeShape,
+                                                 dtype=peakCubeDtype,
+                                                 chunks=True)
+        self.getPeakCube(peaksIntensities, peaksArrayIndex, HCpeaksLabels, HCLabelsList,
+                         dtype=peakCubeDtype, out=peakCube)
+
     # +++++++++++++++++++++++ helper functions ++++++++++++++++++++++++++
 
-    def getPeakCube(self, peaksIntensities, peaksArrayIndex, HCpeaksLabels, HCLabelsList):
+    # compute the maximum intensity for each (pixel, label) pair of the given peaks
+    # returns the unique flat indices pixel * Nz + label - 1 and the corresponding maximum intensities
+    @staticmethod
+    def getPeakCubeValues(peaksPixel, peaksIntensities, peaksLabels, Nz):
+        currentIdxs = np.asarray(peaksLabels).astype('int64') - 1
+        if currentIdxs.size > 0 and (currentIdxs.min() < -Nz or currentIdxs.max() >= Nz):
+            raise IndexError("Peak label out of range of the labels list")
+        # negative labels index from the end, as in numpy indexing
+        currentIdxs[currentIdxs < 0] += Nz
+        keys = peaksPixel.astype('int64') * Nz + currentIdxs
+        if keys.size == 0:
+            return keys, np.asarray(peaksIntensities)
+        sidxs = np.argsort(keys, kind='mergesort')
+        srtKeys = keys[sidxs]
+        starts = np.flatnonzero(np.concatenate(([True], srtKeys[1:] != srtKeys[:-1])))
+        maxInts = np.maximum.reduceat(np.asarray(peaksIntensities)[sidxs], starts)
+        return srtKeys[starts], maxInts
+
+    # assemble the peak cube, i.e., the maximum intensity of the peaks of
+    # each pixel that were assigned to the same global peak label.
+    # dtype = data type of the peak cube
+    # sparse = return a scipy.sparse.csr_matrix of shape (Nx * Ny, Nz) instead of a dense cube
+    # out = optional array-like (e.g., a h5py.Dataset) of shape (Nx, Ny, Nz) the peak cube is written
+    #       to in blocks of about blockSize values, rather than allocating the full cube in memory
+    def getPeakCube(self, peaksIntensities, peaksArrayIndex, HCpeaksLabels, HCLabelsList,
+                    dtype='float64', sparse=False, out=None, blockSize=2**24):
 
         pAILast = peaksArrayIndex.shape[0] - 1
         Nx = peaksArrayIndex[pAILast][0] + 1
         Ny = peaksArrayIndex[pAILast][1] + 1
         Nz = len(HCLabelsList)
-        PC = np.zeros((Nx * Ny, Nz))
+        # read the start indices of the peaks of all pixels once rather than per pixel
+        indptr = peak_arrayindex_to_indptr(peaksArrayIndex[:], HCpeaksLabels.shape[0])
 
-        percentcheck = None
-        timekeep1 = time()
-        for iNxy in range(Nx * Ny):
-            percent = int(100. * float(iNxy + 1) / float(Nx * Ny))
-            if (percent != percentcheck):
-                timer = int(time() - timekeep1)
-                print("[", percent, "% -", timer, "s ]\r", end=' ')
-                sys.stdout.flush()
-                percentcheck = percent
-
-            pStart = peaksArrayIndex[iNxy][2]
+        # number of rows of pixels along x processed at once
+        if out is None:
+            blockNx = Nx
+        else:
+            blockNx = max(1, blockSize // max(Ny * Nz, 1))
+        PC = None
+        sparseData = []
 
-            # look at next arrayindex to see current end,
-            # unless its the last arrayindex
-            if (iNxy == ((Nx * Ny) - 1)):
-                pEnd = HCpeaksLabels.shape[0]
+        timekeep1 = time()
+        for x0 in range(0, Nx, blockNx):
+            x1 = min(Nx, x0 + blockNx)
+            pStart = indptr[x0 * Ny]
+            pEnd = indptr[x1 * Ny]
+            peaksPixel = np.repeat(np.arange(x0 * Ny, x1 * Ny), np.diff(indptr[x0 * Ny: x1 * Ny + 1]))
+            keys, maxInts = self.getPeakCubeValues(peaksPixel,
+                                                   peaksIntensities[pStart:pEnd],
+                                                   HCpeaksLabels[pStart:pEnd],
+                                                   Nz)
+            if sparse:
+                sparseData.append((keys, maxInts))
             else:
-                pEnd = peaksArrayIndex[iNxy + 1][2]
-
-            if (pStart != pEnd):
-                currentInts = peaksIntensities[pStart:pEnd]
-                currentLbls = HCpeaksLabels[pStart:pEnd]
-
-                # method 3
-                # Does direct index replacement if labels for current coordinate are unique
-                uniquelbls = np.unique(currentLbls)
-                if (len(uniquelbls) == len(currentLbls)):
-                    currentIdxs = currentLbls.astype('int32') - 1
-                    PC[iNxy][currentIdxs] = currentInts
-                # if not unique then use the max intensity for the same labels
+                blockPC = np.zeros(((x1 - x0) * Ny, Nz), dtype=dtype)
+                blockPC.flat[keys - x0 * Ny * Nz] = maxInts
+                blockPC = blockPC.reshape((x1 - x0, Ny, Nz))
+                if out is None:
+                    PC = blockPC
                 else:
-                    sidxs = np.argsort(currentLbls)
-                    srtLbls = currentLbls[sidxs]
-                    srtInts = currentInts[sidxs]
-
-                    prevLbl = None
-                    for iLbl in range(len(currentLbls)):
-                        thisLbl = srtLbls[iLbl]
-                        thisInt = srtInts[iLbl]
-                        myIdx = int(thisLbl - 1)
-                        if (thisLbl == prevLbl):
-                            prevInt = PC[iNxy][myIdx]
-                            myInt = max(prevInt, thisInt)
-                        else:
-                            myInt = thisInt
-
-                        prevLbl = thisLbl
-                        PC[iNxy][myIdx] = myInt
-
-        PC = np.reshape(PC, (Nx, Ny, Nz))
+                    out[x0:x1] = blockPC
+
+            percent = int(100. * float(x1) / float(Nx))
+            timer = int(time() - timekeep1)
+            print("[", percent, "% -", timer, "s ]\r", end=' ')
+            sys.stdout.flush()
+
+        if sparse:
+            from scipy.sparse import csr_matrix
+            keys = np.concatenate([k for k, _ in sparseData])
+            maxInts = np.concatenate([v for _, v in sparseData]).astype(dtype)
+            return csr_matrix((maxInts, (keys // Nz, keys % Nz)), shape=(Nx * Ny, Nz))
+        if out is not None:
+            return out
         return PC
 
     # calculate the global m\z
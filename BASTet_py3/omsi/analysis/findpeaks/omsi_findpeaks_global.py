@@ -2,8 +2,32 @@
 Global peak finder computing peaks and associated ion-images
 for the full MSI data.
 """
+import numpy as np
+
 from omsi.analysis.base import analysis_base
+from omsi.dataformat.omsi_file.msidata import omsi_file_msidata
+from omsi.shared import block_helper
 from omsi.shared.log import log_helper
+import omsi.shared.mpi_helper as mpi_helper
+
+
+def get_mean_spectrum(msidata, memory_budget=2**30, comm=None, cache=False):
+    """
+    Compute the mean spectrum of a 3D MSI dataset one block of rows in x at a time,
+    see omsi.shared.block_helper.get_mean_spectrum.
+
+    :param msidata: The 3D MSI dataset (numpy array, h5py.Dataset or omsi_file_msidata)
+    :param memory_budget: Approximate number of bytes of msidata to be read at once
+    :param comm: MPI communicator. If the communicator has more than one rank, then the blocks are
+        distributed across the ranks and the partial sums are reduced across all ranks.
+    :param cache: Use and save the mean spectrum cached in the file. Only used for omsi_file_msidata.
+
+    :returns: 1D float64 numpy array with the mean spectrum
+    """
+    if isinstance(msidata, omsi_file_msidata):
+        return msidata.get_mean_spectrum(memory_budget=memory_budget, comm=comm, cache=cache)
+    return block_helper.get_mean_spectrum(msidata, memory_budget=memory_budget, comm=comm)
+
 
 class omsi_findpeaks_global(analysis_base):
     """
@@ -55,6 +79,20 @@ class omsi_findpeaks_global(analysis_base):
                            default=3,
                            group=groups['settings'],
                            required=True)
+        self.add_parameter(name='memory_budget',
+                           help='Approximate number of bytes of the MSI data to be read at once.',
+                           dtype=int,
+                           default=2**30,
+                           group=groups['settings'],
+                           required=False)
+        self.add_parameter(name='cache_mean_spectrum',
+                           help='Use (and save) the mean spectrum cached with the MSI data in the file so that ' +
+                                'repeated peak finding does not reread the data. Only used if msidata is ' +
+                                'an omsi_file_msidata object.',
+                           dtype=dtypes['bool'],
+                           default=True,
+                           group=groups['settings'],
+                           required=False)
         self.data_names = ['peak_cube',
                            'peak_mz']
 
@@ -190,8 +228,7 @@ class omsi_findpeaks_global(analysis_base):
         Execute the global peak finding for the given msidata and mzdata.
         """
         # Make sure all imports are here
-        from omsi.analysis.findpeaks.third_party.findpeaks import findpeaks
-        import numpy as np
+        from omsi.analysis.findpeaks.third_party.findpeaks import findpeaks_batch
 
         # Copy parameters to local variables for convenience
         msidata = self['msidata']
@@ -200,59 +237,47 @@ class omsi_findpeaks_global(analysis_base):
         peakheight = self['peakheight']
         slwindow = self['slwindow']
         smoothwidth = self['smoothwidth']
+        memory_budget = self['memory_budget']
 
-        # Load the input data
-        data = msidata[:]
         # Ensure the our MSI dataset has sufficient numbers of dimensions
         if len(msidata.shape) == 1:
-            data = data[:][np.newaxis, np.newaxis, :]
+            msidata = msidata[:][np.newaxis, np.newaxis, :]
         elif len(msidata.shape) == 2:
-            data = data[:][np.newaxis, :]
+            msidata = msidata[:][np.newaxis, :]
 
         # Determine the data dimensions
-        shape_x, shape_y, shape_z = data.shape
-        # Linearize the spectral data
-        processed_msidata = data.reshape(shape_x*shape_y, shape_z)
-        # Compute the average spectrum
-        processed_msidata = np.mean(processed_msidata, axis=0)
-        # Find peaks in the average spectrum
+        shape_x, shape_y, shape_z = msidata.shape
+        # Distribute the blocks of the data across all ranks if we are running with MPI
+        comm = self.mpi_comm if mpi_helper.get_size(comm=self.mpi_comm) > 1 else None
+        rank = mpi_helper.get_rank(comm=comm) if comm is not None else 0
+        size = mpi_helper.get_size(comm=comm) if comm is not None else 1
 
-        # REMOVED 20140429
-        findpeaks_data = findpeaks(mzdata[:],
-                                   processed_msidata,
-                                   smoothwidth,
-                                   slwindow,
-                                   peakheight)
-        processed_msidata = findpeaks_data.smoothListGaussian()
+        # Compute the average spectrum without loading the full data
+        processed_msidata = get_mean_spectrum(msidata,
+                                              memory_budget=memory_budget,
+                                              comm=comm,
+                                              cache=self['cache_mean_spectrum'])
+        # Find peaks in the average spectrum: smooth the spectrum, subtract a sliding minima,
+        # and find the peaks in the smoothed, background subtracted spectrum
+        peak_index, _, _ = findpeaks_batch(processed_msidata[np.newaxis, :],
+                                           smoothwidth,
+                                           slwindow,
+                                           peakheight)
+        mz_peaks = mzdata[peak_index]
 
-        # from the smoothed spectra subtract a sliding minima
-
-        # REMOVED 20140429
-        findpeaks_data = findpeaks(mzdata[:],
-                                   processed_msidata,
-                                   smoothwidth,
-                                   slwindow,
-                                   peakheight)
-        slmin = [x for x in findpeaks_data.sliding_window_minimum()]
-        processed_msidata = processed_msidata - slmin
-
-        # find peaks in the smoothed, background subtracted spectra
-        findpeaks_data = findpeaks(mzdata[:],
-                                   processed_msidata,
-                                   smoothwidth,
-                                   slwindow,
-                                   peakheight)
-        [pkmax, pkmin] = findpeaks_data.peakdet()
-        xval_peak = [x[0] for x in pkmax]
-        yval_peak = [x[1] for x in pkmax]
-        pks = np.asarray(pkmax)
-        mz_peaks = mzdata[pks[:, 0].astype(int)]
-        flat_data = data.reshape(shape_x*shape_y, shape_z)
-        peak_cube = np.zeros((shape_x*shape_y, mz_peaks.shape[0]))
-        for i in range(len(mz_peaks)):
-            xx = np.where(np.abs(mzdata - mz_peaks[i]) < integration_width)
-            peak_cube[:, i] = np.amax(flat_data[:, xx[0]], 1)
-        peak_cube = peak_cube.reshape(shape_x, shape_y, len(mz_peaks))
+        # Compute the max intensity in the window around each peak, one block of rows in x at a time
+        peak_windows = [np.where(np.abs(mzdata - mz_peak) < integration_width)[0] for mz_peak in mz_peaks]
+        peak_cube = np.zeros((shape_x, shape_y, mz_peaks.shape[0]))
+        block_x = block_helper.get_block_size_x(msidata, memory_budget, msidata.dtype.itemsize)
+        for xstart in range(rank * block_x, shape_x, size * block_x):
+            xend = min(xstart + block_x, shape_x)
+            flat_data = msidata[xstart:xend].reshape(-1, shape_z)
+            flat_peak_cube = peak_cube[xstart:xend].reshape(-1, mz_peaks.shape[0])
+            for i, peak_window in enumerate(peak_windows):
+                flat_peak_cube[:, i] = np.amax(flat_data[:, peak_window], 1)
+        # Each rank only filled its own blocks and all other values are 0
+        if size > 1:
+            peak_cube = mpi_helper.allreduce(peak_cube, comm=comm)
         # integrate peaks +/- integration_width bins around each of the peaks found in the total spectra
         # TODO : THIS LOOP NEEDS TO BE CONVERTED TO A MAX INSTEAD OF A SUM
         # im = data[:,:,xp]
@@ -270,11 +295,6 @@ class omsi_findpeaks_global(analysis_base):
         # handle also a large range of python built_in types by converting them to numpy for storage in HDF5 but
         # to ensure a consistent behavior we convert the values directly here
 
-        # Clean up the biggest chunks of memory we allocated when we potentially loaded the data from file
-        del data
-        del processed_msidata
-        del flat_data
-
         # Save the analysis data to the __data_list so that the data can be
         # saved automatically by the omsi HDF5 file API
         return peak_cube, mz_peaks
@@ -1,11 +1,118 @@
 """
 Local peak finding analysis module.
 """
+from tempfile import TemporaryFile
+
+import numpy as np
 
 from omsi.analysis.base import analysis_base
 import omsi.shared.mpi_helper as mpi_helper
 from omsi.shared.log import log_helper
 
+
+class growable_array(object):
+    """
+    Simple 1D numpy buffer with amortized O(1) appends. The buffer doubles its capacity
+    whenever it runs full, so that appending many small blocks does not require keeping
+    a list of blocks and a final concatenation (which temporarily doubles the memory).
+    If the buffer is out-of-core, then the values are stored in a memory map of a temporary
+    file so that the buffer does not need to fit into memory.
+    """
+    def __init__(self, dtype, capacity=1024, out_of_core=False):
+        """
+        :param dtype: The numpy dtype of the buffer
+        :param capacity: The initial number of elements allocated
+        :param out_of_core: Store the values in a memory-mapped temporary file
+        """
+        self.size = 0
+        self.__dtype = np.dtype(dtype)
+        self.__file = TemporaryFile() if out_of_core else None
+        self.__data = None
+        self.__allocate(max(int(capacity), 1))
+
+    def __allocate(self, capacity):
+        """
+        Resize the buffer to the given capacity, keeping the first self.size values.
+        """
+        if self.__file is None:
+            if self.__data is None:
+                self.__data = np.empty(capacity, dtype=self.__dtype)
+            else:
+                self.__data.resize(capacity, refcheck=False)
+        else:
+            if self.__data is not None:
+                self.__data.flush()
+                self.__data = None
+            self.__file.truncate(capacity * self.__dtype.itemsize)
+            self.__data = np.memmap(self.__file, dtype=self.__dtype, mode='r+', shape=(capacity,))
+
+    def append(self, values):
+        """
+        Append the given values to the buffer.
+
+        :param values: 1D array of the values to be appended. Values are cast to the dtype of the buffer.
+        """
+        num_values = len(values)
+        if self.size + num_values > self.__data.shape[0]:
+            self.__allocate(max(2 * self.__data.shape[0], self.size + num_values))
+        self.__data[self.size:self.size+num_values] = values
+        self.size += num_values
+
+    def to_array(self):
+        """
+        Release the unused capacity and return the buffer as a numpy array (or numpy.memmap if
+        the buffer is out-of-core). The buffer should not be appended to anymore after this call.
+        """
+        if self.__file is not None and self.size == 0:
+            return np.empty(0, dtype=self.__dtype)
+        self.__allocate(self.size)
+        if self.__file is not None:
+            self.__file.close()  # The memory map keeps the temporary file alive
+            self.__file = None
+        return self.__data
+
+
+def peak_arrayindex_to_indptr(peak_arrayindex, num_peaks):
+    """
+    Convert the peak_arrayindex of a local peak finding to a CSR row pointer, i.e., the peaks of
+    spectrum i are stored in [indptr[i], indptr[i+1]) in the peak_mz and peak_value arrays.
+
+    :param peak_arrayindex: 2D array (or h5py.Dataset) with the (x, y, start_index) of each spectrum
+    :param num_peaks: The total number of peaks, i.e., the length of the peak_mz array
+
+    :returns: 1D int64 numpy array of length peak_arrayindex.shape[0]+1
+    """
+    indptr = np.empty(peak_arrayindex.shape[0] + 1, dtype='int64')
+    indptr[:-1] = peak_arrayindex[:, 2]
+    indptr[-1] = num_peaks
+    return indptr
+
+
+def write_blocked(group, name, data, block_size=2**20):
+    """
+    Write a large 1D array to a new chunked, resizable dataset using fixed-size appends, so that
+    at most block_size values need to be converted and transferred at a time.
+
+    :param group: The h5py.Group where the dataset should be created
+    :param name: The name of the dataset
+    :param data: The 1D numpy array (or h5py.Dataset) to be written
+    :param block_size: The number of values appended at once. This is also used as the chunk size.
+
+    :returns: The h5py.Dataset that was created
+    """
+    num_values = data.shape[0]
+    dataset = group.create_dataset(name=name,
+                                   shape=(0,),
+                                   maxshape=(None,),
+                                   dtype=data.dtype,
+                                   chunks=(max(1, min(block_size, num_values)),))
+    for start in range(0, num_values, block_size):
+        stop = min(start + block_size, num_values)
+        dataset.resize((stop,))
+        dataset[start:stop] = data[start:stop]
+    return dataset
+
+
 class omsi_findpeaks_local(analysis_base):
     """
     Class defining a basic gloabl peak finding. The default implementation computes the peaks on the average
@@ -56,14 +163,27 @@ class omsi_findpeaks_local(analysis_base):
                            default=3,
                            group=groups['settings'],
                            required=True)
+        self.add_parameter(name='peak_value_dtype',
+                           help='The data type used to store the peak intensities',
+                           dtype=str,
+                           default='float32',
+                           choices=['float32', 'float64'],
+                           group=groups['settings'],
+                           required=False)
         self.add_parameter(name='printStatus',
                            help='Print progress status during the analysis',
                            dtype=dtypes['bool'],
                            required=True,
                            group=groups['settings'],
                            default=False)
+        self.add_parameter(name='num_processes',
+                           help='Number of local processes to be used when running without MPI',
+                           dtype=int,
+                           required=False,
+                           group=groups['parallel'],
+                           default=1)
         self.add_parameter(name='schedule',
-                           help='Scheduling to be used for parallel MPI runs',
+                           help='Scheduling to be used for parallel runs',
                            dtype=str,
                            required=False,
                            choices=list(mpi_helper.parallel_over_axes.SCHEDULES.values()),
@@ -103,7 +223,6 @@ class omsi_findpeaks_local(analysis_base):
         # Retrieve the h5py objects for the requried datasets from the local peak finding
         if viewer_option == 0:
             from omsi.shared.data_selection import check_selection_string, selection_type, selection_to_indexlist
-            import numpy as np
             peak_mz = analysis_object['peak_mz']
             peak_values = analysis_object['peak_value']
             array_indices = analysis_object['peak_arrayindex'][:]
@@ -111,10 +230,16 @@ class omsi_findpeaks_local(analysis_base):
             # Determine the shape of the original raw data
             if (indata_mz is None) or (array_indices is None):
                 return None, None
-            num_x = array_indices[:, 0].max()
-            num_y = array_indices[:, 1].max()
+            num_x = array_indices[:, 0].max() + 1
+            num_y = array_indices[:, 1].max() + 1
             num_mz = indata_mz.shape[0]
-            num_spectra = array_indices.shape[0]
+            # CSR row pointer into the peak_mz and peak_value arrays. We only slice the peaks
+            # of the requested pixels from file and never load the complete peak arrays.
+            indptr = peak_arrayindex_to_indptr(array_indices, peak_values.shape[0])
+            # Pixel indices may be out of order (e.g, when we use MPI) so we look up the pixel location
+            pixel_keys = array_indices[:, 0].astype('int64') * num_y + array_indices[:, 1]
+            pixel_order = np.argsort(pixel_keys, kind='mergesort')
+            sorted_pixel_keys = pixel_keys[pixel_order]
             # Determine the size of the selection and the set of selected items
             x_list = selection_to_indexlist(x, num_x)
             y_list = selection_to_indexlist(y, num_y)
@@ -139,29 +264,20 @@ class omsi_findpeaks_local(analysis_base):
             data = np.zeros((shape_x, shape_y, shape_z), dtype=peak_values.dtype)
             # Fill the non-zero locations for the data cube with data
             for ni, ci in enumerate(items):
-                try:
-                    # Pixel indices may be out of order (e.g, when we use MPI) so we look up the pixel location
-                    current_index = np.nonzero(np.logical_and(array_indices[0] == ci[0],
-                                                              array_indices[1] == ci[1]))[0][0]
-                except:
+                key = ci[0] * num_y + ci[1]
+                key_index = np.searchsorted(sorted_pixel_keys, key)
+                if not (0 <= ci[0] < num_x and 0 <= ci[1] < num_y) or \
+                        key_index >= sorted_pixel_keys.shape[0] or sorted_pixel_keys[key_index] != key:
                     log_helper.warning(__name__, "Requested pixel not found: " + str(items[ni]))
                     continue
-                current_dx = ni
-                current_dy = 0
-                start_index = array_indices[current_index][2]
-                if current_index < num_spectra:
-                    end_index = array_indices[(current_index+1)][2]
-                else:
-                    end_index = peak_values.size
+                current_index = pixel_order[key_index]
+                start_index = indptr[current_index]
+                end_index = indptr[current_index + 1]
+                # The start and end index may be the same in case that no peaks were found
+                # for the given spectrum. The data is already initialized to 0 so there is
+                # nothing to do in this case.
                 if start_index != end_index:
-                    temp_values = peak_values[start_index: end_index]
-                    temp_mz = peak_mz[start_index: end_index]
-                    data[current_dx, current_dy, temp_mz] = temp_values
-                else:
-                    # The start and end index may be the same in case that
-                    # no peaks for found for the given spectrum
-                    # The data is already initialized to 0 so there is nothing to do here
-                    pass
+                    data[ni, 0, peak_mz[start_index: end_index]] = peak_values[start_index: end_index]
 
             if len(items) == 1:
                 data = data.reshape((shape_x, shape_z))
@@ -260,7 +376,17 @@ class omsi_findpeaks_local(analysis_base):
                 for element_size in result_sizes[1:]:
                     if element_size > 0:
                         raise ValueError('Parallel I/O with collect parameter set to false not supported')
-        raise NotImplementedError
+        # Serial no MPI, single rank SERIAL with MPI, or we are on the mpi root rank where we have all the data.
+        # The peak arrays can be very large (and are memory-mapped from temporary files), so we write them
+        # using fixed-size appends rather than converting and transferring them in one go. All other data is written using the default mechanism.
+        if analysis_group is None or len(self['peak_mz'].shape) == 0:
+            raise NotImplementedError   # Just let the default implementation of omsi_file_analysis handle this
+        from omsi.dataformat.omsi_file.analysis import omsi_file_analysis
+        for ana_data in self.get_all_analysis_data():
+            if ana_data['name'] in ['peak_mz', 'peak_value']:
+                write_blocked(analysis_group, ana_data['name'], ana_data['data'])
+            else:
+                omsi_file_analysis.__write_omsi_analysis_data__(analysis_group, ana_data)
         """
         import numpy as np
 
@@ -335,7 +461,7 @@ class omsi_findpeaks_local(analysis_base):
 
         """
         # Make sure needed imports are available
-        from omsi.analysis.findpeaks.third_party.findpeaks import findpeaks
+        from omsi.analysis.findpeaks.third_party.findpeaks import findpeaks_batch
         import numpy as np
 
         # Assign parameters to local variables for convenience
@@ -352,15 +478,17 @@ class omsi_findpeaks_local(analysis_base):
             import sys
 
         #############################################################
-        # Parallel execution using MPI
+        # Parallel execution using MPI or local processes
         #############################################################
         # We have more than a single core AND we have multiple spectra to process
-        if mpi_helper.get_size() > 1 and len(self['msidata'].shape) > 1:
+        if (mpi_helper.get_size() > 1 or self['num_processes'] > 1) and len(self['msidata'].shape) > 1:
             # We were not asked to process a specific data subblock from a parallel process
             # but we need to initiate the parallel processing.
             if msidata_subblock is None:
                 # Setup the parallel processing using mpi_helper.parallel_over_axes
                 split_axis = list(range(len(self['msidata'].shape)-1))  # The axes along which we can split the data
+                backend = mpi_helper.parallel_over_axes.BACKENDS['MPI'] if mpi_helper.get_size() > 1 \
+                    else mpi_helper.parallel_over_axes.BACKENDS['LOCAL']
                 scheduler = mpi_helper.parallel_over_axes(task_function=self.execute_analysis,  # Execute this function
                                                           task_function_params={},              # No added parameters
                                                           main_data=msidata,                    # Process the msidata
@@ -368,7 +496,9 @@ class omsi_findpeaks_local(analysis_base):
                                                           main_data_param_name='msidata_subblock',  # data input param
                                                           root=self.mpi_root,                   # The root MPI task
                                                           schedule=self['schedule'],            # Parallel schedule
-                                                          comm=self.mpi_comm)                   # MPI communicator
+                                                          comm=self.mpi_comm,                   # MPI communicator
+                                                          backend=backend,                      # MPI or LOCAL
+                                                          num_processes=self['num_processes'])  # LOCAL processes
                 # Execute the analysis in parallel
                 result = scheduler.run()
                 # Collect the output data to the root rank if requested
@@ -389,45 +519,41 @@ class omsi_findpeaks_local(analysis_base):
                 # collect + root         3
                 #           root         1
                 use_dynamic_schedule = (self['schedule'] == mpi_helper.parallel_over_axes.SCHEDULES['DYNAMIC'])
-                # Case 1: root rank without collect data disabled
-                if mpi_helper.get_rank() == self.mpi_root and not self['collect']:
-                    # We did not process any data on the root if DYNAMIC scheduling was used
-                    if use_dynamic_schedule:
-                        return None, None, None, mzdata
-                    # We processed a data block using dynamic scheduling
-                    else:
-                        return result[0][0]
-                # Case 2: Compile the data on the worker
-                elif mpi_helper.get_rank() != self.mpi_root: # and use_dynamic_schedule:
-                    # Compile the results from all processing task (on workers) or from all workers (on the root)
-                    peak_mz = np.concatenate(tuple([ri[0] for ri in result[0]]), axis=-1)
-                    peak_values = np.concatenate(tuple([ri[1] for ri in result[0]]), axis=-1)
-                    if len(result[1])>1: # Correct indices from the individual runs since they all start at 0
-                        peak_arrayindex = np.asarray([ [b[0], b[1], 0] for b in result[1] ])
-                        peak_arrayindex[:,2] = np.cumsum([0] + [ len(ri[0]) for ri in result[0] ])[:-1]
-                    else:
-                        peak_arrayindex = result[0][0][2]
-                    mzdata = result[0][0][3]
-                    return peak_mz, peak_values, peak_arrayindex, mzdata
-                # Case 3: Compile collected data on the root
-                elif mpi_helper.get_rank() == self.mpi_root: # and use_dynamic_schedule:
-                    # Compile the results from all processing task (on workers) or from all workers (on the root)
-                    peak_mz = np.concatenate(tuple([ri[0] for ri in result[0]]), axis=-1)
-                    peak_values = np.concatenate(tuple([ri[1] for ri in result[0]]), axis=-1)
-                    # Dynamic scheduling uses selections of (int,int,slice) while the static
-                    # scheduling uses (slice, slice, slice), hence we need to compile the peak_arrayindex
-                    # slightly differently depending on the scheduler used
-                    if use_dynamic_schedule:
-                        peak_arrayindex = np.asarray([ [b[0], b[1], 0] for b in result[1]])
-                        peak_arrayindex[:,2] = np.cumsum([0] + [ len(ri[0]) for ri in result[0]])[:-1]
-                    else:
-                        peak_arrayindex = np.concatenate(tuple([ri[2] for ri in result[0]]), axis=0)
-                        d = np.cumsum([0] + [len(ri[0]) for ri in result[0]])
-                        d2 = np.cumsum([0] + [len(ri[2]) for ri in result[0]])
-                        for di in range(len(d2)-1):
-                            peak_arrayindex[d2[di]:d2[di+1], 2] += d[di]
-                    mzdata = result[0][0][3]
-                    return peak_mz, peak_values, peak_arrayindex, mzdata
+                # Case 1: root rank without collect data disabled. We did not process any data on the
+                # root if DYNAMIC scheduling was used with MPI
+                if len(result[0]) == 0 or \
+                        (backend == mpi_helper.parallel_over_axes.BACKENDS['MPI'] and
+                         mpi_helper.get_rank() == self.mpi_root and not self['collect'] and use_dynamic_schedule):
+                    return None, None, None, mzdata
+                # Case 2 and 3: Compile the results from all processing tasks (on workers and on the root
+                # without collect) or from all workers (on the root with collect)
+                peak_mz = growable_array(dtype=result[0][0][0].dtype, out_of_core=True)
+                peak_values = growable_array(dtype=result[0][0][1].dtype, out_of_core=True)
+                for ri in result[0]:
+                    peak_mz.append(ri[0])
+                    peak_values.append(ri[1])
+                peak_mz = peak_mz.to_array()
+                peak_values = peak_values.to_array()
+                block_num_peaks = np.asarray([len(ri[0]) for ri in result[0]], dtype='int64')
+                # Dynamic scheduling uses selections of (int,int,slice) while all other schedules
+                # use (slice, slice, slice), hence we need to compile the peak_arrayindex
+                # slightly differently depending on the scheduler used
+                if use_dynamic_schedule:
+                    peak_arrayindex = np.asarray([[b[0], b[1], 0] for b in result[1]])
+                    peak_arrayindex[:, 2] = np.cumsum(block_num_peaks) - block_num_peaks
+                else:
+                    peak_arrayindex = np.concatenate(tuple([ri[2] for ri in result[0]]), axis=0)
+                    # Shift the pixel indices by the start of each block and the start indices of each
+                    # block by the number of peaks of all previous blocks
+                    block_num_spectra = [len(ri[2]) for ri in result[0]]
+                    block_offsets = np.zeros((len(result[1]), 2), dtype=peak_arrayindex.dtype)
+                    for block_index, block in enumerate(result[1]):
+                        block_starts = [axis_block.start or 0 for axis_block in block[:-1]]
+                        block_offsets[block_index, (2 - len(block_starts)):] = block_starts
+                    peak_arrayindex[:, 0:2] += np.repeat(block_offsets, block_num_spectra, axis=0)
+                    peak_arrayindex[:, 2] += np.repeat(np.cumsum(block_num_peaks) - block_num_peaks,
+                                                       block_num_spectra)
+                return peak_mz, peak_values, peak_arrayindex, mzdata[:]
 
 
         #############################################################
@@ -443,52 +569,45 @@ class omsi_findpeaks_local(analysis_base):
         shape_x = msidata.shape[0]
         shape_y = msidata.shape[1]
 
-        peak_mz = []      # The x values for all peaks, stored in a linear array
-        peak_values = []    # The y values for all peaks, stored in a linear array
-        # List describing for each pixel the start index where its peaks
-        # are stored in the peaks_MZ and peaks_values array
-        peak_arrayindex = np.zeros(shape=(shape_x*shape_y, 3), dtype='int64')
-        current_index = int(0)
-        pixel_index = 0
+        # Number of spectra processed at once, such that a block has about 2**24 values
+        block_size = max(1, min(shape_y, 2**24 // max(msidata.shape[2], 1)))
+
+        # The peaks are stored in CSR form, i.e., the m/z bin indices and intensities of all peaks
+        # are stored in linear arrays and peak_arrayindex[:, 2] gives the start of each spectrum.
+        # We store the m/z bin indices using the smallest unsigned int type that can index the m/z
+        # axis and the values in the requested float type to keep the output compact. The peaks of
+        # the full data are streamed to temporary files as they are found, while the peaks of a
+        # subblock of a parallel run are returned in memory.
+        index_dtype = 'uint32' if msidata.shape[2] <= np.iinfo('uint32').max else 'uint64'
+        peak_mz = growable_array(dtype=index_dtype, out_of_core=msidata_subblock is None)
+        peak_values = growable_array(dtype=self['peak_value_dtype'], out_of_core=msidata_subblock is None)
+        num_peaks = np.zeros(shape_x*shape_y, dtype='int64')   # The number of peaks found in each spectrum
         for xi in range(0, shape_x):
-            for yi in range(0, shape_y):
+            for yi in range(0, shape_y, block_size):
                 if print_status:
-                    sys.stdout.write("[" + str(int(100. * float(pixel_index)/float(shape_x*shape_y))) + "%]" + "\r")
+                    sys.stdout.write("[" + str(int(100. * float(xi*shape_y + yi)/float(shape_x*shape_y))) + "%]" + "\r")
                     sys.stdout.flush()
 
-                # Load the spectrum
-                y = msidata[xi, yi, :]
-                # Find peaks in the spectrum
-                peak_finder = findpeaks(mzdata[:],
-                                        y,
-                                        smoothwidth,
-                                        slwindow,
-                                        peakheight)
-                y = peak_finder.smoothListGaussian()
-                # from the smoothed spectra subtract a sliding minima
-                peak_finder = findpeaks(mzdata[:],
-                                        y,
-                                        smoothwidth,
-                                        slwindow,
-                                        peakheight)
-                slmin = [x for x in peak_finder.sliding_window_minimum()]
-                y = y - slmin
-                # find peaks in the smoothed, background subtracted spectra
-                peak_finder = findpeaks(mzdata[:],
-                                        y,
-                                        smoothwidth,
-                                        slwindow,
-                                        peakheight)
-                [pkmax, pkmin] = peak_finder.peakdet()
-                xp = [x[0] for x in pkmax]
-                yp = [x[1] for x in pkmax]
-                peak_mz = peak_mz + xp
-                peak_values = peak_values + yp
-                peak_arrayindex[pixel_index, 0] = xi
-                peak_arrayindex[pixel_index, 1] = yi
-                peak_arrayindex[pixel_index, 2] = current_index
-                pixel_index += 1
-                current_index += len(yp)
+                # Load a block of spectra
+                spectra = msidata[xi, yi:yi+block_size, :]
+                # Smooth the spectra, subtract a sliding minima, and find the peaks in the
+                # smoothed, background subtracted spectra
+                block_mz, block_values, block_num_peaks = findpeaks_batch(spectra,
+                                                                          smoothwidth,
+                                                                          slwindow,
+                                                                          peakheight)
+                peak_mz.append(block_mz)
+                peak_values.append(block_values)
+                num_peaks[xi*shape_y+yi: xi*shape_y+yi+block_num_peaks.shape[0]] = block_num_peaks
+
+        # List describing for each pixel the start index where its peaks
+        # are stored in the peaks_MZ and peaks_values array
+        peak_arrayindex = np.zeros(shape=(shape_x*shape_y, 3), dtype='int64')
+        peak_arrayindex[:, 0] = np.repeat(np.arange(shape_x), shape_y)
+        peak_arrayindex[:, 1] = np.tile(np.arange(shape_y), shape_x)
+        peak_arrayindex[:, 2] = np.cumsum(num_peaks) - num_peaks
+        peak_mz = peak_mz.to_array()
+        peak_values = peak_values.to_array()
 
         # Add the analysis results and parameters to the anlaysis data so that it can be accessed and written to file
         # We here convert the single scalars to 1D numpy arrays to ensure consistency. The data write function can
@@ -496,8 +615,9 @@ class omsi_findpeaks_local(analysis_base):
         # to ensure a consitent behavior we convert the values directly here
 
         # Save the analysis data to the __data_list so that the data can be
-        # saved automatically by the omsi HDF5 file API
-        return np.asarray(peak_mz), np.asarray(peak_values), peak_arrayindex, mzdata[:]
+        # saved automatically by the omsi HDF5 file API. The m/z data is the same for all
+        # data subblocks so that we only return it for the full data.
+        return peak_mz, peak_values, peak_arrayindex, mzdata[:] if msidata_subblock is None else None
 
 if __name__ == "__main__":
     from omsi.workflow.driver.cl_analysis_driver import cl_analysis_driver
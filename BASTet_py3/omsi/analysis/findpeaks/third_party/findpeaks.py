@@ -2,6 +2,7 @@ import sys
 from numpy import NaN, Inf, arange, isscalar, asarray, array, exp, convolve
 from collections import deque
 import numpy as np
+from scipy.ndimage import minimum_filter1d
 
 class findpeaks:
     Name = "findpeaks"
@@ -125,3 +126,188 @@ class findpeaks:
         print(self.Name)
         print(self.x)
         print(self.y)
+
+
+def gaussian_kernel(size):
+    """
+    The normalized Gaussian kernel used by findpeaks.smoothListGaussian.
+    """
+    x = np.array(list(range(-3*size, 3*size)))
+    g = np.exp(-(x**2)/(2.0*float(size)**2))
+    return g / g.sum()
+
+
+def smooth_gaussian_batch(spectra, size):
+    """
+    Smooth every spectrum of a 2D block (num_spectra, num_bins) the same way as
+    findpeaks.smoothListGaussian does.
+
+    The rows are convolved one at a time with np.convolve. Convolving the whole block at once is not
+    faster and changes the last bits of the result, which can change the peaks found by peakdet_batch.
+
+    :param spectra: 2D array of spectra
+    :param size: the smoothing width
+    :returns: 2D float64 array with the smoothed spectra
+    """
+    g = gaussian_kernel(size)
+    spectra = np.asarray(spectra)
+    # np.convolve returns at least as many values as there are in the kernel
+    smoothed = np.empty((spectra.shape[0], max(spectra.shape[1], g.size)),
+                        dtype=np.result_type(spectra.dtype, g.dtype))
+    for i in range(spectra.shape[0]):
+        smoothed[i] = convolve(spectra[i], g, 'same')
+    return smoothed
+
+
+def sliding_window_minimum_batch(spectra, k):
+    """
+    Compute for every spectrum of a 2D block the same sliding minimum as findpeaks.sliding_window_minimum,
+    i.e., element i of a spectrum y is min(y[max(i - k + 1, 0):i+1]).
+
+    NaN values are not ordered, so the deque of sliding_window_minimum neither removes a NaN nor lets it
+    remove other values, and a NaN can stay the minimum after the next value. minimum_filter1d propagates
+    NaN differently, hence, spectra that contain NaN use sliding_window_minimum itself.
+
+    :param spectra: 2D array of spectra
+    :param k: the size of the sliding window
+    :returns: 2D array with the sliding minimum of every spectrum
+    """
+    spectra = np.asarray(spectra)
+    minima = minimum_filter1d(spectra, size=k, axis=-1, mode='nearest', origin=(k-1)//2)
+    if np.issubdtype(spectra.dtype, np.floating):
+        for i in np.flatnonzero(np.isnan(spectra).any(axis=-1)):
+            minima[i] = list(findpeaks(None, spectra[i], None, k, None).sliding_window_minimum())
+    return minima
+
+
+def _first_departures(v, delta):
+    """
+    For every bin s of the spectrum v, compute the first bin i >= s at which v[i] < max(v[s:i+1]) - delta,
+    i.e., where findpeaks.peakdet would end a maximum it started looking for at bin s.
+
+    Because v[i] < max(v[s:i+1]) - delta holds exactly when v[i] < v[k] - delta for some k in [s, i],
+    this is the smallest over all k >= s of the first bin after k that is below v[k] - delta. Only bins
+    followed by a lower bin need to be looked at, any other bin k is never smaller than bin k+1.
+    The first bins below the thresholds are found for all k at once by binary lifting over a sparse table
+    of the minima of v. NaN values are skipped the same way peakdet skips them.
+
+    :param v: 1D float array with the spectrum
+    :param delta: the peak height
+    :returns: 1D int64 array with the departure bin for every bin, len(v) if there is none
+    """
+    num_bins = v.shape[0]
+    candidates = np.flatnonzero(np.where(np.isnan(v[1:]), -np.inf, v[1:]) < v[:-1])
+    threshold = v[candidates] - delta
+    if np.isnan(v).any():
+        v = np.where(np.isnan(v), np.inf, v)
+    num_levels = max(int(num_bins).bit_length(), 1)
+    # minima[level][p] is the minimum of v[p:p+2**level]. Past the end of v every value is -inf,
+    # so blocks that reach past the end are always below the threshold and are not skipped.
+    minima = [np.concatenate((v, np.full(2 ** num_levels, -np.inf)))]
+    for level in range(1, num_levels):
+        half = 2 ** (level - 1)
+        minima.append(np.minimum(minima[-1][:-half], minima[-1][half:]))
+    below = candidates + 1
+    for level in reversed(range(num_levels)):
+        # Skip the next 2**level bins if none of them is below the threshold
+        skip = np.take(minima[level], below, mode='clip') >= threshold
+        below += skip * (2 ** level)
+    departures = np.full(num_bins, num_bins, dtype='int64')
+    departures[candidates] = np.minimum(below, num_bins)
+    return np.minimum.accumulate(departures[::-1])[::-1]
+
+
+def _turning_points(v):
+    """
+    Get the bins of a spectrum that are not strictly between their two neighbors. peakdet never places a
+    maximum on the other bins, and they never are the first bin where a maximum or minimum ends either,
+    so leaving them out gives the same maxima.
+
+    :param v: 1D float array with the spectrum
+    :returns: 1D array with the indices of the bins that are kept
+    """
+    rising = v[1:] > v[:-1]
+    falling = v[1:] < v[:-1]
+    monotone = (rising[:-1] & rising[1:]) | (falling[:-1] & falling[1:])
+    return np.concatenate(([0], np.flatnonzero(~monotone) + 1, [v.shape[0] - 1])) if v.shape[0] > 1 \
+        else np.arange(v.shape[0])
+
+
+def peakdet_batch(spectra, delta):
+    """
+    Detect the maxima in every spectrum of a 2D block with the same delta-hysteresis as findpeaks.peakdet:
+    a point is a maximum if it has the maximal value and is followed by a value lower by more than delta.
+
+    Only the turning points of a spectrum are looked at. The points where a maximum or a minimum that
+    starts at a given point ends are computed for all points at once, minima as maxima of the negated
+    spectrum. The alternation of maxima and minima then only needs a walk over those points, and each
+    maximum is the first point with the largest value between its start and its end.
+
+    :param spectra: 2D array of spectra
+    :param delta: the peak height, must be a positive scalar
+    :returns: tuple of three 1D arrays: the indices and values of the maxima of all spectra, one spectrum
+        after the other, and the number of maxima found in each spectrum
+    """
+    if not isscalar(delta):
+        raise ValueError('Input argument delta must be a scalar')
+    if delta <= 0:
+        raise ValueError('Input argument delta must be positive')
+    spectra = np.asarray(spectra)
+    if not np.issubdtype(spectra.dtype, np.floating):
+        spectra = spectra.astype('float64')
+    num_spectra = spectra.shape[0]
+    peak_index = []
+    num_peaks = np.zeros(num_spectra, dtype='int64')
+    for i in range(num_spectra):
+        kept = _turning_points(spectra[i])
+        v = spectra[i, kept]
+        num_points = v.shape[0]
+        if num_points == 0:
+            continue
+        end_of_max = _first_departures(v, delta).tolist()
+        end_of_min = _first_departures(-v, delta).tolist()
+        # Walk the alternating maxima and minima, the boundaries of the maxima are
+        # bounds[0]:bounds[1], bounds[2]:bounds[3], ...
+        bounds = []
+        start = 0
+        while True:
+            end = end_of_max[start]
+            if end >= num_points:
+                break
+            bounds += [start, end]
+            start = end_of_min[end]
+            if start >= num_points:
+                break
+        if not bounds:
+            continue
+        starts = np.asarray(bounds[::2])
+        lengths = np.asarray(bounds[1::2]) - starts
+        largest = np.fmax.reduceat(v, bounds)[::2]
+        # The first point in each maximum that has the largest value
+        segment = np.repeat(np.arange(largest.size), lengths)
+        points = np.arange(lengths.sum()) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        is_largest = v[points] == largest[segment]
+        first = np.unique(segment[is_largest], return_index=True)[1]
+        peak_index.append(kept[points[is_largest][first]])
+        num_peaks[i] = largest.size
+    peak_index = np.concatenate(peak_index).astype('int64') if peak_index else np.zeros(0, dtype='int64')
+    rows = np.repeat(np.arange(num_spectra), num_peaks)
+    return peak_index, spectra[rows, peak_index], num_peaks
+
+
+def findpeaks_batch(spectra, sizesmooth, slwindow, peakheight):
+    """
+    Find the peaks in a 2D block of spectra (num_spectra, num_bins). This computes the same as the
+    findpeaks sequence of smoothListGaussian, subtracting the sliding_window_minimum, and peakdet
+    on every single spectrum.
+
+    :param spectra: 2D array of spectra
+    :param sizesmooth: the smoothing width
+    :param slwindow: the size of the sliding window used for the background subtraction
+    :param peakheight: the peak height used by peakdet
+    :returns: tuple of three 1D arrays: the bin indices and values of the peaks of all spectra, one spectrum
+        after the other, and the number of peaks found in each spectrum
+    """
+    smoothed = smooth_gaussian_batch(spectra, sizesmooth)
+    smoothed -= sliding_window_minimum_batch(smoothed, slwindow)
+    return peakdet_batch(smoothed, peakheight)
@@ -6,9 +6,49 @@ from tempfile import TemporaryFile
 import numpy as np
 
 from omsi.analysis.base import analysis_base
+from omsi.shared.block_helper import get_block_size_x, map_blocks
 from omsi.shared.log import log_helper
 
 
+def _tic_block_stats(args):
+    """
+    Compute the total and maximum intensity of all spectra of a block.
+
+    :param args: Tuple of (block, idx_mz) where idx_mz are the m/z indices of the
+        block that should be used (or None for all).
+
+    :returns: Tuple of the total intensity and maximum intensity of the spectra.
+    """
+    block, idx_mz = args
+    if idx_mz is not None:
+        block = block[:, :, idx_mz]
+    return np.sum(block, 2), np.amax(block, 2)
+
+
+def _tic_normalize_block(args):
+    """
+    Normalize the spectra of a block.
+
+    :param args: Tuple of (block, tip, mip, max_count, outformat) with the block of spectra, the normalization
+        factors and maximum intensity of the spectra, the minimum maximum intensity of spectra that should
+        be normalized, and the dtype of the normalized data. All other spectra are set to 0.
+
+    :returns: The normalized block
+    """
+    block, tip, mip, max_count, outformat = args
+    num_spectra_x, ny, nz = block.shape
+    current_data = block.reshape(num_spectra_x*ny, nz)
+    tip = tip.reshape(num_spectra_x*ny)
+    mip = mip.reshape(num_spectra_x*ny)
+    idx_thresh = np.where(np.logical_and(mip >= max_count, tip > 0))
+    current_out_norm = np.zeros(current_data.shape, dtype=outformat)
+    if len(idx_thresh[0]) > 0:
+        current_out_norm[idx_thresh[0], :] = \
+            np.around(np.multiply(current_data[idx_thresh[0], :],
+                                  tip.astype(float)[idx_thresh[0]][:, np.newaxis]))
+    return current_out_norm.reshape(num_spectra_x, ny, nz)
+
+
 ###############################################################
 #  1) Basic integration of your analysis with omsi (Required) #
 ###############################################################
@@ -53,17 +93,35 @@ class omsi_tic_norm(analysis_base):
                            group=groups['settings'],
                            default=None)
 
+        self.add_parameter(name='memory_budget',
+                           help='Approximate number of bytes of data processed at once',
+                           dtype=dtypes['int'],
+                           required=False,
+                           group=groups['settings'],
+                           default=2**30)
+        self.add_parameter(name='num_processes',
+                           help='Number of processes used to process blocks of the data in parallel',
+                           dtype=dtypes['int'],
+                           required=False,
+                           group=groups['parallel'],
+                           default=1)
+
         self.data_names = ['norm_msidata', 'norm_mz']
+        self.deferred_data_names = ['norm_msidata']
+        self.add_deferred_parameter()
         self.analysis_identifier = name_key
+        self.__tic_norm = None
 
     def execute_analysis(self):
         """
         Normalize the data based on the total intensity of a spectrum or the
         intensities of a select set of ions.
 
-        Calculations are performed using a memory map approach to avoid loading
-        all data into memory. TIC normalization can as such be performed even
-        on large files (assuming sufficient disk space).
+        The normalization factors and maximum intensities of all spectra are computed in a
+        single pass over the data. The normalized data is then written one block at a time to a
+        memory map (to avoid loading all data into memory). If the analysis is deferred, then the data
+        is instead normalized directly into the analysis dataset when the analysis is saved, so that the
+        normalized data is written only once. TIC normalization can as such be performed even on large files.
 
         Keyword Arguments:
 
@@ -73,10 +131,14 @@ class omsi_tic_norm(analysis_base):
         :param maxCount: ...
         :param mzTol: ...
         :param infIons: List of informative ions
+        :param memory_budget: Approximate number of bytes of data processed at once
+        :param deferred: Write the normalized data directly to file when the analysis is saved
+        :param num_processes: Number of processes used to process blocks of the data in parallel
 
         """
         # Setting Default Values and retrieving parameter data
-        nx, ny, nz = self['msidata'].shape
+        msidata = self['msidata']
+        nx, ny, nz = msidata.shape
         try:
             ion_list = self['infIons']
         except KeyError:
@@ -90,20 +152,26 @@ class omsi_tic_norm(analysis_base):
                 temp = np.where(abs(mzdata-ion) <= self['mzTol'])
                 idx_mz = np.concatenate([idx_mz, temp[0]])
             idx_mz = idx_mz.astype(int)
+            # Read only the required m/z values in increasing order and select from those in memory
+            read_mz, block_idx_mz = np.unique(idx_mz, return_inverse=True)
+            read_mz = read_mz.tolist()
         else:
-            idx_mz = list(range(nz))
-
-        output_filename = TemporaryFile()  # Create a temporary file to compute the normalization out-of-core
-        idx = np.linspace(0, nx, 20, dtype='int')  # Divide the data into chunks in x to process the data in blocks
-
-        # Compute the normalization factors and column maxs first (computed one-block-at-a-time)
+            read_mz = slice(0, nz)
+            block_idx_mz = None
+
+        # Compute the normalization factors and spectrum maxs in a single pass (one-block-at-a-time)
+        num_read_mz = nz if block_idx_mz is None else len(read_mz)
+        block_x = get_block_size_x(msidata, self['memory_budget'],
+                                   msidata.dtype.itemsize * max(num_read_mz, 1) / float(nz))
+        blocks = [(x0, min(x0 + block_x, nx)) for x0 in range(0, nx, block_x)]
         tic_norm_factors = np.zeros(shape=(nx, ny), dtype='float')
-        msi_spectrum_maxs = np.zeros(shape=(nx, ny), dtype=self['msidata'].dtype)
-        for i in range(len(idx)-1):  # Process the data one-block-at-a-time
-            current_data = self['msidata'][idx[i]:idx[i+1], :, idx_mz]
-            tic_norm_factors[idx[i]:idx[i+1], :] = np.sum(current_data, 2)
-            msi_spectrum_maxs[idx[i]:idx[i+1], :] = np.amax(current_data[:, :, idx_mz], 2)
-            del current_data
+        msi_spectrum_maxs = np.zeros(shape=(nx, ny), dtype=msidata.dtype)
+        block_stats = map_blocks(_tic_block_stats,
+                                 ((msidata[x0:x1, :, read_mz], block_idx_mz) for x0, x1 in blocks),
+                                 num_processes=self['num_processes'])
+        for (x0, x1), (block_tic, block_max) in zip(blocks, block_stats):
+            tic_norm_factors[x0:x1, :] = block_tic
+            msi_spectrum_maxs[x0:x1, :] = block_max
         non_zero_tic = tic_norm_factors > 0
         mean_tic_norm = float(tic_norm_factors[non_zero_tic].mean())
         tic_norm_factors[non_zero_tic] = 1.0 / (tic_norm_factors[non_zero_tic] / mean_tic_norm)
@@ -117,53 +185,58 @@ class omsi_tic_norm(analysis_base):
             outformat = 'uint32'
         log_helper.debug(__name__, "Output format: " + str(outformat))
 
-        # Normalize the data one-block-at-a-time
-        for i in range(len(idx)-1):
-            num_spectra_x = idx[i+1]-idx[i]
-            # Load the data for the current block amd reshape it
-            current_data = self['msidata'][idx[i]:idx[i+1], :, :].reshape(num_spectra_x*ny, nz)
-            tip = tic_norm_factors[idx[i]:idx[i+1], :].reshape(num_spectra_x*ny)
-            mip = msi_spectrum_maxs[idx[i]:idx[i+1], :].reshape(num_spectra_x*ny)
-            idx_thresh = np.where(np.logical_and(mip >= self['maxCount'], tip > 0))
-            current_out_norm = np.zeros(current_data.shape)
-            if len(idx_thresh[0]) > 0:
-                current_out_norm[idx_thresh[0], :] = \
-                    np.around(np.multiply(current_data[idx_thresh[0], :],
-                                          tip.astype(float)[idx_thresh[0]][:, np.newaxis]))
-                # Write the data to the temporary file
-                ofp = np.memmap(output_filename, dtype=outformat, mode='w+', shape=(nx, ny, nz))
-                ofp[idx[i]:idx[i+1], :, :] = current_out_norm.reshape(num_spectra_x, ny, nz)
-                del ofp
-
-        # for i in range(len(idx)-1): # Process the data one-block-at-a-time
-        #     print "Current block: " +  str((idx[i], idx[i+1]))
-        #     current_data = self['msidata'][idx[i]:idx[i+1], :, :]   # Load the data for the current block
-        #     num_spectra = idx[i+1]-idx[i]  # Number of spectra in the current data block
-        #     current_data = current_data.reshape(num_spectra*ny, nz)  # Reshape the data to a 2D array
-        #     tip = np.sum(current_data[:, idx_mz], 1)   # Compute the sum of intensities per spectrum
-        #     mip = np.amax(current_data[:, idx_mz], 1)  # Compute the maximum value per spectrum
-        #     idx_thresh = np.where((mip >= self['maxCount']) & (tip > 0))
-        #     current_out_norm = np.zeros(current_data.shape)  # The normalized data for the current block
-        #     if len(idx_thresh[0]) > 0:
-        #         # tic normalize the data for the current block
-        #         current_out_norm[idx_thresh[0], :] = np.divide(current_data[idx_thresh[0], :],
-        #                                                        tip.astype(float)[idx_thresh[0]][:, np.newaxis])
-        #         # Write the data to the temporary file
-        #         ofp = np.memmap(output_filename, dtype='float', mode='w+', shape=(nx, ny, nz))
-        #         ofp[idx[i]:idx[i+1], :, :] = current_out_norm.reshape(num_spectra, ny, nz)
-        #         del ofp
-
-        # Save the data
-        self['norm_msidata'] = np.memmap(output_filename, dtype=outformat, mode='w+', shape=(nx, ny, nz))
-        self['norm_mz'] = mzdata
-        output_filename.close()
-
-    def record_execute_analysis_outputs(self, analysis_output):
+        # Normalize the data one-block-at-a-time, unless we write the data directly to file later
+        self.__tic_norm = (tic_norm_factors, msi_spectrum_maxs, outformat)
+        norm_msidata = None
+        if not self['deferred']:
+            output_filename = TemporaryFile()  # Create a temporary file to compute the normalization out-of-core
+            norm_msidata = np.memmap(output_filename, dtype=outformat, mode='w+', shape=(nx, ny, nz))
+            self.normalize(out=norm_msidata)
+            output_filename.close()
+
+        return norm_msidata, mzdata
+
+    def normalize(self, out):
+        """
+        Normalize the data one-block-at-a-time using the normalization factors computed by execute_analysis.
+
+        :param out: Array-like (e.g., numpy.memmap or h5py.Dataset) with the shape of the msidata
+            to which the normalized data is written. Blocks are aligned with the chunking of the msidata.
         """
-        We are not returning any outputs here, but we are going to record them manually.
-        :param analysis_output: The output of the execute_analysis(...) function.
+        tic_norm_factors, msi_spectrum_maxs, outformat = self.__tic_norm
+        msidata = self['msidata']
+        nx = msidata.shape[0]
+        # The normalization uses a float64 copy of the block
+        block_x = get_block_size_x(msidata, self['memory_budget'], msidata.dtype.itemsize + 8)
+        blocks = [(x0, min(x0 + block_x, nx)) for x0 in range(0, nx, block_x)]
+        tasks = ((msidata[x0:x1, :, :],
+                  tic_norm_factors[x0:x1, :],
+                  msi_spectrum_maxs[x0:x1, :],
+                  self['maxCount'],
+                  outformat) for x0, x1 in blocks)
+        for (x0, x1), current_out_norm in zip(blocks, map_blocks(_tic_normalize_block, tasks,
+                                                                  num_processes=self['num_processes'])):
+            out[x0:x1, :, :] = current_out_norm
+
+    def write_deferred_analysis_data(self, analysis_group):
         """
-        pass
+        Normalize the data block-by-block directly into the norm_msidata dataset of the analysis group.
+        The dataset uses the chunking of the msidata if available.
+
+        :param analysis_group: The h5py.Group object where the analysis is stored.
+        """
+        msidata = self['msidata']
+        try:
+            chunks = msidata.__best_dataset__((slice(0, 1), slice(0, msidata.shape[1]),
+                                               slice(0, msidata.shape[2]))).chunks
+        except AttributeError:
+            chunks = getattr(msidata, 'chunks', None)
+        norm_msidata = analysis_group.create_dataset(name='norm_msidata',
+                                                     shape=tuple(msidata.shape),
+                                                     dtype=self.__tic_norm[2],
+                                                     chunks=True if chunks is None else
+                                                     tuple(max(1, min(c, n)) for c, n in zip(chunks, msidata.shape)))
+        self.normalize(out=norm_msidata)
 
     ###############################################################
     #  2) Integrating your analysis with the OpenMSI              #
@@ -1,6 +1,76 @@
 from omsi.analysis.base import analysis_base
+from omsi.shared.block_helper import map_blocks
 import numpy as np
 
+
+def rebin_tile(tile, q, sigma, truncate=4.0):
+    """
+    Rebin the m/z axis of a block of spectra. The new bin j is the sum of the old bins
+    q[j]...q[j+1]-1 and the rebinned spectra are smoothed with a 1D Gaussian along m/z.
+
+    :param tile: numpy array with the spectra along the last axis
+    :param q: Indices of the old m/z bins at which the new bins start, see omsi_mz_rebin.execute_analysis
+    :param sigma: Standard deviation of the Gaussian kernel in units of new bins
+    :param truncate: Number of std. deviations at which to truncate the kernel or None to use the
+        default of scipy (for old scipy versions that do not support the truncate parameter)
+
+    :returns: numpy array with the rebinned spectra. The last axis has len(q)-1 values.
+    """
+    import scipy.ndimage as ndi
+    # Accumulate in the same dtype as numpy does for a cumsum of the tile
+    acc_dtype = np.cumsum(np.zeros(1, dtype=tile.dtype)).dtype
+    cs = np.zeros(tile.shape[:-1] + (tile.shape[-1] + 1,), dtype=acc_dtype)
+    np.cumsum(tile, axis=-1, dtype=acc_dtype, out=cs[..., 1:])
+    scan = np.diff(cs.take(q, axis=-1), axis=-1)
+    if truncate is None:
+        return ndi.gaussian_filter1d(scan, sigma=sigma, axis=-1)
+    return ndi.gaussian_filter1d(scan, sigma=sigma, axis=-1, truncate=truncate)
+
+
+def _rebin_tile(args):
+    """Helper function used to call rebin_tile from a multiprocessing pool"""
+    return rebin_tile(*args)
+
+
+def rebin_mz(msidata, q, sigma, truncate=4.0, out=None, dtype='float64', tile_size=2**24, num_processes=1):
+    """
+    Rebin the m/z axis of all spectra of a MSI dataset tile-by-tile. Tiles of (x, y, mz) spectra
+    are read from msidata, rebinned with rebin_tile, and written to out, so that neither the
+    input nor the output need to fit in memory if they are file-based.
+
+    :param msidata: 3D array-like with the MSI data, e.g., a numpy array, h5py.Dataset or omsi_file_msidata
+    :param q: Indices of the old m/z bins at which the new bins start, see omsi_mz_rebin.execute_analysis
+    :param sigma: Standard deviation of the Gaussian kernel in units of new bins
+    :param truncate: Number of std. deviations at which to truncate the kernel, see rebin_tile
+    :param out: Optional 3D array-like (e.g., a h5py.Dataset) of shape (nx, ny, len(q)-1) for the result.
+        If out is chunked, then the tiles are aligned with its chunks. If None, a numpy array is allocated.
+    :param dtype: The dtype of the output array if out is None
+    :param tile_size: Approximate number of values of msidata processed at once
+    :param num_processes: Number of processes used to rebin tiles in parallel
+
+    :returns: The out array with the rebinned data
+    """
+    nx, ny, nmz = msidata.shape[0], msidata.shape[1], msidata.shape[2]
+    if out is None:
+        out = np.zeros((nx, ny, len(q) - 1), dtype=dtype)
+
+    # Determine the tile shape. We use full rows in y if possible and align the tiles with the chunking of out.
+    tile_y = ny if ny * nmz <= tile_size else max(1, tile_size // max(nmz, 1))
+    tile_x = max(1, tile_size // max(tile_y * nmz, 1)) if tile_y == ny else 1
+    chunks = getattr(out, 'chunks', None)
+    if chunks is not None:
+        if tile_y < ny:
+            tile_y = max(chunks[1], tile_y - tile_y % chunks[1])
+        tile_x = max(chunks[0], tile_x - tile_x % chunks[0])
+    tiles = [(x0, min(x0 + tile_x, nx), y0, min(y0 + tile_y, ny))
+             for x0 in range(0, nx, tile_x) for y0 in range(0, ny, tile_y)]
+
+    tasks = ((msidata[x0:x1, y0:y1, :], q, sigma, truncate) for x0, x1, y0, y1 in tiles)
+    for (x0, x1, y0, y1), result in zip(tiles, map_blocks(_rebin_tile, tasks, num_processes=num_processes)):
+        out[x0:x1, y0:y1, :] = result
+        print('Rebinning pixel %s of %s' % ((x1 - 1) * ny + y1, nx * ny))
+    return out
+
 ###############################################################
 #  1) Basic integration of your analysis with omsi (Required) #
 ###############################################################
@@ -56,8 +126,33 @@ class omsi_mz_rebin(analysis_base):
                            default=4,
                            group=groups['settings'])
 
+        self.add_parameter(name='output_dtype',
+                           help='The data type of the rebinned MSI data',
+                           dtype=str,
+                           required=False,
+                           default='float64',
+                           choices=['float64', 'float32'],
+                           group=groups['settings'])
+
+        self.add_parameter(name='tile_size',
+                           help='Approximate number of values of the MSI data that are rebinned at once',
+                           dtype=int,
+                           required=False,
+                           default=2**24,
+                           group=groups['settings'])
+
+        self.add_parameter(name='num_processes',
+                           help='Number of processes used to rebin tiles of the data in parallel',
+                           dtype=int,
+                           required=False,
+                           default=1,
+                           group=groups['parallel'])
+
         self.data_names = ['new_msidata', 'new_mz']
+        self.deferred_data_names = ['new_msidata']
+        self.add_deferred_parameter()
         self.analysis_identifier = name_key
+        self.__rebin_settings = None
 
 
     def execute_analysis(self):
@@ -112,7 +207,6 @@ class omsi_mz_rebin(analysis_base):
             new_mzdata = np.arange(minmz, maxmz, new_spacing)
 
         # do rebinning
-        ## !this could be improved by multithreading or multiprocessing, esp. for gaussian smoothing
 
         # map new bins to old bins; only done once per image, not per pixel
 
@@ -127,34 +221,40 @@ class omsi_mz_rebin(analysis_base):
             old_min_spacing = np.min(np.diff(mzdata))
             new_min_spacing = np.min(np.diff(new_mzdata))
             filter_sigma = max(old_min_spacing/new_min_spacing, 1)
-
-        ## initialize new datacube
-        nx = msidata.shape[0]
-        ny = msidata.shape[1]
-        nmz = len(new_mzdata)
-
-        new_msidata = np.zeros([nx, ny, nmz])
-
-        #define a zero for padding
-        zero = np.array(0, dtype=msidata.dtype)
-        npixel = nx*ny
-        ## interpolation loop
-        for ix in range(nx):
-            for iy in range(ny):
-                cs = np.concatenate(([zero, ], msidata[ix, iy, :].cumsum()))
-                scan = np.diff(cs[q])
-                if scipy_main_version > 13:
-                    new_msidata[ix, iy, :] = \
-                        ndi.filters.gaussian_filter(scan, sigma=filter_sigma, truncate=trunc)
-                else:
-                    new_msidata[ix, iy, :] = \
-                        ndi.filters.gaussian_filter(scan, sigma=filter_sigma)
-                if ix%10==0 and ix==iy:
-                    print('Rebinning pixel %s of %s' % (ix*iy, npixel))
+        if scipy_main_version <= 13:
+            trunc = None
+
+        # rebin the data tile-by-tile, or defer the rebinning until the data is written to file
+        self.__rebin_settings = (q, filter_sigma, trunc)
+        new_msidata = None
+        if not self['deferred']:
+            new_msidata = rebin_mz(msidata, q, filter_sigma,
+                                   truncate=trunc,
+                                   dtype=self['output_dtype'],
+                                   tile_size=self['tile_size'],
+                                   num_processes=self['num_processes'])
 
         #return variables
-        return np.asarray(new_msidata), np.asarray(new_mzdata)
+        return new_msidata, np.asarray(new_mzdata)
+
+
+    def write_deferred_analysis_data(self, analysis_group):
+        """
+        Rebin the data tile-by-tile directly into the new_msidata dataset of the analysis group.
 
+        :param analysis_group: The h5py.Group object where the analysis is stored.
+        """
+        q, filter_sigma, trunc = self.__rebin_settings
+        msidata = self['msidata']
+        new_msidata = analysis_group.create_dataset(name='new_msidata',
+                                                    shape=(msidata.shape[0], msidata.shape[1], len(q) - 1),
+                                                    dtype=self['output_dtype'],
+                                                    chunks=True)
+        rebin_mz(msidata, q, filter_sigma,
+                 truncate=trunc,
+                 out=new_msidata,
+                 tile_size=self['tile_size'],
+                 num_processes=self['num_processes'])
 
     ###############################################################
     #  2) Integrating your analysis with the OpenMSI              #
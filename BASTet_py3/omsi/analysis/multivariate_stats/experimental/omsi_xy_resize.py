@@ -1,10 +1,57 @@
-from omsi.analysis.omsi_analysis_base import omsi_analysis_base
+from omsi.analysis.base import analysis_base
+from omsi.shared.block_helper import map_blocks
 import numpy as np
 
+
+def _resize_tile(args):
+    """
+    Helper function used to resize a tile, e.g., from a multiprocessing pool.
+
+    :param args: Tuple of (tile, output_shape, order)
+    """
+    from skimage.transform import resize
+    tile, output_shape, order = args
+    return resize(tile, output_shape=output_shape, order=order)
+
+
+def resize_xy(msidata, output_shape, order=0, out=None, tile_size=2**24, num_processes=1):
+    """
+    Resize all images of a MSI dataset in m/z-slabs. Each slab contains the complete images for a
+    range of m/z values, so that neither the input nor the output need to fit in memory if they are file-based.
+
+    :param msidata: 3D array-like with the MSI data, e.g., a numpy array, h5py.Dataset or omsi_file_msidata.
+        omsi_file_msidata automatically reads the m/z-slabs from the image-chunked copy of the data if available.
+    :param output_shape: Tuple with the number of pixels in x and y of the resized images
+    :param order: Polynomial order of the spline interpolation, see skimage.transform.resize
+    :param out: Optional 3D array-like (e.g., a h5py.Dataset) of shape (nx, ny, mz) for the result.
+        If out is chunked, then the slabs are aligned with its chunks. If None, a float64 numpy array is allocated.
+    :param tile_size: Approximate number of values of the input or output processed at once
+    :param num_processes: Number of processes used to resize slabs in parallel
+
+    :returns: The out array with the resized data
+    """
+    output_shape = (int(output_shape[0]), int(output_shape[1]))
+    nmz = msidata.shape[2]
+    if out is None:
+        out = np.zeros(output_shape + (nmz,), dtype='float64')
+    image_size = max(msidata.shape[0] * msidata.shape[1], output_shape[0] * output_shape[1], 1)
+    tile_z = max(1, tile_size // image_size)
+    chunks = getattr(out, 'chunks', None)
+    if chunks is not None:
+        tile_z = max(chunks[2], tile_z - tile_z % chunks[2])
+    tiles = [(z0, min(z0 + tile_z, nmz)) for z0 in range(0, nmz, tile_z)]
+
+    tasks = ((msidata[:, :, z0:z1], output_shape, order) for z0, z1 in tiles)
+    for tile_index, ((z0, z1), result) in enumerate(zip(tiles, map_blocks(_resize_tile, tasks,
+                                                                          num_processes=num_processes))):
+        out[:, :, z0:z1] = result
+        print('Resizing slab %s of %s' % (tile_index + 1, len(tiles)))
+    return out
+
 ###############################################################
 #  1) Basic integration of your analysis with omsi (Required) #
 ###############################################################
-class omsi_xy_resize(omsi_analysis_base):
+class omsi_xy_resize(analysis_base):
     """
     Class representing resizing in x and y of an image via interpolation (slow).
     """
@@ -41,7 +88,23 @@ class omsi_xy_resize(omsi_analysis_base):
                            default=0,
                            group=groups['input'])
 
+        self.add_parameter(name='tile_size',
+                           help='Approximate number of values of the MSI data that are resized at once',
+                           dtype=int,
+                           required=False,
+                           default=2**24,
+                           group=groups['settings'])
+
+        self.add_parameter(name='num_processes',
+                           help='Number of processes used to resize slabs of the data in parallel',
+                           dtype=int,
+                           required=False,
+                           default=1,
+                           group=groups['parallel'])
+
         self.data_names = ['new_msidata']
+        self.deferred_data_names = ['new_msidata']
+        self.add_deferred_parameter()
         self.analysis_identifier = name_key
 
     def execute_analysis(self):
@@ -65,16 +128,32 @@ class omsi_xy_resize(omsi_analysis_base):
         ny = self['ny']
         order = self['order']
 
-        #prepping output array to ensure desired size
+        #do interpolation slab-by-slab, unless it is deferred until the data is written to file
+        if self['deferred']:
+            return None
+        new_msidata = resize_xy(msidata, [nx, ny],
+                                order=order,
+                                tile_size=self['tile_size'],
+                                num_processes=self['num_processes'])
+        #return variables
+        return new_msidata
 
-        oldx = msidata.shape[0]
-        oldy = msidata.shape[1]
-        nmz = msidata.shape[2]
+    def write_deferred_analysis_data(self, analysis_group):
+        """
+        Resize the data slab-by-slab directly into the new_msidata dataset of the analysis group.
 
-        #do interpolation
-        new_msidata = resize(msidata[:], output_shape=[nx, ny], order=order)
-        #return variables
-        return np.asarray(new_msidata)
+        :param analysis_group: The h5py.Group object where the analysis is stored.
+        """
+        msidata = self['msidata']
+        new_msidata = analysis_group.create_dataset(name='new_msidata',
+                                                    shape=(int(self['nx']), int(self['ny']), msidata.shape[2]),
+                                                    dtype='float64',
+                                                    chunks=True)
+        resize_xy(msidata, [self['nx'], self['ny']],
+                  order=self['order'],
+                  out=new_msidata,
+                  tile_size=self['tile_size'],
+                  num_processes=self['num_processes'])
 
 
     ###############################################################
@@ -101,7 +180,7 @@ class omsi_xy_resize(omsi_analysis_base):
         """
 
         # Convert the z selection to a python selection
-        from omsi.shared.omsi_data_selection import selection_string_to_object
+        from omsi.shared.data_selection import selection_string_to_object
         zselect = selection_string_to_object(z)  # Convert the selection string to a python selection
 
         """EDIT_ME Specify the number of custom viewer_options you are going to provide for qslice"""
@@ -159,7 +238,7 @@ class omsi_xy_resize(omsi_analysis_base):
         """
 
         # Convert the x,y selection to a python selection
-        from omsi.shared.omsi_data_selection import selection_string_to_object
+        from omsi.shared.data_selection import selection_string_to_object
         x_select = selection_string_to_object(x)  # Convert the selection string to a python selection
         y_select = selection_string_to_object(y)  # Convert the selection string to a python selection
 
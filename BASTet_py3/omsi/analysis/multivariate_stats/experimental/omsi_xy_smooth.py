@@ -1,6 +1,71 @@
 from omsi.analysis.base import analysis_base
+from omsi.shared.block_helper import map_blocks
 import numpy as np
 
+
+def _smooth_tile(args):
+    """
+    Helper function used to smooth a tile, e.g., from a multiprocessing pool.
+
+    :param args: Tuple of (tile, sigma, order, truncate, crop) where crop is the (start, stop)
+        range along x of the smoothed tile that should be returned, i.e., the tile without its halo.
+    """
+    import scipy.ndimage as ndi
+    tile, sigma, order, truncate, crop = args
+    return ndi.gaussian_filter(tile, sigma=[sigma[0], sigma[1], 0], order=order, truncate=truncate)[crop[0]:crop[1]]
+
+
+def smooth_xy(msidata, sigma, order=0, truncate=4.0, out=None, tile_size=2**24, num_processes=1):
+    """
+    Smooth all images of a MSI dataset with a 2D Gaussian tile-by-tile. The data is processed in
+    m/z-slabs of complete images. If a single image is larger than tile_size, then the images are
+    additionally split along x, and each tile is read with the halo of truncate*sigma pixels needed
+    to compute the filter exactly. The result is, hence, identical to filtering the complete data at once.
+
+    :param msidata: 3D array-like with the MSI data, e.g., a numpy array, h5py.Dataset or omsi_file_msidata.
+        omsi_file_msidata automatically reads the m/z-slabs from the image-chunked copy of the data if available.
+    :param sigma: Tuple of the standard deviation in pixels in x and y
+    :param order: Order of the Gaussian derivative filter, see scipy.ndimage.gaussian_filter
+    :param truncate: Number of std. deviations at which to truncate the Gaussian kernel
+    :param out: Optional 3D array-like (e.g., a h5py.Dataset) with the shape of msidata for the result.
+        If out is chunked, then the tiles are aligned with its chunks. If None, a numpy array with the
+        dtype of msidata is allocated.
+    :param tile_size: Approximate number of values of msidata processed at once (without the halo)
+    :param num_processes: Number of processes used to smooth tiles in parallel
+
+    :returns: The out array with the smoothed data
+    """
+    nx, ny, nmz = msidata.shape[0], msidata.shape[1], msidata.shape[2]
+    if out is None:
+        out = np.zeros((nx, ny, nmz), dtype=msidata.dtype)
+    # The halo in x needed to compute the Gaussian exactly, see scipy.ndimage.gaussian_filter1d
+    halo_x = int(truncate * float(sigma[0]) + 0.5) if float(sigma[0]) > 1e-15 else 0
+
+    # Determine the tile shape. We use m/z-slabs of complete images if possible and
+    # align the tiles with the chunking of out
+    tile_x = nx if nx * ny <= tile_size else max(1, tile_size // max(ny, 1))
+    tile_z = max(1, tile_size // max(tile_x * ny, 1)) if tile_x == nx else 1
+    chunks = getattr(out, 'chunks', None)
+    if chunks is not None:
+        if tile_x < nx:
+            tile_x = max(chunks[0], tile_x - tile_x % chunks[0])
+        tile_z = max(chunks[2], tile_z - tile_z % chunks[2])
+    tiles = [(x0, min(x0 + tile_x, nx), z0, min(z0 + tile_z, nmz))
+             for z0 in range(0, nmz, tile_z) for x0 in range(0, nx, tile_x)]
+
+    def read_tile(x0, x1, z0, z1):
+        # Read the tile together with its halo in x
+        read_x0 = max(0, x0 - halo_x)
+        read_x1 = min(nx, x1 + halo_x)
+        return msidata[read_x0:read_x1, :, z0:z1], sigma, order, truncate, (x0 - read_x0, x1 - read_x0)
+
+    tasks = (read_tile(*tile) for tile in tiles)
+    for tile_index, ((x0, x1, z0, z1), result) in enumerate(zip(tiles, map_blocks(_smooth_tile, tasks,
+                                                                                   num_processes=num_processes))):
+        out[x0:x1, :, z0:z1] = result
+        print('Smoothing tile %s of %s' % (tile_index + 1, len(tiles)))
+    return out
+
 ###############################################################
 #  1) Basic integration of your analysis with omsi (Required) #
 ###############################################################
@@ -48,7 +113,23 @@ class omsi_xy_smooth(analysis_base):
                            default=4,
                            group=groups['settings'])
 
+        self.add_parameter(name='tile_size',
+                           help='Approximate number of values of the MSI data that are smoothed at once',
+                           dtype=int,
+                           required=False,
+                           default=2**24,
+                           group=groups['settings'])
+
+        self.add_parameter(name='num_processes',
+                           help='Number of processes used to smooth tiles of the data in parallel',
+                           dtype=int,
+                           required=False,
+                           default=1,
+                           group=groups['parallel'])
+
         self.data_names = ['new_msidata']
+        self.deferred_data_names = ['new_msidata']
+        self.add_deferred_parameter()
         self.analysis_identifier = name_key
 
     def execute_analysis(self):
@@ -82,11 +163,34 @@ class omsi_xy_smooth(analysis_base):
         order = self['order']
         trunc = self['truncate']
 
-        #smoothing
-        gaussfilt = ndi.filters.gaussian_filter
-        new_msidata = gaussfilt(msidata, sigma=[sigma_x, sigma_y, 0], order=order, truncate=trunc)
+        #smoothing tile-by-tile, unless it is deferred until the data is written to file
+        if self['deferred']:
+            return None
+        new_msidata = smooth_xy(msidata, [sigma_x, sigma_y],
+                                order=order,
+                                truncate=trunc,
+                                tile_size=self['tile_size'],
+                                num_processes=self['num_processes'])
         #return variables
-        return np.asarray(new_msidata)
+        return new_msidata
+
+    def write_deferred_analysis_data(self, analysis_group):
+        """
+        Smooth the data tile-by-tile directly into the new_msidata dataset of the analysis group.
+
+        :param analysis_group: The h5py.Group object where the analysis is stored.
+        """
+        msidata = self['msidata']
+        new_msidata = analysis_group.create_dataset(name='new_msidata',
+                                                    shape=tuple(msidata.shape),
+                                                    dtype=msidata.dtype,
+                                                    chunks=True)
+        smooth_xy(msidata, [self['sigma_x'], self['sigma_y']],
+                  order=self['order'],
+                  truncate=self['truncate'],
+                  out=new_msidata,
+                  tile_size=self['tile_size'],
+                  num_processes=self['num_processes'])
 
 
     ###############################################################
@@ -9,6 +9,8 @@ ToDo:
 * Need to implement new file format for combined raw data file (ie., multiple raw files in one folder).
 
 """
+import math
+
 from omsi.datastructures.metadata.metadata_data import metadata_dict
 
 class file_reader_base(object):
@@ -42,6 +44,9 @@ class file_reader_base(object):
 
     * ``__getitem__`` : Implement array slicing for files. Reuqired if the requires_slicing parameter
             should be supported.
+    * ``spectrum_iter_tiles`` : Generator function that iterates over the spectra of a partition of the \
+        (x, y) tiles of the data cube. Readers that can read the spectra of a tile directly should overwrite \
+        this function and ``supports_tile_iter``.
     * ``supports_regions`` : Specify whether the format supports multiple regions (default=False)
     * ``supports_multidata``: Specify whether the format supports multiple datasets (default=False)
     * ``supports_multiexperiment``: Specify whether the format supports multiple experiments (default=False)
@@ -84,6 +89,60 @@ class file_reader_base(object):
         """
         raise NotImplementedError('Iteration over spectra not supported by the file reader.')
 
+    def spectrum_iter_tiles(self, tile_shape, partition_index=0, num_partitions=1):
+        """
+        Enable iteration over the spectra of a partition of the (x, y) tiles of the current data cube.
+
+        The x/y plane is split into tiles of tile_shape[0] x tile_shape[1] spectra. The tiles are
+        numbered in C order and assigned round-robin to num_partitions partitions, i.e., the tile
+        with the index i belongs to the partition i % num_partitions. This allows multiple processes
+        to read disjoint parts of the same file, e.g., for pipelined file conversion.
+
+        The default implementation filters the spectra from spectrum_iter, i.e., each partition
+        still parses the complete file and the spectra are yielded in file order. Readers that
+        overwrite this function should yield all spectra of one tile before starting the next
+        one and indicate this via supports_tile_iter.
+
+        :param tile_shape: Tuple of (x, y) with the number of spectra of a tile
+        :param partition_index: Index of the partition of tiles to be read
+        :param num_partitions: Total number of partitions
+
+        :returns: The function yields for each spectrum the following information:
+
+            * tuple of (x,y) position of the spectrum
+            * Numpy array with the spectrum
+        """
+        num_tiles_y = self.get_num_tiles(tile_shape)[1]
+        for position, spectrum in self.spectrum_iter():
+            tile_index = (position[0] // tile_shape[0]) * num_tiles_y + position[1] // tile_shape[1]
+            if tile_index % num_partitions == partition_index:
+                yield position, spectrum
+
+    def get_num_tiles(self, tile_shape):
+        """
+        Get the number of tiles in x and y for the given tile shape.
+
+        :param tile_shape: Tuple of (x, y) with the number of spectra of a tile
+
+        :returns: Tuple of ints with the number of tiles in x and y
+        """
+        return (int(math.ceil(float(self.shape[0]) / float(tile_shape[0]))),
+                int(math.ceil(float(self.shape[1]) / float(tile_shape[1]))))
+
+    def get_tile_origins(self, tile_shape, partition_index=0, num_partitions=1):
+        """
+        Get the (x, y) start index of the tiles of the given partition (see spectrum_iter_tiles).
+
+        :param tile_shape: Tuple of (x, y) with the number of spectra of a tile
+        :param partition_index: Index of the partition of tiles
+        :param num_partitions: Total number of partitions
+
+        :returns: List of (x, y) tuples with the first spectrum of each tile in the partition
+        """
+        num_tiles_x, num_tiles_y = self.get_num_tiles(tile_shape)
+        return [((tile_index // num_tiles_y) * tile_shape[0], (tile_index % num_tiles_y) * tile_shape[1])
+                for tile_index in range(partition_index, num_tiles_x * num_tiles_y, num_partitions)]
+
     def close_file(self):
         """
         Close the file.
@@ -172,6 +231,14 @@ class file_reader_base(object):
         """
         return 1
 
+    @classmethod
+    def supports_tile_iter(cls):
+        """
+        Define whether the reader implements spectrum_iter_tiles such that each partition only
+        reads its own tiles and the spectra of a tile are yielded consecutively.
+        """
+        return False
+
     @classmethod
     def supports_regions(cls):
         """
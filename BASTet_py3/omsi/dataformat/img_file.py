@@ -192,7 +192,46 @@ class img_file(file_reader_base):
                                        dtype=self.data_type,
                                        count=self.shape[2])
                 yield (xindex, yindex), spektrum   # getitem will open the file if necessary
+        temp_img_file.close()
 
+    def spectrum_iter_tiles(self, tile_shape, partition_index=0, num_partitions=1):
+        """
+        Enable iteration over the spectra of a partition of the (x, y) tiles of the file
+        (see file_reader_base.spectrum_iter_tiles). The spectra of a tile are read one
+        row of the tile at a time as a row is stored contiguously in the img file.
+
+        :param tile_shape: Tuple of (x, y) with the number of spectra of a tile
+        :param partition_index: Index of the partition of tiles to be read
+        :param num_partitions: Total number of partitions
+
+        :return: tuple of ((x , y) , intensities), i.e., the tuple of (x, y) integer index of the spectrum and
+            the numpy array of the intensities
+        """
+        temp_img_file = open(self.img_filename, 'rb')
+        skip = self.shape[2] * np.dtype(self.data_type).itemsize
+        for xstart, ystart in self.get_tile_origins(tile_shape, partition_index, num_partitions):
+            yend = min(ystart + tile_shape[1], self.shape[1])
+            for xindex in range(xstart, min(xstart + tile_shape[0], self.shape[0])):
+                temp_img_file.seek(skip * (ystart + (xindex * self.shape[1])), 0)
+                spectra = np.fromfile(file=temp_img_file,
+                                      dtype=self.data_type,
+                                      count=(yend - ystart) * self.shape[2])
+                # Complete missing spectra at the end of the file with 0's
+                if spectra.size < (yend - ystart) * self.shape[2]:
+                    spectra = np.append(spectra, np.zeros((yend - ystart) * self.shape[2] - spectra.size,
+                                                          dtype=self.data_type))
+                spectra = spectra.reshape((yend - ystart, self.shape[2]))
+                for yindex in range(ystart, yend):
+                    yield (xindex, yindex), spectra[yindex - ystart]
+        temp_img_file.close()
+
+
+    @classmethod
+    def supports_tile_iter(cls):
+        """
+        The img reader reads the tiles of a partition directly.
+        """
+        return True
 
     def close_file(self):
         """Close the img file"""
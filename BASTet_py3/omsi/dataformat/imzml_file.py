@@ -5,7 +5,6 @@ This module provides functionality for reading imzML mass spectrometry image fil
 # import basic packages
 import numpy as np
 import os
-from scipy import interpolate
 # USE xmltodict to expand support for metadata from the imzml files
 
 # import xml parser
@@ -16,19 +15,27 @@ from omsi.shared.log import log_helper
 try:
     import xmltodict
 except ImportError:
-    import omsi.shared.third_party.xmltodict
+    from omsi.shared.third_party import xmltodict
 
 class imzml_file(file_reader_base):
     """
     Interface for reading a single 2D imzml file with a single distinct scan types.
-    """
-    # TODO: Rewrite the entire class to call the pyimzml.ImzMLParser only once for efficiency.
 
+    The imzML XML file is parsed only once to create an index of the offsets of all spectra
+    in the binary .ibd file. The .ibd file is memory-mapped, i.e., spectra of continuous
+    imzML files are read without copies and processed imzML files are reinterpolated to a
+    common m/z axis in batches of spectra. Slicing reads only the selected spectra.
+    """
     available_imzml_types = {'unknown': 'unknown',
                             'continuous': 'continuous',
                             'processed': 'processed'}
 
+    # Accessions of the imzML file content cvParams describing the imzML type
+    imzml_type_accessions = {'IMS:1000030': 'continuous',
+                             'IMS:1000031': 'processed'}
 
+    # Maximum number of values of the arrays used for reinterpolating a batch of processed spectra
+    regrid_batch_values = 2**21
 
     def __init__(self, basename, requires_slicing=True, resolution=15):
         """
@@ -38,8 +45,8 @@ class imzml_file(file_reader_base):
                              in the directory will be used instead.
         :type   basename:   string
 
-        :param  requires_slicing:   Should the complete data be read into memory
-                             (this makes slicing easier). (default is True)
+        :param  requires_slicing:   Unused. Slicing is always supported and reads only the selected
+                             spectra via the index of the .ibd file.
         :type   requires_slicing:   bool
 
         :param resolution: For processed data only, the minimum m/z spacing to use for creating the "full" reprofiled
@@ -57,14 +64,20 @@ class imzml_file(file_reader_base):
         # Call super constructor. This sets self.basename and self.readall
         super(imzml_file, self).__init__(basename=basename, requires_slicing=requires_slicing)
         self.resolution=resolution
+        self.ibd_file = None
 
-        # Compute the mz axis, pixel coordinates data type etc.
-        self.coordinates, self.mz, self.data_type, self.imzml_type, self.dataset_metadata, self.instrument_metadata, \
-        self.method_metadata = self.__compute_file_info(filename=self.basename, resolution=self.resolution)
+        # Parse the imzML file once to index the spectra and read the metadata
+        self.coordinates, self.mz_offsets, self.mz_lengths, self.mz_dtype, self.intensity_offsets, \
+        self.intensity_lengths, self.data_type, self.imzml_type, self.dataset_metadata, self.instrument_metadata, \
+        self.method_metadata = self.__compute_file_info(filename=self.basename)
+        self.ibd_file = np.memmap(self.get_ibd_filename(self.basename), dtype='uint8', mode='r')
 
-        self.num_scans = self.coordinates.size
+        self.num_scans = self.coordinates.shape[0]
         log_helper.info(__name__, 'Read %s scans from imzML file.' % self.num_scans)
 
+        # Compute the mz axis
+        self.mz = self.__compute_mz_axis()
+
         # Compute step size
         self.x_pos = np.unique(self.coordinates[:, 0])
         self.y_pos = np.unique(self.coordinates[:, 1])
@@ -79,118 +92,217 @@ class imzml_file(file_reader_base):
 
         self.shape = (num_x,num_y, self.mz.size)
 
-        # Read the data into memory
-        self.data = None
-        if requires_slicing:
-            self.__read_all(filename=basename)
+        # Map the pixels to the index of their spectrum in the file. Missing pixels are -1.
+        # Coordinates may start at arbitrary locations, hence, we need to substract the minimum to recenter at (0,0)
+        self.xindices = self.coordinates[:, 0] - self.x_pos_min
+        self.yindices = self.coordinates[:, 1] - self.y_pos_min
+        self.spectrum_index = np.full(self.shape[:2], -1, dtype='int64')
+        self.spectrum_index[self.xindices, self.yindices] = np.arange(self.num_scans)
 
         log_helper.info(__name__, "IMZML file type: " + str(self.imzml_type))
         log_helper.info(__name__, "IMZML data type: " + str(self.data_type))
 
-
-
-    def __read_all(self, filename):
+    def spectrum_iter(self):
         """
-        Internal helper function used to read all data. The
-        function directly modifies the self.data entry.  Data is now a list of datacubes.
+        Generator function that yields a position and associated spectrum for a selected datacube type.
+        :yield: (xidx, yidx) a tuple of ints representing x and y position in the image
+        :yield: yi,          a numpy 1D-array of floats containing spectral intensities at the given position
+                                and for the selected datacube type
         """
+        for spectrum in self.__iter_spectra(np.arange(self.num_scans)):
+            yield spectrum
 
-        self.data = np.zeros(shape=self.shape, dtype=self.data_type)
-        log_helper.info(__name__, 'Datacube shape is %s' % [self.data.shape])
-        reader = ImzMLParser(filename)
-        log_helper.debug(__name__,'READING ALL DATA!! GIVE ME RAM (please)!')
+    def spectrum_iter_tiles(self, tile_shape, partition_index=0, num_partitions=1):
+        """
+        Generator function that yields a position and associated spectrum for the spectra of a partition
+        of the (x, y) tiles of the image (see file_reader_base.spectrum_iter_tiles). Only the spectra of
+        the partition are read and the spectra are sorted by tile.
 
-        # Compute the bin edges for reinterpolation if needed
-        if self.imzml_type == self.available_imzml_types['processed']:
-            shift = np.diff(self.mz).mean()
-            bin_edges = np.append(self.mz, self.mz[-1]+ shift)
-        else:
-            bin_edges = None
-        for ind in range(0, len(reader.coordinates)):
-            xidx, yidx = reader.coordinates[ind]
-            # Coordinates may start at arbitrary locations, hence, we need to substract the minimum to recenter at (0,0)
-            xidx -= self.x_pos_min
-            yidx -= self.y_pos_min
-            # Read the spectrum
-            mz, intens = reader.getspectrum(ind)
-            # Reinterpolate intensities if we are in processed mode
-            if bin_edges is not None:
-                f = interpolate.interp1d(mz,intens,fill_value=0,bounds_error=False)
-                intens = f(self.mz)
-                #intens, bin_edges_new = np.histogram(mz, bins=bin_edges, weights=intens)
-            # Save the intensity values in our data cube
-            self.data[xidx, yidx, :] = intens
+        :param tile_shape: Tuple of (x, y) with the number of spectra of a tile
+        :param partition_index: Index of the partition of tiles to be read
+        :param num_partitions: Total number of partitions
 
-    def spectrum_iter(self):
-        """
-        Generator function that yields a position and associated spectrum for a selected datacube type.
         :yield: (xidx, yidx) a tuple of ints representing x and y position in the image
         :yield: yi,          a numpy 1D-array of floats containing spectral intensities at the given position
-                                and for the selected datacube type
         """
-        reader = ImzMLParser(self.basename)
-        for idx in range(0, len(reader.coordinates)):
-            xidx, yidx, zidx = reader.coordinates[idx]
-            # Coordinates may start at arbitrary locations, hence, we need to substract the minimum to recenter at (0,0)
-            xidx -= self.x_pos_min
-            yidx -= self.y_pos_min
-            mz, intens = reader.getspectrum(idx)
-            # Rehistogram the data if we are in procesed mode
+        tile_indices = (self.xindices // tile_shape[0]) * self.get_num_tiles(tile_shape)[1] + \
+            self.yindices // tile_shape[1]
+        selected = np.where(tile_indices % num_partitions == partition_index)[0]
+        selected = selected[np.lexsort((self.yindices[selected], self.xindices[selected], tile_indices[selected]))]
+        for spectrum in self.__iter_spectra(selected):
+            yield spectrum
+
+    def __iter_spectra(self, indices):
+        """
+        Internal helper function used to iterate over the spectra with the given indices in the file.
+        Processed spectra are reinterpolated in batches.
+
+        :param indices: Numpy array with the indices of the spectra in the file
+
+        :yield: Tuple of ((xidx, yidx), intensities)
+        """
+        batch_size = self.__get_batch_size()
+        for batch_start in range(0, len(indices), batch_size):
+            batch = indices[batch_start:(batch_start + batch_size)]
             if self.imzml_type == self.available_imzml_types['processed']:
-                # shift = np.diff(self.mz).mean()
-                # bin_edges = np.append(self.mz, self.mz[-1]+ shift)
-                f = interpolate.interp1d(mz,intens,fill_value=0,bounds_error=False)
-                intens = f(self.mz)
-                # intens, bin_edges_new = np.histogram(mz, bins=bin_edges, weights=intens)
+                spectra = self.__regrid_spectra(batch)
+            else:
+                spectra = [self.__read_array(self.intensity_offsets[idx], self.intensity_lengths[idx], self.data_type)
+                           for idx in batch]
+            for idx, intens in zip(batch, spectra):
+                yield (self.xindices[idx], self.yindices[idx]), intens
+
+    def __get_batch_size(self):
+        """
+        Internal helper function used to compute the number of spectra to be read or reinterpolated at once.
+        """
+        return max(1, self.regrid_batch_values // max(1, self.mz.size))
 
-            yield (xidx, yidx), np.asarray(intens)
+    def __read_array(self, offset, length, dtype):
+        """
+        Internal helper function used to read an array from the .ibd file without copying the data.
+
+        :param offset: Offset of the array in bytes
+        :param length: Number of values of the array
+        :param dtype: The data type of the values
+
+        :return: Read-only numpy array backed by the memory-mapped .ibd file
+        """
+        return np.frombuffer(self.ibd_file, dtype=dtype, count=int(length), offset=int(offset))
+
+    def __read_values(self, offsets, dtype):
+        """
+        Internal helper function used to read a single value at each of the given offsets in the .ibd file.
+
+        :param offsets: Numpy array with the offsets of the values in bytes
+        :param dtype: The data type of the values
+
+        :return: Numpy array with one value per offset
+        """
+        dtype = np.dtype(dtype)
+        byte_indices = np.asarray(offsets, dtype='int64')[:, np.newaxis] + np.arange(dtype.itemsize)
+        return np.ascontiguousarray(self.ibd_file[byte_indices]).view(dtype).reshape(-1)
+
+    def __regrid_spectra(self, indices):
+        """
+        Internal helper function used to linearly reinterpolate a batch of processed spectra to the m/z axis.
+        As for scipy's interp1d with fill_value=0, intensities outside of the m/z range of a spectrum are 0.
+        All spectra of the batch are located on the m/z axis using a single searchsorted on the peaks
+        of all spectra sorted by spectrum and m/z.
+
+        :param indices: Indices of the spectra in the file
+
+        :return: 2D numpy array with the reinterpolated spectra
+        """
+        indices = np.asarray(indices)
+        result = np.zeros((indices.size, self.mz.size), dtype='float64')
+        lengths = self.mz_lengths[indices]
+        if lengths.sum() == 0:
+            return result.astype(self.data_type)
+        mz = np.concatenate([self.__read_array(self.mz_offsets[idx], self.mz_lengths[idx], self.mz_dtype)
+                             for idx in indices]).astype('float64')
+        intens = np.concatenate([self.__read_array(self.intensity_offsets[idx], self.intensity_lengths[idx],
+                                                   self.data_type)
+                                 for idx in indices]).astype('float64')
+        spectrum_ids = np.repeat(np.arange(indices.size), lengths)
+        order = np.lexsort((mz, spectrum_ids))
+        mz = mz[order]
+        intens = intens[order]
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+
+        # Offset the m/z values of each spectrum so that the peaks of all spectra are sorted
+        mz_base = min(mz.min(), self.mz[0])
+        mz_span = max(mz.max(), self.mz[-1]) - mz_base + 1.0
+        keys = spectrum_ids * mz_span + (mz - mz_base)
+        queries = np.arange(indices.size)[:, np.newaxis] * mz_span + (self.mz - mz_base)[np.newaxis, :]
+        # Same choice of the interval as interp1d, i.e., the interval (lo, hi] containing each m/z value
+        hi = np.searchsorted(keys, queries)
+        hi = np.clip(hi, (starts + 1)[:, np.newaxis], np.maximum(ends - 1, starts + 1)[:, np.newaxis])
+        hi = np.minimum(hi, mz.size - 1)
+        lo = hi - 1
+
+        # Interpolate all spectra with at least 2 peaks
+        first = mz[np.minimum(starts, mz.size - 1)]
+        last = mz[np.maximum(ends - 1, 0)]
+        valid = (lengths >= 2)[:, np.newaxis] & \
+                (self.mz[np.newaxis, :] >= first[:, np.newaxis]) & \
+                (self.mz[np.newaxis, :] <= last[:, np.newaxis])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = (intens[hi] - intens[lo]) / (mz[hi] - mz[lo])
+            values = slope * (self.mz[np.newaxis, :] - mz[lo]) + intens[lo]
+        result[valid] = values[valid]
+
+        # Spectra with a single peak only have a value at the m/z of the peak
+        for spectrum_id in np.where(lengths == 1)[0]:
+            result[spectrum_id, self.mz == mz[starts[spectrum_id]]] = intens[starts[spectrum_id]]
+        return result.astype(self.data_type)
+
+    @classmethod
+    def supports_tile_iter(cls):
+        """
+        The imzML reader reads the spectra of the tiles of a partition directly.
+        """
+        return True
 
     @classmethod
-    def __compute_file_info(cls, filename, resolution):
-        ## TODO completely refactor this to make it smartly handle profile or centroid datasets
-        ## TODO: centroid datasets should take in a user parameter "Resolution" and resample data at that resolution
-        ## TODO: profile datasets should work as is
-        ## TODO: checks for profile data vs. centroid data on the variation in length of ['m/z array']
+    def get_ibd_filename(cls, filename):
+        """
+        Get the name of the binary .ibd file associated with the given imzML file.
+
+        :param filename: Name of the imzML file
+
+        :return: String with the name of the .ibd file
+        """
+        filename_only, extension = os.path.splitext(filename)
+        for ibd_extension in ['.ibd', '.IBD']:
+            if os.path.isfile(filename_only + ibd_extension):
+                return filename_only + ibd_extension
+        raise IOError("Could not find binary .ibd file for file %s" % filename)
+
+    def __compute_mz_axis(self):
         """
-        Internal helper function used to compute the mz axis, data type for the intensities, format type
+        Internal helper function used to compute the mz axis. For continuous files, this is the
+        m/z array shared by all spectra. For processed files, the m/z range of all spectra is
+        determined from the first and last value of the (sorted) m/z arrays and reinterpolated
+        based on the resolution.
 
         :return: Numpy array with mz axis
-        :return: string with data type
+        """
+        if self.imzml_type != self.available_imzml_types['processed']:
+            return np.array(self.__read_array(self.mz_offsets[0], self.mz_lengths[0], self.mz_dtype))
+        mz_itemsize = np.dtype(self.mz_dtype).itemsize
+        non_empty = self.mz_lengths > 0
+        min_mz = self.__read_values(self.mz_offsets[non_empty], self.mz_dtype).min()
+        max_mz = self.__read_values(self.mz_offsets[non_empty] + (self.mz_lengths[non_empty] - 1) * mz_itemsize,
+                                    self.mz_dtype).max()
+        f = int(np.ceil(1e6 * np.log(max_mz/min_mz)/self.resolution))
+        log_helper.info(__name__, "Reinterpolated m/z axis for processed imzML file")
+        return np.logspace(np.log10(min_mz), np.log10(max_mz), f)
+
+    @classmethod
+    def __compute_file_info(cls, filename):
+        """
+        Internal helper function used to index the spectra in the .ibd file and to determine the
+        data type for the intensities, the format type, and the metadata of the file.
+
+        :return: Numpy array with the coordinates of the spectra
+        :return: Numpy arrays with the byte offsets and lengths of the m/z arrays and the m/z data type
+        :return: Numpy arrays with the byte offsets and lengths of the intensity arrays and intensity data type
         :return: imzml file type
-        :return:
+        :return: dataset, instrument, and method metadata_dict
         """
         reader = ImzMLParser(filename)
-        # Read the first spectrum
-        mz_axes, intens = reader.getspectrum(0)   # NOTE: mz_axes is a tuple
-        # Read the coordinates
+        reader.m.close()
+        # Read the coordinates and the offsets of the arrays
         coordinates = np.asarray(reader.coordinates)
-
-        # #Start the data at [0,0,0]
-        # coordinates[:,0] = coordinates[:,0] - np.amin(coordinates,axis=0)[0]
-        # coordinates[:,1] = coordinates[:,1] - np.amin(coordinates,axis=0)[1]
-        # coordinates[:,2] = coordinates[:,2] - np.amin(coordinates,axis=0)[2]
-
-        # Determine the data type for the internsity values
-        dtype = np.asarray(intens).dtype.str
-
-        # Compute the mz axis and file type
-        file_type = cls.available_imzml_types['continuous']
-        min_mz, max_mz = np.amin(mz_axes), np.amax(mz_axes)
-        for ind in range(coordinates.shape[0]):      #for ind, loc in enumerate(reader.coordinates):
-            mz, intens = reader.getspectrum(ind)
-            if mz == mz_axes:
-                pass
-            else:
-                file_type = cls.available_imzml_types['processed']
-                if min_mz > np.amin(mz):
-                    min_mz = np.amin(mz)
-                if max_mz < np.amax(mz):
-                    max_mz = np.amax(mz)
-        # Reinterpolate the mz-axis if we have a processed mode imzml file
-        if file_type == cls.available_imzml_types['processed']:
-            f = np.ceil(1e6 * np.log(max_mz/min_mz)/resolution)
-            mz_axes = np.logspace(np.log10(min_mz), np.log10(max_mz), f)
-            log_helper.info(__name__, "Reinterpolated m/z axis for processed imzML file")
+        mz_offsets = np.asarray(reader.mzOffsets, dtype='int64')
+        mz_lengths = np.asarray(reader.mzLengths, dtype='int64')
+        intensity_offsets = np.asarray(reader.intensityOffsets, dtype='int64')
+        intensity_lengths = np.asarray(reader.intensityLengths, dtype='int64')
+        # imzML binary data is little endian
+        mz_dtype = np.dtype(reader.mzPrecision).newbyteorder('<').str
+        dtype = np.dtype(reader.intensityPrecision).newbyteorder('<').str
 
         # Construct the imzml metadata information
         dataset_metadata = metadata_dict()
@@ -209,9 +321,9 @@ class imzml_file(file_reader_base):
         # Parse the metadata for the file. We try to parse only the header and ignore the
         # <run > group in the XML file to avoid going throught the whole file again
         # while extracting the majority of the relevant metadata
+        metdata_header = ''
         try:
             with open(filename, 'r') as ins:
-                metdata_header = ''
                 for line in ins:
                     if '<run' in line:
                         break
@@ -245,7 +357,20 @@ class imzml_file(file_reader_base):
         except:
             log_helper.warning(__name__, "Extraction of additional imzML metadata failed")
 
-        return coordinates, np.asarray(mz_axes), dtype, file_type, dataset_metadata, instrument_metadata, method_metadata
+        # Determine the file type from the file content described in the header. If the
+        # header does not describe the type, then all spectra of continuous files share the m/z array.
+        file_type = cls.available_imzml_types['unknown']
+        for accession, imzml_type in cls.imzml_type_accessions.items():
+            if accession in metdata_header:
+                file_type = cls.available_imzml_types[imzml_type]
+        if file_type == cls.available_imzml_types['unknown']:
+            if np.all(mz_offsets == mz_offsets[0]) and np.all(mz_lengths == mz_lengths[0]):
+                file_type = cls.available_imzml_types['continuous']
+            else:
+                file_type = cls.available_imzml_types['processed']
+
+        return coordinates, mz_offsets, mz_lengths, mz_dtype, intensity_offsets, intensity_lengths, dtype, \
+            file_type, dataset_metadata, instrument_metadata, method_metadata
 
     @classmethod
     def test(cls):
@@ -255,18 +380,31 @@ class imzml_file(file_reader_base):
         pass
 
     def __getitem__(self, key):
-        """Enable slicing of img files"""
-        if self.data is not None:
-            if self.select_dataset is None:
-                return self.data[key]
-            else:
-                return self.data[self.select_dataset][key]
-        else:
-            raise ValueError("Slicing is currently only supported when the object has been initialized with readall")
+        """
+        Enable slicing of imzML files. Only the spectra of the selected pixels are read.
+        Pixels without a spectrum are 0.
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        spectrum_indices = np.asarray(self.spectrum_index[key[0], key[1]])
+        z_indices = np.arange(self.shape[2])[key[2]]
+        result = np.zeros(spectrum_indices.shape + z_indices.shape, dtype=self.data_type)
+        flat_result = result.reshape((spectrum_indices.size, -1))
+        flat_indices = spectrum_indices.reshape(-1)
+        positions = np.where(flat_indices >= 0)[0]
+        # Read the selected spectra in batches to limit the memory used
+        batch_size = self.__get_batch_size()
+        for batch_start in range(0, positions.size, batch_size):
+            batch_positions = positions[batch_start:(batch_start + batch_size)]
+            for position, (_, intens) in zip(batch_positions, self.__iter_spectra(flat_indices[batch_positions])):
+                flat_result[position] = intens[z_indices]
+        return result
 
     def close_file(self):
-        """Close the mzml file"""
-        pass
+        """Close the memory-mapped .ibd file"""
+        self.ibd_file = None
+
 
     @classmethod
     def is_valid_dataset(cls, name):
@@ -21,6 +21,11 @@ class mzml_file(file_reader_base_multidata):
     """
     Interface for reading a single 2D mzml file with several distinct scan types.
 
+    The scan types, coordinates, and mz axes of all scans are computed in a single pass
+    over the mzML file. Reading all data fans the spectra out to the datacubes of all
+    scan types in one additional pass. For indexed mzML files, spectrum_iter uses the
+    offsets of the spectra in the indexList to read only the spectra of the selected scan type.
+
     :ivar available_mzml_types: Dict of available mzml flavors.
     """
 
@@ -28,7 +33,7 @@ class mzml_file(file_reader_base_multidata):
                             'bruker': 'bruker',
                             'thermo': 'thermo'}
 
-    def __init__(self, basename, requires_slicing=True, resolution=5):
+    def __init__(self, basename, requires_slicing=True, resolution=5, use_index=True):
         """
         Open an img file for data reading.
 
@@ -43,6 +48,10 @@ class mzml_file(file_reader_base_multidata):
         :param resolution: For profile data only, the minimum m/z spacing to use for creating the "full" reprofiled
                             data cube
         :type resolution: float
+
+        :param use_index: Use the indexList of indexed mzML files to read only the spectra of the
+                            selected scan type in spectrum_iter. (default is True)
+        :type use_index: bool
         """
         # Determine the correct base
         if os.path.isdir(basename):
@@ -55,18 +64,17 @@ class mzml_file(file_reader_base_multidata):
         # Call super constructor. This sets self.basename and self.readall
         super(mzml_file, self).__init__(basename=basename, requires_slicing=requires_slicing)
         self.resolution = resolution
-        self.mzml_type = self.__compute_filetype(filename=self.basename)
         self.data_type = 'uint32'  # TODO What data type should we use for the interpolated data?
-        self.num_scans = self.__compute_num_scans(filename=self.basename)
+        log_helper.debug(__name__, 'Compute file type, scan types and indicies, coordinates, and mz axes')
+        self.mzml_type, self.spectrum_ids, self.scan_types, self.scan_indices, self.scan_profiled, \
+            self.coordinates, self.mz_all = self.__index_spectra(filename=self.basename, resolution=self.resolution)
+        self.num_scans = len(self.spectrum_ids)
         log_helper.info(__name__, 'Read %s scans from mzML file.' % self.num_scans)
-        log_helper.debug(__name__, 'Compute scan types and indicies')
-        self.scan_types, self.scan_indices, self.scan_profiled = self.__compute_scan_types_and_indices(filename=self.basename)
+        self.use_index = use_index and self.__has_index_list(filename=self.basename)
         log_helper.debug(__name__, 'Compute scan dependencies')
         self.scan_dependencies = self.__compute_scan_dependencies(scan_types=self.scan_types,
                                                                   basename=basename)
         log_helper.info(__name__, 'Found %s different scan types in mzML file.' % len(self.scan_types))
-        log_helper.debug(__name__, 'Compute coordinates')
-        self.coordinates = self.__compute_coordinates()
         log_helper.debug(__name__, 'Parse scan parameters')
         self.scan_params = self.__parse_scan_parameters(self)
 
@@ -75,12 +83,13 @@ class mzml_file(file_reader_base_multidata):
         self.y_pos = np.unique(self.coordinates[:, 1])
         self.step_size = min([min(np.diff(self.x_pos)), min(np.diff(self.y_pos))])
 
-        # Compute the mz axis
-        log_helper.debug(__name__, 'Compute mz axes')
-        self.mz_all = self.__compute_mz_axis(filename=self.basename,
-                                             mzml_filetype=self.mzml_type,
-                                             scan_types=self.scan_types,
-                                             resolution=self.resolution)
+        # Compute the x and y index of each scan in the datacube
+        self.xindices = np.searchsorted(self.x_pos, self.coordinates[:, 0])
+        self.yindices = np.searchsorted(self.y_pos, self.coordinates[:, 1])
+
+        # Compute the bin edges for re-histogramming the scan types in centroided mode
+        self.bin_edges_all = [None if profiled else np.append(mz, mz[-1] + np.diff(mz).mean())
+                              for mz, profiled in zip(self.mz_all, self.scan_profiled)]
 
         # Determine the shape of the dataset, result is a list of shapes for each datacube
         self.shape_all_data = [(self.x_pos.shape[0], self.y_pos.shape[0], mz.shape[0]) for mz in self.mz_all]
@@ -95,41 +104,20 @@ class mzml_file(file_reader_base_multidata):
     def __read_all(self):
         """
         Internal helper function used to read all data. The
-        function directly modifies the self.data entry.  Data is now a list of datacubes
+        function directly modifies the self.data entry.  Data is now a list of datacubes.
+        The spectra of all scan types are read in a single pass over the file.
         """
 
-        self.data = [np.zeros(shape=self.shape_all_data[scan_idx], dtype=self.data_type) for scan_idx, scantype in enumerate(self.scan_types)]
+        self.data = [np.zeros(shape=shape, dtype=self.data_type) for shape in self.shape_all_data]
 
-        for scan_idx, scantype in enumerate(self.scan_types):
-            reader = mzml.read(self.basename)
-            spectrumid = 0
-            if not self.scan_profiled[scan_idx]:
-                shift = np.diff(self.mz_all[scan_idx]).mean()
-                bin_edges = np.append(self.mz_all[scan_idx], self.mz_all[scan_idx][-1]+ shift)
-            else:
-                bin_edges = None
-
-            for spectrum in reader:
-                if spectrum['scanList']['scan'][0]['filter string'] == scantype:
-                    x = spectrum['m/z array']
-                    try:
-                        y = spectrum['intensity array']
-                    except KeyError:
-                        raise KeyError
-                    if bin_edges is None:
-                        yi = np.interp(self.mz_all[scan_idx], x, y, 0, 0)  # Re-interpolate the data in profiled mode
-                    else:
-                         yi, _ = np.histogram(x, bins=bin_edges, weights=y)   # Re-histogram the data in centroided mode
-                    xidx = np.nonzero(self.x_pos == self.coordinates[spectrumid, 0])[0]
-                    yidx = np.nonzero(self.y_pos == self.coordinates[spectrumid, 1])[0]
-                    try:
-                        self.data[scan_idx][xidx, yidx, :] = yi
-                    except:
-                        log_helper.debug(__name__, spectrumid, scan_idx, scantype, self.mz_all[scan_idx].shape)
+        reader = mzml.read(self.basename)
+        for spectrumid, spectrum in enumerate(reader):
+            scan_idx = self.scan_indices[spectrumid]
             # TODO Note if the data is expected to be of float precision then self.data_type needs to be set accordingly
-                if spectrumid%1000 == 0:
-                    log_helper.info(__name__, 'Processed data for %s spectra to datacube for scan type %s' % (spectrumid, scantype))
-                spectrumid += 1
+            self.data[scan_idx][self.xindices[spectrumid], self.yindices[spectrumid], :] = \
+                self.__regrid_spectrum(spectrum, scan_idx)
+            if spectrumid % 1000 == 0:
+                log_helper.info(__name__, 'Processed data for %s spectra to datacubes' % spectrumid)
 
     def spectrum_iter(self):
         """
@@ -140,98 +128,144 @@ class mzml_file(file_reader_base_multidata):
                              and for the selected datacube type
 
         """
-        reader = mzml.read(self.basename)
         if self.select_dataset is None:
            raise ValueError('Select a dataset to continue!')
         dataset_index = self.select_dataset
-        for idx, spectrum in enumerate(reader):
-            current_scan_index = self.scan_indices[idx]
-
-            if current_scan_index == dataset_index:
-                # get the mz axis of the datacube the scan belongs to
-                mz = self.mz_all[self.scan_indices[idx]]
-                x = spectrum['m/z array']
-                try:
-                    y = spectrum['intensity array']
-                except KeyError:
-                    raise KeyError('Key "intensity array" not found in this mzml file')
-
-                if self.scan_profiled[current_scan_index]:
-                    yi = np.interp(mz, x, y, 0, 0)      # Interpolate the data onto the new axes in profiles mode
-                else:
-                    shift = np.diff(mz).mean()
-                    bin_edges = np.append(mz, mz[-1]+ shift)
-                    yi, _ = np.histogram(x, bins=bin_edges, weights=y)   # Re-histogram the data in centroided mode
-                xidx = np.nonzero(self.x_pos == self.coordinates[idx, 0])[0][0]
-                yidx = np.nonzero(self.y_pos == self.coordinates[idx, 1])[0][0]
+        for idx, spectrum in self.__iter_spectra(np.where(self.scan_indices == dataset_index)[0]):
+            yield (self.xindices[idx], self.yindices[idx]), self.__regrid_spectrum(spectrum, dataset_index)
+
+    def __iter_spectra(self, indices):
+        """
+        Internal helper function used to iterate over the spectra with the given sorted indices.
+        For indexed mzML files, only the given spectra are read using the offsets from the indexList.
+
+        :param indices: Sorted numpy array with the indices of the spectra in the file
+
+        :yield: Tuple of (index, spectrum)
+        """
+        if self.use_index:
+            reader = mzml.PreIndexedMzML(self.basename)
+            try:
+                for idx in indices:
+                    yield idx, reader.get_by_id(self.spectrum_ids[idx])
+            finally:
+                reader.close()
+        else:
+            selected = np.zeros(self.num_scans, dtype='bool')
+            selected[indices] = True
+            reader = mzml.read(self.basename)
+            for idx, spectrum in enumerate(reader):
+                if selected[idx]:
+                    yield idx, spectrum
+
+    def __regrid_spectrum(self, spectrum, scan_idx):
+        """
+        Internal helper function used to reinterpolate (profile mode) or re-histogram (centroided mode)
+        a spectrum onto the mz axis of its scan type.
 
-                yield (xidx, yidx), yi
+        :param spectrum: The spectrum dict from pyteomics
+        :param scan_idx: Index of the scan type of the spectrum
 
+        :return: Numpy array with the intensities
+        """
+        x = spectrum['m/z array']
+        try:
+            y = spectrum['intensity array']
+        except KeyError:
+            raise KeyError('Key "intensity array" not found in this mzml file')
+        if self.scan_profiled[scan_idx]:
+            yi = np.interp(self.mz_all[scan_idx], x, y, 0, 0)  # Interpolate the data onto the new axes in profiles mode
+        else:
+            yi, _ = np.histogram(x, bins=self.bin_edges_all[scan_idx], weights=y)   # Re-histogram the data in centroided mode
+        return yi
 
     @classmethod
-    def __compute_mz_axis(cls, filename, mzml_filetype, scan_types, resolution):
+    def __index_spectra(cls, filename, resolution):
+        """
+        Internal helper function used to compute the filetype, the ids, scan types, and coordinates of all
+        scans and the mz axis of each scan type in a single pass over the mzml file.
+
+        :returns: The mzml file type
+        :returns: List of the ids of all spectra
+        :returns: List of unique scan types
+        :returns: Numpy 1d array of ints which index every scan to the relevant datacube
+        :returns: List of bools indicating for each scan type whether the data is in profile mode
+        :returns: 2D numpy integer array of shape (numScans,2) indicating for each scan its x and y coordinate
+        :returns: List of numpy arrays with the mz axis of each scan type
+        """
+        reader = mzml.read(filename)
+        mzml_filetype = None
+        spectrum_ids = []
+        coordinates = []
+        scantypes = []
+        scantype_indices = {}
+        scan_indices = []
+        scan_profiled = []
+        mz_axes = []
+        for idx, spectrum in enumerate(reader):
+            if mzml_filetype is None:
+                mzml_filetype = cls.__compute_filetype(spectrum=spectrum)
+            spectrum_ids.append(spectrum['id'])
+            coordinates.append(cls.__compute_coordinates(spectrum=spectrum, mzml_filetype=mzml_filetype))
+            try:
+                scanfilter = spectrum['scanList']['scan'][0]['filter string']
+                if scanfilter not in scantype_indices:
+                    scantype_indices[scanfilter] = len(scantypes)
+                    scantypes.append(scanfilter)
+                    scan_profiled.append('profile spectrum' in spectrum)
+                    mz_axes.append(np.array([]))
+                scantype_idx = scantype_indices[scanfilter]
+                scan_indices.append(scantype_idx)
+            except:
+                log_helper.debug(__name__, idx)
+                continue
+            mz_axes[scantype_idx] = cls.__update_mz_axis(mz_axis=mz_axes[scantype_idx],
+                                                         spectrum=spectrum,
+                                                         mzml_filetype=mzml_filetype,
+                                                         resolution=resolution)
+
+        assert len(scan_indices) == len(spectrum_ids)
+        return mzml_filetype, spectrum_ids, scantypes, np.asarray(scan_indices, dtype='int64'), scan_profiled, \
+            np.asarray(coordinates, dtype='uint32').reshape((-1, 2)), mz_axes
+
+    @classmethod
+    def __update_mz_axis(cls, mz_axis, spectrum, mzml_filetype, resolution):
         ## TODO completely refactor this to make it smartly handle profile or centroid datasets
         ## TODO: centroid datasets should take in a user parameter "Resolution" and resample data at that resolution
         ## TODO: profile datasets should work as is
         ## TODO: checks for profile data vs. centroid data on the variation in length of ['m/z array']
         """
-        Internal helper function used to compute the mz axis of each scantype
-        Returns a list of numpy arrays
+        Internal helper function used to update the mz axis of a scantype with the next spectrum of the scantype
+        Returns the updated mz axis
         """
-        reader = mzml.read(filename)
-
+        mz = spectrum['m/z array']
         if mzml_filetype == cls.available_mzml_types['thermo']:
-
-            mz_axes = [np.array([]) for _ in scan_types]
-            # all_centroid = True
-            for spectrum in reader:
-                scanfilt = spectrum['scanList']['scan'][0]['filter string']
-                scantype_idx = scan_types.index(scanfilt)
-                mz = spectrum['m/z array']
-                try:
-                    len_axes = len(mz_axes[scantype_idx])
-                except TypeError:
-                    len_axes = 1
+            if len(mz) > len(mz_axis):
+                scan_window = spectrum['scanList']['scan'][0]['scanWindowList']['scanWindow'][0]
+                mzmin = scan_window['scan window lower limit']
+                mzmax = scan_window['scan window upper limit']
                 if 'profile spectrum' in spectrum:
-                    # all_centroid = False
-                    if len(mz) > len_axes:
-                        mzdiff = np.diff(mz).min()
-                        mzmin = spectrum['scanList']['scan'][0]['scanWindowList']['scanWindow'][0]['scan window lower limit']
-                        mzmax = spectrum['scanList']['scan'][0]['scanWindowList']['scanWindow'][0]['scan window upper limit']
-                        mz_axes[scantype_idx] = np.arange(start=mzmin, stop=mzmax, step=mzdiff)
-                        mz_axes[scantype_idx] = np.append(arr=mz_axes[scantype_idx], values=mzmax)
+                    mzdiff = np.diff(mz).min()
+                    mz_axis = np.arange(start=mzmin, stop=mzmax, step=mzdiff)
+                    mz_axis = np.append(arr=mz_axis, values=mzmax)
                 else:
-                    if len(mz) > len_axes:
-                        mzmin = spectrum['scanList']['scan'][0]['scanWindowList']['scanWindow'][0]['scan window lower limit']
-                        mzmax = spectrum['scanList']['scan'][0]['scanWindowList']['scanWindow'][0]['scan window upper limit']
-                        f = np.ceil(1e6 * np.log(mzmax/mzmin)/resolution)
-                        mz_axes[scantype_idx] = np.logspace(np.log10(mzmin), np.log10(mzmax), f)
-                        # ['count', 'index', 'highest observed m/z', 'm/z array', 'total ion current', 'ms level', 'spotID', 'lowest observed m/z', 'defaultArrayLength', 'intensity array', 'centroid spectrum', 'positive scan', 'MS1 spectrum', 'spectrum title', 'base peak intensity', 'scanList', 'id', 'base peak m/z']
-
-            return mz_axes
+                    f = int(np.ceil(1e6 * np.log(mzmax/mzmin)/resolution))
+                    mz_axis = np.logspace(np.log10(mzmin), np.log10(mzmax), f)
+                    # ['count', 'index', 'highest observed m/z', 'm/z array', 'total ion current', 'ms level', 'spotID', 'lowest observed m/z', 'defaultArrayLength', 'intensity array', 'centroid spectrum', 'positive scan', 'MS1 spectrum', 'spectrum title', 'base peak intensity', 'scanList', 'id', 'base peak m/z']
+            return mz_axis
 
         # assume bruker instruments have constant m/z axis from scan to scan
         elif mzml_filetype == cls.available_mzml_types['bruker']:
-
-            mz_axes = [np.array([]) for _ in scan_types]
-
-            for spectrum in reader:
-                scanfilt = spectrum['scanList']['scan'][0]['filter string']
-                scantype_idx = scan_types.index(scanfilt)
-                # grossly inefficient reassignment of m/z array at each scan
-                mz_axes[scantype_idx] = spectrum['m/z array']
-
-            return mz_axes
+            return mz
 
         else:
             raise ValueError('Unknown mzml format')
 
     @classmethod
-    def __compute_filetype(cls, filename):
+    def __compute_filetype(cls, spectrum):
         """
-        Internal helper function used to compute the filetype.
+        Internal helper function used to compute the filetype from the first spectrum.
         """
-        spectrum = next(mzml.read(filename))
         if 'spotID' in spectrum:
             return cls.available_mzml_types['thermo']
         elif 'id' in spectrum:
@@ -239,30 +273,32 @@ class mzml_file(file_reader_base_multidata):
         else:
             return cls.available_mzml_types['unknown']
 
-    def __compute_coordinates(self):
+    @classmethod
+    def __compute_coordinates(cls, spectrum, mzml_filetype):
         """
-        Internal helper function used to compute the coordinates for each scan.
+        Internal helper function used to compute the coordinates for a scan.
 
-        :returns: 2D numpy integer array of shape (numScans,2) indicating for each scan its x and y coordinate
+        :returns: List with the x and y coordinate of the scan
         """
-        reader = mzml.read(self.basename)
-        coords = np.zeros(shape=(self.num_scans, 2), dtype='uint32')
-        if self.mzml_type == self.available_mzml_types['thermo']:
-            spectrumid = 0
-            for spectrum in reader:
-                spotid = spectrum['spotID']
-                coords[spectrumid, :] = list(map(int, spotid.split(',')[-1].split('x')))
-                spectrumid += 1
-        elif self.mzml_type == self.available_mzml_types['bruker']:
-            spectrumid = 0
-            for spectrum in reader:
-                spotdesc = spectrum['id'].split('_x002f_')[1]
-                matchobj = re.findall('\d+', spotdesc)
-                coords[spectrumid, 0] = int(matchobj[2])
-                coords[spectrumid, 1] = int(matchobj[3])
-                spectrumid += 1
-        return coords
+        if mzml_filetype == cls.available_mzml_types['thermo']:
+            spotid = spectrum['spotID']
+            return list(map(int, spotid.split(',')[-1].split('x')))
+        elif mzml_filetype == cls.available_mzml_types['bruker']:
+            spotdesc = spectrum['id'].split('_x002f_')[1]
+            matchobj = re.findall('\d+', spotdesc)
+            return [int(matchobj[2]), int(matchobj[3])]
+        return [0, 0]
 
+    @staticmethod
+    def __has_index_list(filename):
+        """
+        Internal helper function used to check whether the mzml file is an indexed mzML file
+        with the offsets of the spectra in an indexList.
+        """
+        with open(filename, 'rb') as infile:
+            infile.seek(0, os.SEEK_END)
+            infile.seek(max(0, infile.tell() - 4096))
+            return b'<indexListOffset>' in infile.read()
 
     @classmethod
     def test(cls):
@@ -271,36 +307,6 @@ class mzml_file(file_reader_base_multidata):
         """
         pass
 
-    @staticmethod
-    def __compute_num_scans(filename=None):
-        """
-        Internal helper function used to compute the number of scans in the mzml file.
-        """
-        reader = mzml.read(filename)
-        return sum(1 for _ in reader)
-
-    def __compute_scan_types_and_indices(self, filename=None):
-        """
-        Internal helper function used to compute a list of unique scan types in the mzml file.
-        Also computes a numpy 1d array of ints which index every scan to relevant datacube.
-        """
-        reader = mzml.read(filename)
-        scantypes = []
-        scan_indices = []
-        scan_profiled = []
-        for idx, spectrum in enumerate(reader):
-            try:
-                scanfilter = spectrum['scanList']['scan'][0]['filter string']
-                if scanfilter not in scantypes:
-                    scantypes.append(scanfilter)
-                    scan_profiled.append('profile spectrum' in spectrum)
-                scan_indices.append(scantypes.index(scanfilter))
-            except:
-                log_helper.debug(__name__, idx)
-
-        assert len(scan_indices) == self.num_scans
-        return scantypes, scan_indices, scan_profiled
-
     @staticmethod
     def __parse_scan_parameters(self):
         """
@@ -511,9 +517,8 @@ class mzml_file(file_reader_base_multidata):
                 filesize = os.stat(basename).st_size
                 scansize = (npsizes.max() - npsizes.min()) / 2.
                 num_scans = int(filesize/scansize)
-            mz_axis_len = cls.__compute_mz_axis(filename=basename,
-                                                mzml_filetype=cls.__compute_filetype(filename=basename),
-                                                scan_types=cls.__compute_scan_types(filename=basename)).shape[0]
+            mz_axes = cls.__index_spectra(filename=basename, resolution=5)[-1]
+            mz_axis_len = max(mz.shape[0] for mz in mz_axes)
             return num_scans*mz_axis_len
 
             # temp_mzml_file = cls(basename=basename, requires_slicing=False)
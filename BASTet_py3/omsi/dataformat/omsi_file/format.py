@@ -218,6 +218,10 @@ class omsi_format_msidata(omsi_format_data):
     :var format_types: Data layout types supported for storing MSI data.
     :var mzdata_name: Global mz axis for the MSI data cube.
     :var format: Dataset in HDF5 with the format_type descriptor.
+    :var mean_spectrum_name: Optional dataset caching the mean spectrum of all pixels.
+    :var modification_count_attribute: Attribute of the msidata group counting the writes to the data. \
+        The cached mean spectrum stores the count (and the data shape) it was computed for.
+    :var data_shape_attribute: Attribute of the cached mean spectrum with the shape of the data.
     """
 
     def __init__(self):
@@ -226,6 +230,9 @@ class omsi_format_msidata(omsi_format_data):
     format_types = {'full_cube': 1, 'partial_cube': 2, 'partial_spectra': 3}
     mzdata_name = "mz"
     format_name = "format"
+    mean_spectrum_name = "mean_spectrum"
+    modification_count_attribute = "modification_count"
+    data_shape_attribute = "data_shape"
     current_version = "0.1"
 
 
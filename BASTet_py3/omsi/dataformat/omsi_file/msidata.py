@@ -12,6 +12,8 @@ from omsi.dataformat.omsi_file.dependencies import omsi_dependencies_manager
 from omsi.dataformat.omsi_file.methods import omsi_methods_manager
 from omsi.dataformat.omsi_file.instrument import omsi_instrument_manager
 from omsi.dataformat.omsi_file.metadata_collection import omsi_metadata_collection_manager
+import omsi.shared.mpi_helper as mpi_helper
+from omsi.shared import block_helper
 import numpy as np
 
 
@@ -534,6 +536,12 @@ class omsi_file_msidata(omsi_dependencies_manager,
         elif len(key) != 3:
             raise ValueError("Invalid selection")
 
+        # Count the write so that the cached mean spectrum is no longer valid. Writes while no
+        # mean spectrum is cached do not need to be counted, since a new cache records the current count.
+        if str(omsi_format_msidata.mean_spectrum_name) in self.managed_group:
+            self.managed_group.attrs[omsi_format_msidata.modification_count_attribute] = \
+                self.get_modification_count() + 1
+
         # Check the data format and call the approbriate getitem function
         if self.format_type == omsi_format_msidata.format_types['full_cube']:
             return self.__setitem_fullcube__(key, value)
@@ -1351,6 +1359,87 @@ class omsi_file_msidata(omsi_dependencies_manager,
                                      "%]" + "\r")
                     sys.stdout.flush()
 
+    def get_modification_count(self):
+        """
+        Get the modification count of the data, which is incremented by writes via __setitem__ while
+        a mean spectrum is cached. Used to validate the cached mean spectrum, see get_mean_spectrum(..)
+
+        :returns: Integer with the modification count
+        """
+        return int(self.managed_group.attrs.get(omsi_format_msidata.modification_count_attribute, 0))
+
+    def get_cached_mean_spectrum(self):
+        """
+        Get the mean spectrum cached in the file, if it is valid for the current data, i.e., if it
+        was computed for the current shape and modification count of the data.
+
+        :returns: h5py.Dataset with the cached mean spectrum or None if no valid mean spectrum is cached.
+        """
+        mean_spectrum = self.managed_group.get(str(omsi_format_msidata.mean_spectrum_name))
+        if mean_spectrum is None:
+            return None
+        cached_shape = mean_spectrum.attrs.get(omsi_format_msidata.data_shape_attribute)
+        cached_count = mean_spectrum.attrs.get(omsi_format_msidata.modification_count_attribute)
+        if cached_shape is None or cached_count is None or \
+                tuple(int(i) for i in cached_shape) != tuple(int(i) for i in self.shape) or \
+                int(cached_count) != self.get_modification_count():
+            return None
+        return mean_spectrum
+
+    def get_mean_spectrum(self,
+                          memory_budget=2**30,
+                          comm=None,
+                          cache=True):
+        """
+        Compute the mean spectrum of all pixels of the MSI data. Missing spectra count as 0, i.e., this is the
+        same as computing the mean over x and y of the data cube returned by [:, :, :].
+
+        The data is read in blocks of complete rows in x, aligned with the chunking of the data, and summed
+        into a float64 accumulator so that the full data is never loaded at once,
+        see omsi.shared.block_helper.get_mean_spectrum. The result is cached in the file together with the
+        shape and modification count of the data, so that repeated calls do not have to read the data again.
+        The cache is used only as long as neither changes, see get_cached_mean_spectrum(..)
+
+        :param memory_budget: Approximate number of bytes of MSI data to be read at once.
+        :param comm: MPI communicator. If the communicator has more than one rank, then the blocks are
+                     distributed across the ranks and the partial sums are reduced across all ranks.
+                     Use None to compute the mean spectrum on the calling rank alone.
+        :param cache: Use the cached mean spectrum if it is valid. If the file is writable, then the
+                      computed mean spectrum is saved to the file. Since creating a dataset is a collective
+                      operation in parallel HDF5, the mean spectrum is not saved if comm has more than
+                      one rank or if the file uses the mpio driver.
+
+        :returns: 1D float64 numpy array with the mean spectrum
+        """
+        if cache:
+            cached_mean_spectrum = self.get_cached_mean_spectrum()
+            if cached_mean_spectrum is not None:
+                return cached_mean_spectrum[:]
+
+        mean_spectrum = block_helper.get_mean_spectrum(self, memory_budget=memory_budget, comm=comm)
+
+        # Cache the mean spectrum in the file
+        h5py_file = self.managed_group.file
+        size = mpi_helper.get_size(comm=comm) if comm is not None else 1
+        if cache and size == 1 and h5py_file.mode != 'r' and h5py_file.driver != 'mpio':
+            mean_spectrum_name = str(omsi_format_msidata.mean_spectrum_name)
+            cached_mean_spectrum = self.managed_group.get(mean_spectrum_name)
+            if cached_mean_spectrum is not None and cached_mean_spectrum.shape != mean_spectrum.shape:
+                del self.managed_group[mean_spectrum_name]
+                cached_mean_spectrum = None
+            if cached_mean_spectrum is None:
+                cached_mean_spectrum = self.managed_group.create_dataset(name=mean_spectrum_name,
+                                                                         shape=mean_spectrum.shape,
+                                                                         dtype='float64')
+            cached_mean_spectrum[:] = mean_spectrum
+            cached_mean_spectrum.attrs[omsi_format_msidata.data_shape_attribute] = \
+                np.asarray([int(i) for i in self.shape], dtype='int64')
+            cached_mean_spectrum.attrs[omsi_format_msidata.modification_count_attribute] = \
+                self.get_modification_count()
+            h5py_file.flush()
+
+        return mean_spectrum
+
     def __best_dataset__(self, keys, print_info=False):
         """
         Compute the index of the dataset that is best suited for executing the given selection
@@ -0,0 +1,89 @@
+"""
+Module with helper functions for processing large MSI datasets one block (or tile) at a time.
+"""
+import numpy as np
+
+import omsi.shared.mpi_helper as mpi_helper
+
+
+def get_block_size_x(msidata, memory_budget, bytes_per_value):
+    """
+    Determine the number of rows in x of msidata that should be processed at once.
+
+    :param msidata: The 3D MSI dataset (numpy array, h5py.Dataset or omsi_file_msidata)
+    :param memory_budget: Approximate number of bytes a block may use
+    :param bytes_per_value: Number of bytes needed per value of the block for processing
+
+    :returns: Integer number of rows in x. If the dataset is chunked, then this is a
+        multiple of the chunk size in x so that blocks are read chunk-aligned.
+    """
+    nx, ny, nz = [int(i) for i in msidata.shape]
+    block_x = max(1, int(memory_budget // max(ny * nz * bytes_per_value, 1)))
+    try:
+        chunks = msidata.__best_dataset__((slice(0, block_x), slice(0, ny), slice(0, nz))).chunks
+    except AttributeError:
+        chunks = getattr(msidata, 'chunks', None)
+    # Only the chunking of full cubes is aligned with x
+    if chunks is not None and len(chunks) == 3:
+        block_x = max(chunks[0], block_x - block_x % chunks[0])
+    return min(block_x, nx)
+
+
+def get_mean_spectrum(msidata, memory_budget=2**30, comm=None):
+    """
+    Compute the mean spectrum of a 3D MSI dataset by summing blocks of rows in x into a float64 accumulator,
+    so that the full data is never loaded at once.
+
+    :param msidata: The 3D MSI dataset (numpy array, h5py.Dataset or omsi_file_msidata)
+    :param memory_budget: Approximate number of bytes of msidata to be read at once
+    :param comm: MPI communicator. If the communicator has more than one rank, then the blocks are
+        distributed across the ranks and the partial sums are reduced across all ranks.
+
+    :returns: 1D float64 numpy array with the mean spectrum
+    """
+    shape_x, shape_y, shape_z = [int(i) for i in msidata.shape]
+    block_x = get_block_size_x(msidata, memory_budget, msidata.dtype.itemsize)
+    rank = mpi_helper.get_rank(comm=comm) if comm is not None else 0
+    size = mpi_helper.get_size(comm=comm) if comm is not None else 1
+    # Each rank sums every size'th block
+    spectrum_sum = np.zeros(shape_z, dtype='float64')
+    for xstart in range(rank * block_x, shape_x, size * block_x):
+        block = msidata[xstart:min(xstart + block_x, shape_x), :, :]
+        spectrum_sum += np.sum(block.reshape(-1, shape_z), axis=0, dtype='float64')
+    if size > 1:
+        spectrum_sum = mpi_helper.allreduce(spectrum_sum, comm=comm)
+    return spectrum_sum / float(shape_x * shape_y)
+
+
+def map_blocks(function, tasks, num_processes=1):
+    """
+    Apply a function to a sequence of tasks, optionally using a pool of processes. This is used to
+    process large datasets tile-by-tile, where each task contains a tile read from the data.
+
+    :param function: The function to be applied to each task. The function must be picklable if
+        num_processes > 1, i.e., it must be defined at the module level.
+    :param tasks: Iterable of the tasks, e.g., a generator reading the tiles of the data. The tasks are
+        read lazily, i.e., at most num_processes tasks are held in memory at a time.
+    :param num_processes: Number of processes used to process the tasks in parallel
+
+    :returns: Generator of the results in the order of the tasks
+    """
+    if num_processes <= 1:
+        for task in tasks:
+            yield function(task)
+        return
+    from multiprocessing import Pool
+    pool = Pool(num_processes)
+    try:
+        batch = []
+        for task in tasks:
+            batch.append(task)
+            if len(batch) == num_processes:
+                for result in pool.map(function, batch):
+                    yield result
+                batch = []
+        for result in pool.map(function, batch):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
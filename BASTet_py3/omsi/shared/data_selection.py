@@ -104,7 +104,7 @@ import warnings
 ################################################################
 #  Additional custom data processing functions                 #
 ################################################################
-def area_near_peak(x1, halfpeakwidth=2, **kwargs):
+def area_near_peak(x1, halfpeakwidth=2, dtype=None, **kwargs):
     """
     Instead of simply taking the sum or the max to get the "size" of a peak, this code
     finds the peak within a range and sums the data points 'halfpeakwidth' to the
@@ -112,8 +112,13 @@ def area_near_peak(x1, halfpeakwidth=2, **kwargs):
     that it just takes the first halfpeakwidth+1 datapoints in the range
     but if there is no peak, we assume this value is very low anyways.
 
+    The data points around the peaks of all spectra are gathered with np.take_along_axis, one
+    offset at a time, so the result is added up in the same order as a loop over the peak would.
+    Indices outside of the spectrum (< 0 or >= number of bins) are skipped.
+
     :param x1: The data operand specifying the data the reduction should be performed on
     :param halfpeakwidth: The halfpeakwidth around which the peak should be integrated
+    :param dtype: The data type used to add up the data points. Default is the data type of x1.
     :param kwargs: Additional data parameters. These will be ignored. This is used
                    to support the standard axis parameter that is ignored here.
     """
@@ -121,17 +126,15 @@ def area_near_peak(x1, halfpeakwidth=2, **kwargs):
         raise ValueError("Area near peak only defined for 3D cubes of spectra")
     if x1.ndim == 2:
         return x1
-    result = np.zeros((x1.shape[0],x1.shape[1]), dtype=x1.dtype)
-    maxMasses = np.argmax(x1,2)
-    for x in range(x1.shape[0]):
-        for y in range(x1.shape[1]):
-            peak=(list(range(-halfpeakwidth, halfpeakwidth+1)) + maxMasses[x,y]).astype(int)
-            for p in peak:
-                if p<0:
-                    continue
-                if p>= x1.shape[2]:
-                    continue
-                result[x,y] += x1[x,y,p]
+    halfpeakwidth = int(halfpeakwidth)
+    num_bins = x1.shape[2]
+    result = np.zeros((x1.shape[0], x1.shape[1]), dtype=x1.dtype if dtype is None else dtype)
+    max_masses = np.argmax(x1, 2)
+    for offset in range(-halfpeakwidth, halfpeakwidth+1):
+        peak = max_masses + offset
+        valid = (peak >= 0) & (peak < num_bins)
+        values = np.take_along_axis(x1, np.clip(peak, 0, num_bins-1)[:, :, np.newaxis], axis=2)[:, :, 0]
+        result[valid] += values[valid]
     return result
 
 
@@ -37,6 +37,7 @@ if not MPI_AVAILABLE:
 
 import numpy as np
 import itertools
+import math
 import warnings
 import time
 import os
@@ -47,6 +48,10 @@ class parallel_over_axes(object):
     Helper class used to parallelize the execution of a function using MPI by splitting the
     input data into sub-blocks along a given set of axes.
 
+    With the LOCAL backend, the blocks are processed by a pool of local processes instead of MPI ranks.
+    The run() and collect_data() functions behave as on the MPI root rank, i.e., the results of all
+    blocks are available after run().
+
     :ivar task_function: The function we should run.
     :ivar task_function_params: Dict with the input parameters for the function.
         may be None or {} if no parameters are needed.
@@ -67,11 +72,18 @@ class parallel_over_axes(object):
         and complete the task, and not just the execution of the task function itself.
     :ivar run_time: Float time in seconds for executing the run function.
     :ivar comm: The MPI communicator used for the parallelization. Default value is MPI.COMM_WORLD
+    :ivar target_block_time: Time in seconds a block should take to process with the DYNAMIC_BLOCKS schedule.
+    :ivar backend: The execution backend to be used (see parallel_over_axes.BACKENDS)
+    :ivar num_processes: The number of processes used by the LOCAL backend
 
     """
     SCHEDULES = {'STATIC_1D': 'STATIC_1D',
                  'STATIC': 'STATIC',
-                 'DYNAMIC': 'DYNAMIC'}
+                 'DYNAMIC': 'DYNAMIC',
+                 'DYNAMIC_BLOCKS': 'DYNAMIC_BLOCKS'}
+
+    BACKENDS = {'MPI': 'MPI',
+                'LOCAL': 'LOCAL'}
 
     MPI_MESSAGE_TAGS = {'RANK_MSG': 11,
                         'BLOCK_MSG': 12,
@@ -85,7 +97,10 @@ class parallel_over_axes(object):
                  main_data_param_name,
                  schedule=SCHEDULES['STATIC_1D'],
                  root=0,
-                 comm=None):
+                 comm=None,
+                 target_block_time=1.0,
+                 backend=None,
+                 num_processes=None):
         """
 
         :param task_function: The function we should run.
@@ -98,10 +113,22 @@ class parallel_over_axes(object):
         :param schedule: The task scheduling schema to be used (see parallel_over_axes.SCHEDULES
         :param comm: The MPI communicator used for the parallelization. Default value is None, in which case
             MPI.COMM_WORLD is used
+        :param target_block_time: Time in seconds the processing of a block should take when using the
+            DYNAMIC_BLOCKS schedule. The size of the blocks is adapted to the measured block times.
+        :param backend: The execution backend to be used (see parallel_over_axes.BACKENDS). Default value
+            is None, in which case MPI is used if available and LOCAL otherwise.
+        :param num_processes: The number of processes used by the LOCAL backend. Default value is None,
+            in which case the number of CPUs is used.
 
         """
-        if not is_mpi_available():
+        if backend is None:
+            backend = self.BACKENDS['MPI'] if is_mpi_available() else self.BACKENDS['LOCAL']
+        if backend == self.BACKENDS['MPI'] and not is_mpi_available():
             raise ValueError("MPI is not available. MPI is required for parallel execution.")
+        elif backend not in self.BACKENDS.values():
+            raise ValueError("Invalid backend given: " + str(backend))
+        self.backend = backend
+        self.num_processes = num_processes if num_processes is not None else os.cpu_count()
         self.task_function = task_function
         self.schedule = schedule
         self.split_axes = split_axes
@@ -119,6 +146,7 @@ class parallel_over_axes(object):
         self.run_time = None
         self.__data_collected = False
         self.comm = get_comm_world() if comm is None else comm
+        self.target_block_time = target_block_time
 
     def run(self):
         """
@@ -133,19 +161,23 @@ class parallel_over_axes(object):
                divide the data into sub-blocks. In the case of static decomposition we have
                a range slice object along the axes used for decomposition whereas in the
                case of dynamic scheduling we usually have single integer point selections
-               for each task.
+               for each task. With DYNAMIC_BLOCKS scheduling each block is a tuple of slices.
 
         """
         from omsi.shared.log import log_helper
         start_time = time.time()
         self.__data_collected = False
-        if self.schedule == self.SCHEDULES['DYNAMIC']:
-            result = self.__run_dynamic()
-        elif self.schedule == self.SCHEDULES['STATIC_1D'] or self.schedule == self.SCHEDULES['STATIC']:
-            result = self.__run_static_1D()
-        else:
+        if self.schedule not in self.SCHEDULES.values():
             log_helper.error(__name__, "Invalid scheduling scheme given: " + str(self.schedule))
             raise ValueError("Invalid scheduling scheme given: " + str(self.schedule))
+        if self.backend == self.BACKENDS['LOCAL']:
+            result = self.__run_local()
+        elif self.schedule == self.SCHEDULES['DYNAMIC']:
+            result = self.__run_dynamic()
+        elif self.schedule == self.SCHEDULES['DYNAMIC_BLOCKS']:
+            result = self.__run_dynamic_blocks()
+        else:
+            result = self.__run_static_1D()
         end_time = time.time()
         self.run_time = end_time - start_time
         return result
@@ -175,6 +207,10 @@ class parallel_over_axes(object):
         # If we have collected the data already then we don't need to do it again
         if self.__data_collected and not force_collect:
             return self.result, self.blocks
+        # All processes of the LOCAL backend return their results to us
+        if self.backend == self.BACKENDS['LOCAL']:
+            self.__data_collected = True
+            return self.result, self.blocks
 
         # Collect the output
         rank = get_rank(comm=self.comm)
@@ -233,7 +269,7 @@ class parallel_over_axes(object):
                                 "Insufficient number of blocks for number of MPI ranks. Some ranks will remain idle")
         axes_sort_index = np.argsort(axes_shapes)[::-1]
         split_axis = self.split_axes[axes_sort_index[0]]
-        split_axis_size = axes_shapes[split_axis]
+        split_axis_size = axes_shapes[axes_sort_index[0]]
         if split_axis_size < size:
             raise NotImplementedError("STATIC scheduling currently parallelizes only over one axis, " +
                                       "and the largest axis is too small to fill all MPI tasks")
@@ -242,30 +278,38 @@ class parallel_over_axes(object):
         if block_size * size > split_axis_size and block_size > 1:
             block_size -= 1
 
+        # The result and blocks are lists with one entry per block, just as for the other schedules.
+        # Ranks without a block, i.e., if there are fewer blocks than ranks, return empty lists.
+        self.result = []
+        self.blocks = []
+        self.block_times = []
+        if rank >= size:
+            log_helper.info(__name__, "Rank: " + str(rank) + " Block: None")
+            return self.result, self.blocks
+
         # Compute a block for every rank
-        self.blocks = [slice(None)] * len(self.main_data.shape)
+        block = [slice(None)] * len(self.main_data.shape)
         start_index = rank * block_size
         stop_index = start_index + block_size
         if rank == (size-1):
             if stop_index != split_axis_size:
                 stop_index = split_axis_size
-        self.blocks[axes_sort_index[0]] = slice(start_index, stop_index)
-        self.blocks = tuple(self.blocks)
-        log_helper.info(__name__, "Rank: " + str(rank) + " Block: " + str(self.blocks))
+        block[split_axis] = slice(start_index, stop_index)
+        block = tuple(block)
+        log_helper.info(__name__, "Rank: " + str(rank) + " Block: " + str(block))
 
         # Execute the task_function on the given data block
         task_params = self.task_function_params
-        task_params[self.main_data_param_name] = self.main_data[self.blocks]
-        self.result = self.task_function(**task_params)
+        task_params[self.main_data_param_name] = self.main_data[block]
+        self.result.append(self.task_function(**task_params))
+        self.blocks.append(block)
 
         end_time = time.time()
         run_time = end_time - start_time
-        self.block_times = [run_time, ]
+        self.block_times.append(run_time)
         log_helper.info(__name__, "TIME FOR PROCESSING THE DATA BLOCK: " + str(run_time))
 
         # Return the output
-        self.result = [self.result, ]
-        self.blocks = [self.blocks, ]
         return self.result, self.blocks
 
     def __run_dynamic(self):
@@ -366,6 +410,333 @@ class parallel_over_axes(object):
         # Return the result
         return self.result, self.blocks
 
+    def __get_block_grid(self):
+        """
+        Determine the grid of chunks along the split_axes used by the DYNAMIC_BLOCKS schedule.
+
+        :return: Tuple of two lists with the chunk size and the number of chunks for each of the split_axes.
+            If the main_data is not chunked, then each element along the split_axes is its own chunk.
+        """
+        data_shape = self.main_data.shape
+        try:
+            keys = [slice(0, 1) if axis in self.split_axes else slice(None) for axis in range(len(data_shape))]
+            chunks = self.main_data.__best_dataset__(keys).chunks
+        except AttributeError:
+            chunks = getattr(self.main_data, 'chunks', None)
+        if chunks is None or len(chunks) != len(data_shape):
+            chunks = [1] * len(data_shape)
+        chunk_sizes = [int(chunks[axis]) for axis in self.split_axes]
+        num_chunks = [int(math.ceil(float(data_shape[axis]) / chunk_size))
+                      for axis, chunk_size in zip(self.split_axes, chunk_sizes)]
+        return chunk_sizes, num_chunks
+
+    def __get_num_block_chunks(self, chunk_time, num_remaining_chunks, num_workers):
+        """
+        Determine the number of chunks of the next block for the DYNAMIC_BLOCKS schedule.
+
+        :param chunk_time: Measured time in seconds for processing a chunk. 0 if no time has been measured.
+        :param num_remaining_chunks: The number of chunks that have not been assigned yet
+        :param num_workers: The number of processes working on the blocks
+
+        :return: The number of chunks such that the block takes about self.target_block_time seconds
+            but at most half of the remaining chunks per worker.
+        """
+        num_block_chunks = int(self.target_block_time / chunk_time) if chunk_time > 0 else 1
+        return max(1, min(num_block_chunks, num_remaining_chunks // (2 * num_workers)))
+
+    def __get_block_selection(self, chunk_index, num_block_chunks, chunk_sizes, num_chunks):
+        """
+        Compute the selection for a block of chunks for the DYNAMIC_BLOCKS schedule.
+
+        The chunks along the split_axes are numbered in C order. A block consists of up to num_block_chunks
+        consecutive chunks along the last split axis, i.e., the block is a rectangular, chunk-aligned
+        subset of the data.
+
+        :param chunk_index: Index of the first chunk of the block
+        :param num_block_chunks: Maximum number of chunks in the block
+        :param chunk_sizes: The chunk size for each of the split_axes
+        :param num_chunks: The number of chunks for each of the split_axes
+
+        :return: Tuple of the selection and the number of chunks in the block.
+        """
+        chunk_position = np.unravel_index(chunk_index, num_chunks)
+        num_block_chunks = min(num_block_chunks, num_chunks[-1] - chunk_position[-1])
+        selection = [slice(None)] * len(self.main_data.shape)
+        for split_index, axis in enumerate(self.split_axes):
+            block_chunks = num_block_chunks if split_index == (len(self.split_axes) - 1) else 1
+            start = int(chunk_position[split_index]) * chunk_sizes[split_index]
+            stop = min(start + block_chunks * chunk_sizes[split_index], self.main_data.shape[axis])
+            selection[axis] = slice(start, stop)
+        return tuple(selection), num_block_chunks
+
+    def __run_dynamic_blocks(self):
+        """
+        Run the task function using dynamic scheduling of chunk-aligned blocks.
+
+        The data is divided into rectangular blocks aligned with the chunking of the main_data along the
+        split_axes. The root rank hands out blocks to the other ranks on request and processes single-chunk
+        blocks itself while no requests are pending. The number of chunks per block is chosen so that a block
+        takes about self.target_block_time seconds based on the block times measured by the requesting rank,
+        but is reduced towards the end so that all ranks finish at about the same time. To hide the
+        communication latency, each worker requests its next block before processing the current block, and
+        reads the data of the next block while processing the current block if the root answered in time.
+
+        :return: Tuple with the following elements:
+
+            1) List with the results from the local execution of the task_function. Each
+               entry is the result from one return of the task_function.
+            2) List of block_indexes. Each block_index is a tuple of slices with the selection
+               of the block.
+
+        """
+        from omsi.shared.log import log_helper
+        rank = get_rank(comm=self.comm)
+        size = get_size(comm=self.comm)
+        self.result = []
+        self.blocks = []
+        self.block_times = []
+
+        # We are the controlling rank
+        if rank == self.root:
+            chunk_sizes, num_chunks = self.__get_block_grid()
+            total_num_chunks = int(np.prod(num_chunks))
+            log_helper.info(__name__, "PROCESSING " + str(total_num_chunks) + " CHUNKS OF SIZE " + str(chunk_sizes))
+            start_time = time.time()
+            next_chunk = 0
+            all_ranks_status = np.zeros(size, 'bool')
+            all_ranks_status[self.root] = True
+            while not np.all(all_ranks_status) or next_chunk < total_num_chunks:
+                # Answer all pending requests for blocks. Wait for a request if we have no more work ourselves
+                while self.comm.Iprobe(source=MPI.ANY_SOURCE, tag=self.MPI_MESSAGE_TAGS['RANK_MSG']) or \
+                        (next_chunk >= total_num_chunks and not np.all(all_ranks_status)):
+                    request_rank, chunk_time = self.comm.recv(source=MPI.ANY_SOURCE,
+                                                              tag=self.MPI_MESSAGE_TAGS['RANK_MSG'])
+                    if next_chunk >= total_num_chunks:
+                        self.comm.send((None, None), dest=request_rank, tag=self.MPI_MESSAGE_TAGS['BLOCK_MSG'])
+                        all_ranks_status[request_rank] = True
+                        continue
+                    num_block_chunks = self.__get_num_block_chunks(chunk_time, total_num_chunks - next_chunk, size)
+                    block_selection, num_block_chunks = self.__get_block_selection(next_chunk,
+                                                                                   num_block_chunks,
+                                                                                   chunk_sizes,
+                                                                                   num_chunks)
+                    self.comm.send((next_chunk, block_selection),
+                                   dest=request_rank,
+                                   tag=self.MPI_MESSAGE_TAGS['BLOCK_MSG'])
+                    next_chunk += num_block_chunks
+                # Process a single chunk ourselves
+                if next_chunk < total_num_chunks:
+                    block_start_time = time.time()
+                    block_selection, num_block_chunks = self.__get_block_selection(next_chunk, 1,
+                                                                                   chunk_sizes, num_chunks)
+                    next_chunk += num_block_chunks
+                    task_params = self.task_function_params
+                    task_params[self.main_data_param_name] = self.main_data[block_selection]
+                    self.result.append(self.task_function(**task_params))
+                    self.blocks.append(block_selection)
+                    self.block_times.append(time.time() - block_start_time)
+            log_helper.info(__name__, "TIME FOR PROCESSING ALL BLOCKS: " + str(time.time() - start_time))
+
+        # We are a rank that has to run tasks
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            chunk_sizes, _ = self.__get_block_grid()
+            reader = ThreadPoolExecutor(max_workers=1)
+            chunk_time = 0
+            self.comm.send((rank, chunk_time), dest=self.root, tag=self.MPI_MESSAGE_TAGS['RANK_MSG'])
+            block_index, block_selection = self.comm.recv(source=self.root, tag=self.MPI_MESSAGE_TAGS['BLOCK_MSG'])
+            if block_index is not None:
+                block_data = reader.submit(self.main_data.__getitem__, block_selection)
+            while block_index is not None:
+                start_time = time.time()
+                # Request the next block before we process the current one
+                self.comm.send((rank, chunk_time), dest=self.root, tag=self.MPI_MESSAGE_TAGS['RANK_MSG'])
+                next_block_request = self.comm.irecv(source=self.root, tag=self.MPI_MESSAGE_TAGS['BLOCK_MSG'])
+                task_params = self.task_function_params
+                task_params[self.main_data_param_name] = block_data.result()
+                read_time = time.time() - start_time
+                # Start reading the data of the next block while we process the current block if the root
+                # has answered already. The root answers only between its own chunks, so we do not wait
+                # for the answer but process the current block first otherwise.
+                next_block_received, next_block = next_block_request.test()
+                if next_block_received and next_block[0] is not None:
+                    block_data = reader.submit(self.main_data.__getitem__, next_block[1])
+                # Execute the task_function on the given data block
+                task_start_time = time.time()
+                self.result.append(self.task_function(**task_params))
+                self.blocks.append(block_selection)
+                # Record the timings and estimate the time needed per chunk
+                end_time = time.time()
+                self.block_times.append(end_time - start_time)
+                block_num_elements = np.prod([block_selection[axis].stop - block_selection[axis].start
+                                              for axis in self.split_axes])
+                chunk_time = (read_time + end_time - task_start_time) * np.prod(chunk_sizes) / block_num_elements
+                # Start reading the data of the next block now if the root did not answer in time
+                if not next_block_received:
+                    next_block = next_block_request.wait()
+                    if next_block[0] is not None:
+                        block_data = reader.submit(self.main_data.__getitem__, next_block[1])
+                block_index, block_selection = next_block
+            reader.shutdown()
+
+        # Return the result
+        return self.result, self.blocks
+
+    def __run_local(self):
+        """
+        Run the task function in a pool of local processes using concurrent.futures.ProcessPoolExecutor.
+
+        The blocks are the same as for the MPI backend. STATIC scheduling divides the largest split_axis into
+        one block per process, DYNAMIC scheduling processes each element along the split_axes as a separate
+        task, and DYNAMIC_BLOCKS uses chunk-aligned blocks whose size is adapted to the measured block times.
+        If the main_data is an h5py.Dataset or omsi_file_msidata object, then each process opens the file
+        read-only and reads its blocks itself rather than receiving the data from this process. Where
+        available, the processes are started via fork, i.e., the task_function does not need to be picklable,
+        but its results do.
+
+        :return: Tuple with the following elements:
+
+            1) List with the results from the execution of the task_function for all blocks.
+            2) List of block_indexes. Each block_index is a tuple with the selection of the block.
+
+        """
+        from omsi.shared.log import log_helper
+        from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+        import multiprocessing
+        self.result = []
+        self.blocks = []
+        self.block_times = []
+
+        # Let the processes read the data from file if possible
+        data_source = None
+        h5py_object = getattr(self.main_data, 'managed_group', self.main_data)
+        if hasattr(h5py_object, 'file') and hasattr(h5py_object, 'name'):
+            data_source = (h5py_object.file.filename,
+                           h5py_object.name,
+                           h5py_object is not self.main_data)
+            h5py_object.file.flush()
+        start_method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else None
+        executor = ProcessPoolExecutor(max_workers=self.num_processes,
+                                       mp_context=multiprocessing.get_context(start_method),
+                                       initializer=_init_local_process,
+                                       initargs=(self.task_function,
+                                                 self.task_function_params,
+                                                 self.main_data if data_source is None else None,
+                                                 data_source,
+                                                 self.main_data_param_name))
+        log_helper.info(__name__, "PROCESSING DATA BLOCKS USING " + str(self.num_processes) + " PROCESSES")
+        try:
+            if self.schedule == self.SCHEDULES['DYNAMIC_BLOCKS']:
+                chunk_sizes, num_chunks = self.__get_block_grid()
+                total_num_chunks = int(np.prod(num_chunks))
+                next_chunk = 0
+                chunk_time = 0
+                running = {}
+                results = {}
+                while next_chunk < total_num_chunks or len(running) > 0:
+                    # Keep two blocks per process queued so that no process becomes idle
+                    while next_chunk < total_num_chunks and len(running) < 2 * self.num_processes:
+                        num_block_chunks = self.__get_num_block_chunks(chunk_time,
+                                                                       total_num_chunks - next_chunk,
+                                                                       self.num_processes)
+                        block_selection, num_block_chunks = self.__get_block_selection(next_chunk,
+                                                                                       num_block_chunks,
+                                                                                       chunk_sizes,
+                                                                                       num_chunks)
+                        running[executor.submit(_run_local_task, block_selection)] = (next_chunk, block_selection)
+                        next_chunk += num_block_chunks
+                    done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        block_index, block_selection = running.pop(future)
+                        results[block_index] = (future.result(), block_selection)
+                        block_num_elements = np.prod([block_selection[axis].stop - block_selection[axis].start
+                                                      for axis in self.split_axes])
+                        chunk_time = results[block_index][0][1] * np.prod(chunk_sizes) / block_num_elements
+                block_results = [results[block_index][0] for block_index in sorted(results.keys())]
+                self.blocks = [results[block_index][1] for block_index in sorted(results.keys())]
+            else:
+                if self.schedule == self.SCHEDULES['DYNAMIC']:
+                    base_blocks = [[slice(None)]] * len(self.main_data.shape)
+                    for axis_index in self.split_axes:
+                        base_blocks[axis_index] = list(range(self.main_data.shape[axis_index]))
+                    self.blocks = list(itertools.product(*base_blocks))
+                else:
+                    self.blocks = self.__get_static_blocks(self.num_processes)
+                chunksize = max(1, len(self.blocks) // (4 * self.num_processes))
+                block_results = list(executor.map(_run_local_task, self.blocks, chunksize=chunksize))
+        finally:
+            executor.shutdown()
+        self.result = [block_result[0] for block_result in block_results]
+        self.block_times = [block_result[1] for block_result in block_results]
+        return self.result, self.blocks
+
+    def __get_static_blocks(self, size):
+        """
+        Divide the data into one block per process along the largest split_axis.
+
+        :param size: The number of processes
+
+        :return: List of tuples with the selection for each block
+        """
+        axes_shapes = np.asarray(self.main_data.shape)[self.split_axes]
+        split_axis = self.split_axes[np.argmax(axes_shapes)]
+        split_axis_size = self.main_data.shape[split_axis]
+        size = min(size, split_axis_size)
+        # Determine the size of 1D block
+        block_size = int(split_axis_size / float(size) + 0.5)
+        if block_size * size > split_axis_size and block_size > 1:
+            block_size -= 1
+        blocks = []
+        for rank in range(size):
+            block = [slice(None)] * len(self.main_data.shape)
+            stop_index = (rank + 1) * block_size if rank < (size - 1) else split_axis_size
+            block[split_axis] = slice(rank * block_size, stop_index)
+            blocks.append(tuple(block))
+        return blocks
+
+
+# Task function, parameters and data of a process of the LOCAL backend of parallel_over_axes
+_LOCAL_PROCESS = {}
+
+
+def _init_local_process(task_function, task_function_params, main_data, data_source, main_data_param_name):
+    """
+    Initialize a process of the LOCAL backend of parallel_over_axes.
+
+    :param task_function: The function we should run.
+    :param task_function_params: Dict with the input parameters for the function.
+    :param main_data: Dataset over which we parallelize or None if data_source is given.
+    :param data_source: None or tuple of (filename, object name, is_msidata) with the h5py.Dataset or
+        omsi_file_msidata group to be opened read-only as the main_data.
+    :param main_data_param_name: The name of data input parameter of the task function
+    """
+    if data_source is not None:
+        import h5py
+        filename, object_name, is_msidata = data_source
+        main_data = h5py.File(filename, 'r')[object_name]
+        if is_msidata:
+            from omsi.dataformat.omsi_file.msidata import omsi_file_msidata
+            main_data = omsi_file_msidata(main_data)
+    _LOCAL_PROCESS['task_function'] = task_function
+    _LOCAL_PROCESS['task_function_params'] = task_function_params
+    _LOCAL_PROCESS['main_data'] = main_data
+    _LOCAL_PROCESS['main_data_param_name'] = main_data_param_name
+
+
+def _run_local_task(block_selection):
+    """
+    Execute the task function of a process of the LOCAL backend of parallel_over_axes on a block.
+
+    :param block_selection: The selection of the block of the main_data to be processed
+
+    :return: Tuple of the result of the task function and the time in seconds used for the block
+    """
+    start_time = time.time()
+    task_params = dict(_LOCAL_PROCESS['task_function_params'])
+    task_params[_LOCAL_PROCESS['main_data_param_name']] = _LOCAL_PROCESS['main_data'][block_selection]
+    result = _LOCAL_PROCESS['task_function'](**task_params)
+    return result, time.time() - start_time
+
 
 def imports_mpi(python_object):
     """
@@ -419,6 +790,21 @@ def gather(data, comm=None, root=0):
         return [data, ]
 
 
+def allreduce(data, comm=None):
+    """
+    MPI allreduce operation to sum the data of all ranks or return data if MPI is not available
+
+    :param data: The data to be summed, e.g., a numpy array
+    :param comm: MPI communicator. If None, then MPI.COMM_WORLD will be used.
+    :return: The sum of the data from all the ranks
+    """
+    if MPI_AVAILABLE:
+        my_comm = comm if comm is not None else MPI.COMM_WORLD
+        return my_comm.allreduce(data)
+    else:
+        return data
+
+
 def barrier(comm=None):
     """
     MPI barrier operation or no-op when running without MPI
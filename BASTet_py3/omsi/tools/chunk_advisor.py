@@ -0,0 +1,411 @@
+"""Tool used to recommend chunked data layouts for OpenMSI HDF5 files based on an access trace.
+
+  The tool copies a sample of the MSI data of an existing OpenMSI file to temporary HDF5 files with
+  different candidate chunkings and compression settings, replays a trace of data selections
+  (e.g., ion images, spectra, and ROI means as requested by the viewer) against each candidate, and
+  measures the latency and the number of bytes read. Based on the results the tool recommends
+  the --chunking, --optimized-chunking and --compression options for convertToOMSI.
+
+  For usage information execute: python chunk_advisor.py --help
+
+  **Trace format:**
+
+  The trace is a JSON file with a list of operations (or a file with one JSON operation per line).
+  Each operation is a dict with the 'type' of the operation (one of ``slice``, ``spectrum``, or ``roi_mean``)
+  and the optional 'x', 'y', and 'z' selection strings as used by the qslice/qspectrum viewer API
+  (e.g., '5', '10:20', '[1,4,7]', or ':'), e.g.:
+
+  .. code-block:: python
+
+        [{"type": "slice", "z": "1000:1002"},
+         {"type": "spectrum", "x": "12", "y": "40"},
+         {"type": "roi_mean", "x": "10:30", "y": "20:25"}]
+
+  Missing selections default to ':'. The selections refer to the full dataset and are mapped to the
+  sample by shifting ranges and wrapping indices.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+from omsi.dataformat.omsi_file.main_file import omsi_file
+from omsi.shared.data_selection import selection_string_to_object
+from omsi.shared.log import log_helper
+from omsi.tools.convertToOMSI import ConvertFiles
+from omsi.workflow.common import RawDescriptionDefaultHelpArgParseFormatter
+
+available_operations = ['slice', 'spectrum', 'roi_mean']
+"""The types of operations supported in access traces"""
+
+available_compression_options = {'none': (None, None),
+                                 'gzip': ('gzip', 4)}
+"""Compression settings that can be generated by convertToOMSI"""
+
+
+def load_trace(filename):
+    """
+    Load an access trace from file.
+
+    :param filename: Name of the JSON file with the list of operations or file with one JSON operation per line.
+
+    :returns: List of operation dicts with the 'type' and 'x', 'y', 'z' selection strings
+
+    :raises ValueError: If the file contains an invalid operation
+    """
+    with open(filename, 'r') as trace_file:
+        trace_string = trace_file.read().strip()
+    if trace_string.startswith('['):
+        trace = json.loads(trace_string)
+    else:
+        trace = [json.loads(line) for line in trace_string.splitlines() if len(line.strip()) > 0]
+    for operation in trace:
+        if operation.get('type') not in available_operations:
+            raise ValueError('Invalid operation in access trace: ' + str(operation))
+    return trace
+
+
+def generate_trace(shape, num_operations=30, seed=0):
+    """
+    Generate a default access trace with an equal mix of ion images, spectra and ROI means.
+
+    :param shape: The shape of the MSI dataset
+    :param num_operations: The number of operations of each type.
+    :param seed: Seed for the random number generator
+
+    :returns: List of operation dicts with the 'type' and 'x', 'y', 'z' selection strings
+    """
+    random_state = np.random.RandomState(seed)
+    trace = []
+    for _ in range(num_operations):
+        zstart = random_state.randint(0, shape[2])
+        trace.append({'type': 'slice', 'z': '%i:%i' % (zstart, min(zstart + 3, shape[2]))})
+        trace.append({'type': 'spectrum',
+                      'x': str(random_state.randint(0, shape[0])),
+                      'y': str(random_state.randint(0, shape[1]))})
+        # ROIs cover about 10% of the image in x and y
+        roi = []
+        for axis in range(2):
+            width = max(shape[axis] // 10, 1)
+            start = random_state.randint(0, shape[axis] - width + 1)
+            roi.append('%i:%i' % (start, start + width))
+        trace.append({'type': 'roi_mean', 'x': roi[0], 'y': roi[1]})
+    return trace
+
+
+def map_selection(selection, data_size, sample_size):
+    """
+    Map the selection of an axis of the full dataset to the corresponding axis of the sample.
+
+    Ranges keep their width (limited to the size of the sample) and are shifted into the sample.
+    Indices are wrapped into the sample.
+
+    :param selection: int, list, or slice selection for the full dataset
+    :param data_size: The size of the axis of the full dataset
+    :param sample_size: The size of the axis of the sample
+
+    :returns: int, list, or slice selection for the sample
+    """
+    if isinstance(selection, slice):
+        start, stop, step = selection.indices(data_size)
+        width = min(max(stop - start, 1), sample_size)
+        start %= sample_size - width + 1
+        return slice(start, start + width, step)
+    elif isinstance(selection, list):
+        return sorted(set([index % sample_size for index in selection]))
+    else:
+        return selection % sample_size
+
+
+def get_operation_selection(operation, data_shape, sample_shape):
+    """
+    Get the selection of an operation for the sample.
+
+    As h5py supports lists only along a single axis, lists along further axes are
+    replaced with the range of the list.
+
+    :param operation: Dict with the 'type' and 'x', 'y', 'z' selection strings
+    :param data_shape: The shape of the full dataset
+    :param sample_shape: The shape of the sample
+
+    :returns: Tuple of three int, list, or slice selections
+
+    :raises ValueError: If a selection string is invalid
+    """
+    selection = []
+    for axis, axis_name in enumerate(['x', 'y', 'z']):
+        axis_selection = selection_string_to_object(str(operation.get(axis_name, ':')))
+        if axis_selection is None:
+            raise ValueError('Invalid selection %s in operation %s' % (axis_name, str(operation)))
+        axis_selection = map_selection(axis_selection, data_shape[axis], sample_shape[axis])
+        if isinstance(axis_selection, list) and any(isinstance(other, list) for other in selection):
+            axis_selection = slice(axis_selection[0], axis_selection[-1] + 1)
+        selection.append(axis_selection)
+    return tuple(selection)
+
+
+def get_sample(msidata, sample_size=1024 * 1024 * 256):
+    """
+    Read a sample of the MSI data with all m/z values of a block of pixels in the center of the image.
+
+    :param msidata: The omsi_file_msidata (or h5py.Dataset) with the MSI data
+    :param sample_size: Maximum size of the sample in byte. The sample is scaled in x and y while
+        keeping the aspect ratio of the image.
+
+    :returns: Numpy array with the sample
+    """
+    shape = msidata.shape
+    spectrum_size = shape[2] * np.dtype(msidata.dtype).itemsize
+    scale = min(np.sqrt(sample_size / float(shape[0] * shape[1] * spectrum_size)), 1.0)
+    sample_x = max(min(int(shape[0] * scale), shape[0]), 1)
+    sample_y = max(min(int(sample_size / float(sample_x * spectrum_size)), shape[1]), 1)
+    xstart = (shape[0] - sample_x) // 2
+    ystart = (shape[1] - sample_y) // 2
+    return msidata[xstart:xstart + sample_x, ystart:ystart + sample_y, :]
+
+
+def get_candidate_chunkings(data_shape, dtype, user_chunkings=None):
+    """
+    Get the list of candidate chunkings consisting of the chunkings suggested by
+    ConvertFiles.suggest_chunking, a set of chunkings with increasing size of the
+    image tiles, and the user-defined chunkings.
+
+    :param data_shape: The shape of the full dataset
+    :param dtype: The data type of the dataset
+    :param user_chunkings: Optional list of additional (x, y, z) chunkings
+
+    :returns: List of unique (x, y, z) tuples
+    """
+    candidates = list(ConvertFiles.suggest_chunking(xsize=data_shape[0],
+                                                    ysize=data_shape[1],
+                                                    mzsize=data_shape[2],
+                                                    dtype=dtype))
+    candidates += [(2, 2, 4096), (8, 8, 256), (16, 16, 64), (32, 32, 16)]
+    if user_chunkings is not None:
+        candidates += [tuple(chunks) for chunks in user_chunkings]
+    unique_candidates = []
+    for chunks in candidates:
+        chunks = tuple(int(min(chunk, size)) for chunk, size in zip(chunks, data_shape))
+        if chunks not in unique_candidates:
+            unique_candidates.append(chunks)
+    return unique_candidates
+
+
+def get_bytes_read(chunk_bytes, chunks, selection):
+    """
+    Compute the number of bytes of all chunks touched by a selection.
+
+    :param chunk_bytes: Numpy array with the stored size of each chunk in the grid of chunks
+    :param chunks: The chunk shape
+    :param selection: Tuple of three int, list, or slice selections
+
+    :returns: Number of bytes read from file for the selection
+    """
+    chunk_indices = []
+    for axis, axis_selection in enumerate(selection):
+        if isinstance(axis_selection, slice):
+            indices = np.arange(*axis_selection.indices(chunk_bytes.shape[axis] * chunks[axis]))
+        else:
+            indices = np.asarray(axis_selection).reshape(-1)
+        chunk_indices.append(np.unique(indices // chunks[axis]))
+    return int(chunk_bytes[np.ix_(*chunk_indices)].sum())
+
+
+def benchmark_layout(sample, trace, data_shape, chunks, compression='none', temp_dir=None, repeats=1):
+    """
+    Write the sample with the given layout to a temporary file and replay the access trace.
+
+    The chunk cache is disabled while replaying the trace so that each operation reads all
+    chunks it touches. Note that the temporary file is likely cached by the operating system,
+    i.e., the latency mainly reflects the cost for locating and decompressing chunks while the
+    bytes read indicate the expected I/O cost.
+
+    :param sample: Numpy array with the sample of the data
+    :param trace: List of operation dicts (see load_trace)
+    :param data_shape: The shape of the full dataset
+    :param chunks: The (x, y, z) chunking to be evaluated
+    :param compression: Key of available_compression_options
+    :param temp_dir: Directory for the temporary file. Default is the system temp directory.
+    :param repeats: Number of times the trace should be replayed. The minimum latency is used.
+
+    :returns: Dict with the 'chunks', the 'sample_chunks' limited to the shape of the sample, the 'compression',
+        the 'storage_bytes' of the sample and 'time' in seconds, 'bytes_read' and number of operations 'count'
+        per operation type and in total ('all').
+    """
+    compression_filter, compression_opts = available_compression_options[compression]
+    sample_chunks = tuple(min(chunk, size) for chunk, size in zip(chunks, sample.shape))
+    temp_file, filename = tempfile.mkstemp(suffix='.h5', dir=temp_dir)
+    os.close(temp_file)
+    try:
+        with h5py.File(filename, 'w') as sample_file:
+            dataset = sample_file.create_dataset('data',
+                                                 data=sample,
+                                                 chunks=sample_chunks,
+                                                 compression=compression_filter,
+                                                 compression_opts=compression_opts)
+            # Determine the stored size of all chunks
+            num_chunks = tuple(int(np.ceil(size / float(chunk))) for size, chunk in zip(sample.shape, sample_chunks))
+            chunk_bytes = np.zeros(num_chunks, dtype='int64')
+            for chunk_index in range(dataset.id.get_num_chunks()):
+                chunk_info = dataset.id.get_chunk_info(chunk_index)
+                chunk_bytes[tuple(offset // chunk for offset, chunk in zip(chunk_info.chunk_offset, sample_chunks))] = \
+                    chunk_info.size
+        result = {'chunks': tuple(chunks),
+                  'sample_chunks': sample_chunks,
+                  'compression': compression,
+                  'storage_bytes': int(chunk_bytes.sum())}
+        for operation_type in available_operations + ['all']:
+            result[operation_type] = {'time': 0., 'bytes_read': 0, 'count': 0}
+        with h5py.File(filename, 'r', rdcc_nbytes=0) as sample_file:
+            dataset = sample_file['data']
+            for operation in trace:
+                selection = get_operation_selection(operation, data_shape, sample.shape)
+                operation_time = None
+                for _ in range(repeats):
+                    start_time = time.time()
+                    data = dataset[selection]
+                    if operation['type'] == 'roi_mean':
+                        data = np.asarray(data).reshape((-1, ) + np.asarray(data).shape[-1:]).mean(axis=0)
+                    run_time = time.time() - start_time
+                    operation_time = run_time if operation_time is None else min(operation_time, run_time)
+                bytes_read = get_bytes_read(chunk_bytes, sample_chunks, selection)
+                for operation_type in [operation['type'], 'all']:
+                    result[operation_type]['time'] += operation_time
+                    result[operation_type]['bytes_read'] += bytes_read
+                    result[operation_type]['count'] += 1
+        return result
+    finally:
+        os.remove(filename)
+
+
+def recommend_layouts(results, metric='time', max_layouts=2, min_gain=0.2):
+    """
+    Recommend the layouts to be generated based on the benchmark results.
+
+    The best layout is the candidate with the lowest total cost for the trace. Further layouts
+    are added greedily if they reduce the cost of the trace by at least min_gain, assuming that
+    each operation is served from the best of the layouts available for the operation type
+    (similar to omsi_file_msidata.__best_dataset__).
+
+    :param results: List of results from benchmark_layout
+    :param metric: The cost to be minimized. One of 'time' or 'bytes_read'
+    :param max_layouts: The maximum number of layouts to be recommended
+    :param min_gain: The minimum relative reduction of the cost required to add a layout
+
+    :returns: List of results of the recommended layouts. The first layout should be used as
+        the main chunking and the other layouts as optimized chunkings.
+    """
+    def cost(layouts):
+        return sum(min(layout[operation_type][metric] for layout in layouts) for operation_type in available_operations)
+
+    recommended = [min(results, key=lambda result: result['all'][metric])]
+    while len(recommended) < max_layouts:
+        current_cost = cost(recommended)
+        candidates = [result for result in results if result['compression'] == recommended[0]['compression'] and
+                      result['chunks'] not in [layout['chunks'] for layout in recommended]]
+        if len(candidates) == 0:
+            break
+        best_candidate = min(candidates, key=lambda result: cost(recommended + [result]))
+        if cost(recommended + [best_candidate]) > (1. - min_gain) * current_cost:
+            break
+        recommended.append(best_candidate)
+    return recommended
+
+
+def get_convert_args(layouts):
+    """
+    Get the convertToOMSI command line arguments for the given layouts.
+
+    :param layouts: List of results from recommend_layouts
+
+    :returns: List of strings with the command line arguments
+    """
+    args = ['--chunking'] + [str(chunk) for chunk in layouts[0]['chunks']]
+    for layout in layouts[1:]:
+        args += ['--optimized-chunking'] + [str(chunk) for chunk in layout['chunks']]
+    args.append('--compression' if layouts[0]['compression'] == 'gzip' else '--no-compression')
+    return args
+
+
+def main(argv=None):
+    """
+    The main function of the chunk advisor.
+
+    :returns: List of strings with the recommended convertToOMSI command line arguments
+    """
+    if argv is None:
+        argv = sys.argv
+    parser = argparse.ArgumentParser(description='Recommend chunked data layouts for an OpenMSI file by '
+                                                 'replaying an access trace against candidate layouts.',
+                                     formatter_class=RawDescriptionDefaultHelpArgParseFormatter)
+    parser.add_argument('filename', help='The OpenMSI HDF5 file with the MSI data')
+    parser.add_argument('--experiment', type=int, default=0, help='Index of the experiment')
+    parser.add_argument('--dataset', type=int, default=0, help='Index of the MSI dataset in the experiment')
+    parser.add_argument('--trace', default=None,
+                        help='JSON file with the access trace. If not set, a trace with random ion images, '
+                             'spectra and ROI means is used.')
+    parser.add_argument('--sample-size', type=int, default=256, help='Maximum size of the data sample in MB')
+    parser.add_argument('--chunking', type=int, nargs=3, action='append', default=None, metavar=('X', 'Y', 'Z'),
+                        help='Additional candidate chunking. May be given multiple times.')
+    parser.add_argument('--compression', nargs='+', default=sorted(available_compression_options.keys()),
+                        choices=sorted(available_compression_options.keys()),
+                        help='Compression settings to be evaluated')
+    parser.add_argument('--metric', default='time', choices=['time', 'bytes_read'],
+                        help='The cost used to rank the layouts')
+    parser.add_argument('--max-layouts', type=int, default=2,
+                        help='Maximum number of copies of the data with different layouts to be recommended')
+    parser.add_argument('--repeats', type=int, default=3, help='Number of times each operation is repeated')
+    parser.add_argument('--temp-dir', default=None, help='Directory for the temporary sample files')
+    args = parser.parse_args(argv[1:])
+
+    # Read the sample and the trace
+    input_file = omsi_file(args.filename, 'r')
+    msidata = input_file.get_experiment(args.experiment).get_msidata(args.dataset)
+    data_shape = msidata.shape
+    sample = get_sample(msidata, sample_size=args.sample_size * 1024 * 1024)
+    trace = load_trace(args.trace) if args.trace is not None else generate_trace(data_shape)
+    log_helper.info(__name__, "Replaying %i operations on a sample of shape %s of the data of shape %s" %
+                    (len(trace), str(sample.shape), str(data_shape)))
+
+    # Benchmark all candidate layouts
+    temp_dir = tempfile.mkdtemp(dir=args.temp_dir)
+    results = []
+    try:
+        for chunks in get_candidate_chunkings(data_shape, sample.dtype, args.chunking):
+            for compression in args.compression:
+                result = benchmark_layout(sample=sample,
+                                          trace=trace,
+                                          data_shape=data_shape,
+                                          chunks=chunks,
+                                          compression=compression,
+                                          temp_dir=temp_dir,
+                                          repeats=args.repeats)
+                results.append(result)
+    finally:
+        shutil.rmtree(temp_dir)
+    input_file.close_file()
+
+    # Report the results
+    print("%-20s %-12s %10s %10s %10s %10s %10s %12s" % ("chunks", "compression", "size (MB)", "total (ms)",
+                                                        "slice (ms)", "spec. (ms)", "roi (ms)", "read (MB)"))
+    for result in sorted(results, key=lambda result: result['all'][args.metric]):
+        print("%-20s %-12s %10.2f %10.2f %10.3f %10.3f %10.3f %12.2f" %
+              (str(result['chunks']), result['compression'], result['storage_bytes'] / (1024. * 1024.),
+               1000. * result['all']['time'],
+               *[1000. * result[operation_type]['time'] / max(result[operation_type]['count'], 1)
+                 for operation_type in available_operations],
+               result['all']['bytes_read'] / (1024. * 1024.)))
+    layouts = recommend_layouts(results, metric=args.metric, max_layouts=args.max_layouts)
+    convert_args = get_convert_args(layouts)
+    print("Recommended convertToOMSI options: " + " ".join(convert_args))
+    return convert_args
+
+
+if __name__ == "__main__":
+    main()
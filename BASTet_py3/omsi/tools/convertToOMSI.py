@@ -4,7 +4,6 @@
 
 """
 
-# TODO Add write method to optimize the generation of optimized data chunkings by reading many spectra
 # TODO Switch job submission over to use Edison
 # TODO Test file converter and memory usage
 # TODO Make NMF/FPG/FPL etc. seperate workflows
@@ -385,8 +384,9 @@ class ConvertSettings(object):
                                 "merge",
                                 "split+merge"]
     # Available options for the data write. One chunk at a time ('chunk'), one
-    # spectrum at a time ('spectrum'), or all at one once ('all')
-    available_io_options = ["chunk", "spectrum", "all", "spectrum_to_image"]
+    # spectrum at a time ('spectrum'), or all at one once ('all'). 'staged' writes all
+    # copies of the data while reading the input file.
+    available_io_options = ["chunk", "spectrum", "all", "spectrum_to_image", "staged"]
     available_error_options = ["terminate-and-cleanup",
                                "terminate-only",
                                "continue-on-error"]
@@ -394,12 +394,17 @@ class ConvertSettings(object):
     ####################################################################
     #  Define the input parameters used during the conversion         ##
     ####################################################################
-    # Define how the data should be written to file, one chunk at a time
-    # ('chunk'), one spectrum at a time ('spectrum') or all at one once
-    # ('all'); read set of spectra and make into image ('spectrum_to_image')
-    io_option = "spectrum_to_image"
-    # When using the spectrum_to_image io option, what is the maximum block of images we should load in Byte
+    # Define how the additional copies of the data should be written to file. Reread the data from
+    # the first copy one chunk at a time ('chunk'), one spectrum at a time ('spectrum') or all at one
+    # once ('all'); read set of spectra and make into image ('spectrum_to_image'); or stage blocks of
+    # full chunk-rows in memory and write all copies while reading the input file ('staged')
+    io_option = "staged"
+    # When using the staged or spectrum_to_image io option, what is the maximum block we should load in Byte
     io_block_size_limit = 1024 * 1024 * 500  # 500 MB limit
+    # Number of parser processes used to pipeline the initial conversion. 0 means spectrum-by-spectrum conversion.
+    pipeline_workers = 0
+    # Maximum number of tiles buffered between the parsers and the writer when using the pipelined conversion
+    pipeline_queue_size = 4
     format_option = None  # Define which file format reader should be used. None=determine automatically
     region_option = "split+merge"  # Define the region option to be used
     auto_chunk = True  # Automatically decide which chunking should be used
@@ -642,6 +647,26 @@ class ConvertSettings(object):
                 except:
                     log_helper.warning(__name__, "An error accured while parsing the --io-block-limit command.")
                     input_error = True
+            elif current_arg == "--pipeline":
+                start_index += 2
+                try:
+                    ConvertSettings.pipeline_workers = int(argv[i + 1])
+                    if ConvertSettings.pipeline_workers < 0:
+                        raise ValueError("Invalid number of pipeline workers")
+                    log_helper.info(__name__, "Set pipeline workers to: " + str(ConvertSettings.pipeline_workers))
+                except:
+                    log_helper.warning(__name__, "An error accured while parsing the --pipeline command.")
+                    input_error = True
+            elif current_arg == "--pipeline-queue":
+                start_index += 2
+                try:
+                    ConvertSettings.pipeline_queue_size = int(argv[i + 1])
+                    if ConvertSettings.pipeline_queue_size < 1:
+                        raise ValueError("Invalid pipeline queue size")
+                    log_helper.info(__name__, "Set pipeline queue size to: " + str(ConvertSettings.pipeline_queue_size))
+                except:
+                    log_helper.warning(__name__, "An error accured while parsing the --pipeline-queue command.")
+                    input_error = True
             elif current_arg == "--thumbnail":
                 start_index += 1
                 ConvertSettings.generate_thumbnail = True
@@ -908,16 +933,26 @@ class ConvertSettings(object):
         print("")
         print("===I/O OPTIONS=== ")
         print("--io <option>: Available options are: " + str(ConvertSettings.available_io_options))
+        print("             The io option applies only for the generation of subsequent chunkings")
+        print("             and not the initial iteration over the file to generate the first convert.")
         print("             i) all : Read the full data in memory and write it at once")
         print("             ii) spectrum : Read one spectrum at a time and write it to the file. ")
         print("             iii) chunk : Read one chunk at a time and write it to the file.")
-        print("             The io option applies only for the generation of subsequent chunkings")
-        print("             and not the initial iteration over the file to generate the first convert.")
-        print("             iv) spectrum-to-image: Default option when creating image chunk version from")
-        print("             a spectrum-chunk MSI dataset. Read a block of spectra at a time to")
+        print("             iv) spectrum-to-image: Read a block of spectra at a time to")
         print("             complete a set of images and then write the block of images at once.")
-        print("--io-block-limit <MB>: When using spectrum-to-image io (default when using auto-chunking),")
-        print("             what should the maximum block in MB that we load into memory. (Default=2000MB)")
+        print("             v) staged : Default option. Write all chunkings in a single pass over the input")
+        print("             file. Spectra for the additional chunkings are staged in memory in blocks of full")
+        print("             chunk-rows which are written once complete. Chunkings for which a chunk-row does")
+        print("             not fit the --io-block-limit are generated after the pass using spectrum-to-image.")
+        print("--io-block-limit <MB>: When using staged or spectrum-to-image io, what should the maximum")
+        print("             block in MB that we load into memory. (Default=500MB)")
+        print("--pipeline <num_workers>: Pipeline the initial conversion of the raw data. num_workers parser")
+        print("             processes read the spectra of disjoint tiles of the image and assemble them into")
+        print("             buffers matching the HDF5 chunking while a single writer writes whole tiles")
+        print("             chunk-aligned to the file. The --io-block-limit bounds the memory of the buffers.")
+        print("             (Default=0, i.e., write one spectrum at a time)")
+        print("--pipeline-queue <num_tiles>: Maximum number of tiles waiting for the writer when using")
+        print("             --pipeline. (Default=4)")
         print("")
         print("===DATABSE OPTIONS=== ")
         print("")
@@ -1111,14 +1146,61 @@ class ConvertFiles(object):
             data = omsi_file.omsi_file_msidata(data_group=data_group,
                                                preload_mz=False,
                                                preload_xy_index=False)
-            ConvertFiles.write_data(input_file=input_file,
-                                    data=data,
-                                    data_io_option='spectrum',  # ConvertSettings.io_option,
-                                    chunk_shape=ConvertSettings.chunks,
-                                    write_progress=(ConvertSettings.job_id is None))
+            # Create the additional data copies so that we can write them in the same pass. Staging is
+            # only used for chunkings for which full chunk-rows fit the io block size limit. Staging
+            # partial chunk-rows would rewrite (and recompress) every chunk once per block.
+            write_target = data
+            if ConvertSettings.io_option == "staged" and len(additional_chunks) > 0:
+                staged_chunks = []
+                reread_chunks = []
+                for chunkSpec in additional_chunks:
+                    block_rows = StagedLayoutWriter.get_block_rows(shape=input_file.shape,
+                                                                   dtype=input_file.data_type,
+                                                                   chunks=chunkSpec,
+                                                                   block_size_limit=ConvertSettings.io_block_size_limit,
+                                                                   num_datasets=len(additional_chunks))
+                    if block_rows is None:
+                        log_helper.warning(__name__, "A chunk-row of the data copy " + str(chunkSpec) +
+                                           " does not fit the io block size limit. The copy is generated" +
+                                           " after the conversion using spectrum_to_image io instead.")
+                        reread_chunks.append(chunkSpec)
+                    else:
+                        staged_chunks.append(chunkSpec)
+                additional_chunks = reread_chunks
+                if len(staged_chunks) > 0:
+                    staged_datasets = []
+                    for chunkSpec in staged_chunks:
+                        log_helper.info(__name__, "Generating optimized data copy: " + str(chunkSpec))
+                        staged_datasets.append(data.create_optimized_chunking(
+                            chunks=chunkSpec,
+                            compression=ConvertSettings.compression,
+                            compression_opts=ConvertSettings.compression_opts,
+                            copy_data=False,
+                            print_status=True))
+                    write_target = StagedLayoutWriter(dataset=data_dataset,
+                                                      staged_datasets=staged_datasets,
+                                                      block_size_limit=ConvertSettings.io_block_size_limit)
+            if ConvertSettings.pipeline_workers > 0:
+                ConvertFiles.write_data_pipelined(input_file=input_file,
+                                                  data=write_target,
+                                                  chunk_shape=ConvertSettings.chunks,
+                                                  num_workers=ConvertSettings.pipeline_workers,
+                                                  queue_size=ConvertSettings.pipeline_queue_size,
+                                                  block_size_limit=ConvertSettings.io_block_size_limit,
+                                                  write_progress=(ConvertSettings.job_id is None))
+            else:
+                ConvertFiles.write_data(input_file=input_file,
+                                        data=write_target,
+                                        data_io_option='spectrum',  # ConvertSettings.io_option,
+                                        chunk_shape=ConvertSettings.chunks,
+                                        write_progress=(ConvertSettings.job_id is None))
+            if isinstance(write_target, StagedLayoutWriter):
+                write_target.flush()
             ConvertSettings.omsi_output_file.flush()
 
             # Generate any additional data copies if requested
+            reread_io_option = "spectrum_to_image" if ConvertSettings.io_option == "staged" \
+                else ConvertSettings.io_option
             for chunkSpec in additional_chunks:
                 log_helper.info(__name__, "Generating optimized data copy: " + str(chunkSpec))
                 tempdata = data.create_optimized_chunking(chunks=chunkSpec,
@@ -1134,12 +1216,12 @@ class ConvertFiles(object):
                 num_images_block = int(num_images_block) if num_images_block > 1 else 1
                 # Determine the chunking parameter based on the io option
                 chunk_shape_write = (input_file.shape[0], input_file.shape[1], num_images_block) if \
-                                        ConvertSettings.io_option == "spectrum_to_image" \
+                                        reread_io_option == "spectrum_to_image" \
                                         else chunkSpec
                 # Write the data using the given io strategry
                 ConvertFiles.write_data(input_file=data_dataset,
                                         data=tempdata,
-                                        data_io_option=ConvertSettings.io_option,
+                                        data_io_option=reread_io_option,
                                         chunk_shape=chunk_shape_write,
                                         write_progress=(ConvertSettings.job_id is None))
                 ConvertSettings.omsi_output_file.flush()
@@ -1279,7 +1361,8 @@ class ConvertFiles(object):
                 if ConvertSettings.execute_ticnorm:
                     log_helper.info(__name__, "Executing tic normalization")
                     tic = omsi_tic_norm(name_key="tic_norm_" + str(time.ctime()))
-                    tic.execute(msidata=data, mzdata=mzdata)
+                    # The normalized data is only saved, hence, write it directly to file
+                    tic.execute(msidata=data, mzdata=mzdata, deferred=True)
                     ana, anaindex = exp.create_analysis(tic)
             except:
                 warnings.warn("TIC normalization failed.")
@@ -1835,6 +1918,352 @@ class ConvertFiles(object):
                             sys.stdout.write("[" + str(int(100. * float(itertest) / float(num_chunks))) + "%]" + "\r")
                             sys.stdout.flush()
 
+    @staticmethod
+    def get_pipeline_tile_shape(data_shape, dtype, chunk_shape, tile_size_limit):
+        """
+        Helper function used to determine the shape of the tiles of the pipelined conversion.
+
+        A tile contains the full spectra of a block of chunk_shape[0] x n*chunk_shape[1] pixels, i.e.,
+        tiles are aligned with the chunks of the output dataset. The tile is extended along y as long
+        as it does not exceed the tile_size_limit.
+
+        :param data_shape: The shape of the data cube
+        :param dtype: The data type of the data cube
+        :param chunk_shape: The chunking of the output dataset. None if chunking is not used.
+        :param tile_size_limit: Maximum size of a tile in byte. The tile is at least a single chunk in x/y.
+
+        :returns: Tuple of (x, y, z) with the shape of the tiles
+        """
+        chunk_x, chunk_y = (chunk_shape[0], chunk_shape[1]) if chunk_shape is not None else (1, 1)
+        chunk_x, chunk_y = min(chunk_x, data_shape[0]), min(chunk_y, data_shape[1])
+        chunk_size = chunk_x * chunk_y * data_shape[2] * np.dtype(dtype).itemsize
+        num_chunks_y = int(math.ceil(float(data_shape[1]) / float(chunk_y)))
+        num_tile_chunks_y = min(max(int(tile_size_limit / chunk_size), 1), num_chunks_y)
+        return chunk_x, min(num_tile_chunks_y * chunk_y, data_shape[1]), data_shape[2]
+
+    @staticmethod
+    def write_data_pipelined(input_file, data, chunk_shape=None, num_workers=1, queue_size=4,
+                             block_size_limit=1024*1024*500, write_progress=True):
+        """
+        Helper function used to convert the data from a file reader with a pipeline of parser
+        processes and a single writer.
+
+        The x/y plane of the data is split into tiles aligned with the chunking of the output (see
+        get_pipeline_tile_shape). The tiles are assigned round-robin to num_workers parser processes,
+        each of which reads the spectra of its tiles via input_file.spectrum_iter_tiles and assembles
+        them into tile buffers. Complete tiles are passed via a bounded queue to the calling process,
+        which writes each tile with a single chunk-aligned write. Parsing and writing therefore overlap
+        and the writer never writes partial chunks. If the reader does not support tile iteration
+        (see file_reader_base.supports_tile_iter) then a single parser process is used.
+
+        :param input_file: The input file reader (file_reader_base)
+        :param data: The output dataset (either an h5py dataset or omsi_file_msidata object.
+        :param chunk_shape: The chunking used by the data. None if chunking is not used.
+        :param num_workers: The number of parser processes
+        :param queue_size: The maximum number of complete tiles waiting for the writer.
+        :param block_size_limit: Approximate limit in byte for the memory used for tile buffers.
+        :param write_progress: Write progress in % to standard out while data is being written.
+        :type write_progress: bool
+
+        :returns: Dict with the number of spectra written, the 'time' in seconds, the 'write_time' in
+            seconds spend by the writer, and the throughput in 'spectra_per_second' and 'mb_per_second'.
+
+        """
+        import multiprocessing
+        import queue
+        if not input_file.supports_tile_iter() and num_workers > 1:
+            log_helper.info(__name__, "The reader does not support tile iteration. Using a single parser process.")
+            num_workers = 1
+        # Determine the tile shape such that all buffers fit in the memory limit
+        tile_shape = ConvertFiles.get_pipeline_tile_shape(data_shape=input_file.shape,
+                                                          dtype=input_file.data_type,
+                                                          chunk_shape=chunk_shape,
+                                                          tile_size_limit=block_size_limit / float(queue_size +
+                                                                                                   2 * num_workers))
+        log_helper.info(__name__, "Pipelined I/O. Write %s tiles using %i parser processes" % (tile_shape,
+                                                                                           num_workers))
+        # Parsers are forked so that they can inherit the file reader. Fall back to threads otherwise.
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+        else:
+            import multiprocessing.dummy as context
+        tile_queue = context.Queue(maxsize=queue_size)
+        parsers = [context.Process(target=_pipeline_parse_tiles,
+                                   args=(input_file, tile_shape, worker_index, num_workers, tile_queue))
+                   for worker_index in range(num_workers)]
+        for parser in parsers:
+            parser.daemon = True
+            parser.start()
+
+        # Write the tiles as they become available
+        num_spectra_total = float(input_file.shape[0] * input_file.shape[1])
+        spectrum_size = input_file.shape[2] * np.dtype(input_file.data_type).itemsize
+        num_spectra = 0
+        write_time = 0
+        done = set()
+        start_time = time.time()
+        try:
+            while len(done) < num_workers:
+                try:
+                    message = tile_queue.get(timeout=1)
+                except queue.Empty:
+                    for worker_index, parser in enumerate(parsers):
+                        if not parser.is_alive() and worker_index not in done:
+                            raise RuntimeError("Parser process %i terminated unexpectedly" % worker_index)
+                    continue
+                if message[0] == 'done':
+                    done.add(message[1])
+                elif message[0] == 'error':
+                    raise RuntimeError("Parser process %i failed:\n%s" % (message[1], message[2]))
+                else:
+                    xstart, ystart, tile, merge_mask, num_tile_spectra = message[1:]
+                    write_start = time.time()
+                    selection = (slice(xstart, xstart + tile.shape[0]), slice(ystart, ystart + tile.shape[1]))
+                    if merge_mask is not None:
+                        # The tile has been written partially before so we need to merge the spectra
+                        current_tile = data[selection[0], selection[1], :]
+                        current_tile[merge_mask] = tile[merge_mask]
+                        tile = current_tile
+                    data[selection[0], selection[1], :] = tile
+                    write_time += time.time() - write_start
+                    num_spectra += num_tile_spectra
+                    if write_progress:
+                        try:
+                            sys.stdout.write("[" + str(int(100. * num_spectra / num_spectra_total)) + "%]" + "\r")
+                            sys.stdout.flush()
+                        except ValueError:
+                            write_progress = False
+        finally:
+            # Parser threads cannot be terminated but have completed unless an error occurred
+            for parser in parsers:
+                if hasattr(parser, 'terminate'):
+                    parser.terminate()
+                    parser.join()
+
+        # Report the throughput
+        run_time = max(time.time() - start_time, 1e-9)
+        throughput = {'num_spectra': num_spectra,
+                      'time': run_time,
+                      'write_time': write_time,
+                      'spectra_per_second': num_spectra / run_time,
+                      'mb_per_second': num_spectra * spectrum_size / (1024. * 1024.) / run_time}
+        log_helper.info(__name__, "Pipelined I/O: %i spectra (%.1f MB) in %.2f s: %.1f spectra/s, %.2f MB/s. "
+                                  "Writer busy %.1f%% of the time." %
+                        (num_spectra, num_spectra * spectrum_size / (1024. * 1024.), run_time,
+                         throughput['spectra_per_second'], throughput['mb_per_second'],
+                         100. * write_time / run_time))
+        return throughput
+
+
+class StagedLayoutWriter(object):
+    """
+    Helper class used to write multiple copies of a dataset with different chunked layouts in a single pass.
+
+    Data is written directly to the main dataset. For the staged datasets the data is collected in
+    memory in blocks of full chunk-rows, i.e., all spectra of a set of rows in x aligned with the
+    chunking of the dataset. A block is written with a single write once all its spectra have been
+    set. The memory of the open blocks is bounded by block_size_limit. Blocks always contain at least
+    one chunk-row, since partial chunk-rows would rewrite every chunk once per block. If a chunk-row
+    does not fit the limit (see get_block_rows), the limit is exceeded and a warning is logged. If the
+    data is written in an order that leaves more than max_open_blocks incomplete, then blocks are
+    written partially and merged with the data in the file when they are written again. The object
+    can be used in place of an h5py dataset in ConvertFiles.write_data and
+    ConvertFiles.write_data_pipelined.
+    """
+    def __init__(self, dataset, staged_datasets, block_size_limit=1024 * 1024 * 500, max_open_blocks=2):
+        """
+        :param dataset: The main h5py dataset. Data is written to and read from this dataset directly.
+        :param staged_datasets: List of h5py datasets with the same shape as dataset to be written via staging.
+        :param block_size_limit: Approximate limit in byte for the memory used for staging all datasets.
+        :param max_open_blocks: The maximum number of incomplete blocks per staged dataset.
+        """
+        self.dataset = dataset
+        self.shape = dataset.shape
+        self.dtype = dataset.dtype
+        self.staged_datasets = staged_datasets
+        self.max_open_blocks = max_open_blocks
+        # Determine the number of rows in x of the blocks of each staged dataset
+        self.block_rows = []
+        for staged_dataset in staged_datasets:
+            num_rows = self.get_block_rows(shape=self.shape,
+                                           dtype=self.dtype,
+                                           chunks=staged_dataset.chunks,
+                                           block_size_limit=block_size_limit,
+                                           num_datasets=len(staged_datasets),
+                                           max_open_blocks=max_open_blocks)
+            if num_rows is None:
+                num_rows = min(staged_dataset.chunks[0] if staged_dataset.chunks is not None else 1, self.shape[0])
+                log_helper.warning(__name__, "A chunk-row of the staged dataset with chunking " +
+                                   str(staged_dataset.chunks) + " does not fit the block size limit. " +
+                                   "Staging blocks of one chunk-row instead.")
+            self.block_rows.append(num_rows)
+        self.open_blocks = [{} for _ in staged_datasets]  # Dicts of block index -> [block, mask, number of spectra]
+        self.written_blocks = [set() for _ in staged_datasets]
+
+    @staticmethod
+    def get_block_rows(shape, dtype, chunks, block_size_limit, num_datasets=1, max_open_blocks=2):
+        """
+        Get the number of rows in x of the staging blocks for a dataset with the given chunking.
+
+        :param shape: The shape of the dataset
+        :param dtype: The data type of the dataset
+        :param chunks: The chunking of the dataset or None
+        :param block_size_limit: Approximate limit in byte for the memory used for staging all datasets.
+        :param num_datasets: The number of datasets staged at the same time.
+        :param max_open_blocks: The maximum number of incomplete blocks per staged dataset.
+
+        :return: The number of rows, i.e., either all rows or a multiple of the chunk size in x.
+            None if a single chunk-row does not fit the block size limit.
+        """
+        row_size = shape[1] * shape[2] * np.dtype(dtype).itemsize
+        dataset_limit = block_size_limit / float(max(num_datasets, 1))
+        # A block of all rows is never open more than once
+        if shape[0] * row_size <= dataset_limit:
+            return shape[0]
+        chunk_x = chunks[0] if chunks is not None else 1
+        num_rows = int(dataset_limit / float(max_open_blocks * row_size))
+        if num_rows < chunk_x:
+            return None
+        return min((num_rows // chunk_x) * chunk_x, shape[0])
+
+    def __getitem__(self, key):
+        """Read data from the main dataset"""
+        return self.dataset[key]
+
+    def __setitem__(self, key, value):
+        """
+        Write data to all datasets. Selections of a single spectrum or of a block of spectra via
+        slices in x and y and the full m/z range are staged. All other selections are written directly.
+        """
+        self.dataset[key] = value
+        selection = self.__get_block_selection(key)
+        if selection is None:
+            for staged_dataset in self.staged_datasets:
+                staged_dataset[key] = value
+            return
+        (xstart, xstop), (ystart, ystop) = selection
+        value = np.asarray(value).reshape((xstop - xstart, ystop - ystart, self.shape[2]))
+        for dataset_index, num_rows in enumerate(self.block_rows):
+            for block_index in range(xstart // num_rows, (xstop - 1) // num_rows + 1):
+                block = self.__get_open_block(dataset_index, block_index)
+                block_start = block_index * num_rows
+                start, stop = max(xstart, block_start), min(xstop, block_start + block[0].shape[0])
+                block[0][start - block_start:stop - block_start, ystart:ystop, :] = value[start - xstart:stop - xstart]
+                block[2] += np.count_nonzero(~block[1][start - block_start:stop - block_start, ystart:ystop])
+                block[1][start - block_start:stop - block_start, ystart:ystop] = True
+                if block[2] == block[1].size:
+                    self.__write_block(dataset_index, block_index)
+
+    def flush(self):
+        """Write all open blocks to the staged datasets."""
+        for dataset_index, open_blocks in enumerate(self.open_blocks):
+            for block_index in list(open_blocks.keys()):
+                self.__write_block(dataset_index, block_index)
+
+    def __get_block_selection(self, key):
+        """
+        Internal helper function used to get the ((xstart, xstop), (ystart, ystop)) range of a selection
+        or None if the selection is not a block of full spectra.
+        """
+        if not isinstance(key, tuple) or len(key) != 3 or not isinstance(key[2], slice) or \
+                key[2] != slice(None):
+            return None
+        selection = []
+        for axis in range(2):
+            if isinstance(key[axis], (int, np.integer)):
+                selection.append((int(key[axis]), int(key[axis]) + 1))
+            elif isinstance(key[axis], slice) and key[axis].step in (None, 1):
+                start, stop, _ = key[axis].indices(self.shape[axis])
+                if stop <= start:
+                    return None
+                selection.append((start, stop))
+            else:
+                return None
+        return selection
+
+    def __get_open_block(self, dataset_index, block_index):
+        """Internal helper function used to get an open block and write old blocks if needed"""
+        open_blocks = self.open_blocks[dataset_index]
+        if block_index not in open_blocks:
+            if len(open_blocks) >= self.max_open_blocks:
+                self.__write_block(dataset_index, next(iter(open_blocks)))
+            num_rows = min(self.block_rows[dataset_index], self.shape[0] - block_index * self.block_rows[dataset_index])
+            open_blocks[block_index] = [np.zeros((num_rows, ) + tuple(self.shape[1:]), dtype=self.dtype),
+                                        np.zeros((num_rows, self.shape[1]), dtype='bool'),
+                                        0]
+        return open_blocks[block_index]
+
+    def __write_block(self, dataset_index, block_index):
+        """Internal helper function used to write a block to a staged dataset"""
+        block, mask, _ = self.open_blocks[dataset_index].pop(block_index)
+        staged_dataset = self.staged_datasets[dataset_index]
+        block_start = block_index * self.block_rows[dataset_index]
+        block_selection = slice(block_start, block_start + block.shape[0])
+        if block_index in self.written_blocks[dataset_index]:
+            # The block has been written partially before so we need to merge the spectra
+            current_block = staged_dataset[block_selection, :, :]
+            current_block[mask] = block[mask]
+            block = current_block
+        staged_dataset[block_selection, :, :] = block
+        self.written_blocks[dataset_index].add(block_index)
+
+
+def _pipeline_parse_tiles(input_file, tile_shape, partition_index, num_partitions, tile_queue):
+    """
+    Parser process of ConvertFiles.write_data_pipelined.
+
+    Read the spectra of the tiles of the given partition, assemble them into tile buffers and put
+    ('tile', xstart, ystart, tile, merge_mask, num_spectra) messages on the tile_queue. A tile is sent
+    once it is complete. If the reader does not yield the spectra tile by tile, then incomplete tiles
+    are sent when the parser needs to free memory or has read all spectra. If a tile is sent more
+    than once, then merge_mask indicates the spectra that the writer needs to merge with the data
+    already in the file, otherwise merge_mask is None. Finally, ('done', partition_index) or
+    ('error', partition_index, traceback) is put on the queue.
+
+    :param input_file: The input file reader (file_reader_base)
+    :param tile_shape: Tuple of (x, y, z) with the shape of a tile
+    :param partition_index: Index of the partition of tiles to be read
+    :param num_partitions: Total number of partitions
+    :param tile_queue: The queue used to send the tiles to the writer
+    """
+    try:
+        data_shape = input_file.shape
+        # Readers that yield a tile at a time only need a single tile buffer
+        max_open_tiles = 1 if input_file.supports_tile_iter() else input_file.get_num_tiles(tile_shape)[1]
+        open_tiles = {}  # Dict of tile origin -> [tile, mask of the spectra set, number of spectra]
+        sent_tiles = set()
+
+        def send_tile(origin):
+            tile, mask, num_tile_spectra = open_tiles.pop(origin)
+            merge_mask = mask if origin in sent_tiles else None
+            sent_tiles.add(origin)
+            tile_queue.put(('tile', origin[0], origin[1], tile, merge_mask, num_tile_spectra))
+
+        for position, spectrum in input_file.spectrum_iter_tiles(tile_shape[:2], partition_index, num_partitions):
+            origin = ((position[0] // tile_shape[0]) * tile_shape[0], (position[1] // tile_shape[1]) * tile_shape[1])
+            if origin not in open_tiles:
+                if len(open_tiles) >= max_open_tiles:
+                    send_tile(next(iter(open_tiles)))
+                current_shape = (min(tile_shape[0], data_shape[0] - origin[0]),
+                                 min(tile_shape[1], data_shape[1] - origin[1]))
+                open_tiles[origin] = [np.zeros(current_shape + (data_shape[2], ), dtype=input_file.data_type),
+                                      np.zeros(current_shape, dtype='bool'),
+                                      0]
+            current_tile = open_tiles[origin]
+            xindex, yindex = position[0] - origin[0], position[1] - origin[1]
+            current_tile[0][xindex, yindex, :] = spectrum
+            if not current_tile[1][xindex, yindex]:
+                current_tile[1][xindex, yindex] = True
+                current_tile[2] += 1
+            if current_tile[2] == current_tile[1].size:
+                send_tile(origin)
+        for origin in list(open_tiles.keys()):
+            send_tile(origin)
+        tile_queue.put(('done', partition_index))
+    except Exception:
+        import traceback
+        tile_queue.put(('error', partition_index, traceback.format_exc()))
+
 
 if __name__ == "__main__":
     main()
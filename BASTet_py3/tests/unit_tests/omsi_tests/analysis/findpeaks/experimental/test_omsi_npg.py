@@ -0,0 +1,54 @@
+"""
+Test the omsi.analysis.findpeaks.experimental.omsi_npg module
+"""
+import contextlib
+import io
+import unittest
+import numpy as np
+
+from omsi.analysis.findpeaks.experimental.omsi_npg import omsi_npg
+
+
+class test_omsi_npg(unittest.TestCase):
+
+    def setUp(self):
+        self.random_state = np.random.RandomState(0)
+
+    def tearDown(self):
+        pass
+
+    @staticmethod
+    def naive_hc(values, tree_cut):
+        # Merge the nearest neighbors one at a time until the smallest gap reaches tree_cut
+        thelist, inverse_idxs = np.unique(values, return_inverse=True)
+        clusters = [[i] for i in range(len(thelist))]
+        while len(thelist) > 1:
+            dif = np.diff(thelist)
+            if dif.min() >= tree_cut:
+                break
+            mpos = dif.argmin()
+            thelist[mpos] = np.median([thelist[mpos], thelist[mpos + 1]])
+            thelist = np.delete(thelist, mpos + 1)
+            clusters[mpos] += clusters.pop(mpos + 1)
+        labels = np.zeros(sum(len(c) for c in clusters), dtype='int64')
+        for label, cluster in enumerate(clusters):
+            labels[cluster] = label + 1
+        return labels[inverse_idxs]
+
+    def test_myHC(self):
+        npg = omsi_npg()
+        for index in range(40):
+            num_values = self.random_state.randint(1, 200)
+            if index % 2 == 0:
+                values = self.random_state.rand(num_values) * 10
+            else:
+                # Many ties between the gaps
+                values = np.round(self.random_state.rand(num_values) * 20, 1)
+            for tree_cut in [0.01, 0.1, 1.0]:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    result = npg.myHC(values, tree_cut)
+                self.assertTrue(np.array_equal(result, self.naive_hc(values, tree_cut)))
+
+
+if __name__ == '__main__':
+    unittest.main()
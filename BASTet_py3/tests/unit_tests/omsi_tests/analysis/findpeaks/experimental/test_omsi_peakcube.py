@@ -0,0 +1,105 @@
+"""
+Test the omsi.analysis.findpeaks.experimental.omsi_peakcube module
+"""
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+import numpy as np
+import h5py
+
+from omsi.analysis.findpeaks.experimental.omsi_peakcube import omsi_peakcube
+
+
+class test_omsi_peakcube(unittest.TestCase):
+
+    def setUp(self):
+        self.random_state = np.random.RandomState(0)
+        num_x, num_y, self.num_labels = 4, 5, 6
+        num_peaks = self.random_state.randint(0, 8, num_x * num_y)
+        self.peaks_arrayindex = np.zeros((num_x * num_y, 3), dtype='int64')
+        self.peaks_arrayindex[:, 0] = np.repeat(np.arange(num_x), num_y)
+        self.peaks_arrayindex[:, 1] = np.tile(np.arange(num_y), num_x)
+        self.peaks_arrayindex[:, 2] = np.cumsum(num_peaks) - num_peaks
+        # Labels repeat within a pixel and intensities may be negative
+        self.peaks_labels = self.random_state.randint(1, self.num_labels + 1, num_peaks.sum()).astype('float')
+        self.peaks_intensities = self.random_state.randn(num_peaks.sum())
+        self.labels_list = np.arange(1, self.num_labels + 1)
+        # The expected peak cube has the max intensity per pixel and label
+        self.expected = np.zeros((num_x * num_y, self.num_labels))
+        for pixel in range(num_x * num_y):
+            start = self.peaks_arrayindex[pixel, 2]
+            touched = set()
+            for peak in range(start, start + num_peaks[pixel]):
+                label = int(self.peaks_labels[peak]) - 1
+                if label in touched:
+                    self.expected[pixel, label] = max(self.expected[pixel, label], self.peaks_intensities[peak])
+                else:
+                    self.expected[pixel, label] = self.peaks_intensities[peak]
+                    touched.add(label)
+        self.expected = self.expected.reshape((num_x, num_y, self.num_labels))
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for filename in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, filename))
+        os.rmdir(self.temp_dir)
+
+    def get_peak_cube(self, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return omsi_peakcube().getPeakCube(self.peaks_intensities,
+                                               self.peaks_arrayindex,
+                                               self.peaks_labels,
+                                               self.labels_list,
+                                               **kwargs)
+
+    def test_get_peak_cube(self):
+        result = self.get_peak_cube()
+        self.assertEqual(result.dtype, np.dtype('float64'))
+        self.assertTrue(np.array_equal(result, self.expected))
+
+    def test_get_peak_cube_float32(self):
+        result = self.get_peak_cube(dtype='float32')
+        self.assertEqual(result.dtype, np.dtype('float32'))
+        self.assertTrue(np.array_equal(result, self.expected.astype('float32')))
+
+    def test_get_peak_cube_sparse(self):
+        result = self.get_peak_cube(sparse=True)
+        self.assertEqual(result.shape, (20, self.num_labels))
+        self.assertTrue(np.array_equal(result.toarray().reshape(self.expected.shape), self.expected))
+
+    def test_get_peak_cube_out(self):
+        out = np.full(self.expected.shape, np.nan)
+        self.get_peak_cube(out=out, blockSize=self.expected.shape[1] * self.num_labels)
+        self.assertTrue(np.array_equal(out, self.expected))
+
+    def test_execute_analysis_deferred(self):
+        peaks_mzdata = np.linspace(100, 200, 50)
+        peaks_bins = self.random_state.randint(0, 50, self.peaks_labels.size)
+        with h5py.File(os.path.join(self.temp_dir, 'peakcube.h5'), 'w') as h5file:
+            for deferred in [False, True]:
+                analysis = omsi_peakcube()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    analysis.execute(peaksBins=peaks_bins,
+                                     peaksIntensities=self.peaks_intensities,
+                                     peaksArrayIndex=self.peaks_arrayindex,
+                                     peaksMZdata=peaks_mzdata,
+                                     HCpeaksLabels=self.peaks_labels,
+                                     HCLabelsList=self.labels_list,
+                                     deferred=deferred)
+                names = [ana_data['name'] for ana_data in analysis.get_all_analysis_data()]
+                if not deferred:
+                    self.assertTrue(np.array_equal(analysis['npg_peak_cube_mz'], self.expected))
+                    self.assertRaises(NotImplementedError, analysis.write_analysis_data, h5file)
+                    continue
+                # The peak cube is assembled only when the analysis is written
+                self.assertEqual(names, ['npg_peak_mz'])
+                analysis_group = h5file.create_group('analysis')
+                analysis.write_analysis_data(analysis_group=analysis_group)
+                self.assertTrue(np.array_equal(analysis_group['npg_peak_cube_mz'][:], self.expected))
+                self.assertEqual(analysis_group['npg_peak_mz'].shape, (self.num_labels,))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+"""
+Test the omsi.analysis.findpeaks.omsi_findpeaks_global module
+"""
+import unittest
+import numpy as np
+
+from omsi.analysis.findpeaks.omsi_findpeaks_global import omsi_findpeaks_global, get_mean_spectrum
+from omsi.analysis.findpeaks.third_party.findpeaks import findpeaks_batch
+
+
+class test_omsi_findpeaks_global(unittest.TestCase):
+
+    def setUp(self):
+        self.random_state = np.random.RandomState(0)
+        self.mzdata = np.linspace(100, 200, 400)
+        self.msidata = (self.random_state.rand(13, 9, 400) * 20).astype('uint16')
+        self.msidata[:, :, 100] += 500
+        self.msidata[:, :, 250] += 300
+
+    def tearDown(self):
+        pass
+
+    def test_get_mean_spectrum(self):
+        expected = self.msidata.reshape(-1, 400).mean(axis=0)
+        # Use blocks of 3 rows in x that do not divide the data evenly
+        for memory_budget in [2**30, 9 * 400 * 2 * 3]:
+            self.assertTrue(np.allclose(get_mean_spectrum(self.msidata, memory_budget=memory_budget), expected))
+
+    def test_execute_analysis(self):
+        # Find the peaks in the mean spectrum of the full data loaded at once
+        flat_data = self.msidata.reshape(-1, 400)
+        peak_index, _, _ = findpeaks_batch(flat_data.mean(axis=0)[np.newaxis, :], 3, 100, 2)
+        expected_mz = self.mzdata[peak_index]
+        expected_cube = np.zeros((flat_data.shape[0], len(expected_mz)))
+        for i, mz_peak in enumerate(expected_mz):
+            expected_cube[:, i] = flat_data[:, np.abs(self.mzdata - mz_peak) < 0.1].max(axis=1)
+        expected_cube = expected_cube.reshape(13, 9, len(expected_mz))
+
+        analysis = omsi_findpeaks_global()
+        analysis.execute(msidata=self.msidata, mzdata=self.mzdata, memory_budget=9 * 400 * 2 * 3)
+        self.assertTrue(np.array_equal(analysis['peak_mz'], expected_mz))
+        self.assertTrue(np.array_equal(analysis['peak_cube'], expected_cube))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+"""
+Test the omsi.analysis.findpeaks.omsi_findpeaks_local module
+"""
+import os
+import tempfile
+import unittest
+import numpy as np
+import h5py
+
+from omsi.analysis.findpeaks.omsi_findpeaks_local import omsi_findpeaks_local, growable_array, \
+    peak_arrayindex_to_indptr, write_blocked
+
+
+class test_omsi_findpeaks_local(unittest.TestCase):
+
+    def setUp(self):
+        self.random_state = np.random.RandomState(0)
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for filename in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, filename))
+        os.rmdir(self.temp_dir)
+
+    def test_growable_array(self):
+        blocks = [self.random_state.randint(0, 1000, self.random_state.randint(0, 20)) for _ in range(50)]
+        for out_of_core in [False, True]:
+            buffer = growable_array(dtype='uint32', capacity=1, out_of_core=out_of_core)
+            for block in blocks:
+                buffer.append(block)
+            self.assertEqual(buffer.size, sum(len(block) for block in blocks))
+            result = buffer.to_array()
+            self.assertEqual(isinstance(result, np.memmap), out_of_core)
+            self.assertEqual(result.dtype, np.dtype('uint32'))
+            self.assertTrue(np.array_equal(result, np.concatenate(blocks)))
+        self.assertEqual(growable_array(dtype='float32', out_of_core=True).to_array().shape, (0,))
+
+    def test_write_blocked(self):
+        data = np.arange(10, dtype='float32')
+        with h5py.File(os.path.join(self.temp_dir, 'blocked.h5'), 'w') as h5file:
+            dataset = write_blocked(h5file, 'data', data, block_size=3)
+            self.assertEqual(dataset.maxshape, (None,))
+            self.assertEqual(dataset.chunks, (3,))
+            self.assertTrue(np.array_equal(dataset[:], data))
+
+    def test_execute_analysis(self):
+        msidata = (self.random_state.rand(3, 4, 1000) ** 6 * 300).astype('float32')
+        mzdata = np.linspace(100, 1000, 1000)
+        analysis = omsi_findpeaks_local()
+        analysis.execute(msidata=msidata, mzdata=mzdata, peakheight=2, slwindow=50, smoothwidth=2)
+        peak_mz = analysis['peak_mz']
+        peak_value = analysis['peak_value']
+        peak_arrayindex = analysis['peak_arrayindex']
+        # The peaks are streamed to temporary files rather than collected in memory
+        self.assertIsInstance(peak_mz, np.memmap)
+        self.assertIsInstance(peak_value, np.memmap)
+        self.assertEqual(peak_mz.dtype, np.dtype('uint32'))
+        self.assertEqual(peak_value.dtype, np.dtype('float32'))
+        self.assertEqual(peak_arrayindex.shape, (12, 3))
+        indptr = peak_arrayindex_to_indptr(peak_arrayindex, peak_mz.shape[0])
+        self.assertTrue(np.all(np.diff(indptr) >= 0))
+        self.assertEqual(indptr[-1], peak_value.shape[0])
+        # The peaks of each spectrum must be valid, strictly increasing m/z bin indices
+        for index in range(peak_arrayindex.shape[0]):
+            mz_index = peak_mz[indptr[index]:indptr[index+1]]
+            self.assertTrue(np.all(mz_index < mzdata.shape[0]))
+            self.assertTrue(np.all(np.diff(mz_index.astype('int64')) > 0))
+
+    def test_execute_analysis_local_processes(self):
+        msidata = (self.random_state.rand(5, 4, 500) ** 6 * 300).astype('float32')
+        mzdata = np.linspace(100, 1000, 500)
+        analysis = omsi_findpeaks_local()
+        analysis.execute(msidata=msidata, mzdata=mzdata)
+        for schedule in ['STATIC', 'DYNAMIC', 'DYNAMIC_BLOCKS']:
+            parallel_analysis = omsi_findpeaks_local()
+            parallel_analysis.execute(msidata=msidata, mzdata=mzdata, num_processes=2, schedule=schedule)
+            # The spectra may be processed in a different order, so compare the peaks of each pixel
+            for name in ['peak_mz', 'peak_value']:
+                indptr = peak_arrayindex_to_indptr(analysis['peak_arrayindex'], analysis[name].shape[0])
+                parallel_indptr = peak_arrayindex_to_indptr(parallel_analysis['peak_arrayindex'],
+                                                            parallel_analysis[name].shape[0])
+                peaks = {tuple(analysis['peak_arrayindex'][i, 0:2]): list(analysis[name][indptr[i]:indptr[i+1]])
+                         for i in range(20)}
+                parallel_peaks = {tuple(parallel_analysis['peak_arrayindex'][i, 0:2]):
+                                  list(parallel_analysis[name][parallel_indptr[i]:parallel_indptr[i+1]])
+                                  for i in range(20)}
+                self.assertEqual(peaks, parallel_peaks)
+            self.assertTrue(np.array_equal(parallel_analysis['indata_mz'], mzdata))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+"""
+Test the omsi.analysis.findpeaks.third_party.findpeaks module
+"""
+import unittest
+import numpy as np
+
+from omsi.analysis.findpeaks.third_party.findpeaks import findpeaks, findpeaks_batch, peakdet_batch, \
+    sliding_window_minimum_batch
+
+
+class test_findpeaks(unittest.TestCase):
+
+    def setUp(self):
+        self.random_state = np.random.RandomState(0)
+
+    def tearDown(self):
+        pass
+
+    @staticmethod
+    def findpeaks_one_by_one(spectra, smoothwidth, slwindow, peakheight):
+        # The peak finding as it is done with the findpeaks class
+        peak_index = []
+        peak_values = []
+        num_peaks = []
+        for y in spectra:
+            y = findpeaks(None, y, smoothwidth, slwindow, peakheight).smoothListGaussian()
+            y = y - [x for x in findpeaks(None, y, smoothwidth, slwindow, peakheight).sliding_window_minimum()]
+            pkmax, pkmin = findpeaks(None, y, smoothwidth, slwindow, peakheight).peakdet()
+            peak_index += [x[0] for x in pkmax]
+            peak_values += [x[1] for x in pkmax]
+            num_peaks.append(len(pkmax))
+        return np.asarray(peak_index, dtype='int64'), np.asarray(peak_values), np.asarray(num_peaks)
+
+    def test_findpeaks_batch(self):
+        spectra = (self.random_state.rand(5, 2000) ** 6 * 300).astype('float32')
+        for smoothwidth, slwindow, peakheight in [(1, 1, 1), (2, 50, 2), (3, 100, 10)]:
+            expected = self.findpeaks_one_by_one(spectra, smoothwidth, slwindow, peakheight)
+            result = findpeaks_batch(spectra, smoothwidth, slwindow, peakheight)
+            for e, r in zip(expected, result):
+                self.assertTrue(np.array_equal(e, r))
+
+    def test_findpeaks_batch_nan(self):
+        spectra = self.random_state.rand(40, 300) * 100
+        # NaN bins in every other spectrum
+        spectra[::2][self.random_state.rand(20, 300) < 0.05] = np.nan
+        for smoothwidth, slwindow, peakheight in [(1, 1, 1), (1, 20, 2), (2, 50, 2)]:
+            expected = self.findpeaks_one_by_one(spectra, smoothwidth, slwindow, peakheight)
+            result = findpeaks_batch(spectra, smoothwidth, slwindow, peakheight)
+            self.assertTrue(np.array_equal(expected[0], result[0]))
+            self.assertTrue(np.array_equal(expected[1], result[1], equal_nan=True))
+            self.assertTrue(np.array_equal(expected[2], result[2]))
+
+    def test_sliding_window_minimum_batch_nan(self):
+        spectra = self.random_state.randint(0, 5, (200, 30)).astype('float64')
+        spectra[self.random_state.rand(200, 30) < 0.1] = np.nan
+        for k in [1, 2, 5]:
+            result = sliding_window_minimum_batch(spectra, k)
+            for y, r in zip(spectra, result):
+                expected = list(findpeaks(None, y, None, k, None).sliding_window_minimum())
+                self.assertTrue(np.array_equal(r, expected, equal_nan=True))
+
+    def test_peakdet_batch_ties_and_nan(self):
+        for i in range(200):
+            v = self.random_state.randint(0, 5, 40).astype('float64')
+            v[self.random_state.rand(40) < 0.1] = np.nan
+            pkmax, pkmin = findpeaks(None, v, 1, 1, 1).peakdet()
+            peak_index, peak_values, num_peaks = peakdet_batch(v[np.newaxis, :], 1)
+            self.assertListEqual(peak_index.tolist(), [x[0] for x in pkmax])
+            self.assertListEqual(peak_values.tolist(), [x[1] for x in pkmax])
+            self.assertListEqual(num_peaks.tolist(), [len(pkmax)])
+
+    def test_peakdet_batch_delta(self):
+        self.assertRaises(ValueError, peakdet_batch, np.zeros((1, 10)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
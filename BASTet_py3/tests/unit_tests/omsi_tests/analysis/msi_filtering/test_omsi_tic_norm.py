@@ -0,0 +1,77 @@
+"""
+Test the omsi.analysis.msi_filtering.omsi_tic_norm module
+"""
+import os
+import tempfile
+import unittest
+import numpy as np
+import h5py
+
+from omsi.analysis.msi_filtering.omsi_tic_norm import omsi_tic_norm
+
+
+class test_omsi_tic_norm(unittest.TestCase):
+
+    def setUp(self):
+        self.random_state = np.random.RandomState(0)
+        self.mzdata = np.linspace(100, 200, 40)
+        self.msidata = (self.random_state.rand(11, 9, 40) * 50).astype('uint16')
+        self.msidata[3, 4, :] = 0
+
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for filename in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, filename))
+        os.rmdir(self.temp_dir)
+
+    def expected_norm(self, idx_mz, max_count):
+        # Normalize all spectra at once
+        tic = self.msidata[:, :, idx_mz].sum(axis=2).astype('float')
+        maxs = self.msidata[:, :, idx_mz].max(axis=2)
+        non_zero_tic = tic > 0
+        factors = np.zeros(tic.shape)
+        factors[non_zero_tic] = tic[non_zero_tic].mean() / tic[non_zero_tic]
+        factors[maxs < max_count] = 0
+        return np.around(self.msidata * factors[:, :, np.newaxis])
+
+    def test_tic_norm(self):
+        expected = self.expected_norm(slice(None), 10)
+        # Use blocks of 3 rows in x that do not divide the data evenly
+        for memory_budget in [2**30, 9 * 40 * 3 * 10]:
+            analysis = omsi_tic_norm()
+            analysis.execute(msidata=self.msidata, mzdata=self.mzdata, maxCount=10, memory_budget=memory_budget)
+            self.assertFalse(analysis['deferred'])
+            self.assertIsInstance(analysis['norm_msidata'], np.ndarray)
+            self.assertEqual(analysis['norm_msidata'].dtype, np.dtype('uint16'))
+            self.assertTrue(np.array_equal(analysis['norm_msidata'], expected))
+            self.assertTrue(np.array_equal(analysis['norm_mz'], self.mzdata))
+
+    def test_tic_norm_informative_ions(self):
+        ions = np.array([150., 120.])
+        idx_mz = np.concatenate([np.where(abs(self.mzdata - ion) <= 3)[0] for ion in ions])
+        analysis = omsi_tic_norm()
+        analysis.execute(msidata=self.msidata, mzdata=self.mzdata, maxCount=5, infIons=ions, mzTol=3,
+                         memory_budget=500)
+        self.assertTrue(np.array_equal(analysis['norm_msidata'], self.expected_norm(idx_mz, 5)))
+
+    def test_tic_norm_deferred(self):
+        expected = self.expected_norm(slice(None), 10)
+        filename = os.path.join(self.temp_dir, 'tic_norm.h5')
+        with h5py.File(filename, 'w') as h5file:
+            msidata = h5file.create_dataset('msidata', data=self.msidata, chunks=(2, 9, 40))
+            for num_processes in [1, 2]:
+                analysis = omsi_tic_norm()
+                # The data is not normalized until it is written to file
+                analysis.execute(msidata=msidata, mzdata=self.mzdata, maxCount=10,
+                                 memory_budget=9 * 40 * 3 * 10, num_processes=num_processes, deferred=True)
+                self.assertEqual([ana_data['name'] for ana_data in analysis.get_all_analysis_data()], ['norm_mz'])
+                analysis_group = h5file.create_group('analysis_%i' % num_processes)
+                analysis.write_analysis_data(analysis_group=analysis_group)
+                self.assertEqual(analysis_group['norm_msidata'].dtype, np.dtype('uint16'))
+                self.assertEqual(analysis_group['norm_msidata'].chunks, (2, 9, 40))
+                self.assertTrue(np.array_equal(analysis_group['norm_msidata'][:], expected))
+                self.assertTrue(np.array_equal(analysis_group['norm_mz'][:], self.mzdata))
+
+if __name__ == '__main__':
+    unittest.main()
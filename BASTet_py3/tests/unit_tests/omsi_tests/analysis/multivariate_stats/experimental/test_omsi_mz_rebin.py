@@ -0,0 +1,58 @@
+"""
+Test the omsi.analysis.multivariate_stats.experimental.omsi_mz_rebin module
+"""
+import contextlib
+import io
+import unittest
+import numpy as np
+import scipy.ndimage as ndi
+
+from omsi.analysis.multivariate_stats.experimental.omsi_mz_rebin import omsi_mz_rebin, rebin_mz
+
+
+class test_omsi_mz_rebin(unittest.TestCase):
+
+    def setUp(self):
+        self.random_state = np.random.RandomState(0)
+        self.mzdata = np.sort(self.random_state.rand(300) * 900 + 100)
+        self.new_mzdata = np.arange(100, 1000, 5.0)
+        self.q = np.append(np.searchsorted(self.mzdata, self.new_mzdata), self.mzdata.shape[0])
+
+    def tearDown(self):
+        pass
+
+    def rebin_pixel_by_pixel(self, msidata, sigma):
+        # Rebin one spectrum at a time
+        new_msidata = np.zeros((msidata.shape[0], msidata.shape[1], len(self.q) - 1))
+        for ix in range(msidata.shape[0]):
+            for iy in range(msidata.shape[1]):
+                cs = np.concatenate(([np.array(0, dtype=msidata.dtype)], msidata[ix, iy, :].cumsum()))
+                new_msidata[ix, iy, :] = ndi.gaussian_filter(np.diff(cs[self.q]), sigma=sigma, truncate=4)
+        return new_msidata
+
+    def test_rebin_mz(self):
+        for dtype in ['uint16', 'float32']:
+            msidata = (self.random_state.rand(5, 6, self.mzdata.shape[0]) * 1000).astype(dtype)
+            expected = self.rebin_pixel_by_pixel(msidata, 1.5)
+            # Use tiles that do not divide the data evenly
+            for tile_size in [2**24, 7 * self.mzdata.shape[0]]:
+                result = rebin_mz(msidata, self.q, 1.5, truncate=4, tile_size=tile_size)
+                self.assertTrue(np.array_equal(result, expected))
+            out = np.zeros(expected.shape, dtype='float32')
+            rebin_mz(msidata, self.q, 1.5, truncate=4, out=out)
+            self.assertTrue(np.array_equal(out, expected.astype('float32')))
+
+    def test_execute_analysis(self):
+        msidata = (self.random_state.rand(3, 4, self.mzdata.shape[0]) * 1000).astype('float32')
+        analysis = omsi_mz_rebin()
+        with contextlib.redirect_stdout(io.StringIO()):
+            analysis.execute(msidata=msidata, mzdata=self.mzdata, new_mzdata=self.new_mzdata, sigma=2.0,
+                             output_dtype='float32')
+        self.assertEqual(analysis['new_msidata'].dtype, np.dtype('float32'))
+        self.assertTrue(np.array_equal(analysis['new_msidata'],
+                                       self.rebin_pixel_by_pixel(msidata, 2.0).astype('float32')))
+        self.assertTrue(np.array_equal(analysis['new_mz'], self.new_mzdata))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+"""
+Test the omsi.analysis.multivariate_stats.experimental.omsi_xy_resize module
+"""
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+import numpy as np
+import h5py
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from omsi.analysis.multivariate_stats.experimental import omsi_xy_resize as xy_resize_module
+from omsi.analysis.multivariate_stats.experimental.omsi_xy_resize import resize_xy
+
+try:
+    from skimage.transform import resize
+    skimage_available = True
+except ImportError:
+    skimage_available = False
+
+
+def nearest_resize_tile(args):
+    # Stand-in for _resize_tile that does not require skimage
+    tile, output_shape, order = args
+    x_index = (np.arange(output_shape[0]) * tile.shape[0]) // output_shape[0]
+    y_index = (np.arange(output_shape[1]) * tile.shape[1]) // output_shape[1]
+    return tile[x_index][:, y_index].astype('float64')
+
+
+class test_omsi_xy_resize(unittest.TestCase):
+
+    def setUp(self):
+        self.msidata = np.random.RandomState(0).rand(6, 5, 23)
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for filename in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, filename))
+        os.rmdir(self.temp_dir)
+
+    def test_resize_xy_tiles(self):
+        output_shape = (9, 4)
+        expected = nearest_resize_tile((self.msidata, output_shape, 0))
+        with mock.patch.object(xy_resize_module, '_resize_tile', nearest_resize_tile):
+            # single slab, slabs of 3 images and slabs aligned with the chunking of the output
+            for tile_size, num_processes in [(2**24, 1), (9 * 5 * 3, 1), (9 * 5 * 3, 2)]:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    result = resize_xy(self.msidata, output_shape, tile_size=tile_size, num_processes=num_processes)
+                self.assertTrue(np.array_equal(result, expected))
+            with h5py.File(os.path.join(self.temp_dir, 'resize.h5'), 'w') as h5file:
+                out = h5file.create_dataset('out', shape=output_shape + (23,), dtype='float64', chunks=(9, 4, 2))
+                with contextlib.redirect_stdout(io.StringIO()):
+                    resize_xy(self.msidata, output_shape, out=out, tile_size=9 * 5 * 3)
+                self.assertTrue(np.array_equal(out[:], expected))
+
+    @unittest.skipUnless(skimage_available, "skimage is not available")
+    def test_resize_xy(self):
+        for order in [0, 1]:
+            expected = resize(self.msidata, output_shape=(9, 4), order=order)
+            for tile_size, num_processes in [(2**24, 1), (9 * 5 * 3, 2)]:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    result = resize_xy(self.msidata, (9, 4), order=order,
+                                       tile_size=tile_size, num_processes=num_processes)
+                self.assertTrue(np.allclose(result, expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
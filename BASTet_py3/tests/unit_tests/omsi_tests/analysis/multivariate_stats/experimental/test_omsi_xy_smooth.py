@@ -0,0 +1,62 @@
+"""
+Test the omsi.analysis.multivariate_stats.experimental.omsi_xy_smooth module
+"""
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+import numpy as np
+import scipy.ndimage as ndi
+import h5py
+
+from omsi.analysis.multivariate_stats.experimental.omsi_xy_smooth import omsi_xy_smooth, smooth_xy
+
+
+class test_omsi_xy_smooth(unittest.TestCase):
+
+    def setUp(self):
+        self.random_state = np.random.RandomState(0)
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for filename in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, filename))
+        os.rmdir(self.temp_dir)
+
+    def test_smooth_xy(self):
+        for dtype in ['uint16', 'float32']:
+            msidata = (self.random_state.rand(13, 11, 20) * 1000).astype(dtype)
+            for sigma in [(1.5, 2.0), (0, 1.0)]:
+                expected = ndi.gaussian_filter(msidata, sigma=[sigma[0], sigma[1], 0], truncate=4)
+                # m/z-slabs of complete images and tiles along x that need a halo
+                for tile_size in [2**24, 13 * 11 * 3, 11 * 2]:
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        result = smooth_xy(msidata, sigma, truncate=4, tile_size=tile_size)
+                    self.assertEqual(result.dtype, msidata.dtype)
+                    self.assertTrue(np.array_equal(result, expected))
+
+    def test_execute_analysis(self):
+        msidata = self.random_state.rand(6, 7, 10)
+        analysis = omsi_xy_smooth()
+        with contextlib.redirect_stdout(io.StringIO()):
+            analysis.execute(msidata=msidata, sigma_x=1.0, sigma_y=0.5, tile_size=6 * 7 * 3)
+        self.assertTrue(np.array_equal(analysis['new_msidata'],
+                                       ndi.gaussian_filter(msidata, sigma=[1.0, 0.5, 0], truncate=4)))
+
+    def test_execute_analysis_deferred(self):
+        msidata = self.random_state.rand(6, 7, 10)
+        analysis = omsi_xy_smooth()
+        with contextlib.redirect_stdout(io.StringIO()):
+            analysis.execute(msidata=msidata, sigma_x=1.0, sigma_y=0.5, tile_size=6 * 7 * 3, deferred=True)
+            # The data is not smoothed until it is written to file
+            self.assertEqual(len(analysis.get_all_analysis_data()), 0)
+            with h5py.File(os.path.join(self.temp_dir, 'smooth.h5'), 'w') as h5file:
+                analysis_group = h5file.create_group('analysis')
+                analysis.write_analysis_data(analysis_group=analysis_group)
+                self.assertTrue(np.array_equal(analysis_group['new_msidata'][:],
+                                               ndi.gaussian_filter(msidata, sigma=[1.0, 0.5, 0], truncate=4)))
+
+
+if __name__ == '__main__':
+    unittest.main()
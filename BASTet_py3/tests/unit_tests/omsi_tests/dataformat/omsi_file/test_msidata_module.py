@@ -9,6 +9,7 @@ import h5py
 import numpy as np
 from omsi.dataformat.omsi_file.main_file import omsi_file
 from omsi.dataformat.omsi_file.msidata import omsi_file_msidata
+from omsi.dataformat.omsi_file.format import omsi_format_msidata
 
 
 class test_omsi_file_msidata(unittest.TestCase):
@@ -82,6 +83,42 @@ class test_omsi_file_msidata(unittest.TestCase):
         # Test that the number of msi datasets is 1
         self.assertEqual(self.exp.get_num_msidata(), 1)
 
+    def test_get_mean_spectrum(self):
+        # Test the mean spectrum computed in blocks of rows and the cache in the file
+        tempshape = tuple([7, 5, 100])
+        data_dataset, mz_dataset, datagroup = self.exp.create_msidata_full_cube(data_shape=tempshape,
+                                                                                data_type='uint16',
+                                                                                chunks=(2, 2, 100))
+        temp_data_msidata = (np.random.RandomState(0).rand(*tempshape) * 1000).astype('uint16')
+        test_omsi_file_msidata_object = omsi_file_msidata(datagroup)
+        test_omsi_file_msidata_object[:] = temp_data_msidata
+        expected = temp_data_msidata.reshape(-1, tempshape[2]).mean(axis=0)
+
+        # A handle opened before the mean spectrum is cached
+        other_omsi_file_msidata_object = omsi_file_msidata(datagroup)
+
+        # Read blocks of 2 rows in x that do not divide the data evenly
+        mean_spectrum = test_omsi_file_msidata_object.get_mean_spectrum(memory_budget=5 * 100 * 2 * 3)
+        self.assertEqual(mean_spectrum.dtype, np.dtype('float64'))
+        self.assertTrue(np.allclose(mean_spectrum, expected))
+        self.assertTrue(np.allclose(omsi_file_msidata(datagroup).get_cached_mean_spectrum()[:], expected),
+                        msg='Check that the mean spectrum is cached in the file')
+
+        # Modifying the data via any handle invalidates the cache
+        other_omsi_file_msidata_object[0, 0, :] = 0
+        self.assertEqual(test_omsi_file_msidata_object.get_modification_count(), 1)
+        self.assertIsNone(test_omsi_file_msidata_object.get_cached_mean_spectrum())
+        temp_data_msidata[0, 0, :] = 0
+        expected = temp_data_msidata.reshape(-1, tempshape[2]).mean(axis=0)
+        self.assertTrue(np.allclose(test_omsi_file_msidata_object.get_mean_spectrum(), expected))
+        self.assertTrue(np.allclose(other_omsi_file_msidata_object.get_cached_mean_spectrum()[:], expected))
+
+        # A cache computed for a different data shape is not used
+        datagroup[str(omsi_format_msidata.mean_spectrum_name)].attrs[omsi_format_msidata.data_shape_attribute] = \
+            np.asarray([7, 5, 99])
+        self.assertIsNone(test_omsi_file_msidata_object.get_cached_mean_spectrum())
+        self.assertTrue(np.allclose(test_omsi_file_msidata_object.get_mean_spectrum(), expected))
+        self.assertIsNotNone(test_omsi_file_msidata_object.get_cached_mean_spectrum())
 
 if __name__ == '__main__':
     unittest.main()
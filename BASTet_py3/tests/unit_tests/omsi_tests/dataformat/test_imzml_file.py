@@ -0,0 +1,86 @@
+"""
+Test the omsi.dataformat.imzml_file module
+"""
+import os
+import tempfile
+import unittest
+import numpy as np
+
+from omsi.dataformat import imzml_available
+try:
+    from pyimzml.ImzMLWriter import ImzMLWriter
+    from scipy import interpolate
+    from omsi.dataformat.imzml_file import imzml_file
+    imzml_writer_available = True
+except ImportError:
+    imzml_writer_available = False
+
+
+@unittest.skipUnless(imzml_available() and imzml_writer_available, "pyimzml is not available")
+class test_imzml_file(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.random_state = np.random.RandomState(0)
+
+    def tearDown(self):
+        for filename in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, filename))
+        os.rmdir(self.temp_dir)
+
+    def test_continuous(self):
+        mz = np.linspace(100, 200, 40)
+        data = (self.random_state.rand(7, 5, 40) * 100).astype('float32')
+        data[3, 2, :] = 0
+        filename = os.path.join(self.temp_dir, 'continuous.imzML')
+        with ImzMLWriter(filename, mode='continuous', intensity_dtype=np.float32) as writer:
+            for x in range(7):
+                for y in range(5):
+                    if (x, y) != (3, 2):
+                        writer.addSpectrum(mz, data[x, y], (x + 2, y + 1, 1))
+        input_file = imzml_file(filename, requires_slicing=False)
+        self.assertEqual(input_file.imzml_type, 'continuous')
+        self.assertTrue(np.array_equal(input_file.mz, mz))
+        self.assertTrue(np.array_equal(input_file[:], data))
+        self.assertTrue(np.array_equal(input_file[2:5, 1, 3:9], data[2:5, 1, 3:9]))
+        self.assertTrue(np.array_equal(input_file[[1, 4], :, 7], data[[1, 4], :, 7]))
+        positions = []
+        for position, spectrum in input_file.spectrum_iter():
+            self.assertTrue(np.array_equal(spectrum, data[position[0], position[1], :]))
+            positions.append(position)
+        self.assertEqual(len(positions), 34)
+        input_file.close_file()
+
+    def test_processed(self):
+        spectra = {}
+        filename = os.path.join(self.temp_dir, 'processed.imzML')
+        with ImzMLWriter(filename, mode='processed', intensity_dtype=np.float32) as writer:
+            for x in range(6):
+                for y in range(4):
+                    # Include a spectrum with a single peak
+                    num_peaks = 1 if (x, y) == (1, 1) else self.random_state.randint(2, 30)
+                    mz = np.sort(self.random_state.uniform(100, 101, num_peaks))
+                    intensities = (self.random_state.rand(num_peaks) * 100).astype('float32')
+                    spectra[(x, y)] = (mz, intensities)
+                    writer.addSpectrum(mz, intensities, (x + 1, y + 1, 1))
+        input_file = imzml_file(filename, requires_slicing=False, resolution=15)
+        self.assertEqual(input_file.imzml_type, 'processed')
+        expected = np.zeros(input_file.shape, dtype='float32')
+        for (x, y), (mz, intensities) in spectra.items():
+            if mz.size > 1:
+                expected[x, y, :] = interpolate.interp1d(mz, intensities.astype('float64'),
+                                                         fill_value=0, bounds_error=False)(input_file.mz)
+            else:
+                expected[x, y, input_file.mz == mz[0]] = intensities[0]
+        data = input_file[:]
+        self.assertTrue(np.allclose(data, expected, rtol=1e-5, atol=1e-4))
+        # Reinterpolate in batches of 3 spectra
+        input_file.regrid_batch_values = input_file.mz.size * 3
+        self.assertTrue(np.array_equal(input_file[:], data))
+        for position, spectrum in input_file.spectrum_iter_tiles((2, 3), 1, 2):
+            self.assertTrue(np.array_equal(spectrum, data[position[0], position[1], :]))
+        input_file.close_file()
+
+
+if __name__ == '__main__':
+    unittest.main()
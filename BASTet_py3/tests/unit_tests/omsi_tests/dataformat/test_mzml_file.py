@@ -0,0 +1,118 @@
+"""
+Test the omsi.dataformat.mzml_file module
+"""
+import os
+import base64
+import tempfile
+import unittest
+import numpy as np
+
+try:
+    from omsi.dataformat.mzml_file import mzml_file
+    mzml_available = True
+except ImportError:
+    mzml_available = False
+
+
+@unittest.skipUnless(mzml_available, "pyteomics is not available")
+class test_mzml_file(unittest.TestCase):
+
+    scan_types = [('FTMS + p MALDI Full ms [100.00-200.00]', True, 100., 200.),
+                  ('ITMS + c MALDI Z ms2 150.00@cid35.00 [50.00-160.00]', False, 50., 160.)]
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        random_state = np.random.RandomState(0)
+        # Interleaved spectra of all scan types with (x, y, scan type index, m/z, intensities)
+        self.spectra = []
+        for x in range(3):
+            for y in range(2):
+                for scan_idx, (_, profiled, low, high) in enumerate(self.scan_types):
+                    num_peaks = random_state.randint(20, 40) if profiled else random_state.randint(1, 10)
+                    self.spectra.append((x, y, scan_idx, np.sort(random_state.uniform(low, high, num_peaks)),
+                                         random_state.rand(num_peaks) * 1000))
+
+    def tearDown(self):
+        for filename in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, filename))
+        os.rmdir(self.temp_dir)
+
+    def write_mzml(self, filename, indexed):
+        # Write a thermo-style mzML file with spotID coordinates and an optional indexList
+        def binary_array(values, accession, name):
+            encoded = base64.b64encode(np.asarray(values, dtype='<f8').tobytes()).decode()
+            return '<binaryDataArray encodedLength="%i">' \
+                   '<cvParam cvRef="MS" accession="MS:1000523" name="64-bit float" value=""/>' \
+                   '<cvParam cvRef="MS" accession="MS:1000576" name="no compression" value=""/>' \
+                   '<cvParam cvRef="MS" accession="%s" name="%s" value=""/>' \
+                   '<binary>%s</binary></binaryDataArray>' % (len(encoded), accession, name, encoded)
+        text = '<?xml version="1.0" encoding="utf-8"?>\n'
+        if indexed:
+            text += '<indexedmzML xmlns="http://psi.hupo.org/ms/mzml">\n'
+        text += '<mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1.0">\n' \
+                '<run id="run"><spectrumList count="%i">\n' % len(self.spectra)
+        offsets = []
+        for index, (x, y, scan_idx, mz, intensities) in enumerate(self.spectra):
+            filter_string, profiled, low, high = self.scan_types[scan_idx]
+            offsets.append(len(text.encode()))
+            text += '<spectrum index="%i" id="scan=%i" spotID="0,%ix%i" defaultArrayLength="%i">' \
+                    '<cvParam cvRef="MS" accession="%s" name="%s" value=""/>' \
+                    '<scanList count="1"><scan>' \
+                    '<cvParam cvRef="MS" accession="MS:1000512" name="filter string" value="%s"/>' \
+                    '<scanWindowList count="1"><scanWindow>' \
+                    '<cvParam cvRef="MS" accession="MS:1000501" name="scan window lower limit" value="%s"/>' \
+                    '<cvParam cvRef="MS" accession="MS:1000500" name="scan window upper limit" value="%s"/>' \
+                    '</scanWindow></scanWindowList></scan></scanList>' \
+                    '<binaryDataArrayList count="2">%s%s</binaryDataArrayList></spectrum>\n' % \
+                    (index, index, x * 2 + 1, y * 3 + 5, mz.size,
+                     'MS:1000128' if profiled else 'MS:1000127',
+                     'profile spectrum' if profiled else 'centroid spectrum',
+                     filter_string, low, high,
+                     binary_array(mz, 'MS:1000514', 'm/z array'),
+                     binary_array(intensities, 'MS:1000515', 'intensity array'))
+        text += '</spectrumList></run>\n</mzML>\n'
+        if indexed:
+            index_list_offset = len(text.encode())
+            text += '<indexList count="1"><index name="spectrum">'
+            text += ''.join('<offset idRef="scan=%i">%i</offset>' % (index, offset)
+                            for index, offset in enumerate(offsets))
+            text += '</index></indexList><indexListOffset>%i</indexListOffset></indexedmzML>\n' % index_list_offset
+        with open(filename, 'wb') as outfile:
+            outfile.write(text.encode())
+
+    def expected_spectrum(self, input_file, scan_idx, mz, intensities):
+        mz_axis = input_file.mz_all[scan_idx]
+        if self.scan_types[scan_idx][1]:
+            return np.interp(mz_axis, mz, intensities, 0, 0)
+        bin_edges = np.append(mz_axis, mz_axis[-1] + np.diff(mz_axis).mean())
+        return np.histogram(mz, bins=bin_edges, weights=intensities)[0]
+
+    def test_read_mzml(self):
+        for indexed in [True, False]:
+            filename = os.path.join(self.temp_dir, 'test.mzML')
+            self.write_mzml(filename, indexed)
+            input_file = mzml_file(filename, requires_slicing=True, resolution=1000)
+            self.assertEqual(input_file.use_index, indexed)
+            self.assertEqual(input_file.scan_types, [scan_type[0] for scan_type in self.scan_types])
+            self.assertEqual(input_file.scan_profiled, [True, False])
+            self.assertEqual(input_file.shape_all_data[0][:2], (3, 2))
+            # All datacubes are read in a single pass
+            for x, y, scan_idx, mz, intensities in self.spectra:
+                expected = self.expected_spectrum(input_file, scan_idx, mz, intensities)
+                self.assertTrue(np.array_equal(input_file.data[scan_idx][x, y, :],
+                                               expected.astype(input_file.data_type)))
+            # Iterate over the spectra of each scan type
+            for scan_idx in range(len(self.scan_types)):
+                input_file.set_dataset_selection(scan_idx)
+                spectra = list(input_file.spectrum_iter())
+                expected_spectra = [(x, y, self.expected_spectrum(input_file, scan_idx, mz, intensities))
+                                    for x, y, spectrum_scan_idx, mz, intensities in self.spectra
+                                    if spectrum_scan_idx == scan_idx]
+                self.assertEqual(len(spectra), len(expected_spectra))
+                for (position, spectrum), (x, y, expected) in zip(spectra, expected_spectra):
+                    self.assertEqual((position[0], position[1]), (x, y))
+                    self.assertTrue(np.array_equal(spectrum, expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
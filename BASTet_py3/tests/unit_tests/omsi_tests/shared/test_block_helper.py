@@ -0,0 +1,51 @@
+"""
+Test the omsi.shared.block_helper module
+"""
+import os
+import tempfile
+import unittest
+import numpy as np
+import h5py
+
+import omsi.shared.block_helper as block_helper
+
+
+class test_block_helper(unittest.TestCase):
+
+    def setUp(self):
+        self.msidata = (np.random.RandomState(0).rand(7, 5, 100) * 1000).astype('uint16')
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for filename in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, filename))
+        os.rmdir(self.temp_dir)
+
+    def test_get_block_size_x(self):
+        row_size = 5 * 100 * 2
+        self.assertEqual(block_helper.get_block_size_x(self.msidata, 3 * row_size, 2), 3)
+        self.assertEqual(block_helper.get_block_size_x(self.msidata, 0, 2), 1)
+        self.assertEqual(block_helper.get_block_size_x(self.msidata, 2**30, 2), 7)
+        with h5py.File(os.path.join(self.temp_dir, 'blocks.h5'), 'w') as h5file:
+            # Blocks are aligned with the chunking in x, even if a chunk-row exceeds the budget
+            dataset = h5file.create_dataset('data', data=self.msidata, chunks=(2, 5, 10))
+            self.assertEqual(block_helper.get_block_size_x(dataset, 5 * row_size, 2), 4)
+            self.assertEqual(block_helper.get_block_size_x(dataset, row_size, 2), 2)
+
+    def test_get_mean_spectrum(self):
+        expected = self.msidata.reshape(-1, 100).mean(axis=0)
+        for memory_budget in [2**30, 5 * 100 * 2 * 3, 0]:
+            mean_spectrum = block_helper.get_mean_spectrum(self.msidata, memory_budget=memory_budget)
+            self.assertEqual(mean_spectrum.dtype, np.dtype('float64'))
+            self.assertTrue(np.allclose(mean_spectrum, expected))
+
+    def test_map_blocks(self):
+        tasks = [self.msidata[x:x + 2] for x in range(0, 7, 2)]
+        for num_processes in [1, 2, 3]:
+            # The tasks are read lazily from a generator and the results are returned in order
+            results = block_helper.map_blocks(np.sum, (task for task in tasks), num_processes=num_processes)
+            self.assertEqual(list(results), [np.sum(task) for task in tasks])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -66,6 +66,20 @@ class test_omsi_data_selection(unittest.TestCase):
                 failed_test.append([re, case])
         self.assertTrue(len(failed_test)==0, "Failed check selection string for: " + str(failed_test))
 
+    def test_area_near_peak(self):
+        # Compare the vectorized reduction with summing the data points around the peak of every spectrum
+        test_data = np.random.RandomState(0).rand(7, 5, 20).astype('float32')
+        test_data[0, 0, 0] = 10   # peak at the lower boundary
+        test_data[1, 0, 19] = 10  # peak at the upper boundary
+        for halfpeakwidth in [0, 2, 30]:
+            result = data_selection.area_near_peak(test_data, halfpeakwidth=halfpeakwidth)
+            self.assertEqual(result.dtype, test_data.dtype)
+            for x in range(test_data.shape[0]):
+                for y in range(test_data.shape[1]):
+                    peak = np.argmax(test_data[x, y, :])
+                    lower = max(peak - halfpeakwidth, 0)
+                    upper = min(peak + halfpeakwidth + 1, test_data.shape[2])
+                    self.assertAlmostEqual(result[x, y], test_data[x, y, lower:upper].sum(), places=4)
 
 
 if __name__ == '__main__':
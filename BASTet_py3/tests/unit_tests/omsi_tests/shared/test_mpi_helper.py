@@ -0,0 +1,100 @@
+"""
+Test the omsi.shared.mpi_helper module
+"""
+import os
+import tempfile
+import unittest
+import numpy as np
+import h5py
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import omsi.shared.mpi_helper as mpi_helper
+from omsi.shared.mpi_helper import parallel_over_axes
+
+
+def block_sum(data):
+    # Task function used for testing
+    return data.sum(axis=-1)
+
+
+class serial_comm(object):
+    # Stand-in for an MPI communicator with a single rank
+    def gather(self, data, root=0):
+        return [data, ]
+
+
+class test_parallel_over_axes(unittest.TestCase):
+
+    def setUp(self):
+        self.data = np.random.RandomState(0).rand(9, 7, 10)
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for filename in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, filename))
+        os.rmdir(self.temp_dir)
+
+    def check_blocks(self, result, blocks, msg):
+        # Every pixel must be processed exactly once
+        combined = np.zeros(self.data.shape[0:2])
+        counts = np.zeros(self.data.shape[0:2], dtype='int')
+        for block_result, block in zip(result, blocks):
+            combined[block[0:2]] = block_result
+            counts[block[0:2]] += 1
+        self.assertTrue(np.all(counts == 1), msg=msg)
+        self.assertTrue(np.allclose(combined, self.data.sum(axis=-1)), msg=msg)
+
+    def check_local_backend(self, main_data):
+        for schedule in parallel_over_axes.SCHEDULES.values():
+            scheduler = parallel_over_axes(task_function=block_sum,
+                                           task_function_params={},
+                                           main_data=main_data,
+                                           split_axes=[0, 1],
+                                           main_data_param_name='data',
+                                           schedule=schedule,
+                                           backend=parallel_over_axes.BACKENDS['LOCAL'],
+                                           num_processes=3)
+            scheduler.run()
+            result, blocks = scheduler.collect_data()
+            self.assertEqual(len(result), len(blocks))
+            self.assertEqual(len(scheduler.block_times), len(blocks))
+            self.check_blocks(result, blocks, schedule)
+
+    def test_local_backend(self):
+        self.check_local_backend(self.data)
+
+    def test_local_backend_h5py(self):
+        # The processes read the chunks of the dataset from the file themselves
+        with h5py.File(os.path.join(self.temp_dir, 'data.h5'), 'w') as h5file:
+            dataset = h5file.create_dataset('data', data=self.data, chunks=(2, 3, 10))
+            self.check_local_backend(dataset)
+
+    def test_mpi_backend_static(self):
+        # The STATIC schedule returns lists of block results and blocks, both from run and collect_data
+        with mock.patch.object(mpi_helper, 'is_mpi_available', return_value=True):
+            for split_axes in [[0, 1], [1]]:
+                scheduler = parallel_over_axes(task_function=block_sum,
+                                               task_function_params={},
+                                               main_data=self.data,
+                                               split_axes=split_axes,
+                                               main_data_param_name='data',
+                                               schedule=parallel_over_axes.SCHEDULES['STATIC'],
+                                               comm=serial_comm(),
+                                               backend=parallel_over_axes.BACKENDS['MPI'])
+                result, blocks = scheduler.run()
+                self.assertEqual(len(result), 1)
+                self.assertEqual(len(blocks), 1)
+                self.assertEqual(len(scheduler.block_times), 1)
+                self.check_blocks(result, blocks, split_axes)
+                result, blocks = scheduler.collect_data()
+                self.check_blocks(result, blocks, split_axes)
+
+    def test_invalid_backend(self):
+        self.assertRaises(ValueError, parallel_over_axes, block_sum, {}, self.data, [0], 'data', backend='GPU')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+"""
+Test the omsi.tools.chunk_advisor module
+"""
+import os
+import tempfile
+import unittest
+import numpy as np
+
+from omsi.tools.chunk_advisor import benchmark_layout, get_operation_selection, recommend_layouts, get_convert_args
+
+
+class test_chunk_advisor(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.sample = np.random.RandomState(0).rand(10, 8, 30).astype('float32')
+        self.data_shape = (40, 16, 30)
+
+    def tearDown(self):
+        for filename in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, filename))
+        os.rmdir(self.temp_dir)
+
+    def test_get_operation_selection(self):
+        # Ranges are shifted and indices wrapped into the sample
+        selection = get_operation_selection({'type': 'roi_mean', 'x': '35:39', 'y': '[3,12]'},
+                                            self.data_shape, self.sample.shape)
+        self.assertEqual(selection, (slice(0, 4, 1), [3, 4], slice(0, 30, 1)))
+        selection = get_operation_selection({'type': 'spectrum', 'x': '[1,2]', 'y': '[3,5]'},
+                                            self.data_shape, self.sample.shape)
+        self.assertEqual(selection, ([1, 2], slice(3, 6), slice(0, 30, 1)))
+
+    def test_benchmark_layout(self):
+        trace = [{'type': 'spectrum', 'x': '12', 'y': '3'},
+                 {'type': 'slice', 'z': '4:6'},
+                 {'type': 'roi_mean', 'x': '0:3', 'y': '2:5'}]
+        result = benchmark_layout(self.sample, trace, self.data_shape, chunks=(2, 2, 30), compression='none',
+                                  temp_dir=self.temp_dir)
+        chunk_size = 2 * 2 * 30 * 4
+        self.assertEqual(result['storage_bytes'], self.sample.nbytes)
+        self.assertEqual(result['spectrum']['bytes_read'], chunk_size)
+        self.assertEqual(result['slice']['bytes_read'], 5 * 4 * chunk_size)
+        self.assertEqual(result['roi_mean']['bytes_read'], 2 * 2 * chunk_size)
+        self.assertEqual(result['all']['bytes_read'], (1 + 20 + 4) * chunk_size)
+        self.assertEqual(result['all']['count'], 3)
+
+    def test_recommend_layouts(self):
+        def layout(chunks, slice_cost, spectrum_cost):
+            result = {'chunks': chunks, 'compression': 'gzip',
+                      'slice': {'time': slice_cost}, 'spectrum': {'time': spectrum_cost}, 'roi_mean': {'time': 0}}
+            result['all'] = {'time': slice_cost + spectrum_cost}
+            return result
+        results = [layout((1, 1, 30), 10., 1.), layout((10, 8, 1), 1., 10.), layout((4, 4, 8), 4., 4.)]
+        layouts = recommend_layouts(results, metric='time', max_layouts=2)
+        self.assertEqual(get_convert_args(layouts),
+                         ['--chunking', '4', '4', '8', '--optimized-chunking', '1', '1', '30', '--compression'])
+        self.assertEqual(len(recommend_layouts(results, metric='time', max_layouts=2, min_gain=0.5)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
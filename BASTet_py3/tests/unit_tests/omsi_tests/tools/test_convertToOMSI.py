@@ -0,0 +1,109 @@
+"""
+Test the omsi.tools.convertToOMSI module
+"""
+import os
+import tempfile
+import unittest
+import numpy as np
+import h5py
+
+from omsi.dataformat.img_file import img_file
+from omsi.tools.convertToOMSI import ConvertFiles, StagedLayoutWriter
+
+
+class test_convert_files(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.data = (np.random.RandomState(0).rand(13, 11, 50) * 1000).astype('uint16')
+        # Write the data as img file
+        self.basename = os.path.join(self.temp_dir, 'test')
+        header = np.zeros(64, dtype='int16')
+        header[23], header[22] = self.data.shape[0], self.data.shape[1]
+        header.tofile(self.basename + '.hdr')
+        np.linspace(100, 1000, self.data.shape[2]).astype('float32').tofile(self.basename + '.t2m')
+        self.data.tofile(self.basename + '.img')
+
+    def tearDown(self):
+        for filename in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, filename))
+        os.rmdir(self.temp_dir)
+
+    def test_spectrum_iter_tiles(self):
+        input_file = img_file(basename=self.basename, requires_slicing=False)
+        for tile_shape in [(4, 4), (1, 11), (5, 3)]:
+            positions = []
+            for partition_index in range(3):
+                for position, spectrum in input_file.spectrum_iter_tiles(tile_shape, partition_index, 3):
+                    self.assertTrue(np.array_equal(spectrum, self.data[position[0], position[1], :]))
+                    positions.append(position)
+            self.assertEqual(sorted(positions), [(x, y) for x in range(13) for y in range(11)])
+
+    def test_write_data_pipelined(self):
+        input_file = img_file(basename=self.basename, requires_slicing=False)
+        # Tiles of a single chunk and tiles spanning all chunks along y
+        for chunks, block_size_limit in [((4, 4, 16), 4 * 4 * 50 * 2 * 7), ((1, 1, 50), 2**30), (None, 2**30)]:
+            for num_workers in [1, 3]:
+                with h5py.File(os.path.join(self.temp_dir, 'out.h5'), 'w') as out_file:
+                    data = out_file.create_dataset('data', shape=self.data.shape, dtype='uint16', chunks=chunks)
+                    throughput = ConvertFiles.write_data_pipelined(input_file=input_file,
+                                                                   data=data,
+                                                                   chunk_shape=chunks,
+                                                                   num_workers=num_workers,
+                                                                   queue_size=2,
+                                                                   block_size_limit=block_size_limit,
+                                                                   write_progress=False)
+                    self.assertTrue(np.array_equal(data[:], self.data))
+                    self.assertEqual(throughput['num_spectra'], 13 * 11)
+
+    def test_staged_layout_writer(self):
+        input_file = img_file(basename=self.basename, requires_slicing=False)
+        chunkings = [(13, 11, 1), (4, 4, 16), (3, 5, 7)]
+        # Stage complete images, blocks of chunk-rows and blocks smaller than a chunk-row
+        for block_size_limit in [2**30, 11 * 50 * 2 * 5 * 3 * 2, 1]:
+            with h5py.File(os.path.join(self.temp_dir, 'out.h5'), 'w') as out_file:
+                data = out_file.create_dataset('data', shape=self.data.shape, dtype='uint16', chunks=(1, 1, 50))
+                staged_datasets = [out_file.create_dataset('data%i' % index, shape=self.data.shape, dtype='uint16',
+                                                           chunks=chunks, compression='gzip')
+                                   for index, chunks in enumerate(chunkings)]
+                writer = StagedLayoutWriter(dataset=data,
+                                            staged_datasets=staged_datasets,
+                                            block_size_limit=block_size_limit)
+                ConvertFiles.write_data(input_file=input_file,
+                                        data=writer,
+                                        data_io_option='spectrum',
+                                        write_progress=False)
+                writer.flush()
+                for dataset in [data] + staged_datasets:
+                    self.assertTrue(np.array_equal(dataset[:], self.data))
+
+    def test_staged_layout_writer_block_rows(self):
+        row_size = 11 * 50 * 2
+        # All rows, multiples of the chunk-rows, and None if a single chunk-row does not fit
+        self.assertEqual(StagedLayoutWriter.get_block_rows(self.data.shape, 'uint16', (13, 11, 1), 13 * row_size), 13)
+        self.assertEqual(StagedLayoutWriter.get_block_rows(self.data.shape, 'uint16', (13, 11, 1), 12 * row_size),
+                         None)
+        self.assertEqual(StagedLayoutWriter.get_block_rows(self.data.shape, 'uint16', (4, 4, 16), 10 * row_size,
+                                                           num_datasets=1, max_open_blocks=2), 4)
+        self.assertEqual(StagedLayoutWriter.get_block_rows(self.data.shape, 'uint16', (4, 4, 16), 10 * row_size,
+                                                           num_datasets=3, max_open_blocks=2), None)
+        # A limit smaller than a chunk-row stages full chunk-rows anyway
+        input_file = img_file(basename=self.basename, requires_slicing=False)
+        with h5py.File(os.path.join(self.temp_dir, 'out.h5'), 'w') as out_file:
+            data = out_file.create_dataset('data', shape=self.data.shape, dtype='uint16', chunks=(1, 1, 50))
+            staged_dataset = out_file.create_dataset('data0', shape=self.data.shape, dtype='uint16',
+                                                     chunks=(4, 11, 1), compression='gzip')
+            writer = StagedLayoutWriter(dataset=data,
+                                        staged_datasets=[staged_dataset],
+                                        block_size_limit=row_size)
+            self.assertEqual(writer.block_rows, [4])
+            ConvertFiles.write_data(input_file=input_file,
+                                    data=writer,
+                                    data_io_option='spectrum',
+                                    write_progress=False)
+            writer.flush()
+            self.assertTrue(np.array_equal(staged_dataset[:], self.data))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,6 +18,8 @@ import datetime
 import time
 import pickle
 import inspect
+import threading
+from multiprocessing.pool import ThreadPool
 
 # import abc
 # from future.utils import with_metaclass
@@ -74,17 +76,14 @@ class AreaNearPeak():
         self.halfpeakwidth=halfpeakwidth
 
     def reduceImage(self,data):
+        #same algorithm as omsi.shared.data_selection.area_near_peak, which does this reduction on the server
         result = np.zeros((data.shape[0],data.shape[1]))
         maxMasses = np.argmax(data,2)
-        for x in range(data.shape[0]):
-            for y in range(data.shape[1]):
-                peak=(list(range(-self.halfpeakwidth,self.halfpeakwidth+1))+maxMasses[x,y]).astype(int)
-                for p in peak:
-                    if p<0:
-                        continue
-                    if p>= data.shape[2]:
-                        continue
-                    result[x,y]+=data[x,y,p]
+        for offset in range(-self.halfpeakwidth,self.halfpeakwidth+1):
+            peak=maxMasses+offset
+            valid=(peak>=0) & (peak<data.shape[2])
+            values=np.take_along_axis(data,np.clip(peak,0,data.shape[2]-1)[:,:,np.newaxis],axis=2)[:,:,0]
+            result[valid]+=values[valid]
         return result
 
     def remoteReduceOperation(self, **kwargs):
@@ -322,7 +321,8 @@ class ArrayedImage(object):
                       verbose=False,
                       progressbar=None,
                       raiseExceptions=False,
-                      minimumScore=0):
+                      minimumScore=0,
+                      legacyOptimizer=False):
         """
         Performs a local optimization to align the spot centers to maxima spots on the image
 
@@ -363,6 +363,9 @@ class ArrayedImage(object):
                                 the optimizer could choose that didn't overlap with other spots.
         :param minimumScore: Require that at least a score this high is obtainable before moving a spot to a new
                              location. If there are spots missing in the grid, you may want to set this. Default is 0.
+        :param legacyOptimizer: If True, score every candidate location one at a time with spotMask and sumPixels
+                                (the original, much slower algorithm). By default the VectorizedSpotOptimizer is used,
+                                which gives exactly the same spot locations. Default is False.
         :return: no return value
         """
 
@@ -375,21 +378,39 @@ class ArrayedImage(object):
         imStack2=self.imStack
         imWidth=imStack2.shape[1]
         imHeight=imStack2.shape[0]
-        xEdges, yEdges = np.meshgrid(list(range(imWidth)), list(range(imHeight)), sparse=False, indexing='xy')
 
         xCenter=self.xCenters
         yCenter=self.yCenters
 
         numberOfSpots=len(xCenter)
-        spotMaskCache=np.empty(numberOfSpots, dtype=np.ndarray)
         if not ionWeighting:
             ionWeighting=np.empty(len(self.ions))
             ionWeighting.fill(1.)
+
+        if legacyOptimizer:
+            spotMaskCache=np.empty(numberOfSpots, dtype=np.ndarray)
+        else:
+            xCenter=np.asarray(xCenter)
+            yCenter=np.asarray(yCenter)
+            optimizer=VectorizedSpotOptimizer(imStack2,integrationRadius,ionWeighting,halfboxsize,
+                                              avoidOverlaps=avoidOverlaps,
+                                              pixelwiseOverlapAvoidance=pixelwiseOverlapAvoidance,
+                                              overlapDistance_squared=overlapDistance_squared)
         for round in range(optimizationrounds):
             totalscore=0
             minscore=-1
             maxscore=-1
+            if not legacyOptimizer:
+                optimizer.scoreCandidates(xCenter,yCenter)
             for i in range(numberOfSpots):
+                if not legacyOptimizer:
+                    for _ in range(optimizer.numberOfCandidatesOutsideImage(i)):
+                        if(raiseExceptions):
+                            raise IndexError("a location outside of the image was tried for a spot")
+                        elif(verbose):
+                            print("a location outside of the image was tried for spot #",i,"(",alphaRowString(self.spotLocations[i]),"), but ignored")
+                    best,bestX,bestY=optimizer.bestLocation(i,xCenter,yCenter)
+                else:
                     best=-1
                     bestX=xCenter[i]
                     bestY=yCenter[i]
@@ -402,7 +423,7 @@ class ArrayedImage(object):
                                     if(verbose):
                                         print("a location outside of the image was tried for spot #",i,"(",alphaRowString(self.spotLocations[i]),"), but ignored")
                                     continue
-                            currentSpot=oneSpotMask(xEdges,yEdges,newX,newY,integrationRadius)
+                            currentSpot=spotMask(newX,newY,integrationRadius,(imHeight,imWidth))
                             assert (len(currentSpot)>0)
                             if avoidOverlaps:
                                 if pixelwiseOverlapAvoidance:
@@ -420,26 +441,26 @@ class ArrayedImage(object):
                                 bestX=newX
                                 bestY=newY
 
-                    if(best>minimumScore):
-                        xCenter[i]=bestX
-                        yCenter[i]=bestY
-                    else:
-                        if raiseExceptions or best<0: #if the score is <0 something bad must be going on
-                            raise SpotOptimizationException()
-                        elif(verbose):
-                            print("Best score of spot # %d is %d but need > %d. Location stays as it was before."%(i,int(best), minimumScore))
-                    cyclenumber = numberOfSpots*round+i
-                    if(progressbar):
-                        progressbar.value=100*cyclenumber/(numberOfSpots*optimizationrounds)
-                    if(verbose): #to get the stats for this round
-                        totalscore+=best
-                        if(minscore==-1):
-                            minscore=best
-                        minscore=min(minscore,best)
-                        maxscore=max(maxscore,best)
-                        if(cyclenumber%100==99 and not progressbar):
-                            print("{:d}% done with the optimization process".format(int(100*cyclenumber/(numberOfSpots*optimizationrounds))))
-                            sys.stdout.flush()
+                if(best>minimumScore):
+                    xCenter[i]=bestX
+                    yCenter[i]=bestY
+                else:
+                    if raiseExceptions or best<0: #if the score is <0 something bad must be going on
+                        raise SpotOptimizationException()
+                    elif(verbose):
+                        print("Best score of spot # %d is %d but need > %d. Location stays as it was before."%(i,int(best), minimumScore))
+                cyclenumber = numberOfSpots*round+i
+                if(progressbar):
+                    progressbar.value=100*cyclenumber/(numberOfSpots*optimizationrounds)
+                if(verbose): #to get the stats for this round
+                    totalscore+=best
+                    if(minscore==-1):
+                        minscore=best
+                    minscore=min(minscore,best)
+                    maxscore=max(maxscore,best)
+                    if(cyclenumber%100==99 and not progressbar):
+                        print("{:d}% done with the optimization process".format(int(100*cyclenumber/(numberOfSpots*optimizationrounds))))
+                        sys.stdout.flush()
             print("done with optimization round %d of %s"%(round+1,optimizationrounds))
             if(verbose):
                 print("total score:",totalscore,"\t average spot score:",totalscore/numberOfSpots)
@@ -501,9 +522,8 @@ class ArrayedImage(object):
             numberOfSpots=len(self.xCenters)
             for box in ionWeightBoxes:
                 ionweights.append(box.value)
-            xEdges, yEdges = np.meshgrid(list(range(imWidth)), list(range(imHeight)), sparse=False, indexing='xy')
             for i in range(numberOfSpots):
-                currentSpot=oneSpotMask(xEdges,yEdges,self.xCenters[i],self.yCenters[i],integrationRadiusBox.value)
+                currentSpot=spotMask(self.xCenters[i],self.yCenters[i],integrationRadiusBox.value,(imHeight,imWidth))
                 result=sum(sumPixels(currentSpot,self.imStack)*ionweights)/len(currentSpot)
                 results.append(result)
             calcResults.value="{:d} Spots calculated.<br>Low spot score: {:f}<br>High spot score: {:f}<br>Mean spot score: {:f}<br>Median spot score: {:f}".format(
@@ -553,12 +573,10 @@ class ArrayedImage(object):
             params['arrayed_analysis_radius'] = integrationRadius
             update_default_params(params)
 
-        xEdges, yEdges = np.meshgrid(list(range(self.imStack.shape[1])), list(range(self.imStack.shape[0])), sparse=False, indexing='xy')
-
         myPixels = []
         tallies = {}
         for x, y in zip(self.xCenters, self.yCenters):
-            idx = oneSpotMask(xEdges, yEdges, x, y, integrationRadius)
+            idx = spotMask(x, y, integrationRadius, self.imStack.shape[:2])
             myPixels.append(idx)
             if len(idx) not in tallies:
                 tallies[len(idx)] = 0
@@ -621,11 +639,13 @@ class ArrayedImage(object):
         plt.show()
 
 
-    def writeResultTable(self,fileName="",spotList=None,minPixelIntensity=0,alphaRows=False):
+    def writeResultTable(self,fileName="",spotList=None,minPixelIntensity=0,alphaRows=False,spotsPerBlock=4096):
         """
 
         :param fileName: filename to write to. will automatically be appended with a .csv extension.
                             Default is will use current date and time
+        :param spotsPerBlock: The statistics are calculated and written for this many spots at a time,
+                              which limits the memory used for very large plate sets. Default is 4096.
         :return:
         """
 
@@ -655,27 +675,26 @@ class ArrayedImage(object):
             fileHandler.write('%5.4f NumPixels,' % i)
         fileHandler.write('\n')
 
-        for i,myPixel in enumerate(_spotList): #how many spots
-
-            fileHandler.write('%d,%s,%s,%s,%f,%f,' % ( i, self.filename,
-                                                             chr(ord('A')+self.spotLocations[i][0]-1) if alphaRows else str(self.spotLocations[i][0]),
-                                                             self.spotLocations[i][1], np.mean(myPixel[:,0]), np.mean(myPixel[:,1]) ) )
-            for j,ion in enumerate(self.ions): #how many ions
-                values = []
-                for coord in myPixel: #how many pixels per spot
-                    if self.imStack[coord[0],coord[1],j] > minPixelIntensity:
-                        #print self.imStack[coord[0],coord[1],i]
-                        #print coord[0],coord[1],i
-                        #accumulate a list of peak height or
-                        #peak area values for each pixel
-                        #assigned to each spot
-                        values.append(self.imStack[coord[0],coord[1],j])
-                if len(values) > 0:
-                    fileHandler.write('%f,%f,%f,%f,%d,' % (np.sum(values),np.max(values),np.mean(values),np.median(values),len(values)))
-                else:
-                    fileHandler.write('%d,%d,%d,%d,%d,' % (0,0,0,0,len(values)))
-
-            fileHandler.write('\n')
+        for start in range(0,len(_spotList),spotsPerBlock): #a block of spots at a time
+            stats=spotStatistics(self.imStack,_spotList[start:start+spotsPerBlock],minPixelIntensity)
+            columns=[]
+            for j,ion in enumerate(self.ions):
+                empty=stats['num_pixels'][:,j]==0
+                for descriptor in ['sum','max','mean','median']:
+                    #spots without any pixels above minPixelIntensity get zeroes
+                    columns.append(np.where(empty,'0',np.char.mod('%f',stats[descriptor][:,j])))
+                columns.append(np.char.mod('%d',stats['num_pixels'][:,j]))
+            rowCentroids=np.char.mod('%f',stats['row-centroid'])
+            colCentroids=np.char.mod('%f',stats['col-centroid'])
+            lines=[]
+            for k in range(len(rowCentroids)):
+                i=start+k
+                lines.append('%d,%s,%s,%s,%s,%s,' % (i, self.filename,
+                                                     chr(ord('A')+self.spotLocations[i][0]-1) if alphaRows else str(self.spotLocations[i][0]),
+                                                     self.spotLocations[i][1], rowCentroids[k], colCentroids[k]))
+                lines.append(''.join([c[k]+',' for c in columns]))
+                lines.append('\n')
+            fileHandler.write(''.join(lines))
         fileHandler.close()
         IPython.display.display(IPython.display.FileLink(actualFileName,
                                  result_html_prefix="Click the link below to access the results file:<br>",
@@ -714,44 +733,31 @@ class ArrayedImage(object):
                                  "or have generated a spotList using generateSpotList at some point")
             _spotList=self.spotList
 
-        df= None
-
         rowIndexes=self.spotLocations
         if alphaRows:
             rowIndexes=[alphaRowString(sl) for sl in self.spotLocations]
 
+        stats=spotStatistics(self.imStack,_spotList,minPixelIntensity)
+        descriptors=['sum','mean','median','min','max','num_pixels']
+        #spots without any pixels above minPixelIntensity only get a sum and num_pixels of 0
+        stats['sum'][stats['num_pixels']==0]=0
+        #one column per (ion,descriptor), ions first
+        data=np.stack([stats[d] for d in descriptors],axis=2).reshape(len(_spotList),len(self.ions)*len(descriptors))
 
         if multiIndex:
-            df=pd.DataFrame(index=rowIndexes,
+            df=pd.DataFrame(data,index=rowIndexes,
                 dtype='float64',columns=pd.MultiIndex.from_product([self.ions,
-                    ['sum','mean','median','min','max','num_pixels']],names=['ion','descriptor'],sortorder=0))#TURN INDEX INTO (ROW,COLUMN) EVENTUALLY!!!
+                    descriptors],names=['ion','descriptor'],sortorder=0))#TURN INDEX INTO (ROW,COLUMN) EVENTUALLY!!!
         else:
 
             colnames=['row','column','horizontal_coordinate','vertical_coordinate']
-            colnames+=[(i,x) for i in self.ions for x in ['sum','mean','median','min','max','num_pixels']]
-
-            df=pd.DataFrame(index=rowIndexes,columns=colnames)
-
-        for s,spot in enumerate(_spotList): #how many spots
-            if not multiIndex:
-                df.set_value(rowIndexes[s],'horizontal_coordinate',np.mean(spot[:,0]))
-                df.set_value(rowIndexes[s],'vertical_coordinate',np.mean(spot[:,1]))
-            for i,ion in enumerate(self.ions): #how many ions
-                values = []
-                for coord in spot: #how many pixels per spot
-                    if self.imStack[coord[0],coord[1],i] > minPixelIntensity:
-                        values.append(self.imStack[coord[0],coord[1],i])
-                if len(values) > 0:
-                    df.set_value(rowIndexes[s],(ion,'sum'),np.sum(values))
-                    df.set_value(rowIndexes[s],(ion,'max'),np.max(values))
-                    df.set_value(rowIndexes[s],(ion,'min'),np.min(values))
-                    df.set_value(rowIndexes[s],(ion,'median'),np.median(values))
-                    df.set_value(rowIndexes[s],(ion,'mean'),np.mean(values))
-                    df.set_value(rowIndexes[s],(ion,'num_pixels'),len(values))
+            colnames+=[(i,x) for i in self.ions for x in descriptors]
 
-                else:
-                    df.set_value(rowIndexes[s],(ion,'sum'),0)
-                    df.set_value(rowIndexes[s],(ion,'num_pixels'),0)
+            coordinates=np.empty((len(_spotList),4))
+            coordinates.fill(np.nan)
+            coordinates[:,2]=stats['row-centroid']
+            coordinates[:,3]=stats['col-centroid']
+            df=pd.DataFrame(np.hstack((coordinates,data)),index=rowIndexes,columns=colnames)
 
         return df
 
@@ -764,12 +770,18 @@ class OpenMSIsession(object):
         """you won't want to call the constructor, use the 'login' function
         to create an OpenMSIsession object"""
         self.requests_session = requests.Session()
+        #one connection pool shared by the workers of getSpotSpectra, mounted once so that
+        #adapters configured later by the user (retries, proxies, ...) are not replaced
+        adapter=requests.adapters.HTTPAdapter(pool_connections=1,pool_maxsize=32)
+        self.requests_session.mount('https://',adapter)
+        self.requests_session.mount('http://',adapter)
         self.username=username
         self.filename=None
+        self.baseURL='https://openmsi.nersc.gov'
 
     def getFilelist(self):
         payload = {'format':'JSON','mtype':'filelistView'}
-        url = 'https://openmsi.nersc.gov/qmetadata'
+        url = self.baseURL+'/qmetadata'
         r = self.requests_session.get(url,params=payload)
         r.raise_for_status()
         fileList = json.loads(r.content.decode('utf-8'))
@@ -851,13 +863,13 @@ class OpenMSIsession(object):
             self.filename = path.join('/project/projectdirs/openmsi/omsi_data_private/',self.filename)
 
         payload = {'file':self.filename,'format':'JSON','mtype':'file','expIndex':expIndex,'dataIndex':dataIndex}
-        url = 'https://openmsi.nersc.gov/qmetadata'
+        url = self.baseURL+'/qmetadata'
         r = self.requests_session.get(url,params=payload)
         r.raise_for_status()
         metadata = json.loads(r.content.decode('utf-8'))
         originalSize = ast.literal_eval(metadata[u'children'][0][u'shape'])
 
-        newImage=ArrayedImage(originalSize,ions,self.filename,expIndex,dataIndex,getMZ(self.requests_session,self.filename,expIndex,dataIndex))
+        newImage=ArrayedImage(originalSize,ions,self.filename,expIndex,dataIndex,getMZ(self.requests_session,self.filename,expIndex,dataIndex,baseURL=self.baseURL))
         #The new ArrayedImage returned has an empty imStack
         #To populate it, first we'll download the raw data and then reduce it into one slice for every ion
         reduceOnServer = remoteReduce and massRangeReductionStrategy.supportsRemoteReduce()
@@ -878,7 +890,7 @@ class OpenMSIsession(object):
                        }
             if reduceOnServer:
                 payload['operations'] = massRangeReductionStrategy.remoteReduceOperation()
-            url = 'https://openmsi.nersc.gov/qcube'
+            url = self.baseURL+'/qcube'
             #if verbose:
             #    print(payload)
             r = self.requests_session.get(url,params=payload)
@@ -976,7 +988,7 @@ class OpenMSIsession(object):
 
         OKbutton.on_click(do_load)
 
-    def getSpotSpectra(self,img,spotList=None,alphaRows=True,verbose=False):
+    def getSpotSpectra(self,img,spotList=None,alphaRows=True,verbose=False,maxWorkers=8,retries=3):
         """
         Get an average mass spectrum for each of the spots in an image.
         :param img: An ArrayedImage. If it does not have spots defined yet, this function will call
@@ -991,6 +1003,11 @@ class OpenMSIsession(object):
                             identifier. alphaRows=False sets the column names to 2-tuples (row,column).
                             Default is True, ignored if spotList is defined.
         :param verbose:     If Ture, ouput which spot's spectrum just finished the loading process
+        :param maxWorkers:  How many spectra are requested from OpenMSI at the same time. Set to 1 to load the
+                            spectra one after the other. Default is 8. The session keeps up to 32
+                            connections to OpenMSI open for the workers.
+        :param retries:     How many times a request is retried after a connection error, a timeout or a
+                            server error (5xx) before giving up. Default is 3.
         :return:     A dataframe with intensities at various m/z values.
                      Row indexes are m/z values and columns correspond to different spots
                      (Be aware this is different from how the resultsDataFrame is laid out!!)
@@ -1012,37 +1029,68 @@ class OpenMSIsession(object):
         if alphaRows:
             colIndexes=[alphaRowString(sl) for sl in img.spotLocations]
 
-
-
         payload = {'file':img.filename,
           'expIndex':img.expIndex,'dataIndex':img.dataIndex,'qspectrum_viewerOption':'0',
           'qslice_viewerOption':'0',
           'col':0,'row':0,
           'findPeak':'0','format':'JSON'}
-        url = 'https://openmsi.nersc.gov/qmz'
-        r = self.requests_session.get(url,params=payload)
-        r.raise_for_status()
+        url = self.baseURL+'/qmz'
+        r = self.getWithRetries(url,payload,retries)
         data = json.loads(r.text)
         mz = np.asarray(data[u'values_spectra'])
 
-        dataframe = pd.DataFrame(index=mz, dtype='float64',columns=colIndexes)
+        #one preallocated array, column i is the spectrum of spot i
+        spectra = np.empty((len(mz),len(_spotList)))
 
         payload = {'file':img.filename,
                       'expIndex':img.expIndex,'dataIndex':img.dataIndex,'qspectrum_viewerOption':'0',
                   'qslice_viewerOption':'0','operations':'[{"reduction":"mean","axis":0,"min_dim":2}]',
                       'findPeak':'0','format':'JSON'}
-        url = 'https://openmsi.nersc.gov/qspectrum'
-
-        for i,coord in enumerate(_spotList):
-            payload['col'] = '[' + ','.join([str(c[1]) for c in coord]) + ']'
-            payload['row'] = '[' + ','.join([str(c[0]) for c in coord]) + ']'
-            r = self.requests_session.get(url,params=payload)
+        url = self.baseURL+'/qspectrum'
+        finished = [0]
+        finishedLock = threading.Lock()
+
+        def loadSpectrum(i):
+            spotPayload = dict(payload)
+            spotPayload['col'] = '[' + ','.join([str(c[1]) for c in _spotList[i]]) + ']'
+            spotPayload['row'] = '[' + ','.join([str(c[0]) for c in _spotList[i]]) + ']'
+            r = self.getWithRetries(url,spotPayload,retries)
             data = json.loads(r.text)
-            dataframe.iloc[:,i]=data[u'spectrum']
-            if(verbose):
-                print("Finished loading spectrum {:d} out of {:d}".format(i+1,len(_spotList)))
+            spectra[:,i]=data[u'spectrum']
+            with finishedLock:
+                finished[0]+=1
+                if(verbose):
+                    print("Finished loading spectrum {:d} out of {:d}".format(finished[0],len(_spotList)))
+
+        if maxWorkers>1:
+            pool = ThreadPool(min(maxWorkers,max(len(_spotList),1)))
+            try:
+                pool.map(loadSpectrum,range(len(_spotList)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for i in range(len(_spotList)):
+                loadSpectrum(i)
+
+        return pd.DataFrame(spectra,index=mz,columns=colIndexes)
 
-        return dataframe
+    def getWithRetries(self,url,payload,retries=3,backoff=0.5):
+        """
+        GET a url with the session, retrying after connection errors, timeouts and server errors (5xx).
+        Waits backoff, 2*backoff, 4*backoff, ... seconds between the attempts.
+        :return: the response. Raises the last error if all attempts failed.
+        """
+        for attempt in range(retries+1):
+            try:
+                r = self.requests_session.get(url,params=payload)
+                if r.status_code < 500 or attempt == retries:
+                    r.raise_for_status()
+                    return r
+            except (requests.exceptions.ConnectionError,requests.exceptions.Timeout):
+                if attempt == retries:
+                    raise
+            time.sleep(backoff*2**attempt)
 
 
 def login(username=""):
@@ -1081,20 +1129,63 @@ def login(username=""):
     sys.stdout.flush()
     return newOpenMSIsession
 
-def getMZ(client,filename,expIndex,dataIndex):
+def getMZ(client,filename,expIndex,dataIndex,baseURL='https://openmsi.nersc.gov'):
     payload = {'file':filename,
           'expIndex':expIndex,'dataIndex':dataIndex,'qspectrum_viewerOption':'0',
           'qslice_viewerOption':'0',
           'col':0,'row':0,
           'findPeak':'0','format':'JSON'}
-    url = 'https://openmsi.nersc.gov/qmz'
+    url = baseURL+'/qmz'
     r = client.get(url,params=payload)
     r.raise_for_status()
     data = json.loads(r.content.decode('utf-8'))
     return np.asarray(data[u'values_spectra'])
 
+spotStencilCache={}
+
+def spotStencilReach(integrationRadius):
+    """
+    :return: how many pixels a spot stencil can reach past the floored spot center in any direction
+    """
+    return int(np.ceil(integrationRadius))+1
+
+def spotStencil(x,y,integrationRadius):
+    """
+    The pixels of a spot centered at (x,y), as (row,column) offsets relative to (floor(y),floor(x)).
+    The shape of the disk only depends on the integration radius and the fractional part of the center,
+    so it's calculated once and cached in spotStencilCache.
+    The offsets are sorted by row, then column, like the output of np.argwhere.
+    """
+    xFraction=x-np.floor(x)
+    yFraction=y-np.floor(y)
+    key=(integrationRadius,xFraction,yFraction)
+    stencil=spotStencilCache.get(key)
+    if stencil is None:
+        if len(spotStencilCache)>=100000:
+            spotStencilCache.clear()
+        reach=spotStencilReach(integrationRadius)
+        offsets=np.arange(-reach,reach+1)
+        xOffsets,yOffsets=np.meshgrid(offsets,offsets,sparse=False,indexing='xy')
+        stencil=np.argwhere(((xFraction-xOffsets)**2+(yFraction-yOffsets)**2)**0.5<integrationRadius)-reach
+        stencil.flags.writeable=False
+        spotStencilCache[key]=stencil
+    return stencil
+
+def spotMask(x,y,integrationRadius,imageShape):
+    """
+    :param imageShape: (height,width) of the image. Pixels outside of the image are left out.
+    :return: the (row,column) pixels that are less than integrationRadius away from (x,y)
+    """
+    pixels=spotStencil(x,y,integrationRadius)+np.array([int(np.floor(y)),int(np.floor(x))])
+    inside=((pixels[:,0]>=0) & (pixels[:,0]<imageShape[0]) &
+            (pixels[:,1]>=0) & (pixels[:,1]<imageShape[1]))
+    return pixels[inside]
+
 def oneSpotMask(xEdges,yEdges,x,y,integrationRadius):
-    return np.argwhere(((x - xEdges)**2 + (y - yEdges)**2)**0.5 < integrationRadius)
+    """
+    Kept for backwards compatibility, use spotMask instead. Only the shape of the xEdges/yEdges meshgrid is used.
+    """
+    return spotMask(x,y,integrationRadius,np.shape(xEdges))
 
 def sumPixels(pixelMask,imageStack):
     values = []
@@ -1103,6 +1194,52 @@ def sumPixels(pixelMask,imageStack):
     return sum(values)
     #sum (values) returns a vector with one entry per ion,
 
+def spotStatistics(imStack,spotList,minPixelIntensity=0):
+    """
+    Calculates the statistics of all spots at once. The pixels of all spots are gathered from the image stack with
+    one index array, labeled with the spot they belong to, and reduced per spot with grouped array operations.
+    :param imStack: (height,width,number of ions) image stack
+    :param spotList: List of lists of (row,column) pixels that defines the locations of the spots
+    :param minPixelIntensity: Only pixels more intense than this are included in the statistics.
+    :return: A dictionary with (number of spots, number of ions) arrays for 'sum','mean','median','min','max' and
+             'num_pixels', and (number of spots,) arrays with the mean pixel coordinates of the spots in
+             'row-centroid' and 'col-centroid'. The statistics of a spot without any pixels above
+             minPixelIntensity are NaN, and its num_pixels is 0.
+    """
+    numberOfSpots=len(spotList)
+    numberOfIons=imStack.shape[2]
+    spots=[np.asarray(spot,dtype=int).reshape(-1,2) for spot in spotList]
+    spotSizes=np.array([len(spot) for spot in spots],dtype=int)
+    pixels=np.concatenate(spots) if numberOfSpots else np.zeros((0,2),dtype=int)
+    labels=np.repeat(np.arange(numberOfSpots),spotSizes)
+
+    stats={}
+    with np.errstate(invalid='ignore',divide='ignore'):
+        stats['row-centroid']=np.bincount(labels,weights=pixels[:,0],minlength=numberOfSpots)/spotSizes
+        stats['col-centroid']=np.bincount(labels,weights=pixels[:,1],minlength=numberOfSpots)/spotSizes
+    for descriptor in ['sum','mean','median','min','max','num_pixels']:
+        stats[descriptor]=np.empty((numberOfSpots,numberOfIons))
+        stats[descriptor].fill(np.nan)
+
+    values=imStack[pixels[:,0],pixels[:,1],:]
+    for j in range(numberOfIons):
+        included=values[:,j]>minPixelIntensity
+        ionLabels=labels[included]
+        #sort by spot, and by intensity within each spot
+        order=np.lexsort((values[included,j],ionLabels))
+        ionValues=values[included,j][order]
+        counts=np.bincount(ionLabels,minlength=numberOfSpots)
+        stats['num_pixels'][:,j]=counts
+        found=counts>0
+        first=(np.cumsum(counts)-counts)[found]
+        counts=counts[found]
+        stats['sum'][found,j]=np.bincount(ionLabels,weights=values[included,j],minlength=numberOfSpots)[found]
+        stats['mean'][found,j]=stats['sum'][found,j]/counts
+        stats['min'][found,j]=ionValues[first]
+        stats['max'][found,j]=ionValues[first+counts-1]
+        stats['median'][found,j]=(ionValues[first+(counts-1)//2]+ionValues[first+counts//2])/2.
+    return stats
+
 def doesThisOverlap_pixelwise(spotMaskCache,spotMask,ignoreThisSpotNumber,numberOfSpots,verbose=False):
     for pixel in spotMask:
         for i in range(numberOfSpots):
@@ -1120,6 +1257,137 @@ def doesThisOverlap_distancewise(newX,newY,xCenter,yCenter,ignoreThisSpotNumber,
             return True
     return False
 
+class VectorizedSpotOptimizer(object):
+    """
+    Scores the candidate locations of all spots with array operations instead of building a pixel mask for every
+    candidate. Used by ArrayedImage.optimizeSpots.
+
+    A spot's candidates only depend on its own center, which doesn't change until that spot is optimized, so all
+    candidate scores of a round are computed up front by scoreCandidates(). Candidates that share the same disk
+    stencil are scored together, and the pixels of a stencil are added up in the same order as sumPixels does,
+    so the scores (and therefore the tie-breaking) are identical to the original algorithm.
+    The overlap rules depend on where the other spots are at that moment, so they are applied spot by spot
+    in bestLocation().
+    """
+    def __init__(self,imStack,integrationRadius,ionWeighting,halfboxsize,avoidOverlaps=True,
+                 pixelwiseOverlapAvoidance=False,overlapDistance_squared=None):
+        self.imStack=imStack
+        self.integrationRadius=integrationRadius
+        self.ionWeighting=np.asarray(ionWeighting)
+        self.halfboxsize=halfboxsize
+        self.avoidOverlaps=avoidOverlaps
+        self.pixelwiseOverlapAvoidance=pixelwiseOverlapAvoidance
+        self.overlapDistance_squared=overlapDistance_squared
+        self.imHeight=imStack.shape[0]
+        self.imWidth=imStack.shape[1]
+        self.reach=spotStencilReach(integrationRadius)
+        self.paddedStack=np.pad(imStack,((self.reach,self.reach),(self.reach,self.reach),(0,0)),mode='constant')
+        #pixelwise overlap avoidance: the last accepted mask of every spot, and how many spots claim each pixel
+        self.spotMaskCache=None
+        self.paddedOccupancy=None
+        self.candidateX=None
+        self.candidateY=None
+        self.scores=None
+        self.insideImage=None
+
+    def scoreCandidates(self,xCenter,yCenter):
+        """
+        Scores every candidate location of every spot for the current optimization round.
+        """
+        boxOffsets=np.arange(-self.halfboxsize,self.halfboxsize+1)
+        #newX is the outer and newY the inner loop in the original algorithm; keep that order for tie-breaking
+        self.candidateX=np.repeat(boxOffsets[np.newaxis,:]+np.asarray(xCenter)[:,np.newaxis],len(boxOffsets),axis=1)
+        self.candidateY=np.tile(boxOffsets[np.newaxis,:]+np.asarray(yCenter)[:,np.newaxis],(1,len(boxOffsets)))
+        self.insideImage=((self.candidateX>=0) & (self.candidateX<self.imWidth) &
+                          (self.candidateY>=0) & (self.candidateY<self.imHeight))
+        self.scores=np.empty(self.candidateX.shape)
+        self.scores.fill(-np.inf)
+
+        spotIndex,candidateIndex=np.nonzero(self.insideImage)
+        x=self.candidateX[spotIndex,candidateIndex]
+        y=self.candidateY[spotIndex,candidateIndex]
+        #group the candidates by their stencil, so every group is scored with a handful of array operations
+        groups={}
+        for k in range(len(x)):
+            stencil=spotStencil(x[k],y[k],self.integrationRadius)
+            groups.setdefault(stencil.tobytes(),(stencil,[]))[1].append(k)
+        for stencil,members in groups.values():
+            members=np.asarray(members)
+            rows=np.floor(y[members]).astype(int)+self.reach
+            columns=np.floor(x[members]).astype(int)+self.reach
+            pixelSums=np.zeros((len(members),self.imStack.shape[2]))
+            for offset in stencil:
+                pixelSums+=self.paddedStack[rows+offset[0],columns+offset[1],:]
+            #spots at the edge of the image have fewer pixels
+            numberOfPixels=self.countInsideImage(rows-self.reach,columns-self.reach,stencil)
+            assert np.all(numberOfPixels>0)
+            weightedSums=np.zeros(len(members))
+            for ion in range(pixelSums.shape[1]):
+                weightedSums+=pixelSums[:,ion]*self.ionWeighting[ion]
+            self.scores[spotIndex[members],candidateIndex[members]]=weightedSums/numberOfPixels
+
+    def countInsideImage(self,rows,columns,stencil):
+        stencilRows=rows[:,np.newaxis]+stencil[np.newaxis,:,0]
+        stencilColumns=columns[:,np.newaxis]+stencil[np.newaxis,:,1]
+        return np.sum((stencilRows>=0) & (stencilRows<self.imHeight) &
+                      (stencilColumns>=0) & (stencilColumns<self.imWidth),1)
+
+    def numberOfCandidatesOutsideImage(self,i):
+        return int(np.sum(~self.insideImage[i]))
+
+    def overlapsDistancewise(self,i,candidates,xCenter,yCenter):
+        x=self.candidateX[i,candidates]
+        y=self.candidateY[i,candidates]
+        #only spots that are close enough to the search box can possibly overlap with one of the candidates
+        reach=self.overlapDistance_squared**0.5+self.halfboxsize*2**0.5+1
+        neighbors=np.nonzero((xCenter-xCenter[i])**2+(yCenter-yCenter[i])**2<=reach**2)[0]
+        neighbors=neighbors[neighbors!=i]
+        distances_squared=(x[:,np.newaxis]-xCenter[neighbors])**2+(y[:,np.newaxis]-yCenter[neighbors])**2
+        return np.any(distances_squared<=self.overlapDistance_squared,1)
+
+    def overlapsPixelwise(self,i,candidates):
+        if self.spotMaskCache is None:
+            self.spotMaskCache=np.empty(self.candidateX.shape[0],dtype=np.ndarray)
+            self.paddedOccupancy=np.zeros((self.imHeight+2*self.reach,self.imWidth+2*self.reach),dtype=int)
+        #a spot can't overlap with itself
+        if self.spotMaskCache[i] is not None:
+            self.paddedOccupancy[self.spotMaskCache[i][:,0]+self.reach,self.spotMaskCache[i][:,1]+self.reach]-=1
+        overlaps=np.zeros(len(candidates),dtype=bool)
+        for k,c in enumerate(candidates):
+            stencil=spotStencil(self.candidateX[i,c],self.candidateY[i,c],self.integrationRadius)
+            rows=int(np.floor(self.candidateY[i,c]))+self.reach+stencil[:,0]
+            columns=int(np.floor(self.candidateX[i,c]))+self.reach+stencil[:,1]
+            overlaps[k]=np.any(self.paddedOccupancy[rows,columns]>0)
+        return overlaps
+
+    def bestLocation(self,i,xCenter,yCenter):
+        """
+        Applies the overlap rules to the candidates of spot i and picks the best one the same way the original
+        algorithm does: the first candidate with the highest score, as long as that score is higher than -1.
+        :return: (best score, best x, best y). The score is -1 if there was no acceptable location.
+        """
+        candidates=np.nonzero(self.insideImage[i])[0]
+        if self.avoidOverlaps:
+            if self.pixelwiseOverlapAvoidance:
+                overlaps=self.overlapsPixelwise(i,candidates)
+            else:
+                overlaps=self.overlapsDistancewise(i,candidates,xCenter,yCenter)
+            candidates=candidates[~overlaps]
+        if self.avoidOverlaps and self.pixelwiseOverlapAvoidance:
+            #the original algorithm remembers the mask of the last candidate that didn't overlap
+            if len(candidates)>0:
+                self.spotMaskCache[i]=spotMask(self.candidateX[i,candidates[-1]],self.candidateY[i,candidates[-1]],
+                                               self.integrationRadius,(self.imHeight,self.imWidth))
+            if self.spotMaskCache[i] is not None:
+                self.paddedOccupancy[self.spotMaskCache[i][:,0]+self.reach,self.spotMaskCache[i][:,1]+self.reach]+=1
+
+        scores=self.scores[i,candidates]
+        acceptable=scores>-1
+        if not np.any(acceptable):
+            return -1,xCenter[i],yCenter[i]
+        best=np.argmax(np.where(acceptable,scores,-np.inf))
+        return scores[best],self.candidateX[i,candidates[best]],self.candidateY[i,candidates[best]]
+
 class SpotOptimizationException(Exception):
     def __init__(self):
         Exception.__init__(self,("The optimization algorithm was unable to optimize a spot. " +
@@ -1335,10 +1603,10 @@ def barycentric_trapezoidial_interpolation(Nx,Ny,p,hexagonalOffset=0.5):
 
     px = [[p[0,0], p[2,0]],[p[1,0], p[3,0]]] #these are the [2,2] x-coordinates
     py = [[p[0,1], p[2,1]],[p[1,1], p[3,1]]] #these are the [2,2] y-coordinates
-    fx = interpolate.interp2d([0,1], [0,1], px, kind='linear')
-    xi = fx(x_basis[:],y_basis[:]).flatten()
-    fy = interpolate.interp2d([0,1], [0,1], py, kind='linear')
-    yi = fy(x_basis[:],y_basis[:]).flatten()
+    #bilinear interpolation between the corners, one row of Nx points for every y
+    u, v = np.meshgrid(x_basis, y_basis)
+    xi = ((1-v)*((1-u)*px[0][0] + u*px[0][1]) + v*((1-u)*px[1][0] + u*px[1][1])).flatten()
+    yi = ((1-v)*((1-u)*py[0][0] + u*py[0][1]) + v*((1-u)*py[1][0] + u*py[1][1])).flatten()
     d1 = (p[2,0] - p[0,0]) / Nx / 2.0
     d2 = (p[3,0] - p[1,0]) / Nx / 2.0
     offset = (d1 + d2) * hexagonalOffset
@@ -18,10 +18,14 @@ import datetime
 import time
 import pickle
 import inspect
+import os
+import threading
+from collections import OrderedDict, Counter
 
 import sys
 sys.path.insert(0, '/Users/bpb/repos/omaat/BASTet_py3')
 from omsi.dataformat.omsi_file import *
+from omsi.shared.data_selection import area_near_peak
 # import abc
 # from future.utils import with_metaclass
 
@@ -77,18 +81,7 @@ class AreaNearPeak():
         self.halfpeakwidth=halfpeakwidth
 
     def reduceImage(self,data):
-        result = np.zeros((data.shape[0],data.shape[1]))
-        maxMasses = np.argmax(data,2)
-        for x in range(data.shape[0]):
-            for y in range(data.shape[1]):
-                peak=(list(range(-self.halfpeakwidth,self.halfpeakwidth+1))+maxMasses[x,y]).astype(int)
-                for p in peak:
-                    if p<0:
-                        continue
-                    if p>= data.shape[2]:
-                        continue
-                    result[x,y]+=data[x,y,p]
-        return result
+        return area_near_peak(data,self.halfpeakwidth,dtype=np.float64)
 
     def remoteReduceOperation(self, **kwargs):
         return '[{"min_dim": 2, "reduction": "area_near_peak", "halfpeakwidth": %s}]' % str(self.halfpeakwidth)
@@ -325,7 +318,8 @@ class ArrayedImage(object):
                       verbose=False,
                       progressbar=None,
                       raiseExceptions=False,
-                      minimumScore=0):
+                      minimumScore=0,
+                      legacyOptimizer=False):
         """
         Performs a local optimization to align the spot centers to maxima spots on the image
 
@@ -366,6 +360,9 @@ class ArrayedImage(object):
                                 the optimizer could choose that didn't overlap with other spots.
         :param minimumScore: Require that at least a score this high is obtainable before moving a spot to a new
                              location. If there are spots missing in the grid, you may want to set this. Default is 0.
+        :param legacyOptimizer: If True, score every candidate location one at a time with spotMask and sumPixels
+                                (the original, much slower algorithm). By default the VectorizedSpotOptimizer is used,
+                                which gives exactly the same spot locations. Default is False.
         :return: no return value
         """
 
@@ -378,21 +375,39 @@ class ArrayedImage(object):
         imStack2=self.imStack
         imWidth=imStack2.shape[1]
         imHeight=imStack2.shape[0]
-        xEdges, yEdges = np.meshgrid(list(range(imWidth)), list(range(imHeight)), sparse=False, indexing='xy')
 
         xCenter=self.xCenters
         yCenter=self.yCenters
 
         numberOfSpots=len(xCenter)
-        spotMaskCache=np.empty(numberOfSpots, dtype=np.ndarray)
         if not ionWeighting:
             ionWeighting=np.empty(len(self.ions))
             ionWeighting.fill(1.)
+
+        if legacyOptimizer:
+            spotMaskCache=np.empty(numberOfSpots, dtype=np.ndarray)
+        else:
+            xCenter=np.asarray(xCenter)
+            yCenter=np.asarray(yCenter)
+            optimizer=VectorizedSpotOptimizer(imStack2,integrationRadius,ionWeighting,halfboxsize,
+                                              avoidOverlaps=avoidOverlaps,
+                                              pixelwiseOverlapAvoidance=pixelwiseOverlapAvoidance,
+                                              overlapDistance_squared=overlapDistance_squared)
         for round in range(optimizationrounds):
             totalscore=0
             minscore=-1
             maxscore=-1
+            if not legacyOptimizer:
+                optimizer.scoreCandidates(xCenter,yCenter)
             for i in range(numberOfSpots):
+                if not legacyOptimizer:
+                    for _ in range(optimizer.numberOfCandidatesOutsideImage(i)):
+                        if(raiseExceptions):
+                            raise IndexError("a location outside of the image was tried for a spot")
+                        elif(verbose):
+                            print("a location outside of the image was tried for spot #",i,"(",alphaRowString(self.spotLocations[i]),"), but ignored")
+                    best,bestX,bestY=optimizer.bestLocation(i,xCenter,yCenter)
+                else:
                     best=-1
                     bestX=xCenter[i]
                     bestY=yCenter[i]
@@ -405,7 +420,7 @@ class ArrayedImage(object):
                                     if(verbose):
                                         print("a location outside of the image was tried for spot #",i,"(",alphaRowString(self.spotLocations[i]),"), but ignored")
                                     continue
-                            currentSpot=oneSpotMask(xEdges,yEdges,newX,newY,integrationRadius)
+                            currentSpot=spotMask(newX,newY,integrationRadius,(imHeight,imWidth))
                             assert (len(currentSpot)>0)
                             if avoidOverlaps:
                                 if pixelwiseOverlapAvoidance:
@@ -423,26 +438,26 @@ class ArrayedImage(object):
                                 bestX=newX
                                 bestY=newY
 
-                    if(best>minimumScore):
-                        xCenter[i]=bestX
-                        yCenter[i]=bestY
-                    else:
-                        if raiseExceptions or best<0: #if the score is <0 something bad must be going on
-                            raise SpotOptimizationException()
-                        elif(verbose):
-                            print("Best score of spot # %d is %d but need > %d. Location stays as it was before."%(i,int(best), minimumScore))
-                    cyclenumber = numberOfSpots*round+i
-                    if(progressbar):
-                        progressbar.value=100*cyclenumber/(numberOfSpots*optimizationrounds)
-                    if(verbose): #to get the stats for this round
-                        totalscore+=best
-                        if(minscore==-1):
-                            minscore=best
-                        minscore=min(minscore,best)
-                        maxscore=max(maxscore,best)
-                        if(cyclenumber%100==99 and not progressbar):
-                            print("{:d}% done with the optimization process".format(int(100*cyclenumber/(numberOfSpots*optimizationrounds))))
-                            sys.stdout.flush()
+                if(best>minimumScore):
+                    xCenter[i]=bestX
+                    yCenter[i]=bestY
+                else:
+                    if raiseExceptions or best<0: #if the score is <0 something bad must be going on
+                        raise SpotOptimizationException()
+                    elif(verbose):
+                        print("Best score of spot # %d is %d but need > %d. Location stays as it was before."%(i,int(best), minimumScore))
+                cyclenumber = numberOfSpots*round+i
+                if(progressbar):
+                    progressbar.value=100*cyclenumber/(numberOfSpots*optimizationrounds)
+                if(verbose): #to get the stats for this round
+                    totalscore+=best
+                    if(minscore==-1):
+                        minscore=best
+                    minscore=min(minscore,best)
+                    maxscore=max(maxscore,best)
+                    if(cyclenumber%100==99 and not progressbar):
+                        print("{:d}% done with the optimization process".format(int(100*cyclenumber/(numberOfSpots*optimizationrounds))))
+                        sys.stdout.flush()
             print("done with optimization round %d of %s"%(round+1,optimizationrounds))
             if(verbose):
                 print("total score:",totalscore,"\t average spot score:",totalscore/numberOfSpots)
@@ -504,9 +519,8 @@ class ArrayedImage(object):
             numberOfSpots=len(self.xCenters)
             for box in ionWeightBoxes:
                 ionweights.append(box.value)
-            xEdges, yEdges = np.meshgrid(list(range(imWidth)), list(range(imHeight)), sparse=False, indexing='xy')
             for i in range(numberOfSpots):
-                currentSpot=oneSpotMask(xEdges,yEdges,self.xCenters[i],self.yCenters[i],integrationRadiusBox.value)
+                currentSpot=spotMask(self.xCenters[i],self.yCenters[i],integrationRadiusBox.value,(imHeight,imWidth))
                 result=sum(sumPixels(currentSpot,self.imStack)*ionweights)/len(currentSpot)
                 results.append(result)
             calcResults.value="{:d} Spots calculated.<br>Low spot score: {:f}<br>High spot score: {:f}<br>Mean spot score: {:f}<br>Median spot score: {:f}".format(
@@ -556,12 +570,10 @@ class ArrayedImage(object):
             params['arrayed_analysis_radius'] = integrationRadius
             update_default_params(params)
 
-        xEdges, yEdges = np.meshgrid(list(range(self.imStack.shape[1])), list(range(self.imStack.shape[0])), sparse=False, indexing='xy')
-
         myPixels = []
         tallies = {}
         for x, y in zip(self.xCenters, self.yCenters):
-            idx = oneSpotMask(xEdges, yEdges, x, y, integrationRadius)
+            idx = spotMask(x, y, integrationRadius, self.imStack.shape[:2])
             myPixels.append(idx)
             if len(idx) not in tallies:
                 tallies[len(idx)] = 0
@@ -624,11 +636,13 @@ class ArrayedImage(object):
         plt.show()
 
 
-    def writeResultTable(self,fileName="",spotList=None,minPixelIntensity=0,alphaRows=False):
+    def writeResultTable(self,fileName="",spotList=None,minPixelIntensity=0,alphaRows=False,spotsPerBlock=4096):
         """
 
         :param fileName: filename to write to. will automatically be appended with a .csv extension.
                             Default is will use current date and time
+        :param spotsPerBlock: The statistics are calculated and written for this many spots at a time,
+                              which limits the memory used for very large plate sets. Default is 4096.
         :return:
         """
 
@@ -658,27 +672,26 @@ class ArrayedImage(object):
             fileHandler.write('%5.4f NumPixels,' % i)
         fileHandler.write('\n')
 
-        for i,myPixel in enumerate(_spotList): #how many spots
-
-            fileHandler.write('%d,%s,%s,%s,%f,%f,' % ( i, self.filename,
-                                                             chr(ord('A')+self.spotLocations[i][0]-1) if alphaRows else str(self.spotLocations[i][0]),
-                                                             self.spotLocations[i][1], np.mean(myPixel[:,0]), np.mean(myPixel[:,1]) ) )
-            for j,ion in enumerate(self.ions): #how many ions
-                values = []
-                for coord in myPixel: #how many pixels per spot
-                    if self.imStack[coord[0],coord[1],j] > minPixelIntensity:
-                        #print self.imStack[coord[0],coord[1],i]
-                        #print coord[0],coord[1],i
-                        #accumulate a list of peak height or
-                        #peak area values for each pixel
-                        #assigned to each spot
-                        values.append(self.imStack[coord[0],coord[1],j])
-                if len(values) > 0:
-                    fileHandler.write('%f,%f,%f,%f,%d,' % (np.sum(values),np.max(values),np.mean(values),np.median(values),len(values)))
-                else:
-                    fileHandler.write('%d,%d,%d,%d,%d,' % (0,0,0,0,len(values)))
-
-            fileHandler.write('\n')
+        for start in range(0,len(_spotList),spotsPerBlock): #a block of spots at a time
+            stats=spotStatistics(self.imStack,_spotList[start:start+spotsPerBlock],minPixelIntensity)
+            columns=[]
+            for j,ion in enumerate(self.ions):
+                empty=stats['num_pixels'][:,j]==0
+                for descriptor in ['sum','max','mean','median']:
+                    #spots without any pixels above minPixelIntensity get zeroes
+                    columns.append(np.where(empty,'0',np.char.mod('%f',stats[descriptor][:,j])))
+                columns.append(np.char.mod('%d',stats['num_pixels'][:,j]))
+            rowCentroids=np.char.mod('%f',stats['row-centroid'])
+            colCentroids=np.char.mod('%f',stats['col-centroid'])
+            lines=[]
+            for k in range(len(rowCentroids)):
+                i=start+k
+                lines.append('%d,%s,%s,%s,%s,%s,' % (i, self.filename,
+                                                     chr(ord('A')+self.spotLocations[i][0]-1) if alphaRows else str(self.spotLocations[i][0]),
+                                                     self.spotLocations[i][1], rowCentroids[k], colCentroids[k]))
+                lines.append(''.join([c[k]+',' for c in columns]))
+                lines.append('\n')
+            fileHandler.write(''.join(lines))
         fileHandler.close()
         IPython.display.display(IPython.display.FileLink(actualFileName,
                                  result_html_prefix="Click the link below to access the results file:<br>",
@@ -717,44 +730,31 @@ class ArrayedImage(object):
                                  "or have generated a spotList using generateSpotList at some point")
             _spotList=self.spotList
 
-        df= None
-
         rowIndexes=self.spotLocations
         if alphaRows:
             rowIndexes=[alphaRowString(sl) for sl in self.spotLocations]
 
+        stats=spotStatistics(self.imStack,_spotList,minPixelIntensity)
+        descriptors=['sum','mean','median','min','max','num_pixels']
+        #spots without any pixels above minPixelIntensity only get a sum and num_pixels of 0
+        stats['sum'][stats['num_pixels']==0]=0
+        #one column per (ion,descriptor), ions first
+        data=np.stack([stats[d] for d in descriptors],axis=2).reshape(len(_spotList),len(self.ions)*len(descriptors))
 
         if multiIndex:
-            df=pd.DataFrame(index=rowIndexes,
+            df=pd.DataFrame(data,index=rowIndexes,
                 dtype='float64',columns=pd.MultiIndex.from_product([self.ions,
-                    ['sum','mean','median','min','max','num_pixels']],names=['ion','descriptor'],sortorder=0))#TURN INDEX INTO (ROW,COLUMN) EVENTUALLY!!!
+                    descriptors],names=['ion','descriptor'],sortorder=0))#TURN INDEX INTO (ROW,COLUMN) EVENTUALLY!!!
         else:
 
             colnames=['row','column','horizontal_coordinate','vertical_coordinate']
-            colnames+=[(i,x) for i in self.ions for x in ['sum','mean','median','min','max','num_pixels']]
-
-            df=pd.DataFrame(index=rowIndexes,columns=colnames)
-
-        for s,spot in enumerate(_spotList): #how many spots
-            if not multiIndex:
-                df.set_value(rowIndexes[s],'horizontal_coordinate',np.mean(spot[:,0]))
-                df.set_value(rowIndexes[s],'vertical_coordinate',np.mean(spot[:,1]))
-            for i,ion in enumerate(self.ions): #how many ions
-                values = []
-                for coord in spot: #how many pixels per spot
-                    if self.imStack[coord[0],coord[1],i] > minPixelIntensity:
-                        values.append(self.imStack[coord[0],coord[1],i])
-                if len(values) > 0:
-                    df.set_value(rowIndexes[s],(ion,'sum'),np.sum(values))
-                    df.set_value(rowIndexes[s],(ion,'max'),np.max(values))
-                    df.set_value(rowIndexes[s],(ion,'min'),np.min(values))
-                    df.set_value(rowIndexes[s],(ion,'median'),np.median(values))
-                    df.set_value(rowIndexes[s],(ion,'mean'),np.mean(values))
-                    df.set_value(rowIndexes[s],(ion,'num_pixels'),len(values))
+            colnames+=[(i,x) for i in self.ions for x in descriptors]
 
-                else:
-                    df.set_value(rowIndexes[s],(ion,'sum'),0)
-                    df.set_value(rowIndexes[s],(ion,'num_pixels'),0)
+            coordinates=np.empty((len(_spotList),4))
+            coordinates.fill(np.nan)
+            coordinates[:,2]=stats['row-centroid']
+            coordinates[:,3]=stats['col-centroid']
+            df=pd.DataFrame(np.hstack((coordinates,data)),index=rowIndexes,columns=colnames)
 
         return df
 
@@ -811,7 +811,7 @@ class OpenMSIsession(object):
         # _fileSelector_updated()
         # return ipywidgets.Box(children=(title,fileSelector))
 
-    def getArrayedImage(self,ions,massRange,massRangePercent=False,filename=None,massRangeReductionStrategy=None,expIndex=0,dataIndex=0,verbose=True,remoteReduce=True):
+    def getArrayedImage(self,ions,massRange,massRangePercent=False,filename=None,massRangeReductionStrategy=None,expIndex=0,dataIndex=0,verbose=True,remoteReduce=True,memoryBudget=2**30):
         """
         Downloads defined ion slices from an OpenMSI image and returns a new ArrayedImage file
         :param ions: Ihe ion (m/z) slices you want to download. A list of floats
@@ -836,6 +836,8 @@ class OpenMSIsession(object):
         :param verbose: If true, prints progress on which ion it's currently loading
         :param remoteReduce: Perform data reductions remotely on the server if possible (default=True). Set to
                              False to load all data and reduce localle (usually slower).
+        :param memoryBudget: The maximum number of bytes of raw data that are read from the file at once.
+                             Default is 1 GB.
         :return: a new ArrayedImage file that contains the reduced data.
         """
         if massRangeReductionStrategy is None:
@@ -851,24 +853,22 @@ class OpenMSIsession(object):
         #The new ArrayedImage returned has an empty imStack
         #To populate it, first we'll download the raw data and then reduce it into one slice for every ion
         reduceOnServer = remoteReduce and massRangeReductionStrategy.supportsRemoteReduce()
+        startTime = time.time()
+        min_mz=[]
+        max_mz=[]
         for i,ion in enumerate(newImage.ions):
-            startTime = time.time()
             realMassRange = massRange if not massRangePercent else massRange*ion*0.01
             if verbose:
                 print ("loading ion {:d} of {:d}. m/z = {:f} +/- {:f}".format(i+1,len(newImage.ions),ion,realMassRange))
                 sys.stdout.flush()
-            
-            newImage.imStack[:,:,i] = get_image(self.filename,ion-realMassRange,ion+realMassRange,expIndex,dataIndex)
-            # newImage.imStack[:,:,i] = image.sum(axis=2)
-            # data = np.asarray(json.loads(r.content.decode('utf-8')))
-            # if reduceOnServer:
-                # newImage.imStack[:,:,i] = data
-            # else:
-                # if verbose:
-                    # print("Performing mass range reduction locally...")
-                # newImage.imStack[:,:,i] = massRangeReductionStrategy.reduceImage(data)
-            # if verbose:
-                # print ("Time to load ion: " + str(time.time() - startTime) + " seconds")
+            min_mz.append(ion-realMassRange)
+            max_mz.append(ion+realMassRange)
+        #all ions are read in one go, overlapping mass ranges are only read once
+        newImage.imStack[:,:,:] = get_images(self.filename,min_mz,max_mz,expIndex,dataIndex,
+                                             reduction_strategy=massRangeReductionStrategy,
+                                             mzdata=newImage.mz,memory_budget=memoryBudget,verbose=verbose)
+        if verbose:
+            print ("Time to load ions: " + str(time.time() - startTime) + " seconds")
 
         newImage.baseImage = np.sum(newImage.imStack,2)
         print("Image has been loaded.")
@@ -954,7 +954,7 @@ class OpenMSIsession(object):
 
         OKbutton.on_click(do_load)
 
-    def getSpotSpectra(self,img,spotList=None,alphaRows=True,verbose=False):
+    def getSpotSpectra(self,img,spotList=None,alphaRows=True,verbose=False,numProcesses=1,memoryBudget=2**30):
         """
         Get an average mass spectrum for each of the spots in an image.
         :param img: An ArrayedImage. If it does not have spots defined yet, this function will call
@@ -968,7 +968,9 @@ class OpenMSIsession(object):
                             If True, sets the column names of the data frame to strings with an alphabetical
                             identifier. alphaRows=False sets the column names to 2-tuples (row,column).
                             Default is True, ignored if spotList is defined.
-        :param verbose:     If Ture, ouput which spot's spectrum just finished the loading process
+        :param verbose:     If True, output how long it took to read the spectra
+        :param numProcesses: number of processes used to read the spectra. Default is 1, no process pool.
+        :param memoryBudget: the maximum number of bytes of raw data read at once by a process. Default is 1 GB.
         :return:     A dataframe with intensities at various m/z values.
                      Row indexes are m/z values and columns correspond to different spots
                      (Be aware this is different from how the resultsDataFrame is laid out!!)
@@ -992,33 +994,12 @@ class OpenMSIsession(object):
 
 
 
-        payload = {'file':img.filename,
-          'expIndex':img.expIndex,'dataIndex':img.dataIndex,'qspectrum_viewerOption':'0',
-          'qslice_viewerOption':'0',
-          'col':0,'row':0,
-          'findPeak':'0','format':'JSON'}
-        url = 'https://openmsi.nersc.gov/qmz'
-        r = self.requests_session.get(url,params=payload)
-        r.raise_for_status()
-        data = json.loads(r.text)
-        mz = np.asarray(data[u'values_spectra'])
-
-        dataframe = pd.DataFrame(index=mz, dtype='float64',columns=colIndexes)
-
-        payload = {'file':img.filename,
-                      'expIndex':img.expIndex,'dataIndex':img.dataIndex,'qspectrum_viewerOption':'0',
-                  'qslice_viewerOption':'0','operations':'[{"reduction":"mean","axis":0,"min_dim":2}]',
-                      'findPeak':'0','format':'JSON'}
-        url = 'https://openmsi.nersc.gov/qspectrum'
-
-        for i,coord in enumerate(_spotList):
-            payload['col'] = '[' + ','.join([str(c[1]) for c in coord]) + ']'
-            payload['row'] = '[' + ','.join([str(c[0]) for c in coord]) + ']'
-            r = self.requests_session.get(url,params=payload)
-            data = json.loads(r.text)
-            dataframe.iloc[:,i]=data[u'spectrum']
-            if(verbose):
-                print("Finished loading spectrum {:d} out of {:d}".format(i+1,len(_spotList)))
+        mz = img.mz
+        if mz is None:
+            mz = getMZ(None,img.filename,img.expIndex,img.dataIndex)
+        spectra = get_spot_spectra(img.filename,_spotList,img.expIndex,img.dataIndex,
+                                   memory_budget=memoryBudget,num_processes=numProcesses,verbose=verbose)
+        dataframe = pd.DataFrame(spectra,index=mz,columns=colIndexes)
 
         return dataframe
 
@@ -1059,69 +1040,301 @@ class OpenMSIsession(object):
 #     sys.stdout.flush()
 #     return newOpenMSIsession
 
+class MSIDataHandle(object):
+    """
+    An open msidata object together with the metadata that is needed again and again:
+    shape, dtype, chunks of the primary dataset and the m/z axis.
+    """
+    def __init__(self,filename,expIndex,dataIndex):
+        self.filename=filename
+        self.expIndex=expIndex
+        self.dataIndex=dataIndex
+        self.mtime=os.path.getmtime(filename)
+        self.file=omsi_file(filename, 'r' )
+        try:
+            exp=self.file.get_experiment(expIndex)
+            self.msidata=exp.get_msidata(data_index=dataIndex)
+            self.shape=tuple(self.msidata.shape)
+            self.dtype=np.dtype(self.msidata.dtype)
+            self.chunks=self.msidata.get_h5py_datasets(0).chunks
+            self.mz=exp.get_instrument_info().get_instrument_mz()[:]
+            self.mz.setflags(write=False)
+        except:
+            self.file.close_file()
+            raise
+
+    def close(self):
+        self.file.close_file()
+
+class MSIFileCache(object):
+    """
+    Keeps up to maxOpenFiles msidata handles open, keyed by (filename, expIndex, dataIndex), and closes
+    the least recently used one when another one is needed. A handle is reopened when the modification time
+    of its file changes. Handles are not shared with forked processes, those open the files again.
+    Call clear() before writing to a cached file from the same process, HDF5 does not allow that while it is open.
+    """
+    def __init__(self,maxOpenFiles=8):
+        self.maxOpenFiles=maxOpenFiles
+        self.handles=OrderedDict()
+        self.pid=os.getpid()
+        self.lock=threading.RLock()
+
+    def get(self,filename,expIndex=0,dataIndex=0):
+        """
+        :return: the MSIDataHandle of the dataset, opened if it is not in the cache or the file has changed
+        """
+        key=(os.path.abspath(filename),expIndex,dataIndex)
+        with self.lock:
+            if self.pid!=os.getpid():
+                self.handles=OrderedDict()
+                self.pid=os.getpid()
+            handle=self.handles.pop(key,None)
+            if handle is not None and handle.mtime!=os.path.getmtime(filename):
+                handle.close()
+                handle=None
+            if handle is None:
+                handle=MSIDataHandle(filename,expIndex,dataIndex)
+                while len(self.handles)>=max(self.maxOpenFiles,1):
+                    self.handles.popitem(last=False)[1].close()
+            self.handles[key]=handle
+            return handle
+
+    def clear(self):
+        """
+        Close all cached handles.
+        """
+        with self.lock:
+            if self.pid==os.getpid():
+                for handle in self.handles.values():
+                    handle.close()
+            self.handles=OrderedDict()
+            self.pid=os.getpid()
+
+msiFileCache=MSIFileCache()
+
 def get_image(my_file='/Users/bpb/Downloads/20250131_ZD_PlateA.h5',min_mz=650,max_mz=700,
                     my_experiment=0,
                     my_data_index=0,
                     my_slice=None):
-    f = omsi_file(my_file, 'r' )
-    #Get the number of experiments
-    # num_exp = f.get_num_experiments()
-    # print(num_exp)
-    #Get the first experiment. 
-    #exp0  is an object of the type omsi_file_experiment For more information execute:
-    #help( omsi_file_experiment )
-    exp = f.get_experiment(my_experiment)
-    # info = exp0.get_instrument_info()
-    # print(info)
-    # p = f.get_experiment_path(0)
-    # print(p)
-    d = exp.get_msidata(data_index=my_data_index)
-    mzdata = exp.get_instrument_info().get_instrument_mz()    
-    mzdata = mzdata[:]
-    idx_lo = np.argmin(np.abs(mzdata-min_mz))
-    idx_hi = np.argmin(np.abs(mzdata-max_mz))
-    my_slice = d[:,:,idx_lo:idx_hi].sum(axis=2)
-    f.close_file()
-    return my_slice
+    return get_images(my_file,[min_mz],[max_mz],my_experiment,my_data_index)[:,:,0]
+
+def get_mz_indices(mzdata,mz_values):
+    """
+    For every value in mz_values, find the index of the nearest value in the (sorted) m/z axis,
+    the same as np.argmin(np.abs(mzdata-mz_value)) but with np.searchsorted.
+    In case of a tie the lower index is used, like np.argmin does.
+    """
+    mz_values = np.asarray(mz_values).astype(mzdata.dtype)
+    idx = np.clip(np.searchsorted(mzdata,mz_values),1,len(mzdata)-1)
+    lower_is_closer = np.abs(mzdata[idx-1]-mz_values) <= np.abs(mzdata[idx]-mz_values)
+    return np.where(lower_is_closer,idx-1,idx)
+
+def merge_mz_windows(idx_lo,idx_hi):
+    """
+    Merge overlapping or adjacent m/z index windows [idx_lo,idx_hi) into as few contiguous reads as possible.
+    Empty windows are left out.
+
+    :return: list of (read_lo, read_hi, list of the indices of the windows covered by this read)
+    """
+    reads = []
+    for w in np.argsort(idx_lo,kind='stable'):
+        if idx_hi[w] <= idx_lo[w]:
+            continue
+        if reads and idx_lo[w] <= reads[-1][1]:
+            reads[-1][1] = max(reads[-1][1],idx_hi[w])
+            reads[-1][2].append(w)
+        else:
+            reads.append([idx_lo[w],idx_hi[w],[w]])
+    return [(int(lo),int(hi),windows) for lo,hi,windows in reads]
+
+def get_tile_shape(data_shape,chunks,depth,itemsize,memory_budget):
+    """
+    The largest x/y tile, in whole HDF5 chunks, for which a (tile_x, tile_y, depth) block of the data fits
+    in memory_budget bytes. Whole rows in y are preferred. The tile is never smaller than one chunk.
+    """
+    chunk_x,chunk_y = (chunks[0],chunks[1]) if chunks is not None and len(chunks) == 3 else (1,1)
+    max_pixels = max(1,memory_budget // max(1,depth*itemsize))
+    tile_y = min(data_shape[1],max(chunk_y,(max_pixels // chunk_x) // chunk_y * chunk_y))
+    tile_x = min(data_shape[0],max(chunk_x,(max_pixels // tile_y) // chunk_x * chunk_x))
+    return tile_x,tile_y
+
+def get_images(my_file,min_mz,max_mz,
+                    my_experiment=0,
+                    my_data_index=0,
+                    reduction_strategy=None,
+                    mzdata=None,
+                    memory_budget=2**30,
+                    verbose=False,
+                    return_stats=False):
+    """
+    Load the ion images of many m/z windows at once. The file is opened once, overlapping or adjacent windows
+    are merged into a single read, and every window is reduced from the data of its read.
+    The data is read in x/y tiles that are aligned to the HDF5 chunks and small enough to stay within
+    memory_budget, so the full mass range never has to be in memory for the whole image.
+
+    :param min_mz: list with the lower m/z bound of every window
+    :param max_mz: list with the upper m/z bound of every window
+    :param reduction_strategy: PeakArea (default), PeakHeight or AreaNearPeak instance used to reduce a window
+    :param mzdata: the m/z axis of the data, if it has been loaded already
+    :param memory_budget: the maximum number of bytes of raw data read at once. Default is 1 GB.
+    :param verbose: print the tiling, the amount of data read and the throughput
+    :param return_stats: also return a dictionary with the 'bytes_read', 'seconds', 'MB_per_second',
+                         'tile_shape' and number of 'reads'
+    :return: (x, y, number of windows) array with one reduced image per window
+    """
+    if reduction_strategy is None:
+        reduction_strategy = PeakArea()
+    start_time = time.time()
+    handle = msiFileCache.get(my_file,my_experiment,my_data_index)
+    d = handle.msidata
+    if mzdata is None:
+        mzdata = handle.mz
+    idx_lo = get_mz_indices(mzdata,min_mz)
+    idx_hi = get_mz_indices(mzdata,max_mz)
+    images = np.zeros((d.shape[0],d.shape[1],len(idx_lo)))
+    reads = merge_mz_windows(idx_lo,idx_hi)
+
+    stats = {'bytes_read': 0, 'tile_shape': None, 'reads': 0}
+    if reads:
+        widest_lo,widest_hi,_ = max(reads,key=lambda r: r[1]-r[0])
+        dset = d.__best_dataset__((slice(0,d.shape[0]),slice(0,d.shape[1]),slice(widest_lo,widest_hi)))
+        tile_x,tile_y = get_tile_shape(d.shape,dset.chunks,widest_hi-widest_lo,np.dtype(d.dtype).itemsize,memory_budget)
+        stats['tile_shape'] = (tile_x,tile_y)
+        if verbose:
+            print("reading {:d} m/z range(s) in tiles of {:d}x{:d} pixels".format(len(reads),tile_x,tile_y))
+            sys.stdout.flush()
+        for x in range(0,d.shape[0],tile_x):
+            for y in range(0,d.shape[1],tile_y):
+                for read_lo,read_hi,windows in reads:
+                    data = d[x:x+tile_x,y:y+tile_y,read_lo:read_hi]
+                    stats['bytes_read'] += data.nbytes
+                    stats['reads'] += 1
+                    for w in windows:
+                        images[x:x+tile_x,y:y+tile_y,w] = reduction_strategy.reduceImage(data[:,:,idx_lo[w]-read_lo:idx_hi[w]-read_lo])
+
+    stats['seconds'] = time.time() - start_time
+    stats['MB_per_second'] = stats['bytes_read'] / 1e6 / max(stats['seconds'],1e-9)
+    if verbose:
+        print("read {:.1f} MB in {:.2f} seconds ({:.1f} MB/s)".format(stats['bytes_read'] / 1e6,stats['seconds'],stats['MB_per_second']))
+        sys.stdout.flush()
+    if return_stats:
+        return images,stats
+    return images
+
+def group_spot_pixels_by_chunk(spot_list,chunks):
+    """
+    Group the pixels of all spots by the HDF5 chunk column they are stored in, so every chunk column is read
+    once no matter how many spots it contains. A pixel that belongs to several spots appears once per spot.
+
+    :param spot_list: list of spots, each a list of (x,y) pixel coordinates
+    :param chunks: (x,y) chunk size of the dataset
+    :return: list of (x0,x1,y0,y1,x,y,spot) groups, where x0:x1,y0:y1 is the bounding box of the pixels
+             in the group and x, y, spot are arrays with the pixel coordinates and the spot each pixel is from
+    """
+    pixels = [np.asarray(s,dtype=np.int64).reshape(-1,2) for s in spot_list]
+    if not pixels:
+        return []
+    spot = np.repeat(np.arange(len(pixels)),[len(p) for p in pixels])
+    pixels = np.concatenate(pixels)
+    if len(pixels) == 0:
+        return []
+    x,y = pixels[:,0],pixels[:,1]
+    chunk_x,chunk_y = x // chunks[0],y // chunks[1]
+    order = np.lexsort((spot,chunk_y,chunk_x))
+    x,y,spot,chunk_x,chunk_y = x[order],y[order],spot[order],chunk_x[order],chunk_y[order]
+    boundaries = np.flatnonzero((np.diff(chunk_x) != 0) | (np.diff(chunk_y) != 0)) + 1
+    groups = []
+    for gx,gy,gs in zip(np.split(x,boundaries),np.split(y,boundaries),np.split(spot,boundaries)):
+        groups.append((gx.min(),gx.max()+1,gy.min(),gy.max()+1,gx,gy,gs))
+    return groups
+
+def sum_spot_spectra(my_file,groups,
+                    my_experiment=0,
+                    my_data_index=0,
+                    memory_budget=2**30):
+    """
+    Sum the spectra of the pixels in each chunk group made by group_spot_pixels_by_chunk.
+    The m/z axis of a group is read in pieces aligned to the chunks so no more than memory_budget bytes
+    are read at once. This is a module level function so it can be handed to a process pool.
+
+    :return: list of (spots, mz_lo, mz_hi, sums) with the summed spectra of every spot in a group for one
+             piece of the m/z axis, as a (number of spots in the group, mz_hi-mz_lo) array
+    """
+    d = msiFileCache.get(my_file,my_experiment,my_data_index).msidata
+    num_mz = d.shape[2]
+    results = []
+    for x0,x1,y0,y1,x,y,spot in groups:
+        dset = d.__best_dataset__((slice(x0,x1),slice(y0,y1),slice(0,num_mz)))
+        chunk_mz = dset.chunks[2] if dset.chunks else 1
+        depth = max(1,int(memory_budget // ((x1-x0)*(y1-y0)*np.dtype(d.dtype).itemsize)))
+        depth = num_mz if depth >= num_mz else max(chunk_mz,(depth // chunk_mz)*chunk_mz)
+        spots,starts = np.unique(spot,return_index=True)
+        for mz_lo in range(0,num_mz,depth):
+            mz_hi = min(mz_lo+depth,num_mz)
+            data = d[x0:x1,y0:y1,mz_lo:mz_hi]
+            sums = np.add.reduceat(data[x-x0,y-y0,:].astype(np.float64),starts,axis=0)
+            results.append((spots,mz_lo,mz_hi,sums))
+    return results
+
+def _sum_spot_spectra(args):
+    return sum_spot_spectra(*args)
+
+def get_spot_spectra(my_file,spot_list,
+                    my_experiment=0,
+                    my_data_index=0,
+                    memory_budget=2**30,
+                    num_processes=1,
+                    verbose=False):
+    """
+    Compute the mean spectrum of every spot directly from the data cube.
+    The pixels of all spots are grouped by chunk, so each HDF5 chunk is read once even when several
+    spots share it, and the spectra are accumulated into a single (number of m/z values, number of spots) array.
+
+    :param spot_list: list of spots, each a list of (x,y) pixel coordinates
+    :param memory_budget: the maximum number of bytes of raw data read at once by a process. Default is 1 GB.
+    :param num_processes: number of processes the chunk groups are divided over. Default is 1, no process pool.
+    :param verbose: print the number of chunk groups and how long it took to read them
+    :return: (number of m/z values, number of spots) array with the mean spectrum of every spot.
+             Spots without pixels get a spectrum of NaN.
+    """
+    start_time = time.time()
+    d = msiFileCache.get(my_file,my_experiment,my_data_index).msidata
+    num_mz = d.shape[2]
+    dset = d.__best_dataset__((slice(0,1),slice(0,1),slice(0,num_mz)))
+    chunks = dset.chunks if dset.chunks else (1,d.shape[1])
+
+    groups = group_spot_pixels_by_chunk(spot_list,chunks)
+    if num_processes > 1 and len(groups) > 1:
+        from multiprocessing import Pool
+        pool = Pool(num_processes)
+        try:
+            parts = pool.map(_sum_spot_spectra,[(my_file,groups[i::num_processes],my_experiment,my_data_index,memory_budget)
+                                                for i in range(num_processes)])
+        finally:
+            pool.close()
+            pool.join()
+        results = [r for part in parts for r in part]
+    else:
+        results = sum_spot_spectra(my_file,groups,my_experiment,my_data_index,memory_budget)
+
+    spectra = np.zeros((num_mz,len(spot_list)))
+    for spots,mz_lo,mz_hi,sums in results:
+        spectra[mz_lo:mz_hi,spots] += sums.T
+    num_pixels = np.array([len(s) for s in spot_list],dtype=np.float64)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        spectra /= num_pixels
+    if verbose:
+        print("read {:d} chunk group(s) for {:d} spots in {:.2f} seconds".format(len(groups),len(spot_list),time.time()-start_time))
+        sys.stdout.flush()
+    return spectra
 
 def get_image_size(my_file='/Users/bpb/Downloads/20250131_ZD_PlateA.h5',
                 my_experiment=0,
                 my_data_index=0):
-    f = omsi_file(my_file, 'r' )
-    #Get the number of experiments
-    # num_exp = f.get_num_experiments()
-    # print(num_exp)
-    #Get the first experiment. 
-    #exp0  is an object of the type omsi_file_experiment For more information execute:
-    #help( omsi_file_experiment )
-    exp = f.get_experiment(my_experiment)
-    # info = exp0.get_instrument_info()
-    # print(info)
-    # p = f.get_experiment_path(0)
-    # print(p)
-    d = exp.get_msidata(data_index=my_data_index)
-    
-    f.close_file()
-    return d.shape
+    return msiFileCache.get(my_file,my_experiment,my_data_index).shape
 
 def getMZ(client,filename,expIndex,dataIndex):
-    f = omsi_file(filename, 'r' )
-    #Get the number of experiments
-    # num_exp = f.get_num_experiments()
-    # print(num_exp)
-    #Get the first experiment. 
-    #exp0  is an object of the type omsi_file_experiment For more information execute:
-    #help( omsi_file_experiment )
-    exp = f.get_experiment(expIndex)
-    # info = exp0.get_instrument_info()
-    # print(info)
-    # p = f.get_experiment_path(0)
-    # print(p)
-    d = exp.get_msidata(data_index=dataIndex)
-    mzdata = exp.get_instrument_info().get_instrument_mz()    
-    mzdata = mzdata[:]
-    f.close_file()
-    return mzdata
+    return msiFileCache.get(filename,expIndex,dataIndex).mz
     # payload = {'file':filename,
     #       'expIndex':expIndex,'dataIndex':dataIndex,'qspectrum_viewerOption':'0',
     #       'qslice_viewerOption':'0',
@@ -1133,8 +1346,51 @@ def getMZ(client,filename,expIndex,dataIndex):
     # data = json.loads(r.content.decode('utf-8'))
     # return np.asarray(data[u'values_spectra'])
 
+spotStencilCache={}
+
+def spotStencilReach(integrationRadius):
+    """
+    :return: how many pixels a spot stencil can reach past the floored spot center in any direction
+    """
+    return int(np.ceil(integrationRadius))+1
+
+def spotStencil(x,y,integrationRadius):
+    """
+    The pixels of a spot centered at (x,y), as (row,column) offsets relative to (floor(y),floor(x)).
+    The shape of the disk only depends on the integration radius and the fractional part of the center,
+    so it's calculated once and cached in spotStencilCache.
+    The offsets are sorted by row, then column, like the output of np.argwhere.
+    """
+    xFraction=x-np.floor(x)
+    yFraction=y-np.floor(y)
+    key=(integrationRadius,xFraction,yFraction)
+    stencil=spotStencilCache.get(key)
+    if stencil is None:
+        if len(spotStencilCache)>=100000:
+            spotStencilCache.clear()
+        reach=spotStencilReach(integrationRadius)
+        offsets=np.arange(-reach,reach+1)
+        xOffsets,yOffsets=np.meshgrid(offsets,offsets,sparse=False,indexing='xy')
+        stencil=np.argwhere(((xFraction-xOffsets)**2+(yFraction-yOffsets)**2)**0.5<integrationRadius)-reach
+        stencil.flags.writeable=False
+        spotStencilCache[key]=stencil
+    return stencil
+
+def spotMask(x,y,integrationRadius,imageShape):
+    """
+    :param imageShape: (height,width) of the image. Pixels outside of the image are left out.
+    :return: the (row,column) pixels that are less than integrationRadius away from (x,y)
+    """
+    pixels=spotStencil(x,y,integrationRadius)+np.array([int(np.floor(y)),int(np.floor(x))])
+    inside=((pixels[:,0]>=0) & (pixels[:,0]<imageShape[0]) &
+            (pixels[:,1]>=0) & (pixels[:,1]<imageShape[1]))
+    return pixels[inside]
+
 def oneSpotMask(xEdges,yEdges,x,y,integrationRadius):
-    return np.argwhere(((x - xEdges)**2 + (y - yEdges)**2)**0.5 < integrationRadius)
+    """
+    Kept for backwards compatibility, use spotMask instead. Only the shape of the xEdges/yEdges meshgrid is used.
+    """
+    return spotMask(x,y,integrationRadius,np.shape(xEdges))
 
 def sumPixels(pixelMask,imageStack):
     values = []
@@ -1143,6 +1399,52 @@ def sumPixels(pixelMask,imageStack):
     return sum(values)
     #sum (values) returns a vector with one entry per ion,
 
+def spotStatistics(imStack,spotList,minPixelIntensity=0):
+    """
+    Calculates the statistics of all spots at once. The pixels of all spots are gathered from the image stack with
+    one index array, labeled with the spot they belong to, and reduced per spot with grouped array operations.
+    :param imStack: (height,width,number of ions) image stack
+    :param spotList: List of lists of (row,column) pixels that defines the locations of the spots
+    :param minPixelIntensity: Only pixels more intense than this are included in the statistics.
+    :return: A dictionary with (number of spots, number of ions) arrays for 'sum','mean','median','min','max' and
+             'num_pixels', and (number of spots,) arrays with the mean pixel coordinates of the spots in
+             'row-centroid' and 'col-centroid'. The statistics of a spot without any pixels above
+             minPixelIntensity are NaN, and its num_pixels is 0.
+    """
+    numberOfSpots=len(spotList)
+    numberOfIons=imStack.shape[2]
+    spots=[np.asarray(spot,dtype=int).reshape(-1,2) for spot in spotList]
+    spotSizes=np.array([len(spot) for spot in spots],dtype=int)
+    pixels=np.concatenate(spots) if numberOfSpots else np.zeros((0,2),dtype=int)
+    labels=np.repeat(np.arange(numberOfSpots),spotSizes)
+
+    stats={}
+    with np.errstate(invalid='ignore',divide='ignore'):
+        stats['row-centroid']=np.bincount(labels,weights=pixels[:,0],minlength=numberOfSpots)/spotSizes
+        stats['col-centroid']=np.bincount(labels,weights=pixels[:,1],minlength=numberOfSpots)/spotSizes
+    for descriptor in ['sum','mean','median','min','max','num_pixels']:
+        stats[descriptor]=np.empty((numberOfSpots,numberOfIons))
+        stats[descriptor].fill(np.nan)
+
+    values=imStack[pixels[:,0],pixels[:,1],:]
+    for j in range(numberOfIons):
+        included=values[:,j]>minPixelIntensity
+        ionLabels=labels[included]
+        #sort by spot, and by intensity within each spot
+        order=np.lexsort((values[included,j],ionLabels))
+        ionValues=values[included,j][order]
+        counts=np.bincount(ionLabels,minlength=numberOfSpots)
+        stats['num_pixels'][:,j]=counts
+        found=counts>0
+        first=(np.cumsum(counts)-counts)[found]
+        counts=counts[found]
+        stats['sum'][found,j]=np.bincount(ionLabels,weights=values[included,j],minlength=numberOfSpots)[found]
+        stats['mean'][found,j]=stats['sum'][found,j]/counts
+        stats['min'][found,j]=ionValues[first]
+        stats['max'][found,j]=ionValues[first+counts-1]
+        stats['median'][found,j]=(ionValues[first+(counts-1)//2]+ionValues[first+counts//2])/2.
+    return stats
+
 def doesThisOverlap_pixelwise(spotMaskCache,spotMask,ignoreThisSpotNumber,numberOfSpots,verbose=False):
     for pixel in spotMask:
         for i in range(numberOfSpots):
@@ -1160,6 +1462,137 @@ def doesThisOverlap_distancewise(newX,newY,xCenter,yCenter,ignoreThisSpotNumber,
             return True
     return False
 
+class VectorizedSpotOptimizer(object):
+    """
+    Scores the candidate locations of all spots with array operations instead of building a pixel mask for every
+    candidate. Used by ArrayedImage.optimizeSpots.
+
+    A spot's candidates only depend on its own center, which doesn't change until that spot is optimized, so all
+    candidate scores of a round are computed up front by scoreCandidates(). Candidates that share the same disk
+    stencil are scored together, and the pixels of a stencil are added up in the same order as sumPixels does,
+    so the scores (and therefore the tie-breaking) are identical to the original algorithm.
+    The overlap rules depend on where the other spots are at that moment, so they are applied spot by spot
+    in bestLocation().
+    """
+    def __init__(self,imStack,integrationRadius,ionWeighting,halfboxsize,avoidOverlaps=True,
+                 pixelwiseOverlapAvoidance=False,overlapDistance_squared=None):
+        self.imStack=imStack
+        self.integrationRadius=integrationRadius
+        self.ionWeighting=np.asarray(ionWeighting)
+        self.halfboxsize=halfboxsize
+        self.avoidOverlaps=avoidOverlaps
+        self.pixelwiseOverlapAvoidance=pixelwiseOverlapAvoidance
+        self.overlapDistance_squared=overlapDistance_squared
+        self.imHeight=imStack.shape[0]
+        self.imWidth=imStack.shape[1]
+        self.reach=spotStencilReach(integrationRadius)
+        self.paddedStack=np.pad(imStack,((self.reach,self.reach),(self.reach,self.reach),(0,0)),mode='constant')
+        #pixelwise overlap avoidance: the last accepted mask of every spot, and how many spots claim each pixel
+        self.spotMaskCache=None
+        self.paddedOccupancy=None
+        self.candidateX=None
+        self.candidateY=None
+        self.scores=None
+        self.insideImage=None
+
+    def scoreCandidates(self,xCenter,yCenter):
+        """
+        Scores every candidate location of every spot for the current optimization round.
+        """
+        boxOffsets=np.arange(-self.halfboxsize,self.halfboxsize+1)
+        #newX is the outer and newY the inner loop in the original algorithm; keep that order for tie-breaking
+        self.candidateX=np.repeat(boxOffsets[np.newaxis,:]+np.asarray(xCenter)[:,np.newaxis],len(boxOffsets),axis=1)
+        self.candidateY=np.tile(boxOffsets[np.newaxis,:]+np.asarray(yCenter)[:,np.newaxis],(1,len(boxOffsets)))
+        self.insideImage=((self.candidateX>=0) & (self.candidateX<self.imWidth) &
+                          (self.candidateY>=0) & (self.candidateY<self.imHeight))
+        self.scores=np.empty(self.candidateX.shape)
+        self.scores.fill(-np.inf)
+
+        spotIndex,candidateIndex=np.nonzero(self.insideImage)
+        x=self.candidateX[spotIndex,candidateIndex]
+        y=self.candidateY[spotIndex,candidateIndex]
+        #group the candidates by their stencil, so every group is scored with a handful of array operations
+        groups={}
+        for k in range(len(x)):
+            stencil=spotStencil(x[k],y[k],self.integrationRadius)
+            groups.setdefault(stencil.tobytes(),(stencil,[]))[1].append(k)
+        for stencil,members in groups.values():
+            members=np.asarray(members)
+            rows=np.floor(y[members]).astype(int)+self.reach
+            columns=np.floor(x[members]).astype(int)+self.reach
+            pixelSums=np.zeros((len(members),self.imStack.shape[2]))
+            for offset in stencil:
+                pixelSums+=self.paddedStack[rows+offset[0],columns+offset[1],:]
+            #spots at the edge of the image have fewer pixels
+            numberOfPixels=self.countInsideImage(rows-self.reach,columns-self.reach,stencil)
+            assert np.all(numberOfPixels>0)
+            weightedSums=np.zeros(len(members))
+            for ion in range(pixelSums.shape[1]):
+                weightedSums+=pixelSums[:,ion]*self.ionWeighting[ion]
+            self.scores[spotIndex[members],candidateIndex[members]]=weightedSums/numberOfPixels
+
+    def countInsideImage(self,rows,columns,stencil):
+        stencilRows=rows[:,np.newaxis]+stencil[np.newaxis,:,0]
+        stencilColumns=columns[:,np.newaxis]+stencil[np.newaxis,:,1]
+        return np.sum((stencilRows>=0) & (stencilRows<self.imHeight) &
+                      (stencilColumns>=0) & (stencilColumns<self.imWidth),1)
+
+    def numberOfCandidatesOutsideImage(self,i):
+        return int(np.sum(~self.insideImage[i]))
+
+    def overlapsDistancewise(self,i,candidates,xCenter,yCenter):
+        x=self.candidateX[i,candidates]
+        y=self.candidateY[i,candidates]
+        #only spots that are close enough to the search box can possibly overlap with one of the candidates
+        reach=self.overlapDistance_squared**0.5+self.halfboxsize*2**0.5+1
+        neighbors=np.nonzero((xCenter-xCenter[i])**2+(yCenter-yCenter[i])**2<=reach**2)[0]
+        neighbors=neighbors[neighbors!=i]
+        distances_squared=(x[:,np.newaxis]-xCenter[neighbors])**2+(y[:,np.newaxis]-yCenter[neighbors])**2
+        return np.any(distances_squared<=self.overlapDistance_squared,1)
+
+    def overlapsPixelwise(self,i,candidates):
+        if self.spotMaskCache is None:
+            self.spotMaskCache=np.empty(self.candidateX.shape[0],dtype=np.ndarray)
+            self.paddedOccupancy=np.zeros((self.imHeight+2*self.reach,self.imWidth+2*self.reach),dtype=int)
+        #a spot can't overlap with itself
+        if self.spotMaskCache[i] is not None:
+            self.paddedOccupancy[self.spotMaskCache[i][:,0]+self.reach,self.spotMaskCache[i][:,1]+self.reach]-=1
+        overlaps=np.zeros(len(candidates),dtype=bool)
+        for k,c in enumerate(candidates):
+            stencil=spotStencil(self.candidateX[i,c],self.candidateY[i,c],self.integrationRadius)
+            rows=int(np.floor(self.candidateY[i,c]))+self.reach+stencil[:,0]
+            columns=int(np.floor(self.candidateX[i,c]))+self.reach+stencil[:,1]
+            overlaps[k]=np.any(self.paddedOccupancy[rows,columns]>0)
+        return overlaps
+
+    def bestLocation(self,i,xCenter,yCenter):
+        """
+        Applies the overlap rules to the candidates of spot i and picks the best one the same way the original
+        algorithm does: the first candidate with the highest score, as long as that score is higher than -1.
+        :return: (best score, best x, best y). The score is -1 if there was no acceptable location.
+        """
+        candidates=np.nonzero(self.insideImage[i])[0]
+        if self.avoidOverlaps:
+            if self.pixelwiseOverlapAvoidance:
+                overlaps=self.overlapsPixelwise(i,candidates)
+            else:
+                overlaps=self.overlapsDistancewise(i,candidates,xCenter,yCenter)
+            candidates=candidates[~overlaps]
+        if self.avoidOverlaps and self.pixelwiseOverlapAvoidance:
+            #the original algorithm remembers the mask of the last candidate that didn't overlap
+            if len(candidates)>0:
+                self.spotMaskCache[i]=spotMask(self.candidateX[i,candidates[-1]],self.candidateY[i,candidates[-1]],
+                                               self.integrationRadius,(self.imHeight,self.imWidth))
+            if self.spotMaskCache[i] is not None:
+                self.paddedOccupancy[self.spotMaskCache[i][:,0]+self.reach,self.spotMaskCache[i][:,1]+self.reach]+=1
+
+        scores=self.scores[i,candidates]
+        acceptable=scores>-1
+        if not np.any(acceptable):
+            return -1,xCenter[i],yCenter[i]
+        best=np.argmax(np.where(acceptable,scores,-np.inf))
+        return scores[best],self.candidateX[i,candidates[best]],self.candidateY[i,candidates[best]]
+
 class SpotOptimizationException(Exception):
     def __init__(self):
         Exception.__init__(self,("The optimization algorithm was unable to optimize a spot. " +
@@ -1375,10 +1808,10 @@ def barycentric_trapezoidial_interpolation(Nx,Ny,p,hexagonalOffset=0.5):
 
     px = [[p[0,0], p[2,0]],[p[1,0], p[3,0]]] #these are the [2,2] x-coordinates
     py = [[p[0,1], p[2,1]],[p[1,1], p[3,1]]] #these are the [2,2] y-coordinates
-    fx = interpolate.interp2d([0,1], [0,1], px, kind='linear')
-    xi = fx(x_basis[:],y_basis[:]).flatten()
-    fy = interpolate.interp2d([0,1], [0,1], py, kind='linear')
-    yi = fy(x_basis[:],y_basis[:]).flatten()
+    #bilinear interpolation between the corners, one row of Nx points for every y
+    u, v = np.meshgrid(x_basis, y_basis)
+    xi = ((1-v)*((1-u)*px[0][0] + u*px[0][1]) + v*((1-u)*px[1][0] + u*px[1][1])).flatten()
+    yi = ((1-v)*((1-u)*py[0][0] + u*py[0][1]) + v*((1-u)*py[1][0] + u*py[1][1])).flatten()
     d1 = (p[2,0] - p[0,0]) / Nx / 2.0
     d2 = (p[3,0] - p[1,0]) / Nx / 2.0
     offset = (d1 + d2) * hexagonalOffset
@@ -1388,6 +1821,177 @@ def barycentric_trapezoidial_interpolation(Nx,Ny,p,hexagonalOffset=0.5):
             xi[i+j+Nx] += offset
     return xi,yi
 
+class GridTemplate(object):
+    """
+    Everything needed to process a plate without any dialogs: the four corner points of the grid as used by
+    barycentric_trapezoidial_interpolation, the number of columns and rows, the hexagonal offset, the ions
+    and how to load and reduce them, and the settings for optimizeSpots and resultsDataFrame.
+    Position one plate by hand, make a template with fromArrayedImage, save it, and use it with processPlates
+    for every plate with the same layout.
+    """
+    def __init__(self,corners,Nx,Ny,ions,massRange,
+                 hexagonalOffset=0,
+                 massRangePercent=False,
+                 massRangeReductionStrategy=None,
+                 integrationRadius=2,
+                 optimizerOptions=None,
+                 minPixelIntensity=0,
+                 expIndex=0,
+                 dataIndex=0):
+        """
+        :param corners: (4,2) array with the (x,y) coordinates of the top left, bottom left, top right and
+                        bottom right spot, in that order
+        :param optimizerOptions: dictionary with extra keyword arguments for optimizeSpots,
+                                 for example {'halfboxsize':3,'optimizationrounds':5}
+        The other parameters are the same as those of getArrayedImage, optimizeSpots and resultsDataFrame.
+        """
+        self.corners=np.asarray(corners,dtype=np.float64)
+        self.Nx=Nx
+        self.Ny=Ny
+        self.ions=list(ions)
+        self.massRange=massRange
+        self.hexagonalOffset=hexagonalOffset
+        self.massRangePercent=massRangePercent
+        self.massRangeReductionStrategy=massRangeReductionStrategy
+        self.integrationRadius=integrationRadius
+        self.optimizerOptions=dict(optimizerOptions or {})
+        self.minPixelIntensity=minPixelIntensity
+        self.expIndex=expIndex
+        self.dataIndex=dataIndex
+
+    @classmethod
+    def fromArrayedImage(cls,img,massRange,**kwargs):
+        """
+        Make a template from an ArrayedImage that has been positioned with roughPosition.
+        :param massRange: the mass range the ions of img were loaded with
+        :param kwargs: any of the other parameters of GridTemplate
+        """
+        if not img.rough_position_draw_points:
+            raise ValueError("The image needs to be positioned with roughPosition first")
+        kwargs.setdefault('hexagonalOffset',img.rough_position_draw_points[0].hexagonalOffset)
+        kwargs.setdefault('expIndex',img.expIndex)
+        kwargs.setdefault('dataIndex',img.dataIndex)
+        corners=[d.point.center for d in img.rough_position_draw_points]
+        return cls(corners,img.Ncolumns,img.Nrows,img.ions,massRange,**kwargs)
+
+    def save(self,fileName):
+        with open(fileName,'wb') as fid:
+            pickle.dump(self,fid)
+
+    @staticmethod
+    def load(fileName):
+        with open(fileName,'rb') as fid:
+            return pickle.load(fid)
+
+def processPlate(filename,template,verbose=False):
+    """
+    Run image loading, grid interpolation, spot optimization and the result table for one plate.
+    :param filename: the HDF5 file of the plate
+    :param template: a GridTemplate
+    :return: (dataframe, timings) with the resultsDataFrame of the plate and the seconds spent in the
+             'load', 'interpolate', 'optimize' and 'results' stages
+    """
+    timings=OrderedDict()
+    startTime=time.time()
+    session=OpenMSIsession()
+    session.filename=filename
+    img=session.getArrayedImage(template.ions,template.massRange,
+                                massRangePercent=template.massRangePercent,
+                                massRangeReductionStrategy=template.massRangeReductionStrategy,
+                                expIndex=template.expIndex,dataIndex=template.dataIndex,verbose=verbose)
+    timings['load']=time.time()-startTime
+
+    startTime=time.time()
+    xi,yi=barycentric_trapezoidial_interpolation(template.Nx,template.Ny,template.corners,hexagonalOffset=template.hexagonalOffset)
+    img.xCenters=xi
+    img.yCenters=yi
+    img.spotLocations=[(row+1,column+1) for row in range(template.Ny) for column in range(template.Nx)]
+    img.Ncolumns=template.Nx
+    img.Nrows=template.Ny
+    timings['interpolate']=time.time()-startTime
+
+    startTime=time.time()
+    img.optimizeSpots(integrationRadius=template.integrationRadius,verbose=verbose,**template.optimizerOptions)
+    timings['optimize']=time.time()-startTime
+
+    startTime=time.time()
+    img.spotList=[spotMask(x,y,template.integrationRadius,img.imStack.shape[:2]) for x,y in zip(img.xCenters,img.yCenters)]
+    df=img.resultsDataFrame(minPixelIntensity=template.minPixelIntensity,alphaRows=True)
+    timings['results']=time.time()-startTime
+    return df,timings
+
+def _processPlate(args):
+    filename,template,verbose,raiseExceptions=args
+    try:
+        return processPlate(filename,template,verbose)
+    except Exception as e:
+        if raiseExceptions:
+            raise
+        return None,"{}: {}".format(type(e).__name__,e)
+
+def processPlates(filenames,template,fileName=None,numProcesses=None,verbose=False,raiseExceptions=False):
+    """
+    Process many plates with the same layout without any dialogs, one plate per process.
+    :param filenames: list of HDF5 files
+    :param template: a GridTemplate, or the name of a file it was saved to
+    :param fileName: if given, the consolidated table is written to this csv file
+    :param numProcesses: the number of plates processed at the same time. Default is the number of CPUs.
+                         With 1 the plates are processed one after another in this process.
+    :param verbose: print the timings of every plate when it's done
+    :param raiseExceptions: stop at the first plate that fails. By default the error is recorded in the
+                            timings and the plate is left out of the table.
+    :return: (table, timings). table has the resultsDataFrame of all plates, with (file, spot) rows.
+             timings has one row per file with the seconds spent in every stage, the total and the error if any.
+    :raises ValueError: if the same file is given more than once, since the results are keyed by file.
+    """
+    paths=[os.path.realpath(f) for f in filenames]
+    counts=Counter(paths)
+    duplicates=sorted(set(f for f,p in zip(filenames,paths) if counts[p]>1))
+    if duplicates:
+        raise ValueError("The same plate file is given more than once: "+", ".join(duplicates))
+    if not isinstance(template,GridTemplate):
+        template=GridTemplate.load(template)
+    tasks=[(f,template,False,raiseExceptions) for f in filenames]
+    if numProcesses==1 or len(tasks)<2:
+        results=map(_processPlate,tasks)
+        pool=None
+    else:
+        from multiprocessing import Pool
+        pool=Pool(numProcesses)
+        results=pool.imap(_processPlate,tasks)
+
+    frames=OrderedDict()
+    timings=OrderedDict()
+    try:
+        for filename,(df,plateTimings) in zip(filenames,results):
+            if df is None:
+                timings[filename]={'error':plateTimings}
+            else:
+                frames[filename]=df
+                timings[filename]=dict(plateTimings,total=sum(plateTimings.values()))
+            if verbose:
+                print("{}: {}".format(filename,timings[filename]))
+                sys.stdout.flush()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    stages=['load','interpolate','optimize','results','total']
+    timings=pd.DataFrame.from_dict(timings,orient='index')
+    timings=timings.reindex(columns=stages+(['error'] if 'error' in timings else []))
+    if frames:
+        table=pd.concat(list(frames.values()),keys=list(frames.keys()),names=['file','spot'])
+    else:
+        table=pd.DataFrame()
+    if fileName:
+        table.to_csv(fileName)
+    if verbose:
+        print("processed {:d} of {:d} plates, seconds per stage:".format(len(frames),len(filenames)))
+        print(timings[stages].sum())
+        sys.stdout.flush()
+    return table,timings
+
 def alphaRowString(tuple):
     return "{}{:02d}".format(chr(ord('A')+tuple[0]-1),tuple[1])
 
@@ -1,7 +1,27 @@
 # from __future__ import print_function
 
+import os
+import json
+import threading
+import numpy as np
+import pytest
 import omaat_lib as omaat
 
+try:
+	import omaat_lib_offline as omaat_offline
+	from omsi.dataformat.omsi_file import omsi_file
+except ImportError:
+	omaat_offline = None
+
+requires_omsi = pytest.mark.skipif(omaat_offline is None, reason='omaat_lib_offline needs the omsi package of BASTet')
+
+try:
+	from http.server import HTTPServer, BaseHTTPRequestHandler
+	from urllib.parse import urlparse, parse_qs
+except ImportError:
+	from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+	from urlparse import urlparse, parse_qs
+
 def test_print():
 	print('print is working')
 
@@ -39,6 +59,302 @@ def test_get_and_reduce_ion_images_areanearpeak():
 	assert img.baseImage.size == 16371
 
 
+def _synthetic_arrayed_image(seed=0, height=30, width=40, Nx=5, Ny=4):
+	"""
+	Builds an ArrayedImage with random data and a slightly jittered grid of spots, without any web access.
+	"""
+	rng = np.random.RandomState(seed)
+	img = omaat.ArrayedImage((height, width), [800.0, 850.0, 950.0], 'synthetic.h5', 0, 0, None)
+	img.imStack = rng.rand(height, width, 3)
+	xCenters, yCenters = np.meshgrid(np.linspace(2.3, width-2.7, Nx), np.linspace(1.6, height-2.2, Ny))
+	img.xCenters = xCenters.flatten() + rng.rand(Nx*Ny) - 0.5
+	img.yCenters = yCenters.flatten() + rng.rand(Nx*Ny) - 0.5
+	img.spotLocations = [(row+1, column+1) for row in range(Ny) for column in range(Nx)]
+	img.Nrows = Ny
+	img.Ncolumns = Nx
+	return img
+
+def test_vectorized_optimizer_matches_legacy():
+	"""
+	The vectorized spot optimizer must put the spots in exactly the same place as the original algorithm.
+	"""
+	for kwargs in [{}, {'pixelwiseOverlapAvoidance': True}, {'avoidOverlaps': False, 'integrationRadius': 3.5}]:
+		legacy = _synthetic_arrayed_image()
+		legacy.optimizeSpots(legacyOptimizer=True, **kwargs)
+		vectorized = _synthetic_arrayed_image()
+		vectorized.optimizeSpots(**kwargs)
+		assert np.array_equal(legacy.xCenters, vectorized.xCenters)
+		assert np.array_equal(legacy.yCenters, vectorized.yCenters)
+
+def test_results_dataframe_statistics():
+	"""
+	Checks the spot statistics in resultsDataFrame against a direct calculation for every spot and ion.
+	"""
+	img = _synthetic_arrayed_image()
+	spotList = [omaat.spotMask(x, y, 2.5, img.imStack.shape[:2]) for x, y in zip(img.xCenters, img.yCenters)]
+	df = img.resultsDataFrame(spotList=spotList, minPixelIntensity=0.5)
+	for s, spot in enumerate(spotList):
+		for i, ion in enumerate(img.ions):
+			values = img.imStack[spot[:, 0], spot[:, 1], i]
+			values = values[values > 0.5]
+			assert df.iloc[s][(ion, 'num_pixels')] == len(values)
+			assert np.isclose(df.iloc[s][(ion, 'sum')], np.sum(values))
+			assert np.isclose(df.iloc[s][(ion, 'median')], np.median(values))
+			assert np.isclose(df.iloc[s][(ion, 'min')], np.min(values))
+
+class _OpenMSIStandIn(BaseHTTPRequestHandler):
+	"""
+	Answers qmz and qspectrum requests like OpenMSI would. The spectrum of a spot is filled with the mean row
+	index of its pixels. The first spectrum request fails with a 503 to exercise the retries.
+	"""
+	mz = [100.0, 200.0, 300.0]
+	failures = [1]
+
+	def do_GET(self):
+		url = urlparse(self.path)
+		query = parse_qs(url.query)
+		if url.path == '/qmz':
+			body = {'values_spectra': self.mz}
+		elif self.failures[0] > 0:
+			self.failures[0] -= 1
+			self.send_response(503)
+			self.end_headers()
+			return
+		else:
+			rows = json.loads(query['row'][0])
+			body = {'spectrum': [float(np.mean(rows))] * len(self.mz)}
+		self.send_response(200)
+		self.end_headers()
+		self.wfile.write(json.dumps(body).encode('utf-8'))
+
+	def log_message(self, *args):
+		pass
+
+def test_get_spot_spectra_concurrently():
+	"""
+	Fetches the spot spectra concurrently from a local stand-in for the OpenMSI web service.
+	"""
+	server = HTTPServer(('127.0.0.1', 0), _OpenMSIStandIn)
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+	try:
+		openMSIsession = omaat.OpenMSIsession()
+		openMSIsession.baseURL = 'http://127.0.0.1:%d' % server.server_address[1]
+		img = _synthetic_arrayed_image()
+		img.spotList = [omaat.spotMask(x, y, 2, img.imStack.shape[:2]) for x, y in zip(img.xCenters, img.yCenters)]
+		# an adapter configured by the user must not be replaced
+		adapter = omaat.requests.adapters.HTTPAdapter(max_retries=2)
+		openMSIsession.requests_session.mount('http://', adapter)
+		df = openMSIsession.getSpotSpectra(img, maxWorkers=4)
+		assert openMSIsession.requests_session.get_adapter(openMSIsession.baseURL) is adapter
+		assert list(df.index) == _OpenMSIStandIn.mz
+		assert list(df.columns) == [omaat.alphaRowString(sl) for sl in img.spotLocations]
+		for i, spot in enumerate(img.spotList):
+			assert np.allclose(df.iloc[:, i], np.mean(spot[:, 0]))
+	finally:
+		server.shutdown()
+		server.server_close()
+
+
+def _synthetic_omsi_file(filename, seed=0, shape=(13, 11, 40), chunks=(4, 3, 8)):
+	"""
+	Writes a random (x, y, m/z) cube and its m/z axis to an OMSI HDF5 file, without any web access.
+	:return: (data, mz)
+	"""
+	rng = np.random.RandomState(seed)
+	data = (rng.rand(*shape) * 100).astype('float32')
+	mz = np.linspace(600, 1100, shape[2]).astype('float32')
+	f = omsi_file(filename, 'w')
+	exp = f.create_experiment()
+	exp.create_instrument_info(instrument_name='synthetic', mzdata=mz)
+	dataset, mzdataset, _ = exp.create_msidata_full_cube(data_shape=shape, data_type='float32', chunks=chunks)
+	dataset[:] = data
+	mzdataset[:] = mz
+	f.flush()
+	f.close_file()
+	return data, mz
+
+def _reduce_windows(data, mz, min_mz, max_mz, strategy):
+	"""
+	Reduces every m/z window on its own from the full cube.
+	"""
+	images = np.zeros(data.shape[:2] + (len(min_mz),))
+	for w, (low, high) in enumerate(zip(min_mz, max_mz)):
+		lo, hi = np.argmin(np.abs(mz - low)), np.argmin(np.abs(mz - high))
+		if hi > lo:
+			images[:, :, w] = strategy.reduceImage(data[:, :, lo:hi])
+	return images
+
+@requires_omsi
+def test_get_images_merges_windows(tmp_path):
+	"""
+	Loads overlapping, adjacent, separate and empty m/z windows in one go and compares every image
+	with a reduction of its window on its own.
+	"""
+	filename = str(tmp_path / 'plate.h5')
+	data, mz = _synthetic_omsi_file(filename)
+	min_mz = [700.0, 720.0, 760.0, 900.0, 1000.0]
+	max_mz = [740.0, 760.0, 800.0, 950.0, 1000.0]
+	idx_lo = omaat_offline.get_mz_indices(mz, min_mz)
+	idx_hi = omaat_offline.get_mz_indices(mz, max_mz)
+	assert list(idx_lo) == [int(np.argmin(np.abs(mz - v))) for v in min_mz]
+	reads = omaat_offline.merge_mz_windows(idx_lo, idx_hi)
+	assert [(lo, hi) for lo, hi, _ in reads] == [(8, 16), (23, 27)]
+	assert [list(windows) for _, _, windows in reads] == [[0, 1, 2], [3]]
+	for strategy in [omaat_offline.PeakArea(), omaat_offline.PeakHeight(), omaat_offline.AreaNearPeak()]:
+		images, stats = omaat_offline.get_images(filename, min_mz, max_mz, reduction_strategy=strategy, return_stats=True)
+		assert stats['reads'] == 2
+		assert np.allclose(images, _reduce_windows(data, mz, min_mz, max_mz, strategy))
+	omaat_offline.msiFileCache.clear()
+
+@requires_omsi
+def test_get_images_tiles_within_memory_budget(tmp_path):
+	"""
+	Reads the ion images in chunk-aligned tiles that fit the memory budget, down to a single chunk.
+	"""
+	filename = str(tmp_path / 'plate.h5')
+	data, mz = _synthetic_omsi_file(filename, shape=(13, 11, 40), chunks=(4, 3, 8))
+	assert omaat_offline.get_tile_shape((13, 11, 40), (4, 3, 8), 10, 4, 2**30) == (13, 11)
+	assert omaat_offline.get_tile_shape((13, 11, 40), (4, 3, 8), 10, 4, 4*6*10*4) == (4, 6)
+	assert omaat_offline.get_tile_shape((13, 11, 40), (4, 3, 8), 10, 4, 1) == (4, 3)
+	min_mz = [700.0, 900.0]
+	max_mz = [790.0, 950.0]
+	expected = _reduce_windows(data, mz, min_mz, max_mz, omaat_offline.PeakArea())
+	for memory_budget in [2**30, 4*6*8*4, 1]:
+		images, stats = omaat_offline.get_images(filename, min_mz, max_mz, memory_budget=memory_budget, return_stats=True)
+		tile_x, tile_y = stats['tile_shape']
+		assert tile_x % 4 == 0 or tile_x == 13
+		assert tile_y % 3 == 0 or tile_y == 11
+		# the widest read has 7 m/z values
+		assert tile_x * tile_y * 7 * 4 <= max(memory_budget, 4 * 3 * 7 * 4)
+		# every value is read exactly once, however small the tiles are
+		assert stats['bytes_read'] == 13 * 11 * (15 - 8 + 27 - 23) * 4
+		assert np.allclose(images, expected)
+	omaat_offline.msiFileCache.clear()
+
+@requires_omsi
+def test_get_spot_spectra_matches_per_spot_means(tmp_path):
+	"""
+	Compares the spot spectra read by chunk groups with the mean spectrum of the pixels of every spot.
+	"""
+	filename = str(tmp_path / 'plate.h5')
+	data, mz = _synthetic_omsi_file(filename, shape=(13, 11, 40), chunks=(4, 3, 8))
+	# overlapping spots across chunk borders, a spot at the edge of the image and a spot without pixels
+	spots = [omaat_offline.spotMask(x, y, 2, data.shape[:2]) for x, y in [(2.3, 2.1), (4.7, 6.5), (5.2, 7.1), (9.6, 11.8)]]
+	spots.append(np.zeros((0, 2), dtype=int))
+	groups = omaat_offline.group_spot_pixels_by_chunk(spots, (4, 3))
+	assert sum(len(group[4]) for group in groups) == sum(len(spot) for spot in spots)
+	for x0, x1, y0, y1, x, y, spot in groups:
+		assert len(set(x // 4)) == 1 and len(set(y // 3)) == 1
+	for memory_budget, num_processes in [(2**30, 1), (3*3*8*4, 1), (2**30, 2)]:
+		spectra = omaat_offline.get_spot_spectra(filename, spots, memory_budget=memory_budget, num_processes=num_processes)
+		assert spectra.shape == (40, len(spots))
+		for s, spot in enumerate(spots[:-1]):
+			assert np.allclose(spectra[:, s], data[spot[:, 0], spot[:, 1], :].mean(axis=0))
+		assert np.all(np.isnan(spectra[:, -1]))
+	omaat_offline.msiFileCache.clear()
+
+@requires_omsi
+def test_msi_file_cache(tmp_path):
+	"""
+	Checks the least recently used eviction of the handle cache, that rewritten files are opened again
+	and that a forked process does not use the handles of its parent.
+	"""
+	filenames = [str(tmp_path / ('plate%d.h5' % i)) for i in range(3)]
+	for i, filename in enumerate(filenames):
+		_synthetic_omsi_file(filename, seed=i, shape=(5 + i, 4, 10), chunks=(1, 1, 10))
+	cache = omaat_offline.MSIFileCache(maxOpenFiles=2)
+	first = cache.get(filenames[0])
+	assert cache.get(filenames[0]) is first
+	second = cache.get(filenames[1])
+	cache.get(filenames[0])
+	third = cache.get(filenames[2])
+	assert [key[0] for key in cache.handles] == [os.path.abspath(filenames[0]), os.path.abspath(filenames[2])]
+	assert not second.file.hdf_file and first.file.hdf_file
+	assert third.shape == (7, 4, 10)
+
+	# rewrite a cached file, as the acquisition software would
+	rewritten = str(tmp_path / 'rewritten.h5')
+	data, mz = _synthetic_omsi_file(rewritten, seed=3, shape=(9, 4, 10), chunks=(1, 1, 10))
+	os.replace(rewritten, filenames[0])
+	os.utime(filenames[0], (first.mtime + 10, first.mtime + 10))
+	reopened = cache.get(filenames[0])
+	assert reopened is not first and not first.file.hdf_file
+	assert reopened.shape == (9, 4, 10)
+	assert np.array_equal(reopened.msidata[:], data)
+
+	# the module functions go through the shared cache
+	assert omaat_offline.get_image_size(filenames[2]) == (7, 4, 10)
+	_synthetic_omsi_file(rewritten, seed=4, shape=(3, 4, 10), chunks=(1, 1, 10))
+	os.replace(rewritten, filenames[2])
+	os.utime(filenames[2], (third.mtime + 10, third.mtime + 10))
+	assert omaat_offline.get_image_size(filenames[2]) == (3, 4, 10)
+	omaat_offline.msiFileCache.clear()
+
+	# a forked process opens the files again
+	cache.pid = -1
+	forked = cache.get(filenames[2])
+	assert forked is not third and len(cache.handles) == 1
+	cache.clear()
+	assert not cache.handles and not forked.file.hdf_file
+	for handle in [reopened, third]:
+		handle.close()
+
+def _synthetic_plate(filename, seed):
+	"""
+	Writes a plate with a 5x4 grid of spots at two ions on top of random noise to an OMSI HDF5 file.
+	:return: the m/z values of the two ions
+	"""
+	rng = np.random.RandomState(seed)
+	mz = np.linspace(600, 1100, 60).astype('float32')
+	rows, columns = np.mgrid[0:40, 0:50]
+	data = rng.rand(40, 50, 60).astype('float32')
+	for r in range(4):
+		for c in range(5):
+			spot = np.exp(-((rows - 6 - r*9 - rng.rand())**2 + (columns - 5 - c*10 - rng.rand())**2) / 4.)
+			data[:, :, 20] += 100 * spot
+			data[:, :, 40] += 50 * spot
+	f = omsi_file(filename, 'w')
+	exp = f.create_experiment()
+	exp.create_instrument_info(instrument_name='synthetic', mzdata=mz)
+	dataset, mzdataset, _ = exp.create_msidata_full_cube(data_shape=data.shape, data_type='float32', chunks=(8, 8, 16))
+	dataset[:] = data
+	mzdataset[:] = mz
+	f.flush()
+	f.close_file()
+	return [float(mz[20]), float(mz[40])]
+
+@requires_omsi
+def test_process_plates(tmp_path):
+	"""
+	Processes plates with a saved grid template. A plate that fails is recorded in the timings and left out of
+	the table, and the same plate given twice is rejected.
+	"""
+	filenames = [str(tmp_path / ('plate%d.h5' % i)) for i in range(2)]
+	for i, filename in enumerate(filenames):
+		ions = _synthetic_plate(filename, i)
+	template = omaat_offline.GridTemplate([[5, 6], [5, 33], [45, 6], [45, 33]], 5, 4, ions, 5, integrationRadius=2)
+	templateFile = str(tmp_path / 'template.pkl')
+	template.save(templateFile)
+	missing = str(tmp_path / 'missing.h5')
+
+	table, timings = omaat_offline.processPlates(filenames + [missing], templateFile, numProcesses=1)
+	assert list(timings.index) == filenames + [missing]
+	assert timings['error'].isnull().tolist() == [True, True, False]
+	assert list(table.index.levels[0]) == filenames
+	assert len(table) == 2 * 20
+	for filename in filenames:
+		df, _ = omaat_offline.processPlate(filename, template)
+		assert table.loc[filename].equals(df)
+	pooled, _ = omaat_offline.processPlates(filenames + [missing], template, numProcesses=2)
+	assert pooled.equals(table)
+
+	with pytest.raises(Exception):
+		omaat_offline.processPlates([missing], template, numProcesses=1, raiseExceptions=True)
+	with pytest.raises(ValueError):
+		omaat_offline.processPlates([filenames[0], str(tmp_path / '.' / 'plate0.h5')], template)
+	omaat_offline.msiFileCache.clear()
 
 # def test_fileselector():
 #     if "openMSIsession" not in locals():